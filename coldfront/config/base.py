@@ -108,6 +108,7 @@ MIDDLEWARE = [
 MIDDLEWARE += [
     'author.middlewares.AuthorDefaultBackendMiddleware',
     'coldfront.config.log_filters.RequestMiddleware',
+    'coldfront.core.utils.middleware.PermissionCacheMiddleware',
 ]
 
 
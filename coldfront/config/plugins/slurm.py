@@ -1,4 +1,4 @@
-from coldfront.config.base import INSTALLED_APPS
+from coldfront.config.base import INSTALLED_APPS, MIDDLEWARE
 from coldfront.config.env import ENV
 from coldfront.config.logging import LOGGING
 
@@ -10,6 +10,14 @@ SLURM_SACCTMGR_PATH = ENV.str('SLURM_SACCTMGR_PATH', default='/usr/bin/sacctmgr'
 SLURM_NOOP = ENV.bool('SLURM_NOOP', False)
 SLURM_IGNORE_USERS = ENV.list('SLURM_IGNORE_USERS', default=['root'])
 SLURM_IGNORE_ACCOUNTS = ENV.list('SLURM_IGNORE_ACCOUNTS', default=[])
+SLURM_BATCH_MAX_OPS = ENV.int('SLURM_BATCH_MAX_OPS', default=200)
+# queue each request's sacctmgr changes and run them together after the view returns
+SLURM_BATCH_REQUESTS = ENV.bool('SLURM_BATCH_REQUESTS', default=False)
+
+if SLURM_BATCH_REQUESTS:
+    MIDDLEWARE += [
+        'coldfront.plugins.slurm.middleware.SacctmgrBatchMiddleware',
+    ]
 
 
 LOGGING['handlers']['slurm'] = {
@@ -20,6 +20,8 @@ SLURMREST_NOOP = ENV.bool('SLURMREST_NOOP', default=False)
 SLURMREST_IGNORE_USERS = ENV.list('SLURMREST_IGNORE_USERS', default=['root'])
 SLURMREST_IGNORE_ACCOUNTS = ENV.list('SLURMREST_IGNORE_ACCOUNTS', default=[])
 SLURMREST_IGNORE_CLUSTERS = ENV.list('SLURMREST_IGNORE_CLUSTERS', default=[])
+SLURMREST_CONNECTION_POOL_SIZE = ENV.int('SLURMREST_CONNECTION_POOL_SIZE', default=4)
+SLURMREST_SHARE_CACHE_TTL = ENV.int('SLURMREST_SHARE_CACHE_TTL', default=60)
 
 SLURMREST_CLUSTERS = {}
 for cluster in ENV.str('SLURMREST_CLUSTERS', '').split(','):
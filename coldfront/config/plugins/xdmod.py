@@ -13,6 +13,9 @@ XDMOD_USER = ENV.str('XDMOD_USER', default='')
 XDMOD_PASS = ENV.str('XDMOD_PASS', default='')
 XDMOD_VERIFY = ENV.bool('XDMOD_VERIFY', default=True)
 XDMOD_API_URL = ENV.str('XDMOD_API_URL')
+XDMOD_MAX_WORKERS = ENV.int('XDMOD_MAX_WORKERS', default=8)
+XDMOD_CACHE_DIR = ENV.str('XDMOD_CACHE_DIR', default='')
+XDMOD_CACHE_TTL = ENV.int('XDMOD_CACHE_TTL', default=60 * 60 * 6)
 
 
 LOGGING['handlers']['xdmod'] = {
@@ -0,0 +1,225 @@
+"""Time the allocation list queries on a large synthetic database.
+
+Seeds the requested number of allocations, spread over projects with project
+users and allocation users, inside a transaction that is rolled back at the
+end. It then times these queries:
+- the multi-join, distinct() visibility filter the allocation list used before;
+- the Exists() filter it uses now;
+- a deep page of the full allocation list read with OFFSET;
+- the same page read with a keyset.
+"""
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+from coldfront.core.allocation.models import (
+    Allocation,
+    AllocationStatusChoice,
+    AllocationUser,
+    AllocationUserStatusChoice,
+)
+from coldfront.core.allocation.views import allocation_filter
+from coldfront.core.field_of_science.models import FieldOfScience
+from coldfront.core.project.models import (
+    Project,
+    ProjectStatusChoice,
+    ProjectUser,
+    ProjectUserRoleChoice,
+    ProjectUserStatusChoice,
+)
+from coldfront.core.resource.models import Resource, ResourceType
+from coldfront.core.utils.views import keyset_paginate
+
+
+class Rollback(Exception):
+    """Raised to discard the synthetic data."""
+
+
+def legacy_allocation_filter(allocations, user):
+    """The visibility filter allocation_filter applied before it used Exists()"""
+    return allocations.filter(
+        Q(status__name__in=['Active', 'New', 'Renewal Requested', ]) &
+        Q(project__status__name__in=['New', 'Active', ]) &
+        (
+            (
+                (
+                    Q(resources__resource_type__name__contains='Storage') &
+                    (
+                        (Q(project__projectuser__user=user) &
+                        Q(project__projectuser__status__name='Active')) |
+                        (Q(allocationuser__user=user) &
+                        Q(allocationuser__status__name='Active'))
+                    )
+                ) | (
+                    Q(resources__resource_type__name__contains='Cluster') &
+                    Q(allocationuser__user=user) &
+                    Q(allocationuser__status__name='Active')
+                )
+            ) |
+            Q(project__pi=user) |
+            Q(resources__allowed_users=user) | (
+                Q(project__projectuser__user=user) &
+                Q(project__projectuser__status__name='Active') &
+                Q(project__projectuser__role__name__contains='Manager')
+            )
+        )
+    ).distinct()
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the allocation list queries on ~100k synthetic allocations'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--allocations', type=int, default=100000,
+            help='number of synthetic allocations')
+        parser.add_argument('--allocations-per-project', type=int, default=10,
+            help='number of allocations of each synthetic project')
+        parser.add_argument('--users-per-allocation', type=int, default=2,
+            help='number of allocation users of each allocation')
+        parser.add_argument('--page-size', type=int, default=500,
+            help='number of allocations per page of the full list')
+        parser.add_argument('--rounds', type=int, default=3,
+            help='number of times each query is run; the best time is reported')
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.seed(options)
+                self.run(options)
+                raise Rollback
+        except Rollback:
+            self.stdout.write('synthetic data rolled back')
+
+    def timed(self, label, func, rounds):
+        best, result = None, None
+        for _ in range(rounds):
+            start = time.perf_counter()
+            result = func()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        self.stdout.write(f'{label:>28}: {best * 1000:9.1f}ms')
+        return best, result
+
+    def seed(self, options):
+        start = time.perf_counter()
+        n_allocations = options['allocations']
+        per_project = options['allocations_per_project']
+        n_projects = max(n_allocations // per_project, 1)
+        users_per_allocation = options['users_per_allocation']
+
+        FieldOfScience.objects.get_or_create(
+            pk=FieldOfScience.DEFAULT_PK, defaults={'description': 'Other'}
+        )
+        project_status = ProjectStatusChoice.objects.get_or_create(name='Active')[0]
+        projectuser_status = ProjectUserStatusChoice.objects.get_or_create(name='Active')[0]
+        roles = [
+            ProjectUserRoleChoice.objects.get_or_create(name=name)[0]
+            for name in ('User', 'General Manager')
+        ]
+        allocation_status = AllocationStatusChoice.objects.get_or_create(name='Active')[0]
+        allocationuser_status = AllocationUserStatusChoice.objects.get_or_create(name='Active')[0]
+        for type_name, count in (('Storage', 8), ('Cluster', 2)):
+            resource_type = ResourceType.objects.get_or_create(name=type_name)[0]
+            Resource.objects.bulk_create([
+                Resource(
+                    name=f'bench-{type_name.lower()}-{i}', resource_type=resource_type,
+                    description='benchmark resource',
+                )
+                for i in range(count)
+            ])
+        # reloaded, since not every backend returns the pks of bulk_create
+        resources = list(Resource.objects.filter(name__startswith='bench-').order_by('pk'))
+
+        get_user_model().objects.bulk_create([
+            get_user_model()(username=f'bench-user-{i}') for i in range(n_projects)
+        ], batch_size=5000)
+        users = list(
+            get_user_model().objects.filter(username__startswith='bench-user-').order_by('pk')
+        )
+        Project.objects.bulk_create([
+            Project(
+                title=f'bench-project-{i}', pi=users[i], status=project_status,
+                description='benchmark project',
+            )
+            for i in range(n_projects)
+        ], batch_size=5000)
+        projects = list(Project.objects.filter(title__startswith='bench-project-').order_by('pk'))
+        ProjectUser.objects.bulk_create([
+            ProjectUser(
+                project=project, user=users[(i + offset) % n_projects],
+                role=roles[offset % 2], status=projectuser_status,
+            )
+            for i, project in enumerate(projects) for offset in range(1, 4)
+        ], batch_size=5000)
+        Allocation.objects.bulk_create([
+            Allocation(
+                project=projects[i % n_projects], status=allocation_status,
+                justification='benchmark allocation',
+            )
+            for i in range(n_allocations)
+        ], batch_size=5000)
+        allocations = list(Allocation.objects.filter(
+            project__title__startswith='bench-project-'
+        ).only('pk').order_by('pk'))
+        Allocation.resources.through.objects.bulk_create([
+            Allocation.resources.through(
+                allocation_id=allocation.pk, resource_id=resources[i % len(resources)].pk
+            )
+            for i, allocation in enumerate(allocations)
+        ], batch_size=5000)
+        AllocationUser.objects.bulk_create([
+            AllocationUser(
+                allocation=allocation, user=users[(i + offset) % n_projects],
+                status=allocationuser_status,
+            )
+            for i, allocation in enumerate(allocations)
+            for offset in range(users_per_allocation)
+        ], batch_size=5000)
+        self.sample_user = users[n_projects // 2]
+        self.stdout.write(
+            f'seeded {n_allocations} allocations in {n_projects} projects '
+            f'in {time.perf_counter() - start:.1f}s'
+        )
+
+    def run(self, options):
+        rounds = options['rounds']
+        allocations = Allocation.objects.exclude(status__name='Merged').order_by('id')
+        user = self.sample_user
+
+        legacy = self.timed(
+            'visibility, joins+distinct',
+            lambda: list(legacy_allocation_filter(allocations, user).values_list('pk', flat=True)),
+            rounds,
+        )
+        current = self.timed(
+            'visibility, Exists()',
+            lambda: list(allocation_filter(allocations, user).values_list('pk', flat=True)),
+            rounds,
+        )
+        if sorted(legacy[1]) != sorted(current[1]):
+            self.stdout.write(self.style.ERROR('the two visibility filters disagree'))
+
+        page_size = options['page_size']
+        offset = max(allocations.count() - page_size, 0)
+        # the pk of the row just before the last page
+        after = allocations.values_list('pk', flat=True)[offset - 1] if offset else None
+        offset_page = self.timed(
+            'last page, OFFSET',
+            lambda: [a.pk for a in allocations[offset:offset + page_size]],
+            rounds,
+        )
+        keyset_page = self.timed(
+            'last page, keyset',
+            lambda: [a.pk for a in keyset_paginate(allocations, after, page_size)],
+            rounds,
+        )
+        if offset_page[1] != keyset_page[1]:
+            self.stdout.write(self.style.ERROR('the OFFSET and keyset pages differ'))
+
+        self.stdout.write(self.style.SUCCESS(
+            f'visibility speedup: {legacy[0] / max(current[0], 1e-9):.2f}x, '
+            f'last page speedup: {offset_page[0] / max(keyset_page[0], 1e-9):.2f}x'
+        ))
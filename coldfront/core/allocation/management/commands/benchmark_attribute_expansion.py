@@ -0,0 +1,94 @@
+"""Compare the interpreted and compiled attribute expansion paths.
+
+Builds a synthetic cluster in memory (no database access) in which every
+allocation carries an 'Attribute Expanded Text' slurm_specs value that is
+expanded with the cluster resource's slurm_specs_attriblist, then times
+expanding all of them with make_attribute_parameter_dictionary (which
+re-parses the attriblist for every attribute) and with expand_attribute
+(which compiles the attriblist once and reuses it).
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from coldfront.core import attribute_expansion
+
+ATTRIBLIST = '\n'.join([
+    '#Set cpumin from Core Usage attribute',
+    'cpumin := :Core Usage (Hours)',
+    '#Default to 1 SU',
+    'cpumin |= 1',
+    '#Convert to cpumin',
+    'cpumin *= 60',
+    'account := ALLOCATION:slurm_account_name',
+    "qos := 'normal'",
+    'qos += RESOURCE:qos_suffix',
+])
+RAW_VALUE = 'GrpTRESMins=cpu={cpumin}:QOS={qos}:Account={account}'
+
+
+class SyntheticObject:
+    """Stand-in for an Allocation or Resource with an in-memory attribute map."""
+
+    def __init__(self, attributes):
+        self.attributes = attributes
+
+    def get_attribute(self, name):
+        return self.attributes.get(name)
+
+
+class Command(BaseCommand):
+    help = 'Benchmark interpreted vs compiled attribute expansion on a synthetic cluster'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--allocations', type=int, default=5000,
+            help='number of synthetic allocations in the cluster')
+        parser.add_argument('--rounds', type=int, default=3,
+            help='number of times to expand every allocation')
+
+    def handle(self, *args, **options):
+        resource = SyntheticObject({'qos_suffix': '_high'})
+        allocations = [
+            SyntheticObject({
+                'Core Usage (Hours)': i * 10,
+                'slurm_account_name': f'lab_{i}',
+            })
+            for i in range(options['allocations'])
+        ]
+
+        def interpreted(allocation):
+            apdict = attribute_expansion.make_attribute_parameter_dictionary(
+                attribute_name='slurm_specs',
+                attribute_parameter_string=ATTRIBLIST,
+                resources=[resource],
+                allocations=[allocation])
+            return RAW_VALUE.format(**apdict)
+
+        def compiled(allocation):
+            return attribute_expansion.expand_attribute(
+                raw_value=RAW_VALUE,
+                attribute_name='slurm_specs',
+                attriblist_string=ATTRIBLIST,
+                resources=[resource],
+                allocations=[allocation])
+
+        attribute_expansion.compile_attriblist.cache_clear()
+        results = {}
+        for label, func in (('interpreted', interpreted), ('compiled', compiled)):
+            start = time.perf_counter()
+            for _ in range(options['rounds']):
+                expanded = [func(allocation) for allocation in allocations]
+            elapsed = time.perf_counter() - start
+            results[label] = (elapsed, expanded)
+            self.stdout.write(
+                f'{label:>12}: {elapsed:.3f}s for {options["rounds"]} x '
+                f'{len(allocations)} expansions'
+            )
+
+        if results['interpreted'][1] != results['compiled'][1]:
+            self.stdout.write(self.style.ERROR('compiled and interpreted results differ'))
+        speedup = results['interpreted'][0] / max(results['compiled'][0], 1e-9)
+        self.stdout.write(self.style.SUCCESS(
+            f'speedup: {speedup:.2f}x '
+            f'({attribute_expansion.compile_attriblist.cache_info()})'
+        ))
@@ -0,0 +1,39 @@
+"""Report allocation summaries that are missing or no longer match their
+allocation's resources, attributes and rates, for instance after attribute
+writes that sent no signals.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from coldfront.core.allocation.models import (
+    check_allocation_summaries,
+    refresh_allocation_summaries,
+)
+
+
+class Command(BaseCommand):
+    help = 'Check the denormalized allocation summaries against their allocations'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true',
+            help='refresh the summaries found stale')
+        parser.add_argument('--batch-size', type=int, default=500,
+            help='number of allocations checked per batch')
+
+    def handle(self, *args, **options):
+        problems = check_allocation_summaries(batch_size=options['batch_size'])
+        for allocation_pk, differences in sorted(problems.items()):
+            if differences is None:
+                self.stdout.write(f'allocation {allocation_pk}: no summary')
+                continue
+            details = ', '.join(
+                f'{field}: {stored!r} != {expected!r}' for field, stored, expected in differences
+            )
+            self.stdout.write(f'allocation {allocation_pk}: {details}')
+        if not problems:
+            self.stdout.write('all allocation summaries are up to date')
+            return
+        if options['fix']:
+            refresh_allocation_summaries(problems, batch_size=options['batch_size'])
+            self.stdout.write(f'refreshed {len(problems)} allocation summaries')
+            return
+        raise CommandError(f'{len(problems)} allocation summaries are stale')
@@ -0,0 +1,26 @@
+"""Recompute the AllocationSummary of every allocation from its resources,
+attributes and rates.
+"""
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from coldfront.core.allocation.models import AllocationSummary, refresh_allocation_summaries
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the denormalized allocation summaries from scratch'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+            help='number of allocations summarized per batch')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        with transaction.atomic():
+            AllocationSummary.objects.all().delete()
+            written = refresh_allocation_summaries(batch_size=options['batch_size'])
+        self.stdout.write(
+            f'rebuilt {written} allocation summaries in {time.perf_counter() - start:.2f}s'
+        )
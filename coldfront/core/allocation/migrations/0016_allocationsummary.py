@@ -0,0 +1,36 @@
+# Generated by Django 4.2.11 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import model_utils.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('resource', '0004_alter_resource_linked_resources'),
+        ('allocation', '0015_allocationstatuschoice_description'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AllocationSummary',
+            fields=[
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, editable=False, verbose_name='created')),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, editable=False, verbose_name='modified')),
+                ('allocation', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='summary', serialize=False, to='allocation.allocation')),
+                ('size', models.FloatField(blank=True, null=True)),
+                ('usage', models.FloatField(blank=True, null=True)),
+                ('quota_bytes', models.FloatField(blank=True, null=True)),
+                ('usage_bytes', models.FloatField(blank=True, null=True)),
+                ('percent_full', models.FloatField(blank=True, null=True)),
+                ('path', models.CharField(blank=True, default='', max_length=512)),
+                ('cost', models.FloatField(blank=True, null=True)),
+                ('parent_resource', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='resource.resource')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['size'], name='allocation__size_34eb3d_idx'), models.Index(fields=['usage'], name='allocation__usage_0e0032_idx'), models.Index(fields=['percent_full'], name='allocation__percent_3535f9_idx')],
+            },
+        ),
+    ]
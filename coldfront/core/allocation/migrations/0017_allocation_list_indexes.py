@@ -0,0 +1,21 @@
+# Generated by Django 4.2.11 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('allocation', '0016_allocationsummary'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='allocationattribute',
+            index=models.Index(fields=['allocation', 'allocation_attribute_type'], name='allocation__allocat_e5f9be_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='allocationuser',
+            index=models.Index(fields=['user', 'status'], name='allocation__user_id_1ac97f_idx'),
+        ),
+    ]
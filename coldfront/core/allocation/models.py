@@ -1,28 +1,33 @@
 """allocation models"""
 import datetime
 import logging
+import math
+import threading
 from ast import literal_eval
 from enum import Enum
 
 from django.conf import settings
 from django.core.exceptions import ValidationError, ObjectDoesNotExist
-from django.db import models
-from django.db.models import Q
+from django.db import models, transaction
+from django.db.models import Prefetch
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.html import mark_safe
 from django.utils.module_loading import import_string
 from model_utils.models import TimeStampedModel
 from simple_history.models import HistoricalRecords
 
-from ifxuser.models import Organization, OrgRelation
 from coldfront.config.env import ENV
 from coldfront.core import attribute_expansion
-from coldfront.core.resource.models import Resource
+from coldfront.core.resource.models import Resource, ResourceAttribute
 from coldfront.core.utils.common import import_from_settings
-from coldfront.core.project.models import Project, ProjectPermission
+from coldfront.core.utils.permissions import clear_permission_cache, current_permission_cache
+from coldfront.core.project.models import Project, ProjectPermission, project_permissions
 
 
 if ENV.bool('PLUGIN_IFX', default=False):
-    from coldfront.core.utils.fasrc import get_resource_rate
+    from coldfront.core.utils.fasrc import get_resource_rate, resource_rates
 
 
 logger = logging.getLogger(__name__)
@@ -34,6 +39,10 @@ ALLOCATION_FUNCS_ON_EXPIRE = import_from_settings('ALLOCATION_FUNCS_ON_EXPIRE',
 ALLOCATION_RESOURCE_ORDERING = import_from_settings(
     'ALLOCATION_RESOURCE_ORDERING', ['-is_allocatable', 'resource_type', 'name']
 )
+# relations loaded alongside each AllocationAttribute in an attribute snapshot
+ATTRIBUTE_SNAPSHOT_RELATED = (
+    'allocation_attribute_type__attribute_type', 'allocationattributeusage',
+)
 
 class AllocationPermission(Enum):
     """ A project permission stores the user and manager fields of a project. """
@@ -66,6 +75,48 @@ class AllocationStatusChoice(TimeStampedModel):
         return (self.name,)
 
 
+class AllocationQuerySet(models.QuerySet):
+    """QuerySet for Allocation with helpers to bulk-load related data."""
+
+    def with_attribute_snapshot(self):
+        """Prefetch the AllocationAttributes of every allocation in the
+        queryset, with their types and usages, so that get_attribute and the
+        properties derived from it are served from memory.
+        """
+        return self.prefetch_related(Prefetch(
+            'allocationattribute_set',
+            queryset=AllocationAttribute.objects.select_related(
+                *ATTRIBUTE_SNAPSHOT_RELATED
+            ).order_by('pk'),
+        ))
+
+    def with_parent_resource(self, attributes=False):
+        """Prefetch the resources of every allocation in the queryset, ordered
+        by ALLOCATION_RESOURCE_ORDERING and with their resource types and
+        parent tiers, so that get_parent_resource resolves without queries.
+        With attributes=True the resources' attribute snapshots are prefetched
+        too, so that quantity_label and the unit-dependent properties such as
+        size and usage don't query per allocation.
+        """
+        resources = Resource.objects.select_related(
+            'resource_type', 'parent_resource'
+        ).order_by(*ALLOCATION_RESOURCE_ORDERING)
+        if attributes:
+            resources = resources.with_attribute_snapshot()
+        return self.prefetch_related(Prefetch(
+            'resources', queryset=resources, to_attr='ordered_resources',
+        ))
+
+    def with_resource_attributes(self):
+        """Prefetch the resources of every allocation in the queryset together
+        with their attribute snapshots, so that expanding 'Attribute Expanded
+        Text' attributes does not query per allocation or per resource.
+        """
+        return self.prefetch_related(Prefetch(
+            'resources', queryset=Resource.objects.with_attribute_snapshot(),
+        ))
+
+
 class Allocation(TimeStampedModel):
     """ An allocation provides users access to a resource.
 
@@ -104,6 +155,7 @@ class Allocation(TimeStampedModel):
     is_locked = models.BooleanField(default=False)
     is_changeable = models.BooleanField(default=False)
     history = HistoricalRecords()
+    objects = AllocationQuerySet.as_manager()
 
     def clean(self):
         """ Validates the allocation and raises errors if the allocation is invalid. """
@@ -137,6 +189,45 @@ class Allocation(TimeStampedModel):
 
         super().save(*args, **kwargs)
 
+    def refresh_from_db(self, *args, **kwargs):
+        self.clear_attribute_snapshot()
+        self.clear_parent_resource()
+        super().refresh_from_db(*args, **kwargs)
+
+    def _get_attribute_snapshot(self):
+        """
+        Returns:
+            dict[str, list[AllocationAttribute]]: the allocation's attributes, with their types and usages, keyed by attribute type name and ordered by pk
+
+        All attributes are loaded in a single query on first access (or taken
+        from AllocationQuerySet.with_attribute_snapshot) and kept until an
+        AllocationAttribute or AllocationAttributeUsage of this allocation is
+        saved or deleted.
+        """
+        snapshot = getattr(self, '_attribute_snapshot', None)
+        if snapshot is not None:
+            return snapshot
+        prefetched = getattr(self, '_prefetched_objects_cache', {})
+        if 'allocationattribute_set' in prefetched:
+            attributes = prefetched['allocationattribute_set']
+        else:
+            attributes = self.allocationattribute_set.select_related(
+                *ATTRIBUTE_SNAPSHOT_RELATED
+            ).order_by('pk')
+        snapshot = {}
+        for attribute in attributes:
+            snapshot.setdefault(
+                attribute.allocation_attribute_type.name, []
+            ).append(attribute)
+        self._attribute_snapshot = snapshot
+        return snapshot
+
+    def clear_attribute_snapshot(self):
+        """Discard the in-memory attribute snapshot so the next read reloads it."""
+        self._attribute_snapshot = None
+        getattr(self, '_prefetched_objects_cache', {}).pop('allocationattribute_set', None)
+        self.__dict__.pop('_cost', None)
+
     @property
     def unit_label(self):
         label = self.get_parent_resource.quantity_label
@@ -277,9 +368,7 @@ class Allocation(TimeStampedModel):
         if not size_attr_name:
             return None
         try:
-            return float(self.allocationattribute_set.get(
-                allocation_attribute_type__name=size_attr_name
-            ).allocationattributeusage.value)
+            return float(self._get_attribute_usage(size_attr_name).value)
         except ObjectDoesNotExist:
             if self.usage_exact:
                 label_divisor = {'TB':1000000000000, 'TiB':1099511627776}
@@ -306,24 +395,22 @@ class Allocation(TimeStampedModel):
         if not size_attr_name:
             return None
         try:
-            return float(self.allocationattribute_set.get(
-                allocation_attribute_type__name=size_attr_name
-            ).allocationattributeusage.value)
+            return float(self._get_attribute_usage(size_attr_name).value)
         except ObjectDoesNotExist:
             return None
 
     @property
     def path(self):
-        subdir_attribute = AllocationAttributeType.objects.get(name='Subdirectory')
-        attr_filter = (
-            Q(allocation_id=self.id) & Q(allocation_attribute_type_id=subdir_attribute.pk)
-        )
-        if AllocationAttribute.objects.filter(attr_filter):
-            return AllocationAttribute.objects.get(attr_filter).value
+        subdir_attribute = self.get_full_attribute('Subdirectory')
+        if subdir_attribute:
+            return subdir_attribute.value
         return ''
 
     @property
     def cost(self):
+        if '_cost' in self.__dict__:
+            # set by costs_for
+            return self._cost
         try:
             price = float(get_resource_rate(self.resources.first().name))
         except AttributeError:
@@ -335,9 +422,8 @@ class Allocation(TimeStampedModel):
         size_attr_name = self._return_size_attr_name()
         if not size_attr_name:
             return None
-        size = self.allocationattribute_set.filter(
-                    allocation_attribute_type__name=size_attr_name)
-        size_value = None if not size else size.first().value
+        size = self.get_full_attribute(size_attr_name)
+        size_value = None if not size else size.value
         return 0 if not size_value else price * float(size_value)
 
     @property
@@ -357,11 +443,15 @@ class Allocation(TimeStampedModel):
             str: the allocation's attribute type, usage out of total value, and usage out of total value as a percentage
         """
         html_string = ''
+        allocationattribute_set = sorted(
+            (a for attrs in self._get_attribute_snapshot().values() for a in attrs),
+            key=lambda a: a.pk,
+        )
         if public_only:
-            allocationattribute_set = self.allocationattribute_set.filter(
-                allocation_attribute_type__is_private=False)
-        else:
-            allocationattribute_set = self.allocationattribute_set.all()
+            allocationattribute_set = [
+                a for a in allocationattribute_set
+                if not a.allocation_attribute_type.is_private
+            ]
         for attribute in allocationattribute_set:
             if attribute.allocation_attribute_type.name in ALLOCATION_ATTRIBUTE_VIEW_LIST:
                 html_string += '%s: %s <br>' % (
@@ -403,8 +493,11 @@ class Allocation(TimeStampedModel):
             str: the resources for the allocation
         """
 
-        return ', '.join([ele.name for ele in self.resources.all().order_by(
-            *ALLOCATION_RESOURCE_ORDERING)])
+        ordered_resources = getattr(self, 'ordered_resources', None)
+        if ordered_resources is None:
+            ordered_resources = self.resources.all().order_by(
+                *ALLOCATION_RESOURCE_ORDERING)
+        return ', '.join([ele.name for ele in ordered_resources])
 
     @property
     def get_resources_as_list(self):
@@ -421,15 +514,19 @@ class Allocation(TimeStampedModel):
         Returns:
             Resource: the parent resource for the allocation
         """
-        if self.resources.count() == 0:
-            return None
-        if self.resources.count() == 1:
-            return self.resources.first()
-        parent = self.resources.order_by(*ALLOCATION_RESOURCE_ORDERING).first()
-        if parent:
-            return parent
-        # Fallback
-        return self.resources.first()
+        ordered_resources = getattr(self, 'ordered_resources', None)
+        if ordered_resources is not None:
+            return ordered_resources[0] if ordered_resources else None
+        if not hasattr(self, '_parent_resource'):
+            self._parent_resource = self.resources.select_related(
+                'resource_type', 'parent_resource'
+            ).order_by(*ALLOCATION_RESOURCE_ORDERING).first()
+        return self._parent_resource
+
+    def clear_parent_resource(self):
+        """Discard the resolved parent resource so the next read recomputes it."""
+        self.__dict__.pop('_parent_resource', None)
+        self.__dict__.pop('ordered_resources', None)
 
     @property
     def get_cluster(self):
@@ -466,8 +563,7 @@ class Allocation(TimeStampedModel):
             str: the value of the first attribute found for this allocation with the specified name
         """
 
-        attr = self.allocationattribute_set.filter(
-            allocation_attribute_type__name=name).first()
+        attr = self.get_full_attribute(name)
         if attr:
             if expand:
                 return attr.expanded_value(
@@ -479,12 +575,22 @@ class Allocation(TimeStampedModel):
 
     def get_full_attribute(self, name):
         """return the full AllocationAttribute object for the given name, or None if not found"""
-        attr = self.allocationattribute_set.filter(
-            allocation_attribute_type__name=name).first()
-        if attr:
-            return attr
+        attrs = self._get_attribute_snapshot().get(name)
+        if attrs:
+            return attrs[0]
         return None
 
+    def _get_attribute_usage(self, name):
+        """return the AllocationAttributeUsage of the named attribute.
+        Raises ObjectDoesNotExist if the attribute or its usage is missing.
+        """
+        attr = self.get_full_attribute(name)
+        if not attr:
+            raise AllocationAttribute.DoesNotExist(
+                f'allocation {self.pk} has no attribute {name}'
+            )
+        return attr.allocationattributeusage
+
     def set_usage(self, name, value):
         """
         Params:
@@ -492,15 +598,14 @@ class Allocation(TimeStampedModel):
             value (float): value to set usage to
         """
 
-        attr = self.allocationattribute_set.filter(
-            allocation_attribute_type__name=name).first()
+        attr = self.get_full_attribute(name)
         if not attr:
             return
 
         if not attr.allocation_attribute_type.has_usage:
             return
 
-        if not AllocationAttributeUsage.objects.filter(allocation_attribute=attr).exists():
+        if not hasattr(attr, 'allocationattributeusage'):
             usage = AllocationAttributeUsage.objects.create(
                 allocation_attribute=attr)
         else:
@@ -522,8 +627,7 @@ class Allocation(TimeStampedModel):
             list: the list of values of the attributes found with specified name
         """
 
-        attr = self.allocationattribute_set.filter(
-            allocation_attribute_type__name=name).all()
+        attr = self._get_attribute_snapshot().get(name, [])
         if expand:
             return [a.expanded_value(typed=typed,
                 extra_allocations=extra_allocations) for a in attr]
@@ -569,44 +673,7 @@ class Allocation(TimeStampedModel):
             list[AllocationPermission]: list of user permissions for the allocation
         """
 
-        if user.is_superuser:
-            return list(AllocationPermission)
-
-        project_perms = self.project.user_permissions(user)
-
-        if ProjectPermission.DATA_MANAGER in project_perms:
-            return [AllocationPermission.USER, AllocationPermission.MANAGER]
-
-        managed_resources = [
-            resource for resource in self.resources.all() if user in resource.allowed_users.all()]
-
-        if managed_resources:
-            return [AllocationPermission.USER, AllocationPermission.MANAGER]
-
-        if self.project.projectuser_set.filter(user=user, status__name='Active').exists():
-            return [AllocationPermission.USER]
-        if self.allocationuser_set.filter(user=user, status__name__in=['Active', 'New']).exists():
-            return [AllocationPermission.USER]
-
-        departments = Organization.objects.filter(
-            org_tree='Research Computing Storage Billing',
-            useraffiliation__role='approver',
-            useraffiliation__user=user,
-        )
-        for department in departments:
-            child_lab_ids = list(
-                OrgRelation.objects.filter(parent=department, child__rank="lab").values_list(
-                    'child_id', flat=True
-                )
-            )
-            org_names = list(Organization.objects.filter(
-                id__in=child_lab_ids
-            ).values_list('name'))
-            org_names_str = ''.join([name[0] for name in org_names])
-            proj_pi_name = self.project.pi.full_name
-            if proj_pi_name in org_names_str:
-                return [AllocationPermission.USER]
-        return []
+        return list(allocation_permissions(user, [self])[self.pk])
 
     def has_perm(self, user, perm):
         """
@@ -632,6 +699,305 @@ class Allocation(TimeStampedModel):
         return '%s (%s)' % (self.get_parent_resource.name, self.project.pi)
 
 
+def allocation_permissions(user, allocations):
+    """Resolve a user's permissions for many allocations at once.
+
+    Permissions found in the active PermissionCache are reused. The rest are
+    resolved from the project permissions (see project_permissions) with one
+    query for the resources the user manages and one for the user's
+    allocation memberships, and stored in the cache. Pass allocations with
+    select_related('project') to avoid a query per project.
+
+    Params:
+        user (User): user for whom to return permissions
+        allocations (iterable[Allocation]): allocations to resolve
+
+    Returns:
+        dict: allocation pk to list[AllocationPermission]
+    """
+    allocations = list(allocations)
+    if user.is_superuser:
+        return {allocation.pk: list(AllocationPermission) for allocation in allocations}
+
+    cache = current_permission_cache()
+    resolved = {}
+    missing = []
+    for allocation in allocations:
+        permissions = cache.get('allocation', allocation.pk, user.pk) if cache else None
+        if permissions is None:
+            missing.append(allocation)
+        else:
+            resolved[allocation.pk] = permissions
+    if not missing:
+        return resolved
+
+    missing_ids = [allocation.pk for allocation in missing]
+    project_perms = project_permissions(
+        user, {allocation.project_id: allocation.project for allocation in missing}.values()
+    )
+    managed_ids = set(Allocation.resources.through.objects.filter(
+        allocation_id__in=missing_ids, resource__allowed_users=user,
+    ).values_list('allocation_id', flat=True))
+    member_ids = None
+    for allocation in missing:
+        perms = project_perms[allocation.project_id]
+        if ProjectPermission.DATA_MANAGER in perms or allocation.pk in managed_ids:
+            permissions = [AllocationPermission.USER, AllocationPermission.MANAGER]
+        elif ProjectPermission.USER in perms:
+            # active project users and department approvers
+            permissions = [AllocationPermission.USER]
+        else:
+            if member_ids is None:
+                member_ids = set(AllocationUser.objects.filter(
+                    user=user, allocation_id__in=missing_ids,
+                    status__name__in=['Active', 'New'],
+                ).values_list('allocation_id', flat=True))
+            permissions = [AllocationPermission.USER] if allocation.pk in member_ids else []
+        resolved[allocation.pk] = permissions
+        if cache:
+            cache.set('allocation', allocation.pk, user.pk, permissions)
+    return resolved
+
+
+
+def costs_for(allocations):
+    """Compute Allocation.cost for many allocations at once.
+
+    Rates come from the cached resource rate table (see
+    coldfront.core.utils.fasrc.resource_rates). The allocations' resources are
+    loaded with their attribute snapshots in three queries and the size
+    attributes of all allocations in one, however many allocations there are.
+    Each cost is also stored on the given allocation, so that its cost
+    property doesn't query until clear_attribute_snapshot is called.
+
+    Params:
+        allocations (iterable[Allocation]): allocations to price
+
+    Returns:
+        dict: allocation pk to monthly cost, or None where Allocation.cost is None
+    """
+    allocations = list(allocations)
+    rates = resource_rates()
+    costs = {}
+    prices = {}
+    size_attr_names = {}
+    for allocation in Allocation.objects.filter(
+        pk__in=[allocation.pk for allocation in allocations]
+    ).only('pk').with_parent_resource(attributes=True):
+        costs[allocation.pk] = None
+        if not allocation.ordered_resources:
+            continue
+        # Allocation.cost prices the allocation's first resource in name order
+        price = rates.get(min(allocation.ordered_resources, key=lambda r: r.name).name)
+        size_attr_name = allocation._return_size_attr_name()
+        if price is None or not size_attr_name:
+            continue
+        prices[allocation.pk] = float(price)
+        size_attr_names[allocation.pk] = size_attr_name
+
+    sizes = {}
+    # walk in descending pk order so the oldest attribute wins, as in get_full_attribute
+    for allocation_id, name, value in AllocationAttribute.objects.filter(
+        allocation_id__in=size_attr_names,
+        allocation_attribute_type__name__in=set(size_attr_names.values()),
+    ).values_list('allocation_id', 'allocation_attribute_type__name', 'value').order_by('-pk'):
+        if size_attr_names[allocation_id] == name:
+            sizes[allocation_id] = value
+    for allocation_pk, price in prices.items():
+        size_value = sizes.get(allocation_pk)
+        costs[allocation_pk] = 0 if not size_value else price * float(size_value)
+    for allocation in allocations:
+        allocation._cost = costs.get(allocation.pk)
+    return costs
+
+class AllocationSummary(TimeStampedModel):
+    """ An allocation summary keeps the values derived from an allocation's
+    resources and attributes, so that lists, the API and reports can read,
+    filter and sort them in SQL. Summaries are refreshed by signal handlers
+    when the allocation's attributes, usages, resources or rates change; use
+    the rebuild_allocation_summaries command to recompute them all and
+    check_allocation_summaries to find stale ones.
+
+    Attributes:
+        allocation (Allocation): the summarized allocation
+        parent_resource (Resource): the allocation's parent resource
+        size (float): the allocation's size in its display unit
+        usage (float): the allocation's usage in its display unit
+        quota_bytes (float): the allocation's exact size
+        usage_bytes (float): the allocation's exact usage
+        percent_full (float): usage as a percentage of size
+        path (str): the allocation's subdirectory
+        cost (float): the allocation's monthly cost
+    """
+
+    allocation = models.OneToOneField(
+        Allocation, on_delete=models.CASCADE, primary_key=True, related_name='summary'
+    )
+    parent_resource = models.ForeignKey(
+        Resource, on_delete=models.SET_NULL, blank=True, null=True, related_name='+'
+    )
+    size = models.FloatField(blank=True, null=True)
+    usage = models.FloatField(blank=True, null=True)
+    quota_bytes = models.FloatField(blank=True, null=True)
+    usage_bytes = models.FloatField(blank=True, null=True)
+    percent_full = models.FloatField(blank=True, null=True)
+    path = models.CharField(max_length=512, blank=True, default='')
+    cost = models.FloatField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['size']),
+            models.Index(fields=['usage']),
+            models.Index(fields=['percent_full']),
+        ]
+
+    def __str__(self):
+        return f'summary of allocation {self.allocation_id}'
+
+
+SUMMARY_FIELDS = (
+    'parent_resource', 'size', 'usage', 'quota_bytes', 'usage_bytes',
+    'percent_full', 'path', 'cost',
+)
+
+
+def summarize_allocations(allocations):
+    """Return unsaved AllocationSummary objects for the given allocations.
+
+    The allocations are reloaded with their resources and attributes in a
+    fixed number of queries, and priced with costs_for.
+    """
+    allocations = list(Allocation.objects.filter(
+        pk__in=[allocation.pk for allocation in allocations]
+    ).with_parent_resource(attributes=True).with_attribute_snapshot())
+    costs = costs_for(allocations) if ENV.bool('PLUGIN_IFX', default=False) else {}
+    summaries = []
+    for allocation in allocations:
+        summary = AllocationSummary(
+            allocation=allocation,
+            parent_resource=allocation.get_parent_resource,
+            path=allocation.path,
+            cost=costs.get(allocation.pk),
+        )
+        # the size properties fall back to these values, with a warning,
+        # when the allocation has no size attribute
+        if allocation._return_size_attr_name():
+            summary.size = allocation.size
+            summary.usage = allocation.usage
+            summary.quota_bytes = allocation.size_exact or 0
+            summary.usage_bytes = allocation.usage_exact
+        else:
+            summary.size, summary.quota_bytes = 0, 0
+        if summary.size and summary.usage is not None:
+            summary.percent_full = round(summary.usage / summary.size * 100, 2)
+        summaries.append(summary)
+    return summaries
+
+
+def refresh_allocation_summaries(allocation_ids=None, batch_size=500):
+    """Recompute and save the summaries of the given allocations, or of all
+    allocations when allocation_ids is None.
+
+    Existing summaries are updated and missing ones created in separate
+    statements, since MySQL can't upsert on a named unique field.
+
+    Returns:
+        int: number of summaries written
+    """
+    allocations = Allocation.objects.all()
+    if allocation_ids is not None:
+        allocations = allocations.filter(pk__in=list(allocation_ids))
+    pks = list(allocations.values_list('pk', flat=True).order_by('pk'))
+    written = 0
+    for start in range(0, len(pks), batch_size):
+        batch = pks[start:start + batch_size]
+        summaries = summarize_allocations(Allocation(pk=pk) for pk in batch)
+        existing = set(
+            AllocationSummary.objects.filter(pk__in=batch).values_list('pk', flat=True)
+        )
+        now = timezone.now()
+        updates, creates = [], []
+        for summary in summaries:
+            if summary.allocation_id in existing:
+                # bulk_update doesn't touch auto-updated fields
+                summary.modified = now
+                updates.append(summary)
+            else:
+                creates.append(summary)
+        AllocationSummary.objects.bulk_update(updates, [*SUMMARY_FIELDS, 'modified'])
+        # a summary created meanwhile by another process is just as fresh
+        AllocationSummary.objects.bulk_create(creates, ignore_conflicts=True)
+        written += len(summaries)
+    return written
+
+
+# connection alias -> ids of the allocations whose summaries are refreshed
+# when the current transaction commits
+_pending_summary_refreshes = threading.local()
+
+
+def _refresh_pending_summaries(using):
+    allocation_ids = _pending_summary_refreshes.__dict__.pop(using, None)
+    if allocation_ids:
+        refresh_allocation_summaries(allocation_ids)
+
+
+def schedule_summary_refresh(allocation_ids, using='default'):
+    """Refresh the summaries of the given allocations once the current
+    transaction commits, when their attributes are final. Allocations
+    scheduled in the same transaction are collected in one set per connection
+    and refreshed together by the first on_commit callback to run.
+
+    Each call registers its own callback, which costs no queries: a rolled
+    back transaction drops its callbacks but not the set, so the next
+    transaction's callback has to be registered to refresh it.
+    """
+    allocation_ids = set(allocation_ids)
+    if not allocation_ids:
+        return
+    if not transaction.get_connection(using).in_atomic_block:
+        refresh_allocation_summaries(allocation_ids)
+        return
+    _pending_summary_refreshes.__dict__.setdefault(using, set()).update(allocation_ids)
+    transaction.on_commit(lambda: _refresh_pending_summaries(using), using=using)
+
+
+def check_allocation_summaries(allocation_ids=None, batch_size=500):
+    """Compare stored allocation summaries with freshly computed ones.
+
+    Returns:
+        dict: allocation pk to the list of (field, stored, expected) tuples
+        of every summary that differs, or to None for a missing summary
+    """
+    allocations = Allocation.objects.all()
+    if allocation_ids is not None:
+        allocations = allocations.filter(pk__in=list(allocation_ids))
+    pks = list(allocations.values_list('pk', flat=True).order_by('pk'))
+    problems = {}
+    for start in range(0, len(pks), batch_size):
+        batch = pks[start:start + batch_size]
+        stored = AllocationSummary.objects.in_bulk(batch)
+        for expected in summarize_allocations(Allocation(pk=pk) for pk in batch):
+            summary = stored.get(expected.allocation_id)
+            if summary is None:
+                problems[expected.allocation_id] = None
+                continue
+            differences = []
+            for field in SUMMARY_FIELDS:
+                attname = AllocationSummary._meta.get_field(field).attname
+                stored_value = getattr(summary, attname)
+                expected_value = getattr(expected, attname)
+                if isinstance(expected_value, float) and isinstance(stored_value, float):
+                    if math.isclose(stored_value, expected_value, rel_tol=1e-9):
+                        continue
+                elif stored_value == expected_value:
+                    continue
+                differences.append((field, stored_value, expected_value))
+            if differences:
+                problems[expected.allocation_id] = differences
+    return problems
+
+
 class AllocationAdminNote(TimeStampedModel):
     """ An allocation admin note is a note that an admin makes on an allocation.
 
@@ -726,6 +1092,11 @@ class AllocationAttribute(TimeStampedModel):
     value = models.CharField(max_length=128)
     history = HistoricalRecords()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['allocation', 'allocation_attribute_type']),
+        ]
+
     def save(self, *args, **kwargs):
         """ Saves the allocation attribute. """
 
@@ -850,6 +1221,93 @@ class AllocationAttributeUsage(TimeStampedModel):
         return '{}: {}'.format(self.allocation_attribute.allocation_attribute_type.name, self.value)
 
 
+@receiver(m2m_changed, sender=Allocation.resources.through)
+def allocation_resources_clear_parent_resource(sender, instance, action, reverse, **kwargs):
+    '''
+    Invalidate the resolved parent resource of an Allocation whose resources change
+    '''
+    if not reverse and action.startswith('post_'):
+        instance.clear_parent_resource()
+
+
+@receiver(post_save, sender=AllocationAttribute)
+@receiver(post_delete, sender=AllocationAttribute)
+def allocation_attribute_clear_snapshot(sender, instance, **kwargs):
+    '''
+    Invalidate the attribute snapshot of the Allocation the changed
+    AllocationAttribute is attached to, if that Allocation is in memory
+    '''
+    if AllocationAttribute.allocation.is_cached(instance):
+        instance.allocation.clear_attribute_snapshot()
+
+
+@receiver(post_save, sender=AllocationAttributeUsage)
+@receiver(post_delete, sender=AllocationAttributeUsage)
+def allocation_attribute_usage_clear_snapshot(sender, instance, **kwargs):
+    '''
+    Invalidate the attribute snapshot of the Allocation the changed
+    AllocationAttributeUsage belongs to, if that Allocation is in memory
+    '''
+    if AllocationAttributeUsage.allocation_attribute.is_cached(instance):
+        allocation_attribute_clear_snapshot(
+            sender, instance.allocation_attribute, **kwargs
+        )
+
+
+@receiver(post_save, sender=AllocationAttribute)
+@receiver(post_delete, sender=AllocationAttribute)
+def allocation_attribute_refresh_summary(sender, instance, **kwargs):
+    '''
+    Refresh the summary of the Allocation the changed AllocationAttribute is
+    attached to
+    '''
+    schedule_summary_refresh([instance.allocation_id])
+
+
+@receiver(post_save, sender=AllocationAttributeUsage)
+@receiver(post_delete, sender=AllocationAttributeUsage)
+def allocation_attribute_usage_refresh_summary(sender, instance, **kwargs):
+    '''
+    Refresh the summary of the Allocation the changed AllocationAttributeUsage
+    belongs to
+    '''
+    if AllocationAttributeUsage.allocation_attribute.is_cached(instance):
+        allocation_ids = [instance.allocation_attribute.allocation_id]
+    else:
+        allocation_ids = AllocationAttribute.objects.filter(
+            pk=instance.allocation_attribute_id
+        ).values_list('allocation_id', flat=True)
+    schedule_summary_refresh(allocation_ids)
+
+
+@receiver(m2m_changed, sender=Allocation.resources.through)
+def allocation_resources_refresh_summary(sender, instance, action, reverse, pk_set, **kwargs):
+    '''
+    Refresh the summaries of the Allocations whose resources change
+    '''
+    if not reverse:
+        if action.startswith('post_'):
+            schedule_summary_refresh([instance.pk])
+    elif action == 'pre_clear':
+        # the cleared allocations can't be found once the clear is done
+        schedule_summary_refresh(instance.allocation_set.values_list('pk', flat=True))
+    elif action in ('post_add', 'post_remove'):
+        schedule_summary_refresh(pk_set)
+
+
+@receiver(post_save, sender=ResourceAttribute)
+@receiver(post_delete, sender=ResourceAttribute)
+def resource_attribute_refresh_summaries(sender, instance, **kwargs):
+    '''
+    Refresh the summaries of a Resource's Allocations when its quantity label,
+    which sets their size unit, changes
+    '''
+    if instance.resource_attribute_type.name == 'quantity_label':
+        schedule_summary_refresh(
+            Allocation.objects.filter(resources=instance.resource_id).values_list('pk', flat=True)
+        )
+
+
 class AllocationUserStatusChoice(TimeStampedModel):
     """ An allocation user status choice indicates the status of an allocation user. Examples include Active, Error, and Removed.
 
@@ -901,6 +1359,9 @@ class AllocationUser(TimeStampedModel):
     class Meta:
         verbose_name_plural = 'Allocation User Status'
         unique_together = ('user', 'allocation')
+        indexes = [
+            models.Index(fields=['user', 'status']),
+        ]
 
     def get_attribute(self, name, typed=True):
         """
@@ -1002,6 +1463,17 @@ class AllocationUser(TimeStampedModel):
         return self.allocation.usage_exact
 
 
+@receiver(post_save, sender=AllocationUser)
+@receiver(post_delete, sender=AllocationUser)
+@receiver(m2m_changed, sender=Allocation.resources.through)
+def allocation_membership_clear_permission_cache(sender, **kwargs):
+    '''
+    Forget the permissions resolved earlier in the request once an
+    allocation's users or resources change
+    '''
+    clear_permission_cache()
+
+
 class AllocationUserAttributeType(TimeStampedModel):
     """indicates the type of the allocationuser attribute. Examples: Fairshare, usage_in_bytes.
 
@@ -0,0 +1,233 @@
+"""A common interface for pulling storage quotas into ColdFront.
+
+Each storage backend is wrapped in a QuotaSource whose list_quotas returns
+normalized QuotaRecords. poll_quota_sources fetches from any number of
+sources at once, and write_quota_records pairs the records of one source with
+that source's allocations and saves the quota and usage values with bulk
+queries.
+
+Tests can swap a backend for a QuotaSource subclass whose list_quotas returns
+canned records; nothing else touches the backend.
+"""
+import logging
+import threading
+import time
+from collections import namedtuple
+
+from django.db import connections
+
+from coldfront.core.allocation.models import Allocation, AllocationAttributeType
+from coldfront.core.allocation.utils import bulk_set_attribute_values_and_usages
+from coldfront.core.utils.common import import_from_settings
+
+# seconds to wait for a source's quotas, counted from the start of the poll
+QUOTA_SOURCE_TIMEOUT = import_from_settings('QUOTA_SOURCE_TIMEOUT', 600)
+# maximum number of sources polled at once
+QUOTA_SOURCE_WORKERS = import_from_settings('QUOTA_SOURCE_WORKERS', 8)
+
+TIB = 1024 ** 4
+
+logger = logging.getLogger(__name__)
+
+# limit_tb and used_tb are for sources that report sizes in the allocation's
+# own units; when they are None the sizes are derived from the byte values.
+# server names the resource of sources that span several resources.
+QuotaRecord = namedtuple(
+    'QuotaRecord',
+    ['path', 'group', 'limit_bytes', 'used_bytes', 'limit_tb', 'used_tb', 'server'],
+    defaults=(None, None, None),
+)
+
+
+def normalize_path(path):
+    """Return path with exactly one leading and no trailing slash."""
+    return '/' + (path or '').strip('/')
+
+
+class QuotaSource:
+    """A storage backend that reports quotas for the allocations of a resource.
+
+    Subclasses implement list_quotas. By default records are matched to the
+    resource's active allocations by path; sources that identify allocations
+    differently override allocation_key and record_key, or match.
+    """
+    name = 'quota source'
+    timeout = QUOTA_SOURCE_TIMEOUT
+    size_attribute_name = 'Storage Quota (TiB)'
+
+    def __init__(self, resource=None, timeout=None):
+        self.resource = resource
+        if resource is not None:
+            self.name = resource.name
+        if timeout is not None:
+            self.timeout = timeout
+
+    def __str__(self):
+        return self.name
+
+    def list_quotas(self):
+        """Return an iterable of QuotaRecords. Runs in a worker thread."""
+        raise NotImplementedError
+
+    def allocations(self):
+        return Allocation.objects.filter(
+            status__name='Active', resources=self.resource,
+        ).with_attribute_snapshot()
+
+    def allocation_key(self, allocation):
+        return normalize_path(allocation.path)
+
+    def record_key(self, record):
+        return normalize_path(record.path)
+
+    def get_size_attribute_name(self, allocation):
+        return self.size_attribute_name
+
+    def match(self, records):
+        """Pair records with allocations. The first record for a key wins.
+
+        Returns:
+            tuple: list of (allocation, record) pairs and list of allocations
+            with no record
+        """
+        index = {}
+        for record in records:
+            index.setdefault(self.record_key(record), record)
+        pairs = []
+        unmatched = []
+        for allocation in self.allocations():
+            record = index.get(self.allocation_key(allocation))
+            if record is None:
+                unmatched.append(allocation)
+            else:
+                pairs.append((allocation, record))
+        return pairs, unmatched
+
+
+class QuotaPollResult:
+    """The outcome of polling one QuotaSource."""
+    __slots__ = ('source', 'records', 'error', 'elapsed')
+
+    def __init__(self, source, records=None, error=None, elapsed=0.0):
+        self.source = source
+        self.records = records if records is not None else []
+        self.error = error
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def summary(self):
+        if self.ok:
+            return f'{self.source}: {len(self.records)} quotas in {self.elapsed:.2f}s'
+        return f'{self.source}: failed after {self.elapsed:.2f}s: {self.error}'
+
+
+def _timed_list_quotas(source):
+    start = time.perf_counter()
+    try:
+        return list(source.list_quotas()), None, time.perf_counter() - start
+    except Exception as e:
+        return None, e, time.perf_counter() - start
+    finally:
+        # sources may touch the database from this thread
+        connections.close_all()
+
+
+def poll_quota_sources(sources, max_workers=None):
+    """List the quotas of every source concurrently.
+
+    A source that raises, or that hasn't answered within its timeout, gets a
+    failed result instead of holding up the others. Sources run in daemon
+    threads, so one that hangs past its timeout is abandoned and can't keep
+    the process from exiting.
+
+    Returns:
+        list[QuotaPollResult]: one result per source, in source order
+    """
+    sources = list(sources)
+    if not sources:
+        return []
+    slots = threading.BoundedSemaphore(max_workers or min(QUOTA_SOURCE_WORKERS, len(sources)))
+    outcomes = [None] * len(sources)
+    finished = [threading.Event() for _ in sources]
+
+    def run(index, source):
+        with slots:
+            outcomes[index] = _timed_list_quotas(source)
+        finished[index].set()
+
+    start = time.perf_counter()
+    for index, source in enumerate(sources):
+        threading.Thread(
+            target=run, args=(index, source), name=f'quota-source-{index}', daemon=True,
+        ).start()
+    results = []
+    for index, source in enumerate(sources):
+        remaining = source.timeout - (time.perf_counter() - start)
+        if finished[index].wait(max(remaining, 0)):
+            records, error, elapsed = outcomes[index]
+        else:
+            records, elapsed = None, time.perf_counter() - start
+            error = TimeoutError(f'no quotas within {source.timeout}s')
+        result = QuotaPollResult(source, records=records, error=error, elapsed=elapsed)
+        if result.ok:
+            logger.info('quota poll %s', result.summary())
+        else:
+            logger.error('quota poll %s', result.summary())
+        results.append(result)
+    return results
+
+
+def write_quota_records(source, records, change_reason='quota update'):
+    """Save the quotas and usages of a source's records to its allocations.
+
+    Each matched allocation gets its Quota_In_Bytes attribute and its storage
+    quota attribute (source.get_size_attribute_name) set, along with their
+    usages, through bulk_set_attribute_values_and_usages.
+
+    Returns:
+        dict: report of complete allocations, allocations with no entry or an
+        empty quota, errors and change counts
+    """
+    records = list(records)
+    pairs, unmatched = source.match(records)
+    report = {
+        'complete': 0,
+        'no entry': [f'{a.pk} {a.path} {a}' for a in unmatched],
+        'empty quota': [],
+        'errors': [],
+        'unmatched records': len(records) - len({id(record) for _, record in pairs}),
+    }
+    for entry in report['no entry']:
+        logger.warning('no %s quota entry for allocation %s', source, entry)
+
+    attribute_types = {t.name: t for t in AllocationAttributeType.objects.all()}
+    updates = []
+    for allocation, record in pairs:
+        if record.limit_bytes is None and record.limit_tb is None:
+            logger.warning('no hard limit set for allocation %s', allocation)
+            report['empty quota'].append(f'{allocation.pk} {allocation.path} {allocation}')
+            continue
+        size_attribute_name = source.get_size_attribute_name(allocation)
+        if size_attribute_name not in attribute_types:
+            logger.error('no attribute type %s for allocation %s', size_attribute_name, allocation)
+            report['errors'].append(f'{allocation.pk} {allocation}: no {size_attribute_name}')
+            continue
+        limit_tb, used_tb = record.limit_tb, record.used_tb
+        if record.limit_bytes is not None:
+            updates.append((
+                allocation, attribute_types['Quota_In_Bytes'],
+                record.limit_bytes, record.used_bytes,
+            ))
+            if limit_tb is None:
+                limit_tb = record.limit_bytes / TIB
+            if used_tb is None and record.used_bytes is not None:
+                used_tb = record.used_bytes / TIB
+        updates.append((allocation, attribute_types[size_attribute_name], limit_tb, used_tb))
+        report['complete'] += 1
+    report['changes'] = dict(
+        bulk_set_attribute_values_and_usages(updates, change_reason=change_reason)
+    )
+    return report
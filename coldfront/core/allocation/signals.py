@@ -26,6 +26,9 @@ allocation_user_attribute_edit = django.dispatch.Signal()
 allocation_user_remove_on_slurm = django.dispatch.Signal()
     #providing_args=["username", "account"]
 
+allocation_attributes_bulk_saved = django.dispatch.Signal()
+    #providing_args=["attributes"]
+
 allocation_raw_share_edit = django.dispatch.Signal()
     #providing_args=["account", "raw_share"]
 
@@ -1,18 +1,21 @@
 import datetime
 # import the logging library
 import logging
+from collections import defaultdict
 
+from django.db.models import F
 from django.utils import timezone
-from django.contrib.auth import get_user_model
 
 from coldfront.core.allocation.models import (
     Allocation,
+    AllocationAttribute,
     AllocationStatusChoice,
+    AllocationUser,
     AllocationChangeRequest,
     AllocationAttributeChangeRequest,
 )
 from coldfront.core.utils.common import import_from_settings
-from coldfront.core.utils.mail import send_email_template
+from coldfront.core.utils.mail import MailQueue, send_email_template
 
 # Get an instance of a logger
 logger = logging.getLogger(__name__)
@@ -36,6 +39,8 @@ PENDING_ALLOCATION_STATUSES = import_from_settings(
     'PENDING_ALLOCATION_STATUSES', ['New'])
 ACTIVE_ALLOCATION_STATUSES = import_from_settings(
     'ACTIVE_ALLOCATION_STATUSES', ['Active', 'Payment Pending', 'Payment Requested', 'Unpaid'])
+# allocation attributes that let an allocation opt out of expiry notices
+EXPIRY_NOTIFICATION_ATTRIBUTES = ('EXPIRE NOTIFICATION', 'CLOUD_USAGE_NOTIFICATION')
 
 def update_statuses():
 
@@ -107,165 +112,160 @@ def send_request_reminder_emails():
     return (pending_changerequests, pending_allocations)
 
 
-def send_expiry_emails():
-    #Allocations expiring soon
-    admin_projectdict = {}
-    admin_allocationdict = {}
-    for user in get_user_model().objects.all():
-        projectdict = {}
-        allocationdict = {}
-        email_receiver_list = []
-
-        expring_in_days = timezone.now().date() + datetime.timedelta(days=1)
-
-        for allocationuser in user.allocationuser_set.all():
-            allocation = allocationuser.allocation
-
-            if allocation.end_date == expring_in_days:
-
-                project_url = f'{CENTER_BASE_URL.strip("/")}/{"project"}/{allocation.project.pk}/'
-
-                allocation_renew_url = f'{CENTER_BASE_URL.strip("/")}/{"allocation"}/{allocation.pk}/{"renew"}/'
-
-                allocation_url = f'{CENTER_BASE_URL.strip("/")}/{"allocation"}/{allocation.pk}/'
-
-                resource_name = allocation.get_parent_resource.name
-
-                template_context = {
-                    'center_name': CENTER_NAME,
-                    'project_dict': projectdict,
-                    'allocation_dict': allocationdict,
-                    'project_renewal_help_url': CENTER_PROJECT_RENEWAL_HELP_URL,
-                    'opt_out_instruction_url': EMAIL_OPT_OUT_INSTRUCTION_URL,
-                    'signature': EMAIL_SIGNATURE
-                }
-
-                expire_notification = allocation.allocationattribute_set.filter(
-                    allocation_attribute_type__name='EXPIRE NOTIFICATION').first()
-
-                for projectuser in allocation.project.projectuser_set.filter(user=user, status__name='Active'):
-                    if not (expire_notification and expire_notification.value == 'Yes'):
-                        continue
-
-                    if not (projectuser.enable_notifications and
-                        allocationuser.user == user and allocationuser.status.name == 'Active'):
-                        continue
-
-                    if user.email not in email_receiver_list:
-                        email_receiver_list.append(user.email)
-
-                    if project_url not in allocationdict:
-                        allocationdict[project_url] = []
-                    if {allocation_renew_url : resource_name} not in allocationdict[project_url]:
-                        allocationdict[project_url].append({allocation_renew_url : resource_name})
-
-                    if allocation.project.title not in projectdict:
-                        projectdict[allocation.project.title] = (project_url, allocation.project.pi.username)
-
-                    if EMAIL_ADMINS_ON_ALLOCATION_EXPIRE:
-
-                        if project_url not in admin_allocationdict:
-                            admin_allocationdict[project_url] = []
-                        if {allocation_url : resource_name} not in admin_allocationdict[project_url]:
-                            admin_allocationdict[project_url].append({allocation_url : resource_name})
-
-                        if allocation.project.title not in admin_projectdict:
-                            admin_projectdict[allocation.project.title] = (project_url, allocation.project.pi.username)
-
-
-        if email_receiver_list:
-
-            send_email_template('Your access to resource(s) have expired',
-                        'email/allocation_expired.txt',
-                        template_context,
-                        EMAIL_SENDER,
-                        email_receiver_list
-                        )
-
-            logger.debug(f'Allocation(s) expired email sent to user {user}.')
-
-        projectdict = {}
-        expirationdict = {}
-        email_receiver_list = []
-        for days_remaining in sorted(set(EMAIL_ALLOCATION_EXPIRING_NOTIFICATION_DAYS)):
-
-            expring_in_days = timezone.now().date() + datetime.timedelta(days=days_remaining)
-
-            for allocationuser in user.allocationuser_set.all():
-                allocation = allocationuser.allocation
-
-                if allocation.status.name in ACTIVE_ALLOCATION_STATUSES and allocation.end_date == expring_in_days:
-
-                    project_url = f'{CENTER_BASE_URL.strip("/")}/{"project"}/{allocation.project.pk}/'
-
-                    allocation_renew_url = f'{CENTER_BASE_URL.strip("/")}/{"allocation"}/{allocation.pk}/'
-                    if allocation.status.name == 'Active':
-                        allocation_renew_url = allocation_renew_url + '{"renew"}/'
-
-                    resource_name = allocation.get_parent_resource.name
-
-                    template_context = {
-                        'center_name': CENTER_NAME,
-                        'expring_in_days': days_remaining,
-                        'project_dict': projectdict,
-                        'expiration_dict': expirationdict,
-                        'expiration_days': sorted(set(EMAIL_ALLOCATION_EXPIRING_NOTIFICATION_DAYS)),
-                        'project_renewal_help_url': CENTER_PROJECT_RENEWAL_HELP_URL,
-                        'opt_out_instruction_url': EMAIL_OPT_OUT_INSTRUCTION_URL,
-                        'signature': EMAIL_SIGNATURE
-                    }
-
-                    expire_notification = allocation.allocationattribute_set.filter(
-                        allocation_attribute_type__name='EXPIRE NOTIFICATION').first()
-                    if expire_notification and expire_notification.value == 'No':
-                        continue
-
-                    cloud_usage_notification = allocation.allocationattribute_set.filter(
-                        allocation_attribute_type__name='CLOUD_USAGE_NOTIFICATION').first()
-                    if cloud_usage_notification and cloud_usage_notification.value == 'No':
-                        continue
-
-                    for projectuser in allocation.project.projectuser_set.filter(user=user, status__name='Active'):
-                        if not (projectuser.enable_notifications and
-                            allocationuser.user == user and allocationuser.status.name == 'Active'):
-                            continue
-
-                        if user.email not in email_receiver_list:
-                            email_receiver_list.append(user.email)
-
-                        if days_remaining not in expirationdict:
-                            expirationdict[days_remaining] = []
-                        expirationdict[days_remaining].append((project_url, allocation_renew_url, resource_name))
-
-                        if allocation.project.title not in projectdict:
-                            projectdict[allocation.project.title] = (project_url, allocation.project.pi.username)
+def _expiry_notification_targets(end_dates):
+    """Load the allocations ending on one of end_dates with what is needed to
+    notify their users, in three queries.
+
+    Returns
+    -------
+    allocations : list
+        the allocations, with their project, PI, status and parent resource
+    notification_settings : dict
+        allocation pk -> {attribute name: value} for the attributes in
+        EXPIRY_NOTIFICATION_ATTRIBUTES
+    recipients : dict
+        allocation pk -> list of (user pk, email) of the active allocation
+        users who are active project users with notifications enabled
+    """
+    allocations = list(
+        Allocation.objects.filter(end_date__in=end_dates)
+        .select_related('project__pi', 'status')
+        .with_parent_resource()
+        .order_by('pk')
+    )
+    allocation_ids = [allocation.pk for allocation in allocations]
 
-        if email_receiver_list:
+    notification_settings = defaultdict(dict)
+    # walk in descending pk order so the oldest attribute of a type wins
+    for allocation_id, name, value in AllocationAttribute.objects.filter(
+        allocation_id__in=allocation_ids,
+        allocation_attribute_type__name__in=EXPIRY_NOTIFICATION_ATTRIBUTES,
+    ).values_list('allocation_id', 'allocation_attribute_type__name', 'value').order_by('-pk'):
+        notification_settings[allocation_id][name] = value
 
-            send_email_template(f"Your access to {CENTER_NAME}'s resources is expiring soon",
-                        'email/allocation_expiring.txt',
-                        template_context,
-                        EMAIL_SENDER,
-                        email_receiver_list
-                        )
+    recipients = defaultdict(list)
+    for allocation_id, user_id, email in AllocationUser.objects.filter(
+        allocation_id__in=allocation_ids,
+        status__name='Active',
+        user__projectuser__project=F('allocation__project'),
+        user__projectuser__status__name='Active',
+        user__projectuser__enable_notifications=True,
+    ).values_list('allocation_id', 'user_id', 'user__email').distinct().order_by('user_id'):
+        recipients[allocation_id].append((user_id, email))
 
-            logger.debug(f'Allocation(s) expiring in soon, email sent to user {user}.')
+    return allocations, notification_settings, recipients
 
 
-    # produce "allocations have expired" list and send emails
-    if EMAIL_ADMINS_ON_ALLOCATION_EXPIRE:
+def send_expiry_emails():
+    """Email users about allocations that have expired or are expiring soon.
 
-        if admin_projectdict:
+    Only the allocations ending tomorrow or in one of
+    EMAIL_ALLOCATION_EXPIRING_NOTIFICATION_DAYS days are loaded. Their users
+    get one email per kind of notice, listing all of their allocations, and
+    the emails are sent in batches through a MailQueue.
+    """
+    base_url = CENTER_BASE_URL.strip('/')
+    today = timezone.now().date()
+    expired_date = today + datetime.timedelta(days=1)
+    expiration_days = sorted(set(EMAIL_ALLOCATION_EXPIRING_NOTIFICATION_DAYS))
+    days_remaining_by_date = {
+        today + datetime.timedelta(days=days): days for days in expiration_days
+    }
+    allocations, notification_settings, recipients = _expiry_notification_targets(
+        {expired_date, *days_remaining_by_date}
+    )
 
+    # (user pk, email) -> (project_dict, allocation_dict or expiration_dict)
+    expired = defaultdict(lambda: ({}, {}))
+    expiring = defaultdict(lambda: ({}, {}))
+    admin_projectdict = {}
+    admin_allocationdict = {}
+    for allocation in allocations:
+        users = recipients.get(allocation.pk)
+        if not users:
+            continue
+        attributes = notification_settings.get(allocation.pk, {})
+        project = allocation.project
+        project_url = f'{base_url}/project/{project.pk}/'
+        allocation_url = f'{base_url}/allocation/{allocation.pk}/'
+        project_entry = (project_url, project.pi.username)
+        resource_name = allocation.get_parent_resource.name
+
+        if allocation.end_date == expired_date and attributes.get('EXPIRE NOTIFICATION') == 'Yes':
+            renewal = {f'{allocation_url}renew/': resource_name}
+            for user in users:
+                projectdict, allocationdict = expired[user]
+                projectdict.setdefault(project.title, project_entry)
+                renewals = allocationdict.setdefault(project_url, [])
+                if renewal not in renewals:
+                    renewals.append(renewal)
+            if EMAIL_ADMINS_ON_ALLOCATION_EXPIRE:
+                admin_projectdict.setdefault(project.title, project_entry)
+                admin_allocations = admin_allocationdict.setdefault(project_url, [])
+                if {allocation_url: resource_name} not in admin_allocations:
+                    admin_allocations.append({allocation_url: resource_name})
+
+        days_remaining = days_remaining_by_date.get(allocation.end_date)
+        if (
+            days_remaining is not None
+            and allocation.status.name in ACTIVE_ALLOCATION_STATUSES
+            and 'No' not in [attributes.get(name) for name in EXPIRY_NOTIFICATION_ATTRIBUTES]
+        ):
+            allocation_renew_url = allocation_url
+            if allocation.status.name == 'Active':
+                allocation_renew_url += 'renew/'
+            for user in users:
+                projectdict, expirationdict = expiring[user]
+                expirationdict.setdefault(days_remaining, []).append(
+                    (project_url, allocation_renew_url, resource_name)
+                )
+                projectdict.setdefault(project.title, project_entry)
+
+    base_context = {
+        'center_name': CENTER_NAME,
+        'project_renewal_help_url': CENTER_PROJECT_RENEWAL_HELP_URL,
+        'opt_out_instruction_url': EMAIL_OPT_OUT_INSTRUCTION_URL,
+        'signature': EMAIL_SIGNATURE,
+    }
+    with MailQueue() as mail_queue:
+        for (user_id, email), (projectdict, allocationdict) in expired.items():
+            mail_queue.add_template('Your access to resource(s) have expired',
+                                    'email/allocation_expired.txt',
+                                    {**base_context, 'project_dict': projectdict, 'allocation_dict': allocationdict},
+                                    EMAIL_SENDER,
+                                    [email],
+                                    )
+            logger.debug(f'Allocation(s) expired email queued for user {user_id}.')
+
+        for (user_id, email), (projectdict, expirationdict) in expiring.items():
+            template_context = {
+                **base_context,
+                'expring_in_days': min(expirationdict),
+                'project_dict': projectdict,
+                'expiration_dict': dict(sorted(expirationdict.items())),
+                'expiration_days': expiration_days,
+            }
+            mail_queue.add_template(f"Your access to {CENTER_NAME}'s resources is expiring soon",
+                                    'email/allocation_expiring.txt',
+                                    template_context,
+                                    EMAIL_SENDER,
+                                    [email],
+                                    )
+            logger.debug(f'Allocation(s) expiring soon email queued for user {user_id}.')
+
+        # produce "allocations have expired" list and send emails
+        if EMAIL_ADMINS_ON_ALLOCATION_EXPIRE and admin_projectdict:
             admin_template_context = {
                 'project_dict': admin_projectdict,
                 'allocation_dict': admin_allocationdict,
                 'signature': EMAIL_SIGNATURE
             }
+            mail_queue.add_template('Allocation(s) have expired',
+                                    'email/admin_allocation_expired.txt',
+                                    admin_template_context,
+                                    EMAIL_SENDER,
+                                    [EMAIL_ADMIN_LIST,],
+                                    )
 
-            send_email_template('Allocation(s) have expired',
-                                'email/admin_allocation_expired.txt',
-                                admin_template_context,
-                                EMAIL_SENDER,
-                                [EMAIL_ADMIN_LIST,]
-                                )
+    # return statement for testing
+    return ([email for _, email in expired], [email for _, email in expiring])
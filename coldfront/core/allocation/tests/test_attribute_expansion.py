@@ -0,0 +1,80 @@
+"""Unit tests for compiled attribute expansion"""
+
+from django.test import SimpleTestCase
+
+from coldfront.core import attribute_expansion
+
+
+class FakeAttributeHolder:
+    """Stand-in for an Allocation or Resource"""
+
+    def __init__(self, attributes):
+        self.attributes = attributes
+
+    def get_attribute(self, name):
+        return self.attributes.get(name)
+
+
+ATTRIBLIST = '\n'.join([
+    '#Set cpumin from Core Usage attribute',
+    'cpumin := :Core Usage (Hours)',
+    'cpumin |= 1',
+    'cpumin *= 60',
+    'hours := :cpumin',
+    'hours /= 7',
+    'hours (= floor',
+    "qos := 'normal'",
+    'qos += RESOURCE:qos_suffix',
+    'account := ALLOCATION:slurm_account_name',
+    'missing := :No Such Attribute',
+    'not a statement',
+])
+
+
+class CompiledAttributeExpansionTests(SimpleTestCase):
+    """Tests for compile_attriblist and evaluate_attriblist"""
+
+    def setUp(self):
+        self.resources = [FakeAttributeHolder({'qos_suffix': '_high'})]
+        self.allocations = [FakeAttributeHolder({
+            'Core Usage (Hours)': 100, 'slurm_account_name': 'poisson_lab',
+        })]
+
+    def test_compiled_matches_interpreted(self):
+        """the compiled path produces the same parameters as the interpreter"""
+        interpreted = attribute_expansion.make_attribute_parameter_dictionary(
+            attribute_name='slurm_specs',
+            attribute_parameter_string=ATTRIBLIST,
+            resources=self.resources,
+            allocations=self.allocations,
+        )
+        compiled = attribute_expansion.evaluate_attriblist(
+            attribute_expansion.compile_attriblist(ATTRIBLIST),
+            attribute_name='slurm_specs',
+            resources=self.resources,
+            allocations=self.allocations,
+        )
+        self.assertEqual(compiled, interpreted)
+        self.assertEqual(compiled['cpumin'], 6000)
+        self.assertEqual(compiled['hours'], 857)
+        self.assertEqual(compiled['qos'], 'normal_high')
+        self.assertIsNone(compiled['missing'])
+
+    def test_expand_attribute(self):
+        """expand_attribute formats the raw value with the compiled parameters"""
+        expanded = attribute_expansion.expand_attribute(
+            raw_value='GrpTRESMins=cpu={cpumin}:QOS={qos}',
+            attribute_name='slurm_specs',
+            attriblist_string=ATTRIBLIST,
+            resources=self.resources,
+            allocations=self.allocations,
+        )
+        self.assertEqual(expanded, 'GrpTRESMins=cpu=6000:QOS=normal_high')
+
+    def test_compile_attriblist_is_cached(self):
+        """each distinct attriblist string is compiled only once"""
+        attribute_expansion.compile_attriblist.cache_clear()
+        first = attribute_expansion.compile_attriblist(ATTRIBLIST)
+        second = attribute_expansion.compile_attriblist(ATTRIBLIST)
+        self.assertIs(first, second)
+        self.assertEqual(attribute_expansion.compile_attriblist.cache_info().misses, 1)
@@ -1,8 +1,25 @@
 """Unit tests for the allocation models"""
+from unittest import mock
 
+from django.core.cache import caches
+from django.db import connection
 from django.test import TestCase
 from django.core.exceptions import ValidationError
+from ifxbilling.models import Rate
 
+from coldfront.core.allocation.models import (
+    Allocation,
+    AllocationSummary,
+    check_allocation_summaries,
+    costs_for,
+    refresh_allocation_summaries,
+)
+from coldfront.core.utils.fasrc import (
+    RESOURCE_RATES_KEY,
+    invalidate_resource_rates,
+    resource_rates,
+)
+from coldfront.core.utils.permissions import permission_cache
 from coldfront.core.test_helpers.factories import setup_models, AllocationFactory
 
 UTIL_FIXTURES = [
@@ -60,3 +77,255 @@ class AllocationAttributeModelTests(TestCase):
         self.allocationattribute.value = "1000TB"
         with self.assertRaisesMessage(ValidationError, 'Value must be entirely numeric. Please remove any non-numeric characters.'):
             self.allocationattribute.clean()
+
+
+class AllocationAttributeSnapshotTests(TestCase):
+    """Tests for the Allocation attribute snapshot"""
+    fixtures = UTIL_FIXTURES
+
+    @classmethod
+    def setUpTestData(cls):
+        """Set up allocations to test the attribute snapshot"""
+        setup_models(cls)
+
+    def test_get_attribute_uses_one_query(self):
+        """all attribute reads after the first are served from the snapshot"""
+        allocation = Allocation.objects.get(pk=self.storage_allocation.pk)
+        with self.assertNumQueries(1):
+            allocation.get_attribute('Storage Quota (TB)')
+            allocation.get_attribute('Expense Code')
+            allocation.get_full_attribute('Quota_In_Bytes')
+            allocation.get_attribute_list('Storage Quota (TB)')
+
+    def test_with_attribute_snapshot_primes_queryset(self):
+        """with_attribute_snapshot loads attributes for all allocations up front"""
+        allocations = list(Allocation.objects.with_attribute_snapshot())
+        with self.assertNumQueries(0):
+            for allocation in allocations:
+                allocation.get_attribute('Storage Quota (TB)')
+                allocation.get_full_attribute('Quota_In_Bytes')
+
+    def test_snapshot_invalidated_on_attribute_save(self):
+        """saving an attribute clears the snapshot of its allocation"""
+        allocation = self.storage_allocation
+        self.assertEqual(allocation.get_attribute('Storage Quota (TB)'), 100)
+        attribute = allocation.get_full_attribute('Storage Quota (TB)')
+        attribute.value = 200
+        attribute.save()
+        self.assertEqual(allocation.get_attribute('Storage Quota (TB)'), 200)
+
+    def test_snapshot_invalidated_on_usage_save(self):
+        """saving an attribute usage clears the snapshot of its allocation"""
+        allocation = self.storage_allocation
+        self.assertEqual(allocation.usage, 10)
+        usage = allocation.get_full_attribute('Storage Quota (TB)').allocationattributeusage
+        usage.value = 20
+        usage.save()
+        self.assertEqual(allocation.usage, 20)
+
+    def test_snapshot_invalidated_on_attribute_delete(self):
+        """deleting an attribute clears the snapshot of its allocation"""
+        allocation = self.storage_allocation
+        allocation.get_full_attribute('Storage Quota (TB)').delete()
+        self.assertIsNone(allocation.get_attribute('Storage Quota (TB)'))
+
+
+class AllocationParentResourceTests(TestCase):
+    """Tests for Allocation parent resource resolution"""
+    fixtures = UTIL_FIXTURES
+
+    @classmethod
+    def setUpTestData(cls):
+        """Set up allocations to test parent resource resolution"""
+        setup_models(cls)
+
+    def test_get_parent_resource_is_memoized(self):
+        """the parent resource, its type and tier are resolved in one query"""
+        allocation = Allocation.objects.get(pk=self.storage_allocation.pk)
+        with self.assertNumQueries(1):
+            allocation.get_parent_resource
+            allocation.get_parent_resource.resource_type.name
+            allocation.get_parent_resource.parent_resource
+            str(allocation.get_parent_resource)
+
+    def test_with_parent_resource_primes_queryset(self):
+        """with_parent_resource resolves parent resources for all allocations up front"""
+        allocations = list(Allocation.objects.with_parent_resource())
+        with self.assertNumQueries(0):
+            for allocation in allocations:
+                allocation.get_parent_resource.resource_type.name
+        self.assertIn(self.storage_resource, [a.get_parent_resource for a in allocations])
+
+    def test_parent_resource_cleared_on_resources_change(self):
+        """changing an allocation's resources recomputes its parent resource"""
+        allocation = AllocationFactory()
+        self.assertIsNone(allocation.get_parent_resource)
+        allocation.resources.add(self.cluster_resource)
+        self.assertEqual(allocation.get_parent_resource, self.cluster_resource)
+
+
+class AllocationCostTests(TestCase):
+    """Tests for Allocation.cost and costs_for"""
+    fixtures = UTIL_FIXTURES
+
+    @classmethod
+    def setUpTestData(cls):
+        """Set up allocations to price"""
+        setup_models(cls)
+
+    def setUp(self):
+        # cache the rate table as a cache shared between processes would
+        patcher = mock.patch(
+            'coldfront.core.utils.fasrc.shared_cache', return_value=caches['default']
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        invalidate_resource_rates()
+
+    def test_costs_for_matches_cost(self):
+        """costs_for returns the cost property of every allocation"""
+        allocations = list(Allocation.objects.all())
+        expected = {a.pk: Allocation.objects.get(pk=a.pk).cost for a in allocations}
+        self.assertEqual(costs_for(allocations), expected)
+        self.assertEqual(expected[self.storage_allocation.pk], 100)
+
+    def test_costs_for_queries_independent_of_allocations(self):
+        """costs are computed with a fixed number of queries and stored on the allocations"""
+        for i in range(3):
+            allocation = AllocationFactory(project=self.project, justification=f'storage {i}')
+            allocation.resources.add(self.storage_resource)
+        allocations = list(Allocation.objects.all())
+        costs_for(allocations)
+        with self.assertNumQueries(4):
+            costs_for(allocations)
+        with self.assertNumQueries(0):
+            for allocation in allocations:
+                allocation.cost
+
+    def test_rate_change_updates_costs(self):
+        """saving a Rate reloads the rate table"""
+        costs_for([self.storage_allocation])
+        rate = Rate.objects.get(product__product_name=self.storage_resource.name, is_active=True)
+        rate.price = 200
+        rate.save()
+        self.assertEqual(costs_for([self.storage_allocation])[self.storage_allocation.pk], 200)
+
+    def test_rate_table_dropped_on_commit(self):
+        """a rate table cached before the Rate change commits is dropped on commit"""
+        rate = Rate.objects.get(product__product_name=self.storage_resource.name, is_active=True)
+        rate.price = 200
+        with self.captureOnCommitCallbacks(execute=True):
+            rate.save()
+            # another process reloads the table before the change is visible to it
+            caches['default'].set(RESOURCE_RATES_KEY, {self.storage_resource.name: 100})
+        self.assertEqual(resource_rates()[self.storage_resource.name], 200)
+
+    def test_rates_not_kept_across_requests_in_process_local_cache(self):
+        """with a process-local cache, the rate table is only kept for a request"""
+        with mock.patch('coldfront.core.utils.fasrc.shared_cache', return_value=None):
+            resource_rates()
+            with self.assertNumQueries(2):
+                resource_rates()
+            with permission_cache():
+                resource_rates()
+                with self.assertNumQueries(0):
+                    self.assertEqual(resource_rates()[self.storage_resource.name], 100)
+
+
+class AllocationSummaryTests(TestCase):
+    """Tests for AllocationSummary and its upkeep"""
+    fixtures = UTIL_FIXTURES
+
+    @classmethod
+    def setUpTestData(cls):
+        """Set up allocations to summarize"""
+        setup_models(cls)
+
+    def setUp(self):
+        invalidate_resource_rates()
+        refresh_allocation_summaries()
+
+    def test_summary_matches_properties(self):
+        """summaries hold the values the allocation properties compute"""
+        summary = AllocationSummary.objects.get(allocation=self.storage_allocation)
+        allocation = Allocation.objects.get(pk=self.storage_allocation.pk)
+        self.assertEqual(summary.parent_resource, self.storage_resource)
+        self.assertEqual(summary.size, allocation.size)
+        self.assertEqual(summary.usage, allocation.usage)
+        self.assertEqual(summary.quota_bytes, allocation.size_exact)
+        self.assertEqual(summary.usage_bytes, allocation.usage_exact)
+        self.assertEqual(summary.percent_full, 10)
+        self.assertEqual(summary.cost, 100)
+        self.assertEqual(check_allocation_summaries(), {})
+
+    def test_refresh_without_upsert(self):
+        """summaries are refreshed on databases that can't upsert on a named field"""
+        AllocationSummary.objects.filter(allocation=self.storage_allocation).update(size=1)
+        AllocationSummary.objects.filter(allocation=self.cluster_allocation).delete()
+        with mock.patch.object(connection.features, 'supports_update_conflicts', False), \
+                mock.patch.object(connection.features, 'supports_update_conflicts_with_target', False):
+            self.assertEqual(refresh_allocation_summaries(), Allocation.objects.count())
+        self.assertEqual(AllocationSummary.objects.get(allocation=self.storage_allocation).size, 100)
+        self.assertTrue(AllocationSummary.objects.filter(allocation=self.cluster_allocation).exists())
+        self.assertEqual(check_allocation_summaries(), {})
+
+    def test_attribute_writes_refresh_summary(self):
+        """saving an attribute usage refreshes the summary on commit"""
+        usage = self.storage_allocation.get_full_attribute(
+            'Storage Quota (TB)'
+        ).allocationattributeusage
+        usage.value = 50
+        with self.captureOnCommitCallbacks(execute=True):
+            usage.save()
+        summary = AllocationSummary.objects.get(allocation=self.storage_allocation)
+        self.assertEqual(summary.usage, 50)
+        self.assertEqual(summary.percent_full, 50)
+
+    def test_attribute_writes_share_one_refresh(self):
+        """the summaries of attributes saved in one transaction are refreshed together"""
+        usage = self.storage_allocation.get_full_attribute(
+            'Storage Quota (TB)'
+        ).allocationattributeusage
+        with mock.patch(
+            'coldfront.core.allocation.models.refresh_allocation_summaries',
+            wraps=refresh_allocation_summaries,
+        ) as refresh:
+            with self.captureOnCommitCallbacks(execute=True):
+                usage.value = 50
+                usage.save()
+                usage.value = 60
+                usage.save()
+                self.cluster_allocation.resources.remove(self.cluster_resource)
+        refresh.assert_called_once()
+        self.assertTrue(
+            {self.storage_allocation.pk, self.cluster_allocation.pk} <= set(refresh.call_args[0][0])
+        )
+        summary = AllocationSummary.objects.get(allocation=self.storage_allocation)
+        self.assertEqual(summary.usage, 60)
+
+    def test_rate_change_refreshes_cost(self):
+        """saving a Rate reprices the summaries of its resource's allocations"""
+        rate = Rate.objects.get(product__product_name=self.storage_resource.name, is_active=True)
+        rate.price = 200
+        with self.captureOnCommitCallbacks(execute=True):
+            rate.save()
+        summary = AllocationSummary.objects.get(allocation=self.storage_allocation)
+        self.assertEqual(summary.cost, 200)
+
+    def test_checker_reports_stale_summaries(self):
+        """the checker lists missing summaries and differing fields"""
+        AllocationSummary.objects.filter(allocation=self.storage_allocation).update(size=1)
+        AllocationSummary.objects.filter(allocation=self.cluster_allocation).delete()
+        problems = check_allocation_summaries()
+        self.assertEqual(problems[self.storage_allocation.pk], [('size', 1, 100)])
+        self.assertIsNone(problems[self.cluster_allocation.pk])
+
+    def test_sort_and_filter_in_sql(self):
+        """allocations can be ordered and filtered by their summaries"""
+        self.assertEqual(
+            list(Allocation.objects.filter(summary__percent_full__gte=5)),
+            [self.storage_allocation],
+        )
+        self.assertEqual(
+            Allocation.objects.order_by('-summary__size').first(), self.storage_allocation
+        )
@@ -0,0 +1,143 @@
+"""Unit tests for the storage quota sources"""
+
+import threading
+from unittest import mock
+
+from django.test import SimpleTestCase, TestCase
+
+from coldfront.core.allocation.models import Allocation, AllocationAttributeType
+from coldfront.core.allocation.quota_sources import (
+    TIB,
+    QuotaRecord,
+    QuotaSource,
+    poll_quota_sources,
+    write_quota_records,
+)
+from coldfront.core.test_helpers.factories import setup_models, AllocationAttributeFactory
+
+UTIL_FIXTURES = [
+    "coldfront/core/test_helpers/test_data/test_fixtures/ifx.json",
+]
+
+
+class FakeQuotaSource(QuotaSource):
+    """Stand-in for a storage backend that returns canned records"""
+    size_attribute_name = 'Storage Quota (TB)'
+
+    def __init__(self, records=(), resource=None, name=None, error=None, block=None, timeout=None):
+        super().__init__(resource, timeout=timeout)
+        if name:
+            self.name = name
+        self.records = list(records)
+        self.error = error
+        self.block = block
+
+    def list_quotas(self):
+        if self.block is not None:
+            self.block.wait(5)
+        if self.error is not None:
+            raise self.error
+        return self.records
+
+
+class PollQuotaSourcesTests(SimpleTestCase):
+    """Tests for poll_quota_sources"""
+
+    def test_results_in_source_order(self):
+        """every source gets a result with its records and timing"""
+        records = [QuotaRecord('/a', 'a_lab', 10, 5)]
+        sources = [FakeQuotaSource(records, name='one'), FakeQuotaSource(name='two')]
+        results = poll_quota_sources(sources)
+        self.assertEqual([r.source for r in results], sources)
+        self.assertTrue(all(r.ok for r in results))
+        self.assertEqual(results[0].records, records)
+        self.assertGreaterEqual(results[0].elapsed, 0)
+        self.assertIn('one: 1 quotas in', results[0].summary())
+
+    def test_failing_source_does_not_stop_others(self):
+        """a source that raises gets a failed result"""
+        results = poll_quota_sources([
+            FakeQuotaSource(name='broken', error=ConnectionError('refused')),
+            FakeQuotaSource([QuotaRecord('/a', 'a_lab', 10, 5)], name='working'),
+        ])
+        self.assertFalse(results[0].ok)
+        self.assertIsInstance(results[0].error, ConnectionError)
+        self.assertEqual(len(results[1].records), 1)
+
+    def test_slow_source_times_out(self):
+        """a source that doesn't answer within its timeout gets a failed result"""
+        block = threading.Event()
+        try:
+            results = poll_quota_sources([
+                FakeQuotaSource(name='slow', block=block, timeout=0.05),
+                FakeQuotaSource([QuotaRecord('/a', 'a_lab', 10, 5)], name='fast'),
+            ])
+        finally:
+            block.set()
+        self.assertIsInstance(results[0].error, TimeoutError)
+        self.assertTrue(results[1].ok)
+
+    def test_hung_source_thread_is_daemon(self):
+        """a source hung past its timeout is left in a thread that can't block exit"""
+        block = threading.Event()
+        try:
+            poll_quota_sources([FakeQuotaSource(name='hung', block=block, timeout=0.01)])
+            hung = [t for t in threading.enumerate() if t.name.startswith('quota-source-')]
+            self.assertTrue(hung)
+            self.assertTrue(all(t.daemon for t in hung))
+        finally:
+            block.set()
+
+
+class WriteQuotaRecordsTests(TestCase):
+    """Tests for write_quota_records"""
+    fixtures = UTIL_FIXTURES
+
+    @classmethod
+    def setUpTestData(cls):
+        """Set up a storage allocation with a path"""
+        setup_models(cls)
+        AllocationAttributeFactory(
+            allocation=cls.storage_allocation,
+            allocation_attribute_type=AllocationAttributeType.objects.get(name='Subdirectory'),
+            value='rc_labs/poisson_lab',
+        )
+
+    def test_records_written_to_matching_allocations(self):
+        """quota and usage values are saved to the allocation with the record's path"""
+        source = FakeQuotaSource(resource=self.storage_resource)
+        report = write_quota_records(source, [
+            QuotaRecord('/rc_labs/poisson_lab/', 'poisson_lab', 2 * TIB, TIB),
+            QuotaRecord('/rc_labs/other_lab', 'other_lab', TIB, 0),
+        ])
+        self.assertEqual(report['complete'], 1)
+        self.assertEqual(report['unmatched records'], 1)
+        self.assertEqual(report['changes']['attributes updated'], 2)
+        allocation = Allocation.objects.get(pk=self.storage_allocation.pk)
+        self.assertEqual(allocation.get_attribute('Quota_In_Bytes'), 2 * TIB)
+        self.assertEqual(allocation.size, 2)
+        self.assertEqual(allocation.usage, 1)
+
+    @mock.patch('coldfront.plugins.ifx.models.update_allocation_product')
+    def test_quota_change_updates_product(self, update_allocation_product):
+        """a changed storage quota updates the allocation's Product"""
+        source = FakeQuotaSource(resource=self.storage_resource)
+        write_quota_records(source, [
+            QuotaRecord('/rc_labs/poisson_lab', 'poisson_lab', 3 * TIB, TIB),
+        ])
+        update_allocation_product.assert_called_once()
+        self.assertEqual(
+            update_allocation_product.call_args.args[0].pk, self.storage_allocation.pk
+        )
+
+    def test_empty_quota_and_missing_entry_reported(self):
+        """allocations without a record or with no limit are reported and left alone"""
+        source = FakeQuotaSource(resource=self.storage_resource)
+        report = write_quota_records(source, [])
+        self.assertEqual(len(report['no entry']), 1)
+        report = write_quota_records(source, [
+            QuotaRecord('rc_labs/poisson_lab', 'poisson_lab', None, 10),
+        ])
+        self.assertEqual(len(report['empty quota']), 1)
+        self.assertEqual(report['changes'], {})
+        self.assertEqual(self.storage_allocation.size, 100)
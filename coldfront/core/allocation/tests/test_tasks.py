@@ -1,4 +1,7 @@
 
+from unittest.mock import patch
+
+from django.core import mail
 from django.test import TestCase
 
 from django.utils import timezone
@@ -6,10 +9,13 @@ from django.utils import timezone
 from coldfront.core.allocation.models import AllocationStatusChoice
 from coldfront.core.test_helpers.factories import (
     setup_models,
+    AAttributeTypeFactory,
     AllocationFactory,
+    AllocationAttributeFactory,
+    AllocationAttributeTypeFactory,
     AllocationChangeRequestFactory,
 )
-from coldfront.core.allocation.tasks import send_request_reminder_emails
+from coldfront.core.allocation.tasks import send_expiry_emails, send_request_reminder_emails
 
 UTIL_FIXTURES = [
     "coldfront/core/test_helpers/test_data/test_fixtures/ifx.json",
@@ -51,3 +57,54 @@ class RequestReminderEmails(TestCase):
     def test_send_request_reminder_emails(self):
         """test send_request_reminder_emails task"""
         pending_changerequests, pending_allocations = send_request_reminder_emails()
+
+
+@patch('coldfront.core.utils.mail.EMAIL_ENABLED', True)
+@patch('coldfront.core.allocation.tasks.EMAIL_SENDER', 'test-admin@coldfront.org')
+@patch('coldfront.core.allocation.tasks.EMAIL_ALLOCATION_EXPIRING_NOTIFICATION_DAYS', [7, 30])
+class ExpiryEmails(TestCase):
+    """Tests for send_expiry_emails"""
+    fixtures = UTIL_FIXTURES
+
+    @classmethod
+    def setUpTestData(cls):
+        """storage allocation expires tomorrow, cluster allocation in 7 days"""
+        setup_models(cls)
+        today = timezone.now().date()
+        cls.storage_allocation.end_date = today + timezone.timedelta(days=1)
+        cls.storage_allocation.save()
+        cls.cluster_allocation.end_date = today + timezone.timedelta(days=7)
+        cls.cluster_allocation.save()
+        cls.expire_notification = AllocationAttributeFactory(
+            allocation=cls.storage_allocation,
+            allocation_attribute_type=AllocationAttributeTypeFactory(
+                name='EXPIRE NOTIFICATION',
+                attribute_type=AAttributeTypeFactory(name='Yes/No'),
+            ),
+            value='Yes',
+        )
+
+    def test_send_expiry_emails(self):
+        """only allocation users who are notified project users get emails"""
+        expired, expiring = send_expiry_emails()
+        self.assertEqual(expired, [self.proj_allocationuser.email])
+        self.assertEqual(expiring, [self.proj_allocationuser.email])
+        self.assertEqual(len(mail.outbox), 2)
+        for message in mail.outbox:
+            self.assertEqual(message.to, [self.proj_allocationuser.email])
+        self.assertIn(self.project.title, mail.outbox[1].body)
+        self.assertIn('Allocation(s) expiring in 7 days', mail.outbox[1].body)
+
+    def test_notifications_can_be_disabled(self):
+        """opted out project users and allocations don't get emails"""
+        self.expire_notification.value = 'No'
+        self.expire_notification.save()
+        self.npu.enable_notifications = False
+        self.npu.save()
+        self.assertEqual(send_expiry_emails(), ([], []))
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_query_count_independent_of_users(self):
+        """targets are loaded in a fixed number of queries"""
+        with self.assertNumQueries(4):
+            send_expiry_emails()
@@ -0,0 +1,93 @@
+"""Unit tests for the allocation utils"""
+from unittest import mock
+
+from django.test import TestCase
+
+from coldfront.core.allocation.models import Allocation, AllocationAttributeType
+from coldfront.core.allocation.utils import bulk_set_attribute_values_and_usages
+from coldfront.core.test_helpers.factories import (
+    setup_models,
+    AllocationAttributeTypeFactory,
+)
+
+UTIL_FIXTURES = [
+    "coldfront/core/test_helpers/test_data/test_fixtures/ifx.json",
+]
+
+
+class BulkSetAttributeValuesTests(TestCase):
+    """Tests for bulk_set_attribute_values_and_usages"""
+    fixtures = UTIL_FIXTURES
+
+    @classmethod
+    def setUpTestData(cls):
+        """Set up allocations with quota attributes"""
+        setup_models(cls)
+        cls.quota_bytes_type = AllocationAttributeType.objects.get(name='Quota_In_Bytes')
+        cls.quota_tb_type = AllocationAttributeType.objects.get(name='Storage Quota (TB)')
+
+    def _allocation(self):
+        return Allocation.objects.filter(
+            pk=self.storage_allocation.pk
+        ).with_attribute_snapshot().get()
+
+    def test_unchanged_values_are_not_written(self):
+        """values that already match are counted but not saved"""
+        allocation = self._allocation()
+        with self.assertNumQueries(0):
+            counts = bulk_set_attribute_values_and_usages([
+                (allocation, self.quota_bytes_type, 109951162777600, 10995116277760),
+                (allocation, self.quota_tb_type, 100, 10),
+            ])
+        self.assertEqual(counts['attributes unchanged'], 2)
+        self.assertEqual(counts['usages unchanged'], 2)
+
+    def test_changed_values_are_updated(self):
+        """changed values and usages are written and the snapshot is cleared"""
+        allocation = self._allocation()
+        counts = bulk_set_attribute_values_and_usages([
+            (allocation, self.quota_tb_type, 200, 10),
+            (allocation, self.quota_bytes_type, 109951162777600, 20),
+        ])
+        self.assertEqual(counts['attributes updated'], 1)
+        self.assertEqual(counts['usages updated'], 1)
+        self.assertEqual(allocation.get_attribute('Storage Quota (TB)'), 200)
+        quota_bytes = allocation.get_full_attribute('Quota_In_Bytes')
+        self.assertEqual(quota_bytes.allocationattributeusage.value, 20)
+        self.assertEqual(
+            quota_bytes.allocationattributeusage.history.first().history_change_reason,
+            'quota update',
+        )
+
+    def test_missing_attributes_are_created_with_usages(self):
+        """attributes missing from the allocation are created with their usage"""
+        new_type = AllocationAttributeTypeFactory(name='Storage Quota (TiB)', has_usage=True)
+        allocation = self._allocation()
+        counts = bulk_set_attribute_values_and_usages([
+            (allocation, new_type, 90.9, 9.1),
+        ], change_reason='test')
+        self.assertEqual(counts['attributes created'], 1)
+        self.assertEqual(counts['usages created'], 1)
+        attribute = allocation.get_full_attribute('Storage Quota (TiB)')
+        self.assertEqual(attribute.value, '90.9')
+        self.assertEqual(attribute.allocationattributeusage.value, 9.1)
+        self.assertEqual(attribute.history.first().history_change_reason, 'test')
+
+    @mock.patch('coldfront.plugins.ifx.models.update_allocation_product')
+    def test_product_updated_after_bulk_write(self, update_allocation_product):
+        """a bulk change to a storage quota updates the allocation's Product once"""
+        allocation = self._allocation()
+        bulk_set_attribute_values_and_usages([
+            (allocation, self.quota_tb_type, 200, 10),
+            (allocation, self.quota_bytes_type, 219902325555200, 10995116277760),
+        ])
+        update_allocation_product.assert_called_once()
+        self.assertEqual(update_allocation_product.call_args.args[0].pk, allocation.pk)
+
+        update_allocation_product.reset_mock()
+        # only Quota_In_Bytes changes, which isn't part of the Product
+        bulk_set_attribute_values_and_usages([
+            (self._allocation(), self.quota_tb_type, 200, 10),
+            (self._allocation(), self.quota_bytes_type, 109951162777600, 10995116277760),
+        ])
+        update_allocation_product.assert_not_called()
@@ -1,7 +1,11 @@
 import logging
+from contextlib import nullcontext
+from unittest.mock import patch
 
+from django.db import connection
 from django.db.models import Count
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
 from coldfront.core.test_helpers import utils
@@ -168,6 +172,25 @@ class AllocationListViewTest(AllocationViewBaseTest):
         response = self.client.get("/allocation/?show_all_allocations=on")
         self.assertEqual(len(response.context['item_list']), 0)
 
+    @patch('coldfront.core.allocation.views.ALLOCATION_LIST_PAGE_SIZE', 20)
+    def test_allocation_list_keyset_pages(self):
+        """show_all_allocations pages follow one another without gaps or repeats"""
+        self.client.force_login(self.admin_user, backend=BACKEND)
+        for order in ('order_by=id', 'order_by=id&direction=des', 'order_by=project__title'):
+            seen = []
+            url = f"/allocation/?show_all_allocations=on&{order}"
+            response = self.client.get(url)
+            while True:
+                page = response.context['page_obj']
+                self.assertLessEqual(len(page), 20)
+                seen.extend(allocation.pk for allocation in page)
+                if not page.next_cursor:
+                    break
+                response = self.client.get(f"{url}&after={page.next_cursor}")
+            self.assertEqual(sorted(seen), sorted(Allocation.objects.values_list('pk', flat=True)))
+            if order == 'order_by=id&direction=des':
+                self.assertEqual(seen, sorted(seen, reverse=True))
+
     def test_allocation_list_search_admin(self):
         """Confirm that AllocationList search works for admin"""
         self.client.force_login(self.admin_user, backend=BACKEND)
@@ -380,6 +403,19 @@ class AllocationDetailViewTest(AllocationViewBaseTest):
             self, self.proj_allocationuser, self.url, 'Remove Users'
         )
 
+    def test_allocationdetail_resolves_permissions_once(self):
+        """project and allocation permissions are resolved once per request"""
+        self.client.force_login(self.proj_datamanager, backend="django.contrib.auth.backends.ModelBackend")
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['user_can_manage_allocation'])
+        with CaptureQueriesContext(connection) as cached:
+            self.client.get(self.url)
+        with patch('coldfront.core.utils.middleware.permission_cache', nullcontext):
+            with CaptureQueriesContext(connection) as uncached:
+                self.client.get(self.url)
+        self.assertLess(len(cached), len(uncached))
+
 
 class AllocationDetailViewPostTest(AllocationViewBaseTest):
     def setUp(self):
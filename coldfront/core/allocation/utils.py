@@ -1,10 +1,18 @@
 import logging
+from collections import Counter
+
+from django.db import transaction
 from django.db.models import Q
+from simple_history.utils import bulk_create_with_history, bulk_update_with_history
 
 from coldfront.core.allocation.models import (Allocation,
+                                              AllocationAttribute,
+                                              AllocationAttributeUsage,
                                               AllocationStatusChoice,
                                               AllocationUser,
-                                              AllocationUserStatusChoice)
+                                              AllocationUserStatusChoice,
+                                              schedule_summary_refresh)
+from coldfront.core.allocation.signals import allocation_attributes_bulk_saved
 from coldfront.core.resource.models import Resource
 
 logger = logging.getLogger(__name__)
@@ -45,6 +53,110 @@ def get_or_create_allocation(project_obj, resource_obj):
         created = True
     return allocation, created
 
+def bulk_set_attribute_values_and_usages(updates, change_reason='quota update'):
+    """Write allocation attribute values and their usages with bulk queries,
+    skipping rows whose stored values already match.
+
+    Params:
+        updates (iterable): (allocation, allocation_attribute_type, value, usage)
+            tuples. Each allocation should come from
+            AllocationQuerySet.with_attribute_snapshot() so that current values
+            are read without further queries. usage may be None to leave the
+            usage alone.
+        change_reason (str): history change reason for the written rows
+
+    Sends allocation_attributes_bulk_saved with the created and updated
+    attributes, since the bulk queries send no post_save.
+
+    Returns:
+        Counter: numbers of attributes and usages created, updated and unchanged
+    """
+    updates = list(updates)
+    counts = Counter()
+    attribute_creates = []
+    attribute_updates = []
+    usage_creates = []
+    usage_updates = []
+    new_attribute_usages = []
+    for allocation, attribute_type, value, usage in updates:
+        value = str(value)
+        attribute = allocation.get_full_attribute(attribute_type.name)
+        if attribute is None:
+            attribute = AllocationAttribute(
+                allocation=allocation, allocation_attribute_type=attribute_type, value=value,
+            )
+            attribute_creates.append(attribute)
+            counts['attributes created'] += 1
+            if usage is not None or attribute_type.has_usage:
+                new_attribute_usages.append((attribute, usage))
+            continue
+        if attribute.value != value:
+            attribute.value = value
+            attribute_updates.append(attribute)
+            counts['attributes updated'] += 1
+        else:
+            counts['attributes unchanged'] += 1
+        if usage is None:
+            continue
+        if hasattr(attribute, 'allocationattributeusage'):
+            attribute_usage = attribute.allocationattributeusage
+            if attribute_usage.value != float(usage):
+                attribute_usage.value = usage
+                usage_updates.append(attribute_usage)
+                counts['usages updated'] += 1
+            else:
+                counts['usages unchanged'] += 1
+        else:
+            usage_creates.append(
+                AllocationAttributeUsage(allocation_attribute=attribute, value=usage)
+            )
+            counts['usages created'] += 1
+
+    with transaction.atomic():
+        if attribute_updates:
+            bulk_update_with_history(
+                attribute_updates, AllocationAttribute, ['value'],
+                batch_size=500, default_change_reason=change_reason,
+            )
+        if usage_updates:
+            bulk_update_with_history(
+                usage_updates, AllocationAttributeUsage, ['value'],
+                batch_size=500, default_change_reason=change_reason,
+            )
+        if attribute_creates:
+            # the returned objects carry pks even on backends that can't return them from bulk_create
+            created = bulk_create_with_history(
+                attribute_creates, AllocationAttribute,
+                batch_size=500, default_change_reason=change_reason,
+            )
+            pks = {
+                (attribute.allocation_id, attribute.allocation_attribute_type_id): attribute.pk
+                for attribute in created
+            }
+            for attribute, usage in new_attribute_usages:
+                attribute.pk = pks[(attribute.allocation_id, attribute.allocation_attribute_type_id)]
+                usage_creates.append(AllocationAttributeUsage(
+                    allocation_attribute=attribute, value=usage or 0,
+                ))
+                counts['usages created'] += 1
+        if usage_creates:
+            bulk_create_with_history(
+                usage_creates, AllocationAttributeUsage,
+                batch_size=500, default_change_reason=change_reason,
+            )
+    changed = {attribute.allocation_id for attribute in attribute_creates + attribute_updates}
+    changed.update(usage.allocation_attribute.allocation_id for usage in usage_creates + usage_updates)
+    for allocation, *_ in updates:
+        if allocation.pk in changed:
+            allocation.clear_attribute_snapshot()
+    # the bulk writes send no post_save, so receivers of attribute changes get this instead
+    schedule_summary_refresh(changed)
+    if attribute_creates or attribute_updates:
+        allocation_attributes_bulk_saved.send(
+            sender=AllocationAttribute, attributes=attribute_creates + attribute_updates,
+        )
+    return counts
+
 def set_allocation_user_status_to_error(allocation_user_pk):
     allocation_user_obj = AllocationUser.objects.get(pk=allocation_user_pk)
     error_status = AllocationUserStatusChoice.objects.get(name='Error')
@@ -14,7 +14,7 @@ from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import get_user_model
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
-from django.db.models import Q
+from django.db.models import Exists, OuterRef, Q
 from django.forms import formset_factory
 from django.http import (HttpResponseRedirect,
                         JsonResponse, HttpResponse,
@@ -28,7 +28,12 @@ from django.template.loader import render_to_string
 from django.views.generic import ListView, TemplateView
 from django.views.generic.edit import CreateView, FormView
 
-from coldfront.core.utils.views import ColdfrontListView, NoteCreateView, NoteUpdateView
+from coldfront.core.utils.views import (
+    ColdfrontListView,
+    NoteCreateView,
+    NoteUpdateView,
+    keyset_paginate,
+)
 from coldfront.core.user.forms import UserSearchForm
 from coldfront.core.allocation.forms import (AllocationAccountForm,
                                              AllocationAddUserForm,
@@ -75,7 +80,7 @@ from coldfront.core.allocation.utils import (generate_guauge_data_from_usage,
                                             check_l3_tag,
                                              get_user_resources)
 from coldfront.core.project.models import (Project, ProjectPermission,
-                                           ProjectUserStatusChoice)
+                                           ProjectUser, ProjectUserStatusChoice)
 from coldfront.core.resource.models import Resource
 from coldfront.core.utils.common import get_domain_url, import_from_settings
 from coldfront.core.utils.mail import send_allocation_admin_email, send_allocation_customer_email
@@ -112,41 +117,40 @@ ACTIVE_ALLOCATION_STATUSES = import_from_settings(
     'ACTIVE_ALLOCATION_STATUSES', ['Active'])
 PENDING_ACTIVE_ALLOCATION_STATUSES = import_from_settings(
     'PENDING_ACTIVE_ALLOCATION_STATUSES', ['Active', 'New', 'Renewal Requested'])
+ALLOCATION_LIST_PAGE_SIZE = import_from_settings('ALLOCATION_LIST_PAGE_SIZE', 500)
 
 logger = logging.getLogger(__name__)
 
 
 def allocation_filter(allocations, user):
-    """Offer a definitive list of the allocations that are shown to a user"""
+    """Offer a definitive list of the allocations that are shown to a user.
+
+    Each way a user can see an allocation is an Exists() subquery, so the
+    allocations are not multiplied by joins and need no distinct().
+    """
+    active_projectuser = ProjectUser.objects.filter(
+        project=OuterRef('project'), user=user, status__name='Active'
+    )
+    active_allocationuser = AllocationUser.objects.filter(
+        allocation=OuterRef('pk'), user=user, status__name='Active'
+    )
+    resources = Allocation.resources.through.objects.filter(allocation=OuterRef('pk'))
     allocations = allocations.filter(
         Q(status__name__in=['Active', 'New', 'Renewal Requested', ]) &
         Q(project__status__name__in=['New', 'Active', ]) &
-        # Q(project__projectuser__status__name='Active') &
-        # Q(project__projectuser__user=self.request.user) &
         (
             (
-                (
-                    Q(resources__resource_type__name__contains='Storage') &
-                    (
-                        (Q(project__projectuser__user=user) &
-                        Q(project__projectuser__status__name='Active')) |
-                        (Q(allocationuser__user=user) &
-                        Q(allocationuser__status__name='Active'))
-                    )
-                ) | (
-                    Q(resources__resource_type__name__contains='Cluster') &
-                    Q(allocationuser__user=user) &
-                    Q(allocationuser__status__name='Active')
-                )
+                Exists(resources.filter(resource__resource_type__name__contains='Storage')) &
+                (Exists(active_projectuser) | Exists(active_allocationuser))
+            ) | (
+                Exists(resources.filter(resource__resource_type__name__contains='Cluster')) &
+                Exists(active_allocationuser)
             ) |
             Q(project__pi=user) |
-            Q(resources__allowed_users=user) | (
-                Q(project__projectuser__user=user) &
-                Q(project__projectuser__status__name='Active') &
-                Q(project__projectuser__role__name__contains='Manager')
-            )
+            Exists(resources.filter(resource__allowed_users=user)) |
+            Exists(active_projectuser.filter(role__name__contains='Manager'))
         )
-    ).distinct()
+    )
     return allocations
 
 def attribute_and_usage_as_floats(attribute):
@@ -566,13 +570,16 @@ class AllocationListView(ColdfrontListView):
             'project', 'project__pi', 'status',
         ).prefetch_related(
             'resources', 'allocationuser_set', 'allocationuser_set__status',
-        ).exclude(status__name='Merged')
+        ).with_attribute_snapshot().with_parent_resource().exclude(status__name='Merged')
+        resources = Allocation.resources.through.objects.filter(allocation=OuterRef('pk'))
+        self.show_all = False
         if allocation_search_form.is_valid():
             data = allocation_search_form.cleaned_data
 
             if data.get('show_all_allocations') and (
                 self.request.user.is_superuser or self.request.user.has_perm(
             'allocation.can_view_all_allocations')):
+                self.show_all = True
                 allocations = allocations.order_by(order_by)
             else:
                 allocations = allocation_filter(allocations, self.request.user)
@@ -587,27 +594,32 @@ class AllocationListView(ColdfrontListView):
             if data.get('username'):
                 allocations = allocations.filter(
                     Q(project__pi__username__icontains=data.get('username')) |
-                    Q(allocationuser__user__username__icontains=data.get('username')) &
-                    Q(allocationuser__status__name='Active')
+                    Exists(AllocationUser.objects.filter(
+                        allocation=OuterRef('pk'),
+                        user__username__icontains=data.get('username'),
+                        status__name='Active',
+                    ))
                 )
 
             # Resource Type
             if data.get('resource_type'):
-                allocations = allocations.filter(
-                    resources__resource_type=data.get('resource_type')
-                )
+                allocations = allocations.filter(Exists(
+                    resources.filter(resource__resource_type=data.get('resource_type'))
+                ))
             # Resource Name
             if data.get('resource_name'):
-                allocations = allocations.filter(
-                    resources__in=data.get('resource_name')
-                )
+                allocations = allocations.filter(Exists(
+                    resources.filter(resource__in=data.get('resource_name'))
+                ))
             # Allocation Attribute Name
             if data.get('allocation_attribute_name') and data.get('allocation_attribute_value'):
-                allocations = allocations.filter(
-                    Q(allocationattribute__allocation_attribute_type=data.get(
-                        'allocation_attribute_name')) &
-                    Q(allocationattribute__value=data.get('allocation_attribute_value'))
-                )
+                allocations = allocations.filter(Exists(
+                    AllocationAttribute.objects.filter(
+                        allocation=OuterRef('pk'),
+                        allocation_attribute_type=data.get('allocation_attribute_name'),
+                        value=data.get('allocation_attribute_value'),
+                    )
+                ))
 
             # End Date
             if data.get('end_date'):
@@ -627,11 +639,18 @@ class AllocationListView(ColdfrontListView):
             if data.get('status'):
                 allocations = allocations.filter(status__in=data.get('status'))
         else:
-            allocations = allocations.filter(
-                Q(allocationuser__user=self.request.user)
-                & Q(allocationuser__status__name='Active')
-            ).order_by(order_by)
-        return allocations.distinct()
+            allocations = allocations.filter(Exists(AllocationUser.objects.filter(
+                allocation=OuterRef('pk'), user=self.request.user, status__name='Active',
+            ))).order_by(order_by)
+        return allocations
+
+    def get_paginate_by(self, queryset):
+        # the full list of allocations is read a page at a time
+        return ALLOCATION_LIST_PAGE_SIZE if self.show_all else None
+
+    def paginate_queryset(self, queryset, page_size):
+        page = keyset_paginate(queryset, self.request.GET.get('after'), page_size)
+        return None, page, page.object_list, False
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(
@@ -1731,7 +1750,7 @@ class AllocationRequestListView(LoginRequiredMixin, UserPassesTestMixin, Templat
         context = super().get_context_data(**kwargs)
         allocation_list = Allocation.objects.filter(
             status__name__in=PENDING_ALLOCATION_STATUSES
-        )
+        ).with_parent_resource()
         AllocationFormSet = formset_factory(
             AllocationUpdateForm, max_num=len(allocation_list),
         )
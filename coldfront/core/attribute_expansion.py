@@ -7,6 +7,8 @@
 
 import logging
 import math
+from collections import namedtuple
+from functools import lru_cache
 
 
 logger = logging.getLogger(__name__)
@@ -16,6 +18,19 @@ logger = logging.getLogger(__name__)
 
 ATTRIBUTE_EXPANSION_TYPE_PREFIX = 'Attribute Expanded'
 ATTRIBUTE_EXPANSION_ATTRIBLIST_SUFFIX = '_attriblist'
+# Number of distinct attriblist strings kept by compile_attriblist
+ATTRIBUTE_EXPANSION_CACHE_SIZE = 256
+# Prefixes marking an argument as a parameter/attribute reference
+ATTRIBUTE_PARAMETER_SOURCES = [ ':APDICT', 'RESOURCE:', 'ALLOCATION:', ':' ]
+
+# Compiled form of a single attribute parameter statement.  Argument is a
+# ParameterArgument, or for the '(' opcode the name of the function to apply.
+ParameterStatement = namedtuple(
+    'ParameterStatement', ['parameter_string', 'pname', 'opcode', 'argument'])
+# Compiled form of an argument.  Source is None for constants (value is the
+# constant), else one of ATTRIBUTE_PARAMETER_SOURCES (value is the name to
+# look up).
+ParameterArgument = namedtuple('ParameterArgument', ['source', 'value'])
 
 
 def is_expandable_type(attribute_type):
@@ -119,8 +134,7 @@ def get_attribute_parameter_value(
     # If argument if prefixed with any of the strings in attrib_sources,
     # strip the prefix and set attrib_source accordingly
     attrib_source = None
-    attrib_sources = [ ':APDICT', 'RESOURCE:', 'ALLOCATION:', ':' ]
-    for asrc in attrib_sources:
+    for asrc in ATTRIBUTE_PARAMETER_SOURCES:
         if argument.startswith(asrc):
             # Got a match
             attrib_source = asrc
@@ -251,6 +265,7 @@ def process_attribute_parameter_operation(
         if opcode == '(':
             if argument == 'floor':
                 newval = math.floor(oldvalue)
+                return newval
             else:
                 logger.error(
                     'Unrecognized function named %s in %s= for %s, returning None',
@@ -319,16 +334,17 @@ def process_attribute_parameter_string(
     opcode = pname[-1:]
     pname = pname[:-1].strip()
 
+    # Extra text to display in diagnostics if error occurs
+    error_text = 'processing attribute_parameter_string={pstr} ' \
+        'for expansion of attribute {aname}'.format(
+        pstr = parameter_string, aname=attribute_name)
+
     # Argument is a parameter/attribute/constant unless opcode is '('
     # So get its value if parameter/attribute/constant
     value = None
     if opcode == '(':
         value = argument
     else:
-        # Extra text to display in diagnostics if error occurs
-        error_text = 'processing attribute_parameter_string={pstr} ' \
-            'for expansion of attribute {aname}'.format(
-            pstr = parameter_string, aname=attribute_name)
         value = get_attribute_parameter_value(
             argument = argument,
             attribute_parameter_dict = attribute_parameter_dict,
@@ -389,6 +405,127 @@ def make_attribute_parameter_dictionary(attribute_name,
     return apdict
 
 
+def compile_parameter_argument(argument):
+    """Compiles the argument of an attribute parameter statement.
+
+    This parses argument the same way get_attribute_parameter_value does,
+    but without evaluating it, and returns a ParameterArgument.  String and
+    numeric literals become constants (source None); parameter and
+    attribute references keep their source prefix so they can be looked
+    up at evaluation time.  Arguments which cannot be parsed compile to
+    the constant None.
+    """
+    if argument.startswith("'"):
+        tmpstr = argument[1:]
+        if tmpstr[-1:] == "'":
+            return ParameterArgument(None, tmpstr[:-1])
+        logger.warning(
+            "Bad string literal '%s' found while compiling attriblist; missing final single quote",
+            argument)
+        return ParameterArgument(None, None)
+
+    for asrc in ATTRIBUTE_PARAMETER_SOURCES:
+        if argument.startswith(asrc):
+            return ParameterArgument(asrc, argument[len(asrc):])
+
+    try:
+        return ParameterArgument(None, int(argument))
+    except ValueError:
+        try:
+            return ParameterArgument(None, float(argument))
+        except ValueError:
+            logger.warning("Unable to compile argument '%s' in attriblist, "
+                "using None", argument)
+            return ParameterArgument(None, None)
+
+
+@lru_cache(maxsize=ATTRIBUTE_EXPANSION_CACHE_SIZE)
+def compile_attriblist(attribute_parameter_string):
+    """Compiles an attriblist string into a tuple of ParameterStatements.
+
+    The statements are parsed exactly as process_attribute_parameter_string
+    would parse them (blank lines, comments and lines without '=' are
+    dropped), but only once per distinct attriblist string: results are
+    kept in an LRU cache of ATTRIBUTE_EXPANSION_CACHE_SIZE entries keyed
+    on the attriblist text.  Use evaluate_attriblist to produce the
+    attribute parameter dictionary from the compiled statements.
+    """
+    statements = []
+    for parameter_string in attribute_parameter_string.splitlines():
+        parmstr = parameter_string.strip()
+        if not parmstr or parmstr.startswith('#'):
+            continue
+        tmp = parmstr.split('=', 1)
+        if len(tmp) != 2:
+            logger.error("Invalid parameter string '%s', no '=', while "
+                "compiling attriblist", parmstr)
+            continue
+        pname = tmp[0]
+        argument = tmp[1].strip()
+        opcode = pname[-1:]
+        pname = pname[:-1].strip()
+        if opcode != '(':
+            argument = compile_parameter_argument(argument)
+        statements.append(ParameterStatement(parmstr, pname, opcode, argument))
+    return tuple(statements)
+
+
+def evaluate_parameter_argument(argument, attribute_parameter_dict,
+        resources=[], allocations=[]):
+    """Evaluates a compiled ParameterArgument.
+
+    Lookups follow the same order as get_attribute_parameter_value: the
+    attribute_parameter_dict, then allocations, then resources.  The
+    allocations and resources are read through get_attribute, so when their
+    attribute snapshots are loaded no queries are made.
+    """
+    source, value = argument
+    if source is None:
+        return value
+
+    if source in [':', 'APDICT:'] and value in attribute_parameter_dict:
+        return attribute_parameter_dict[value]
+
+    if source in [':', 'ALLOCATION:']:
+        for alloc in allocations:
+            tmp = alloc.get_attribute(value)
+            if tmp is not None:
+                return tmp
+
+    if source in [':', 'RESOURCE:']:
+        for res in resources:
+            tmp = res.get_attribute(value)
+            if tmp is not None:
+                return tmp
+
+    return None
+
+
+def evaluate_attriblist(statements, attribute_name, resources=[], allocations=[]):
+    """Create the attribute parameter dictionary from compiled statements.
+
+    This is the compiled equivalent of make_attribute_parameter_dictionary;
+    statements should come from compile_attriblist.
+    """
+    apdict = dict()
+    for statement in statements:
+        error_text = 'processing attribute_parameter_string={pstr} ' \
+            'for expansion of attribute {aname}'.format(
+            pstr = statement.parameter_string, aname=attribute_name)
+        if statement.opcode == '(':
+            value = statement.argument
+        else:
+            value = evaluate_parameter_argument(
+                argument = statement.argument,
+                attribute_parameter_dict = apdict,
+                resources = resources,
+                allocations = allocations)
+        apdict[statement.pname] = process_attribute_parameter_operation(
+            opcode=statement.opcode, oldvalue=apdict.get(statement.pname),
+            argument=value, error_text=error_text)
+    return apdict
+
+
 def expand_attribute(raw_value, attribute_name, attriblist_string,
     resources = [], allocations = []):
     """Main method to expand parameters in an attribute.
@@ -429,7 +566,9 @@ def expand_attribute(raw_value, attribute_name, attriblist_string,
     This method will parse the attriblist_string to form an attribute
     parameter dictionary, which will then be used via the standard python
     format() method to expand the parameters in the raw_value.  If all
-    of this is successful, we return the expanded string.
+    of this is successful, we return the expanded string.  The
+    attriblist_string is compiled once with compile_attriblist and the
+    compiled statements reused for later expansions.
 
     On errors, we just return the raw_value
     """
@@ -437,8 +576,8 @@ def expand_attribute(raw_value, attribute_name, attriblist_string,
     # We wrap everything in a try block so we can return raw_value on error
     try:
         # Create the attribute parameter dictionary
-        apdict = make_attribute_parameter_dictionary(
-            attribute_parameter_string = attriblist_string,
+        apdict = evaluate_attriblist(
+            statements = compile_attriblist(attriblist_string),
             attribute_name = attribute_name,
             resources = resources,
             allocations = allocations)
@@ -0,0 +1,109 @@
+"""Index of the projects that department approvers may view.
+
+An approver of a "Research Computing Storage Billing" department can view the
+projects of the labs directly under that department. The project ids each
+approver can view are computed with one query from the nanites OrgRelation
+and UserAffiliation tables and the ProjectOrganization lab mapping, then kept
+in the APPROVER_INDEX_CACHE cache so a permission check is a single set lookup.
+
+Every cached index is tagged with a generation. Saving or deleting an
+Organization, OrgRelation, UserAffiliation or ProjectOrganization starts a new
+generation, which retires all cached indexes at once. Bulk updates that skip
+signals are picked up once APPROVER_INDEX_TIMEOUT runs out, or by calling
+invalidate_approver_index.
+
+Approver changes are often made by the nanites syncs running in other
+processes, so the index is only cached across requests when the cache is
+shared between processes. With a process-local cache, such as the default
+LocMemCache, it is kept for the length of a request in its PermissionCache.
+"""
+import uuid
+
+from django.db.models.signals import post_delete, post_save
+from ifxuser.models import Organization, OrgRelation, UserAffiliation
+
+from coldfront.core.utils.common import import_from_settings, shared_cache
+from coldfront.core.utils.permissions import clear_permission_cache, current_permission_cache
+
+APPROVER_INDEX_CACHE = import_from_settings('APPROVER_INDEX_CACHE', 'default')
+APPROVER_INDEX_TIMEOUT = import_from_settings('APPROVER_INDEX_TIMEOUT', 3600)
+APPROVER_ORG_TREE = 'Research Computing Storage Billing'
+
+_GENERATION_KEY = 'department_approver_index:generation'
+
+
+def _generation(cache):
+    return cache.get_or_set(_GENERATION_KEY, lambda: uuid.uuid4().hex, None)
+
+
+def compute_approver_project_ids(user):
+    """Return the ids of the projects whose lab sits directly under a
+    department the user is an approver of.
+    """
+    # imported here because the ifx plugin models import the project models
+    from coldfront.plugins.ifx.models import ProjectOrganization
+
+    lab_ids = OrgRelation.objects.filter(
+        parent__org_tree=APPROVER_ORG_TREE,
+        parent__useraffiliation__role='approver',
+        parent__useraffiliation__user=user,
+        child__rank='lab',
+    ).values('child_id')
+    return frozenset(
+        ProjectOrganization.objects.filter(
+            organization_id__in=lab_ids
+        ).values_list('project_id', flat=True)
+    )
+
+
+def approver_project_ids(user):
+    """Return the frozenset of project ids the user may view as a department
+    approver, cached in APPROVER_INDEX_CACHE if it is shared between
+    processes, else in the request's PermissionCache.
+    """
+    if not user.is_authenticated:
+        return frozenset()
+    cache = shared_cache(APPROVER_INDEX_CACHE)
+    if cache is None:
+        request_cache = current_permission_cache()
+        project_ids = request_cache.get('approver_index', None, user.pk) if request_cache else None
+        if project_ids is None:
+            project_ids = compute_approver_project_ids(user)
+            if request_cache is not None:
+                request_cache.set('approver_index', None, user.pk, project_ids)
+        return project_ids
+    key = f'department_approver_index:{_generation(cache)}:{user.pk}'
+    project_ids = cache.get(key)
+    if project_ids is None:
+        project_ids = compute_approver_project_ids(user)
+        cache.set(key, project_ids, APPROVER_INDEX_TIMEOUT)
+    return project_ids
+
+
+def invalidate_approver_index(**kwargs):
+    """Retire every cached approver index."""
+    cache = shared_cache(APPROVER_INDEX_CACHE)
+    if cache is not None:
+        cache.set(_GENERATION_KEY, uuid.uuid4().hex, None)
+    clear_permission_cache()
+
+
+# proxy models send their own signals, so they are listed alongside their bases
+APPROVER_INDEX_SOURCES = (
+    Organization,
+    OrgRelation,
+    UserAffiliation,
+    'ifx.ProjectOrganization',
+    'department.Department',
+    'department.DepartmentMember',
+    'department.DepartmentProject',
+)
+
+for _sender in APPROVER_INDEX_SOURCES:
+    _label = _sender if isinstance(_sender, str) else _sender._meta.label
+    post_save.connect(
+        invalidate_approver_index, sender=_sender, dispatch_uid=f'approver_index_save_{_label}'
+    )
+    post_delete.connect(
+        invalidate_approver_index, sender=_sender, dispatch_uid=f'approver_index_delete_{_label}'
+    )
@@ -1,11 +1,30 @@
 import logging
+from unittest import mock
+
 from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
+from coldfront.core.allocation.models import AllocationAttributeType, AllocationPermission
+from coldfront.core.project.models import Project, ProjectPermission
 from coldfront.core.test_helpers import utils
-from coldfront.core.test_helpers.factories import setup_models
-from coldfront.core.test_helpers.fasrc_factories import setup_departments
+from coldfront.core.test_helpers.factories import (
+    AllocationAttributeFactory,
+    AllocationFactory,
+    AllocationUserFactory,
+    setup_models,
+)
+from coldfront.core.test_helpers.fasrc_factories import setup_departments, OrgRelationFactory
+from coldfront.core.department.billing import DepartmentBillingSummary
 from coldfront.core.department.models import Department
+from coldfront.core.department.permissions import (
+    approver_project_ids,
+    invalidate_approver_index,
+)
+from coldfront.core.utils.permissions import permission_cache
+from coldfront.plugins.ifx.models import ProjectOrganization
 
 UTIL_FIXTURES = [
         "coldfront/core/test_helpers/test_data/test_fixtures/ifx.json",
@@ -113,3 +132,138 @@ class DepartmentDetailViewTest(DepartmentViewTest):
         #print("response USER:", response.context, "\n\n")
         # confirm that only the user's projects are visible
         self.assertEqual(len(response.context['projects']), 1)
+
+
+class ApproverIndexTest(DepartmentViewTest):
+    """Tests for the department approver permission index"""
+
+    def setUp(self):
+        self.dept_manager_user = get_user_model().objects.get(username='eostrom')
+        invalidate_approver_index()
+
+    def test_approver_sees_department_labs(self):
+        """approvers get user permissions on exactly the projects of their labs"""
+        dept2_proj = Project.objects.get(pi=self.dept_member_user)
+        self.assertTrue(self.project.has_perm(self.dept_manager_user, ProjectPermission.USER))
+        self.assertTrue(
+            self.storage_allocation.has_perm(self.dept_manager_user, AllocationPermission.USER)
+        )
+        self.assertFalse(dept2_proj.has_perm(self.dept_manager_user, ProjectPermission.USER))
+
+    def test_index_is_cached_in_shared_cache(self):
+        """with a cache shared between processes, the index is read without queries"""
+        with mock.patch(
+            'coldfront.core.department.permissions.shared_cache', return_value=caches['default']
+        ):
+            invalidate_approver_index()
+            approver_project_ids(self.dept_manager_user)
+            with self.assertNumQueries(0):
+                project_ids = approver_project_ids(self.dept_manager_user)
+        self.assertIn(self.project.pk, project_ids)
+
+    def test_index_is_not_kept_in_process_local_cache(self):
+        """with a process-local cache, the index is only kept for the request"""
+        approver_project_ids(self.dept_manager_user)
+        with self.assertNumQueries(1):
+            approver_project_ids(self.dept_manager_user)
+        with permission_cache():
+            approver_project_ids(self.dept_manager_user)
+            with self.assertNumQueries(0):
+                project_ids = approver_project_ids(self.dept_manager_user)
+        self.assertIn(self.project.pk, project_ids)
+
+    def test_index_invalidated_on_org_relation_change(self):
+        """adding a lab to the approver's department updates the index"""
+        dept2_proj = Project.objects.get(pi=self.dept_member_user)
+        self.assertNotIn(dept2_proj.pk, approver_project_ids(self.dept_manager_user))
+        OrgRelationFactory(
+            parent=self.school,
+            child=ProjectOrganization.objects.get(project=dept2_proj).organization,
+        )
+        self.assertIn(dept2_proj.pk, approver_project_ids(self.dept_manager_user))
+
+
+class DepartmentBillingSummaryTest(DepartmentViewTest):
+    """Tests for DepartmentBillingSummary"""
+
+    def setUp(self):
+        self.department = Department.objects.first()
+        self.requires_payment_type = AllocationAttributeType.objects.get(name='RequiresPayment')
+        self.quota_type = AllocationAttributeType.objects.get(name='Storage Quota (TB)')
+        AllocationAttributeFactory(
+            allocation=self.storage_allocation,
+            allocation_attribute_type=self.requires_payment_type,
+            value='True',
+        )
+
+    def add_storage_allocation(self, project):
+        allocation = AllocationFactory(project=project, justification=f'storage {project.pk}')
+        allocation.resources.add(self.storage_resource)
+        for attribute_type, value in (
+            (self.quota_type, 50), (self.requires_payment_type, 'True'),
+        ):
+            AllocationAttributeFactory(
+                allocation=allocation, allocation_attribute_type=attribute_type, value=value
+            )
+        AllocationUserFactory(allocation=allocation, user=self.proj_allocationuser)
+        return allocation
+
+    def test_summary_content(self):
+        """billed storage allocations are grouped by PI with their costs"""
+        summary = DepartmentBillingSummary(self.department.projects)
+        self.assertEqual(list(summary.storage_pi_dict), [self.pi_user])
+        [allocation] = summary.storage_pi_dict[self.pi_user]
+        self.assertEqual(allocation, self.storage_allocation)
+        self.assertEqual(allocation.user_count, 2)
+        self.assertEqual(float(allocation.cost), float(self.storage_allocation.cost))
+        self.assertEqual(summary.storage_full_price, float(self.storage_allocation.cost))
+        project = next(p for p in summary.projects if p == self.project)
+        self.assertEqual(project.allocs, [self.storage_allocation])
+        self.assertEqual(project.projectuser_count, self.project.projectuser_set.count())
+        self.assertEqual(summary.storage_bill_counts, (1, 1, 2))
+
+    def test_storage_without_quota_is_billed(self):
+        """billed storage allocations without a quota attribute stay in the bill"""
+        allocation = AllocationFactory(project=self.project, justification='no quota')
+        allocation.resources.add(self.storage_resource)
+        AllocationAttributeFactory(
+            allocation=allocation,
+            allocation_attribute_type=self.requires_payment_type,
+            value='True',
+        )
+        summary = DepartmentBillingSummary(self.department.projects)
+        billed = {a.pk: a for a in summary.storage_pi_dict[self.pi_user]}
+        self.assertIn(allocation.pk, billed)
+        self.assertEqual(billed[allocation.pk].size, 0)
+        project = next(p for p in summary.projects if p == self.project)
+        self.assertNotIn(allocation, project.allocs)
+        self.assertEqual(summary.storage_bill_counts[1], 2)
+
+    def test_query_count_is_constant(self):
+        """adding labs with billed allocations doesn't add queries"""
+        def count_queries():
+            with CaptureQueriesContext(connection) as queries:
+                summary = DepartmentBillingSummary(self.department.projects)
+                summary.storage_bill_counts
+                summary.active_allocation_counts
+            return len(queries.captured_queries)
+
+        baseline = count_queries()
+        for project in Project.objects.exclude(pi=self.dept_member_user):
+            self.add_storage_allocation(project)
+        self.assertEqual(count_queries(), baseline)
+
+    def test_views_agree(self):
+        """the department page and PDF report show the same storage bill"""
+        self.client.force_login(self.admin_user)
+        response = self.client.get(f"/department/{self.department.pk}/")
+        detail_table = dict(response.context['detail_table'])
+        summary = DepartmentBillingSummary(self.department.projects.filter(status__name='Active'))
+        self.assertEqual(
+            detail_table['Total Amount Due, Monthly Storage'],
+            f'${round(summary.storage_full_price, 2)}',
+        )
+        self.assertEqual(
+            {pi: [a.pk for a in allocs] for pi, allocs in response.context['storage_pi_dict'].items()},
+            {pi: [a.pk for a in allocs] for pi, allocs in summary.storage_pi_dict.items()},
+        )
@@ -2,7 +2,7 @@
 
 from django.conf import settings
 from django.contrib import messages
-from django.db.models import Sum, Q
+from django.db.models import Q
 from django.urls import reverse, reverse_lazy
 from django.shortcuts import get_object_or_404
 from django.views.generic import DetailView
@@ -10,7 +10,7 @@ from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django_renderpdf.views import PDFView
 
 from coldfront.core.utils.views import ColdfrontListView, NoteCreateView, NoteUpdateView
-from coldfront.core.allocation.models import Allocation, AllocationUser, AllocationAttributeType
+from coldfront.core.department.billing import DepartmentBillingSummary
 from coldfront.core.department.forms import DepartmentSearchForm
 from coldfront.core.department.models import (
     Department,
@@ -173,69 +173,20 @@ class DepartmentDetailView(LoginRequiredMixin, UserPassesTestMixin, DetailView):
                 status__name__in=['New', 'Active'], projectuser__user=self.request.user
             )
 
-        quota_attr_ids = [
-            attr.pk for attr in AllocationAttributeType.objects.filter(
-                name__in=['Core Usage (Hours)', 'Storage Quota (TB)', 'Storage Quota (TiB)']
-            )
-        ]
-
-        attribute_filter = (
-            Q(allocation__allocationattribute__allocation_attribute_type_id__in=quota_attr_ids)
-            & Q(allocation__status__name='Active')
-        )
-        attribute_string = 'allocation__allocationattribute__value'
-        project_objs = list(
-            department_obj.projects.filter(projectview_filter).annotate(
-                total_quota=Sum(attribute_string, filter=attribute_filter)
-            )
-        )
-
-        allocationuser_filter = (Q(status__name='Active') & ~Q(usage_bytes__isnull=True))
+        summary = DepartmentBillingSummary(department_obj.projects.filter(projectview_filter))
+        project_objs = summary.projects
+        storage_pi_dict = summary.storage_pi_dict
 
-        quota_attrs = AllocationAttributeType.objects.filter(
-            name__in=['Core Usage (Hours)', 'Storage Quota (TB)', 'Storage Quota (TiB)']
-        )
-
-        storage_pi_dict = {p.pi: [] for p in project_objs}
-        compute_pi_dict = {p.pi: [] for p in project_objs}
-        for p in project_objs:
-            p.allocs = p.allocation_set.filter(
-                allocationattribute__allocation_attribute_type__in=quota_attrs,
-                status__name='Active',
-            )
-            p.storage_allocs = p.allocs.filter(
-                resources__resource_type__name='Storage',
-                allocationattribute__allocation_attribute_type__name='RequiresPayment',
-                allocationattribute__value='True'
-            )
-            p.compute_allocs = p.allocs.filter(
-                resources__resource_type__name='Cluster')
-            storage_pi_dict[p.pi].extend(list(p.storage_allocs))
-            compute_pi_dict[p.pi].extend(list(p.compute_allocs))
-        storage_pi_dict = {pi:allocs for pi, allocs in storage_pi_dict.items() if allocs}
-        compute_pi_dict = {pi:allocs for pi, allocs in compute_pi_dict.items() if allocs}
-        for pi, allocs in storage_pi_dict.items():
-            pi.storage_total_price = sum(float(a.cost) for a in allocs if a.cost)
-        for pi, allocs in compute_pi_dict.items():
-            pi.compute_total_price = sum(float(a.cost) for a in allocs if a.cost)
-
-        context['compute_pi_dict'] = compute_pi_dict
+        context['compute_pi_dict'] = summary.compute_pi_dict
         context['storage_pi_dict'] = storage_pi_dict
         context['projects'] = project_objs
         context['department'] = department_obj
 
-        allocation_objs = Allocation.objects.filter(
-            project_id__in=[o.id for o in project_objs],
-            status__name='Active',
-        )
-
-        allocation_users = AllocationUser.objects.filter(
-            Q(allocation_id__in=[o.id for o in allocation_objs]) & allocationuser_filter
-        ).order_by('user__username')
+        allocation_count, allocation_user_count = summary.active_allocation_counts
         context['notes'] = self.return_visible_notes(department_obj)
         context['note_update_link'] = 'department-note-update'
 
-        storage_full_price = sum(pi.storage_total_price for pi in storage_pi_dict.keys())
+        storage_full_price = summary.storage_full_price
         # compute_full_price = sum(pi.compute_total_price for pi in compute_pi_dict.keys())
         detail_table = [
             ('Department', department_obj.name),
@@ -243,16 +194,16 @@ class DepartmentDetailView(LoginRequiredMixin, UserPassesTestMixin, DetailView):
         if self.request.user.is_superuser or 'approver' in member_permissions:
             detail_table.extend([
                 ('Total Labs in Bill', len(project_objs)),
-                ('Total Allocations in Bill', allocation_objs.count()),
-                ('Total Users in Bill', allocation_users.count()),
+                ('Total Allocations in Bill', allocation_count),
+                ('Total Users in Bill', allocation_user_count),
             ])
         else:
             detail_table.extend([
                 ('Your Labs', len(project_objs)),
-                ('Your Allocations', allocation_objs.count()),
-                ('Total Users in Your Allocations', allocation_users.count()),
+                ('Your Allocations', allocation_count),
+                ('Total Users in Your Allocations', allocation_user_count),
             ])
-        approvers = department_obj.members.filter(role="Approver")
+        approvers = department_obj.members.filter(role="Approver").select_related('user')
         approvers_string = ', '.join([m.user.full_name for m in approvers])
         detail_table.extend([
             ('Approvers', approvers_string),
@@ -294,40 +245,18 @@ class DepartmentStorageReportView(LoginRequiredMixin, UserPassesTestMixin, PDFVi
         context = super().get_context_data(**kwargs)
 
         department_obj = get_object_or_404(Department, pk=self.kwargs.get('pk'))
-        project_objs = list(department_obj.projects.filter(status__name='Active'))
-
-        storage_pi_dict = {p.pi: [] for p in project_objs}
-        for p in project_objs:
-            p.storage_allocs = p.allocation_set.filter(
-                resources__resource_type__name='Storage',
-                allocationattribute__allocation_attribute_type__name='RequiresPayment',
-                allocationattribute__value='True',
-                status__name='Active',
-            )
-            storage_pi_dict[p.pi].extend(list(p.storage_allocs))
-        storage_pi_dict = {pi: allocs for pi, allocs in storage_pi_dict.items() if allocs}
-        for pi, allocs in storage_pi_dict.items():
-            pi.storage_total_price = sum(float(a.cost) for a in allocs if a.cost)
-
-        storage_alloc_ids = [a.id for allocs in storage_pi_dict.values() for a in allocs]
-        storage_project_ids = {a.project_id for allocs in storage_pi_dict.values() for a in allocs}
-
-        allocationuser_filter = Q(status__name='Active') & ~Q(usage_bytes__isnull=True)
-        allocation_users = AllocationUser.objects.filter(
-            Q(allocation_id__in=storage_alloc_ids) & allocationuser_filter
-        )
-
-        storage_full_price = sum(pi.storage_total_price for pi in storage_pi_dict)
+        summary = DepartmentBillingSummary(department_obj.projects.filter(status__name='Active'))
+        lab_count, allocation_count, allocation_user_count = summary.storage_bill_counts
         detail_table = [
             ('Department', department_obj.name),
-            ('Total Labs in Bill', len(storage_project_ids)),
-            ('Total Allocations in Bill', len(storage_alloc_ids)),
-            ('Total Users in Bill', allocation_users.count()),
+            ('Total Labs in Bill', lab_count),
+            ('Total Allocations in Bill', allocation_count),
+            ('Total Users in Bill', allocation_user_count),
             ('Service Period', '1 Month'),
-            ('Total Amount Due, Monthly Storage', f'${round(storage_full_price, 2)}'),
+            ('Total Amount Due, Monthly Storage', f'${round(summary.storage_full_price, 2)}'),
         ]
 
         context['department'] = department_obj
-        context['storage_pi_dict'] = storage_pi_dict
+        context['storage_pi_dict'] = summary.storage_pi_dict
         context['detail_table'] = detail_table
         return context
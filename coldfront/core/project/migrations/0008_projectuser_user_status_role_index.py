@@ -0,0 +1,17 @@
+# Generated by Django 4.2.11 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('project', '0007_alter_historicalproject_description_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='projectuser',
+            index=models.Index(fields=['user', 'status', 'role'], name='project_pro_user_id_4c684f_idx'),
+        ),
+    ]
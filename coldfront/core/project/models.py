@@ -5,13 +5,15 @@ from django.core.exceptions import ValidationError
 from django.core.validators import MinLengthValidator
 from django.conf import settings
 from django.db import models
+from django.db.models.signals import post_delete, post_save
 from coldfront.core.utils.validate import AttributeValidator
 from model_utils.models import TimeStampedModel
 from simple_history.models import HistoricalRecords
 
-from ifxuser.models import Organization, OrgRelation
+from coldfront.core.department.permissions import approver_project_ids
 from coldfront.core.field_of_science.models import FieldOfScience
 from coldfront.core.utils.common import import_from_settings
+from coldfront.core.utils.permissions import clear_permission_cache, current_permission_cache
 
 PROJECT_ENABLE_PROJECT_REVIEW = import_from_settings('PROJECT_ENABLE_PROJECT_REVIEW', False)
 DATA_MANAGERS = import_from_settings('DATA_MANAGERS', ['Manager'])
@@ -194,53 +196,7 @@ class Project(TimeStampedModel):
             list[ProjectPermission]: a list of the user's permissions for the project
         """
 
-        if user.is_superuser:
-            return list(ProjectPermission)
-
-        user_conditions = (models.Q(status__name='Active') & models.Q(user=user))
-        if not self.projectuser_set.filter(user_conditions).exists() and not self.pi.id == user.id:
-            # if the user is an approver in a project's department, give them user permissions
-            departments = Organization.objects.filter(
-                org_tree='Research Computing Storage Billing',
-                useraffiliation__role='approver',
-                useraffiliation__user=user,
-            )
-            for department in departments:
-                child_lab_ids = list(
-                    OrgRelation.objects.filter(parent=department, child__rank="lab").values_list(
-                        'child_id', flat=True
-                    )
-                )
-                org_names = list(Organization.objects.filter(
-                    id__in=child_lab_ids
-                ).values_list('name'))
-                org_names_str = ''.join([name[0] for name in org_names])
-                proj_pi_name = self.pi.full_name
-                if proj_pi_name in org_names_str:
-                    return [ProjectPermission.USER]
-            return []
-
-
-        permissions = [ProjectPermission.USER]
-        project_permission_dict = {
-            ProjectPermission.GENERAL_MANAGER: ["General Manager"],
-            ProjectPermission.DATA_MANAGER: DATA_MANAGERS,
-            ProjectPermission.ACCESS_MANAGER: ACCESS_MANAGERS,
-        }
-
-        for permission, role_list in project_permission_dict.items():
-            if (
-                self.projectuser_set.filter(
-                    user_conditions & models.Q(role__name__in=role_list)
-                ).exists()
-                or self.pi.id == user.id
-            ):
-                permissions.append(permission)
-
-        if self.pi.id == user.id:
-            permissions.append(ProjectPermission.PI)
-
-        return permissions
+        return list(project_permissions(user, [self])[self.pk])
 
     def has_perm(self, user, perm):
         """
@@ -286,6 +242,78 @@ class Project(TimeStampedModel):
         return (self.title,) + self.pi.natural_key()
 
 
+PROJECT_PERMISSION_ROLES = {
+    ProjectPermission.GENERAL_MANAGER: ["General Manager"],
+    ProjectPermission.DATA_MANAGER: DATA_MANAGERS,
+    ProjectPermission.ACCESS_MANAGER: ACCESS_MANAGERS,
+}
+
+
+def _permissions_from_roles(project, user, role_names):
+    """Permissions of a user holding the active role_names (None for a
+    non-member) in the project.
+    """
+    is_pi = project.pi_id == user.pk
+    if role_names is None and not is_pi:
+        # if the user is an approver in a project's department, give them user permissions
+        if project.pk in approver_project_ids(user):
+            return [ProjectPermission.USER]
+        return []
+
+    permissions = [ProjectPermission.USER]
+    for permission, role_list in PROJECT_PERMISSION_ROLES.items():
+        if is_pi or not role_names.isdisjoint(role_list):
+            permissions.append(permission)
+
+    if is_pi:
+        permissions.append(ProjectPermission.PI)
+
+    return permissions
+
+
+def project_permissions(user, projects):
+    """Resolve a user's permissions for many projects at once.
+
+    Permissions found in the active PermissionCache are reused; the rest are
+    resolved with a single query over the user's active ProjectUser roles
+    and stored in the cache.
+
+    Params:
+        user (User): user whose permissions are to be retrieved
+        projects (iterable[Project]): projects to resolve
+
+    Returns:
+        dict: project pk to list[ProjectPermission]
+    """
+    projects = list(projects)
+    if user.is_superuser:
+        return {project.pk: list(ProjectPermission) for project in projects}
+
+    cache = current_permission_cache()
+    resolved = {}
+    missing = []
+    for project in projects:
+        permissions = cache.get('project', project.pk, user.pk) if cache else None
+        if permissions is None:
+            missing.append(project)
+        else:
+            resolved[project.pk] = permissions
+    if not missing:
+        return resolved
+
+    roles = {}
+    for project_id, role_name in ProjectUser.objects.filter(
+        user=user, status__name='Active', project_id__in=[p.pk for p in missing],
+    ).values_list('project_id', 'role__name'):
+        roles.setdefault(project_id, set()).add(role_name)
+    for project in missing:
+        permissions = _permissions_from_roles(project, user, roles.get(project.pk))
+        resolved[project.pk] = permissions
+        if cache:
+            cache.set('project', project.pk, user.pk, permissions)
+    return resolved
+
+
 class ProjectAdminComment(TimeStampedModel):
     """ A project admin comment is a comment that an admin can make on a project.
 
@@ -418,6 +446,14 @@ class ProjectUser(TimeStampedModel):
     class Meta:
         unique_together = ('user', 'project')
         verbose_name_plural = "Project User Status"
+        indexes = [
+            models.Index(fields=['user', 'status', 'role']),
+        ]
+
+# a role change makes permissions resolved earlier in the request stale
+post_save.connect(clear_permission_cache, sender=ProjectUser, dispatch_uid='projectuser_clear_permission_cache')
+post_delete.connect(clear_permission_cache, sender=ProjectUser, dispatch_uid='projectuser_delete_clear_permission_cache')
+
 
 class AttributeType(TimeStampedModel):
     """ An attribute type indicates the data type of the attribute. Examples include Date, Float, Int, Text, and Yes/No.
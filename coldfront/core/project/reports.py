@@ -0,0 +1,234 @@
+"""Bulk generation of the project storage report PDFs.
+
+The data of every report is loaded for all projects at once by
+storage_report_contexts, as plain dicts that ProjectStorageReportView and the
+monthly report task render with the same template. render_storage_reports
+turns them into PDFs in a process pool, since WeasyPrint rendering is CPU
+bound, and keeps the bytes in the STORAGE_REPORT_CACHE cache under a hash of
+the report data and template, so a lab whose report hasn't changed since the
+last run is not rendered again. The monthly run starts a fresh process, so
+when STORAGE_REPORT_CACHE is private to a process, as the default LocMemCache
+is, the PDFs are kept in a FileBasedCache in STORAGE_REPORT_CACHE_DIR instead.
+
+Reports are rendered the way ProjectStorageReportView rendered them for the
+monthly emails, in a request made by the TESTUSER user, so the template sees
+the same context processor variables.
+"""
+import hashlib
+import io
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache.backends.filebased import FileBasedCache
+from django.db import connections
+from django.db.models import Count
+from django.template import engines
+from django.template.loader import get_template
+from django.test import RequestFactory
+from django_renderpdf.helpers import render_pdf
+
+from coldfront.core.allocation.models import Allocation, costs_for
+from coldfront.core.project.models import Project, ProjectAttribute, ProjectReview, ProjectUser
+from coldfront.core.utils.common import import_from_settings, shared_cache
+
+logger = logging.getLogger(__name__)
+
+STORAGE_REPORT_TEMPLATE = 'project/project_storagereport.html'
+STORAGE_REPORT_ALLOCATION_STATUSES = ['Active', 'Paid', 'Ready for Review', 'Payment Requested']
+# number of rendering processes; None uses every CPU
+STORAGE_REPORT_WORKERS = import_from_settings('STORAGE_REPORT_WORKERS', None)
+STORAGE_REPORT_CACHE = import_from_settings('STORAGE_REPORT_CACHE', 'default')
+STORAGE_REPORT_CACHE_TIMEOUT = import_from_settings('STORAGE_REPORT_CACHE_TIMEOUT', 60 * 60 * 24 * 40)
+# where the PDFs are cached when STORAGE_REPORT_CACHE is private to a process
+STORAGE_REPORT_CACHE_DIR = import_from_settings(
+    'STORAGE_REPORT_CACHE_DIR', os.path.join(settings.BASE_DIR, 'local_data', 'storage_report_cache')
+)
+TESTUSER = import_from_settings('TESTUSER')
+
+_report_user = None
+
+
+def storage_report_cache():
+    """Return STORAGE_REPORT_CACHE if it is shared between processes, else a
+    FileBasedCache in STORAGE_REPORT_CACHE_DIR.
+    """
+    cache = shared_cache(STORAGE_REPORT_CACHE)
+    if cache is None:
+        cache = FileBasedCache(STORAGE_REPORT_CACHE_DIR, {'TIMEOUT': STORAGE_REPORT_CACHE_TIMEOUT})
+    return cache
+
+
+def storage_report_contexts(projects):
+    """Return the storage report template context of every project, keyed by
+    project pk, loading the data of all projects in bulk.
+    """
+    project_ids = [project.pk for project in projects]
+    center_base_url = import_from_settings('CENTER_BASE_URL', '')
+
+    starfish_zones = {}
+    # walk in descending pk order so the oldest attribute wins, as in get_attribute
+    for project_id, value in ProjectAttribute.objects.filter(
+        project_id__in=project_ids, proj_attr_type__name='Starfish Zone'
+    ).values_list('project_id', 'value').order_by('-pk'):
+        starfish_zones[project_id] = value
+
+    last_review_status = dict(
+        ProjectReview.objects.filter(project_id__in=project_ids)
+        .order_by('project_id', 'created')
+        .values_list('project_id', 'status__name')
+    )
+
+    contexts = {}
+    for project in Project.objects.filter(pk__in=project_ids).select_related(
+        'pi', 'status', 'field_of_science'
+    ):
+        contexts[project.pk] = {
+            'project': {
+                'pk': project.pk,
+                'title': project.title,
+                'description': project.description,
+                'field_of_science': str(project.field_of_science),
+                'status': str(project.status),
+                'created': project.created,
+                'review_pending': last_review_status.get(project.pk) == 'Pending',
+                'sf_zone': starfish_zones.get(project.pk),
+                'pi': {
+                    'username': project.pi.username,
+                    'first_name': project.pi.first_name,
+                    'last_name': project.pi.last_name,
+                    'email': project.pi.email,
+                },
+            },
+            'storage_allocations': [],
+            'allocation_total': {'allocation_user_count': 0, 'size': 0, 'cost': 0, 'usage': 0},
+            'project_users': [],
+            'CENTER_BASE_URL': center_base_url,
+        }
+
+    allocations = Allocation.objects.filter(
+        project_id__in=project_ids,
+        status__name__in=STORAGE_REPORT_ALLOCATION_STATUSES,
+        resources__resource_type__name='Storage',
+    ).distinct().select_related('status').with_parent_resource(
+        attributes=True
+    ).with_attribute_snapshot().annotate(
+        user_count=Count('allocationuser', distinct=True)
+    ).order_by('project_id', '-pk')
+    costs_for(allocations)
+    for allocation in allocations:
+        context = contexts[allocation.project_id]
+        resource = allocation.get_parent_resource
+        cost, requires_payment = allocation.cost, allocation.requires_payment
+        size, usage = allocation.size, allocation.usage
+        context['storage_allocations'].append({
+            'pk': allocation.pk,
+            'status': allocation.status.name,
+            'resource_name': resource.name,
+            'quantity_label': resource.quantity_label,
+            'path': allocation.path,
+            'user_count': allocation.user_count,
+            'size': size,
+            'usage': usage,
+            'requires_payment': requires_payment,
+            'cost': cost,
+        })
+        total = context['allocation_total']
+        if cost and requires_payment:
+            total['cost'] += cost
+        if size:
+            total['size'] += size
+        if usage:
+            total['usage'] += usage
+        total['allocation_user_count'] += allocation.user_count
+
+    for project_user in ProjectUser.objects.filter(
+        project_id__in=project_ids, status__name='Active'
+    ).select_related('user', 'role', 'status').order_by('user__username'):
+        contexts[project_user.project_id]['project_users'].append({
+            'username': project_user.user.username,
+            'first_name': project_user.user.first_name,
+            'last_name': project_user.user.last_name,
+            'email': project_user.user.email,
+            'role': project_user.role.name,
+            'status': project_user.status.name,
+            'enable_notifications': project_user.enable_notifications,
+        })
+    return contexts
+
+
+def storage_report_hash(context, template_source=None):
+    """Return a hash of a report's data and template, which changes whenever
+    the rendered PDF would.
+    """
+    if template_source is None:
+        template_source = get_template(STORAGE_REPORT_TEMPLATE).template.source
+    digest = hashlib.sha256(template_source.encode())
+    digest.update(json.dumps(context, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+def render_storage_report(context):
+    """Render a storage report context to PDF bytes, with the context
+    processor variables of a report request made by TESTUSER.
+    """
+    global _report_user
+    if _report_user is None:
+        _report_user = get_user_model().objects.get(username=TESTUSER)
+    request = RequestFactory().get(f'/project/{context["project"]["pk"]}/report')
+    request.user = _report_user
+    template_context = {}
+    for processor in engines['django'].engine.template_context_processors:
+        template_context.update(processor(request))
+    template_context.update(context)
+    output = io.BytesIO()
+    render_pdf(STORAGE_REPORT_TEMPLATE, output, context=template_context)
+    return output.getvalue()
+
+
+def render_storage_reports(contexts, max_workers=None, use_cache=True):
+    """Render the storage report contexts, keyed by project pk, to PDFs.
+
+    Reports found in the cache are reused and the rest are rendered in a
+    process pool of STORAGE_REPORT_WORKERS processes, or in this process when
+    there is only one to render. Returns a dict of project pk to PDF bytes;
+    a report that failed to render is logged and left out.
+    """
+    cache = storage_report_cache()
+    template_source = get_template(STORAGE_REPORT_TEMPLATE).template.source
+    keys = {
+        pk: f'storage_report_pdf:{storage_report_hash(context, template_source)}'
+        for pk, context in contexts.items()
+    }
+    pdfs = cache.get_many(keys.values()) if use_cache else {}
+    pdfs = {pk: pdfs[key] for pk, key in keys.items() if key in pdfs}
+    to_render = [pk for pk in contexts if pk not in pdfs]
+    logger.info('rendering %s storage reports, %s unchanged', len(to_render), len(pdfs))
+
+    rendered = {}
+    if len(to_render) == 1 or max_workers == 1 or STORAGE_REPORT_WORKERS == 1:
+        for pk in to_render:
+            try:
+                rendered[pk] = render_storage_report(contexts[pk])
+            except Exception as e:
+                logger.exception('could not render the storage report of project %s: %s', pk, e)
+    elif to_render:
+        # forked workers must not share this process's database connections
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=max_workers or STORAGE_REPORT_WORKERS) as executor:
+            futures = {pk: executor.submit(render_storage_report, contexts[pk]) for pk in to_render}
+            for pk, future in futures.items():
+                try:
+                    rendered[pk] = future.result()
+                except Exception as e:
+                    logger.exception('could not render the storage report of project %s: %s', pk, e)
+
+    if use_cache and rendered:
+        cache.set_many(
+            {keys[pk]: pdf for pk, pdf in rendered.items()}, STORAGE_REPORT_CACHE_TIMEOUT
+        )
+    pdfs.update(rendered)
+    return pdfs
@@ -7,9 +7,13 @@ from django.test import RequestFactory
 from coldfront.core.department.models import Department
 from coldfront.core.department.views import DepartmentStorageReportView
 from coldfront.core.project.models import Project
-from coldfront.core.project.views import ProjectStorageReportView
-from coldfront.core.utils.common import import_from_settings
-from coldfront.core.utils.mail import send_email_template, email_template_context, build_link
+from coldfront.core.project.reports import (
+    render_storage_report,
+    render_storage_reports,
+    storage_report_contexts,
+)
+from coldfront.core.utils.common import PhaseTimer, import_from_settings
+from coldfront.core.utils.mail import MailQueue, send_email_template, email_template_context, build_link
 
 TESTUSER = import_from_settings('TESTUSER')
 EMAIL_ADMIN_LIST = import_from_settings('EMAIL_ADMIN_LIST')
@@ -20,21 +24,44 @@ DEPARTMENT_REPORT_RANKS = ('school', 'institution')
 logger = logging.getLogger(__name__)
 
 def send_storage_report_emails():
-    """Send monthly email with project storage reports"""
-    projects = Project.objects.filter(
-        status__name='Active',
-        allocation__resources__resource_type__name="Storage",
-        allocation__status__name="Active"
-    ).distinct()
-    for project in projects:
-        send_storagereport_pdf(project)
+    """Send monthly email with project storage reports.
 
-def send_storagereport_pdf(project, context=None):
+    The report data of every project is loaded at once and the PDFs are
+    rendered in parallel, reusing cached PDFs of unchanged reports. The time
+    spent in each phase is logged and returned.
     """
-    Renders the ReportPdfView to PDF and emails it to `to_email`.
-    `context` will be passed to the view when rendering.
+    timer = PhaseTimer()
+    with timer.phase('load'):
+        projects = list(Project.objects.filter(
+            status__name='Active',
+            allocation__resources__resource_type__name="Storage",
+            allocation__status__name="Active"
+        ).distinct())
+        report_contexts = storage_report_contexts(projects)
+    with timer.phase('render'):
+        pdfs = render_storage_reports(report_contexts)
+    with timer.phase('mail'):
+        with MailQueue() as mail_queue:
+            for project in projects:
+                if project.pk in pdfs:
+                    _send_storage_report(
+                        project, report_contexts[project.pk], pdfs[project.pk], mail_queue.add_template
+                    )
+    logger.info('sent %s storage reports for %s projects: %s', len(pdfs), len(projects), timer.summary())
+    return timer.timings
+
+def send_storagereport_pdf(project, context=None, mail_queue=None):
     """
-    system_user = get_user_model().objects.get(username=TESTUSER)
+    Renders the project's storage report to PDF and emails it to the PI and
+    the project's General Managers. The email is added to `mail_queue` when
+    one is given instead of being sent right away.
+    """
+    report_context = storage_report_contexts([project])[project.pk]
+    pdf_bytes = render_storage_report(report_context)
+    send = mail_queue.add_template if mail_queue is not None else send_email_template
+    _send_storage_report(project, report_context, pdf_bytes, send)
+
+def _send_storage_report(project, report_context, pdf_bytes, send):
     month = datetime.now().strftime("%B")
     year = datetime.now().year
     title = project.title
@@ -44,26 +71,13 @@ def send_storagereport_pdf(project, context=None):
         'project_title': title,
         'project_detail_url': build_link(f'/project/{project.pk}/')
     })
-    # 1) build a fake GET request, set any necessary attributes
-    factory = RequestFactory()
-    request = factory.get(f'project/{project.pk}/report')
-    request.user = system_user
-
-    # 2) instantiate and call class‐based view
-    view = ProjectStorageReportView.as_view()
-    response = view(request, pk=project.pk)
-
-    # 3) make sure the response is rendered and grab the bytes
-    if hasattr(response, 'rendered_content'):
-        pdf_bytes = response.rendered_content
-    else:
-        pdf_bytes = response.content
-
-    receivers = project.projectuser_set.filter(role__name='General Manager', status__name='Active')
-    receiver_list = [receiver.user.email for receiver in receivers] + [project.pi.email]
+    receiver_list = [
+        project_user['email'] for project_user in report_context['project_users']
+        if project_user['role'] == 'General Manager'
+    ] + [report_context['project']['pi']['email']]
     attachment = (f'{title}_{month}_{year}_storagereport.pdf', pdf_bytes, 'application/pdf')
     try:
-        send_email_template(
+        send(
             subject,
             'email/storage_report.txt',
             context,
@@ -81,13 +95,16 @@ def send_dept_storage_report_emails():
     """Send monthly email with department storage reports to departments
     with rank of 'school' or 'institution'.
     """
-    for department in Department.objects.filter(rank__in=DEPARTMENT_REPORT_RANKS):
-        send_dept_storagereport_pdf(department)
+    with MailQueue() as mail_queue:
+        for department in Department.objects.filter(rank__in=DEPARTMENT_REPORT_RANKS):
+            send_dept_storagereport_pdf(department, mail_queue=mail_queue)
 
-def send_dept_storagereport_pdf(department, context=None):
+def send_dept_storagereport_pdf(department, context=None, mail_queue=None):
     """
     Renders the DepartmentStorageReportView to PDF and emails it to the
     department's approvers. `context` will be passed to the view when rendering.
+    The email is added to `mail_queue` when one is given instead of being sent
+    right away.
     """
     system_user = get_user_model().objects.get(username=TESTUSER)
     month = datetime.now().strftime("%B")
@@ -117,8 +134,9 @@ def send_dept_storagereport_pdf(department, context=None):
     approvers = department.members.filter(role="Approver")
     receiver_list = [approver.user.email for approver in approvers]
     attachment = (f'{code}_{month}_{year}_dept_storagereport.pdf', pdf_bytes, 'application/pdf')
+    send = mail_queue.add_template if mail_queue is not None else send_email_template
     try:
-        send_email_template(
+        send(
             subject,
             'email/dept_storage_report.txt',
             context,
@@ -1,14 +1,31 @@
 import logging
+from unittest import mock
 
+from django.core.cache import caches
 from django.core.exceptions import ValidationError
 from django.test import TestCase
 
+from coldfront.core.allocation.models import (
+    Allocation,
+    AllocationPermission,
+    allocation_permissions,
+)
+from coldfront.core.department.permissions import approver_project_ids
 from coldfront.core.test_helpers.factories import (
+    setup_models,
     FieldOfScienceFactory,
+    ProjectFactory,
     ProjectStatusChoiceFactory,
     UserFactory,
 )
-from coldfront.core.project.models import Project
+from coldfront.core.project.models import (
+    Project,
+    ProjectPermission,
+    ProjectUser,
+    ProjectUserRoleChoice,
+    project_permissions,
+)
+from coldfront.core.utils.permissions import permission_cache
 
 logging.disable(logging.CRITICAL)
 
@@ -145,3 +162,73 @@ class TestProject(TestCase):
         with self.assertRaises(Project.DoesNotExist):
             Project.objects.get(pk=project_obj.pk)
         self.assertEqual(0, len(Project.objects.all()))
+
+
+class ProjectPermissionResolverTest(TestCase):
+    """Tests for request-scoped permission resolution"""
+    fixtures = ["coldfront/core/test_helpers/test_data/test_fixtures/ifx.json"]
+
+    @classmethod
+    def setUpTestData(cls):
+        setup_models(cls)
+
+    def setUp(self):
+        # keep the cached approver index out of the query counts, as a shared cache would
+        patcher = mock.patch(
+            'coldfront.core.department.permissions.shared_cache', return_value=caches['default']
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        approver_project_ids(self.proj_datamanager)
+        approver_project_ids(self.nonproj_allocationuser)
+
+    def test_permissions_memoized_in_cache(self):
+        """inside a permission cache, a project's permissions are resolved with one query"""
+        project = Project.objects.get(pk=self.project.pk)
+        with permission_cache():
+            with self.assertNumQueries(1):
+                self.assertTrue(project.has_perm(self.proj_datamanager, ProjectPermission.DATA_MANAGER))
+                self.assertTrue(project.has_perm(self.proj_datamanager, ProjectPermission.USER))
+                self.assertFalse(project.has_perm(self.proj_datamanager, ProjectPermission.PI))
+
+    def test_permissions_not_memoized_outside_cache(self):
+        """without a permission cache every check is resolved afresh"""
+        project = Project.objects.get(pk=self.project.pk)
+        with self.assertNumQueries(2):
+            project.has_perm(self.proj_datamanager, ProjectPermission.USER)
+            project.has_perm(self.proj_datamanager, ProjectPermission.USER)
+
+    def test_role_change_clears_cache(self):
+        """saving a ProjectUser forgets the permissions resolved so far"""
+        project = Project.objects.get(pk=self.project.pk)
+        with permission_cache():
+            self.assertTrue(project.has_perm(self.proj_datamanager, ProjectPermission.DATA_MANAGER))
+            project_user = ProjectUser.objects.get(project=project, user=self.proj_datamanager)
+            project_user.role = ProjectUserRoleChoice.objects.get(name='User')
+            project_user.save()
+            self.assertFalse(project.has_perm(self.proj_datamanager, ProjectPermission.DATA_MANAGER))
+
+    def test_bulk_project_permissions(self):
+        """project_permissions resolves many projects with one query"""
+        other_project = ProjectFactory(title='other_lab')
+        with self.assertNumQueries(1):
+            permissions = project_permissions(
+                self.proj_datamanager, [self.project, other_project]
+            )
+        self.assertIn(ProjectPermission.DATA_MANAGER, permissions[self.project.pk])
+        self.assertEqual(permissions[other_project.pk], [])
+
+    def test_bulk_allocation_permissions(self):
+        """allocation_permissions resolves many allocations with a fixed number of queries"""
+        allocations = list(Allocation.objects.filter(
+            project=self.project
+        ).select_related('project'))
+        with self.assertNumQueries(2):
+            permissions = allocation_permissions(self.proj_datamanager, allocations)
+        for allocation in allocations:
+            self.assertIn(AllocationPermission.MANAGER, permissions[allocation.pk])
+        with self.assertNumQueries(3):
+            permissions = allocation_permissions(self.nonproj_allocationuser, allocations)
+        self.assertEqual(
+            permissions[self.storage_allocation.pk], [AllocationPermission.USER]
+        )
@@ -0,0 +1,87 @@
+"""Unit tests for the project storage reports"""
+import shutil
+import tempfile
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.core.cache.backends.filebased import FileBasedCache
+from django.test import TestCase
+
+from coldfront.core.project import reports
+from coldfront.core.project.reports import (
+    render_storage_report,
+    render_storage_reports,
+    storage_report_cache,
+    storage_report_contexts,
+    storage_report_hash,
+)
+from coldfront.core.test_helpers.factories import setup_models
+
+UTIL_FIXTURES = [
+    "coldfront/core/test_helpers/test_data/test_fixtures/ifx.json",
+]
+
+
+class StorageReportTests(TestCase):
+    """Tests for the storage report data and rendering"""
+    fixtures = UTIL_FIXTURES
+
+    @classmethod
+    def setUpTestData(cls):
+        setup_models(cls)
+
+    def setUp(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        patcher = patch('coldfront.core.project.reports.STORAGE_REPORT_CACHE_DIR', cache_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_process_local_cache_falls_back_to_files(self):
+        """with the default LocMemCache, PDFs are cached on disk to outlive the process"""
+        self.assertIsInstance(storage_report_cache(), FileBasedCache)
+
+    @patch('coldfront.core.project.reports.render_pdf')
+    def test_rendered_as_testuser(self, render_pdf):
+        """reports are rendered with the request context of the TESTUSER user"""
+        get_user_model().objects.get_or_create(username=reports.TESTUSER)
+        reports._report_user = None
+        self.addCleanup(setattr, reports, '_report_user', None)
+        context = storage_report_contexts([self.project])[self.project.pk]
+        render_storage_report(context)
+        template_context = render_pdf.call_args.kwargs['context']
+        self.assertEqual(template_context['user'].username, reports.TESTUSER)
+        self.assertEqual(template_context['request'].user.username, reports.TESTUSER)
+        self.assertEqual(template_context['project'], context['project'])
+
+    def test_report_context(self):
+        """storage allocations, totals and active project users are collected"""
+        context = storage_report_contexts([self.project])[self.project.pk]
+        self.assertEqual(context['project']['title'], self.project.title)
+        self.assertEqual(context['project']['pi']['email'], self.pi_user.email)
+        allocation, = context['storage_allocations']
+        self.assertEqual(allocation['pk'], self.storage_allocation.pk)
+        self.assertEqual(allocation['resource_name'], self.storage_resource.name)
+        self.assertEqual(allocation['size'], self.storage_allocation.size)
+        self.assertEqual(allocation['usage'], self.storage_allocation.usage)
+        self.assertEqual(allocation['user_count'], 2)
+        self.assertEqual(context['allocation_total']['allocation_user_count'], 2)
+        self.assertEqual(
+            [user['username'] for user in context['project_users']],
+            sorted(self.project.projectuser_set.values_list('user__username', flat=True)),
+        )
+
+    @patch('coldfront.core.project.reports.render_storage_report', return_value=b'%PDF')
+    def test_unchanged_reports_are_not_rendered_again(self, render):
+        """rendered reports are cached under a hash of their data"""
+        contexts = storage_report_contexts([self.project])
+        self.assertEqual(render_storage_reports(contexts, max_workers=1), {self.project.pk: b'%PDF'})
+        self.assertEqual(render_storage_reports(contexts, max_workers=1), {self.project.pk: b'%PDF'})
+        self.assertEqual(render.call_count, 1)
+
+        context = contexts[self.project.pk]
+        digest = storage_report_hash(context)
+        context['allocation_total']['usage'] += 1
+        self.assertNotEqual(storage_report_hash(context), digest)
+        render_storage_reports(contexts, max_workers=1)
+        self.assertEqual(render.call_count, 2)
@@ -0,0 +1,76 @@
+"""Unit tests for the project utils"""
+from unittest import mock
+
+from django.core.cache import caches
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from coldfront.core.project.utils import (
+    generate_usage_history_graph,
+    invalidate_usage_history_graphs,
+)
+from coldfront.core.test_helpers.factories import setup_models
+from coldfront.core.test_helpers.fasrc_factories import setup_departments
+
+UTIL_FIXTURES = [
+    "coldfront/core/test_helpers/test_data/test_fixtures/ifx.json",
+]
+
+
+class UsageHistoryGraphTests(TestCase):
+    """Tests for generate_usage_history_graph"""
+    fixtures = UTIL_FIXTURES
+
+    @classmethod
+    def setUpTestData(cls):
+        setup_models(cls)
+        setup_departments(cls)
+
+    def setUp(self):
+        invalidate_usage_history_graphs()
+
+    def test_graph_has_a_column_per_allocation(self):
+        """every allocation gets a 13 month column named after its resource"""
+        data = generate_usage_history_graph(self.project, use_cache=False)
+        allocations = self.project.allocation_set.all()
+        self.assertEqual(
+            sorted(data['groups'][0]),
+            sorted(a.get_parent_resource.name for a in allocations),
+        )
+        allocation_columns = data['columns'][:-1]
+        self.assertEqual(len(allocation_columns), allocations.count())
+        for column in allocation_columns:
+            self.assertEqual(len(column), 14)
+        self.assertEqual(data['columns'][-1][0], 'month')
+        self.assertTrue(data['columns'][-1][-1].endswith('(PROJECTED)'))
+
+    @mock.patch('coldfront.core.project.utils.shared_cache', return_value=caches['default'])
+    def test_graph_is_cached(self, shared_cache):
+        """a cached graph is returned without queries until billing records change"""
+        invalidate_usage_history_graphs()
+        data = generate_usage_history_graph(self.project)
+        with self.assertNumQueries(0):
+            self.assertEqual(generate_usage_history_graph(self.project), data)
+        invalidate_usage_history_graphs()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(generate_usage_history_graph(self.project), data)
+        self.assertTrue(queries.captured_queries)
+
+    @mock.patch('coldfront.core.project.utils.shared_cache', return_value=caches['default'])
+    def test_quota_change_retires_cached_graph(self, shared_cache):
+        """changing an allocation attribute retires its project's graph"""
+        invalidate_usage_history_graphs()
+        generate_usage_history_graph(self.project)
+        attribute = self.storage_allocation.allocationattribute_set.first()
+        attribute.save()
+        with CaptureQueriesContext(connection) as queries:
+            generate_usage_history_graph(self.project)
+        self.assertTrue(queries.captured_queries)
+
+    def test_graph_not_cached_in_process_local_cache(self):
+        """with a process-local cache, every graph is computed afresh"""
+        generate_usage_history_graph(self.project)
+        with CaptureQueriesContext(connection) as queries:
+            generate_usage_history_graph(self.project)
+        self.assertTrue(queries.captured_queries)
@@ -1,3 +1,9 @@
+from contextlib import nullcontext
+from unittest.mock import patch
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
 from coldfront.core.project.tests.test_views import ProjectViewTestBase
 from coldfront.core.test_helpers import utils
 from coldfront.core.test_helpers.factories import ProjectAttributeFactory
@@ -118,3 +124,19 @@ class ProjectDetailViewTest(ProjectViewTestBase):
         soup = utils.login_and_get_soup(self.client, self.proj_nonallocationuser, self.url)
         allocations_table = soup.find('table', {'id': 'allocation_history'})
         self.assertIn("holylfs10/tier1", allocations_table.get_text())
+
+    ### Query-count regression tests ###
+    def test_projectdetail_resolves_permissions_once(self):
+        """permissions are resolved once per request however often they are checked"""
+        self.client.force_login(self.proj_datamanager, backend="django.contrib.auth.backends.ModelBackend")
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+        with CaptureQueriesContext(connection) as cached:
+            self.client.get(self.url)
+        # the cache lives only as long as the request
+        with CaptureQueriesContext(connection) as cached_again:
+            self.client.get(self.url)
+        with patch('coldfront.core.utils.middleware.permission_cache', nullcontext):
+            with CaptureQueriesContext(connection) as uncached:
+                self.client.get(self.url)
+        self.assertEqual(len(cached), len(cached_again))
+        self.assertLess(len(cached), len(uncached))
@@ -1,53 +1,169 @@
+import uuid
+from collections import defaultdict
 from datetime import date
 
-from django.db.models import Q
+from django.db.models import Q, Sum
+from django.db.models.signals import post_delete, post_save
 from ifxbilling.models import BillingRecord
 
-from coldfront.core.utils.common import import_from_settings
+from coldfront.core.allocation.models import (
+    Allocation,
+    AllocationAttribute,
+    costs_for,
+)
+from coldfront.core.allocation.signals import allocation_attributes_bulk_saved
+from coldfront.core.utils.common import import_from_settings, shared_cache
 from coldfront.plugins.ifx.models import ProjectOrganization
 
 EMAIL_SENDER = import_from_settings('EMAIL_SENDER')
+# cache alias for usage history graphs; they are only cached when it is
+# shared between processes, since BillingRecords are written by other processes
+USAGE_HISTORY_CACHE = import_from_settings('USAGE_HISTORY_CACHE', 'default')
+# seconds a project's usage history graph is kept; new or removed
+# BillingRecords retire all cached graphs sooner, and allocation or quota
+# changes retire the graph of their project
+USAGE_HISTORY_CACHE_TIMEOUT = import_from_settings('USAGE_HISTORY_CACHE_TIMEOUT', 3600)
 
+_USAGE_HISTORY_GENERATION_KEY = 'usage_history_graph:generation'
 
-def generate_usage_history_graph(project):
+
+def _generation(cache, key):
+    return cache.get_or_set(key, lambda: uuid.uuid4().hex, None)
+
+
+def _project_generation_key(project_id):
+    return f'usage_history_graph:{project_id}:generation'
+
+
+def invalidate_usage_history_graphs(**kwargs):
+    """Retire every cached usage history graph."""
+    cache = shared_cache(USAGE_HISTORY_CACHE)
+    if cache is not None:
+        cache.set(_USAGE_HISTORY_GENERATION_KEY, uuid.uuid4().hex, None)
+
+
+def invalidate_project_usage_history_graphs(project_ids):
+    """Retire the cached usage history graphs of the given projects."""
+    cache = shared_cache(USAGE_HISTORY_CACHE)
+    if cache is not None:
+        cache.set_many(
+            {_project_generation_key(pk): uuid.uuid4().hex for pk in set(project_ids)}, None
+        )
+
+
+def allocation_invalidate_usage_history_graph(sender, instance, **kwargs):
+    invalidate_project_usage_history_graphs([instance.project_id])
+
+
+def allocation_attribute_invalidate_usage_history_graph(sender, instance, **kwargs):
+    if shared_cache(USAGE_HISTORY_CACHE) is not None:
+        invalidate_project_usage_history_graphs([instance.allocation.project_id])
+
+
+def allocation_attributes_invalidate_usage_history_graphs(sender, attributes, **kwargs):
+    if shared_cache(USAGE_HISTORY_CACHE) is not None:
+        invalidate_project_usage_history_graphs(Allocation.objects.filter(
+            pk__in={attribute.allocation_id for attribute in attributes}
+        ).values_list('project_id', flat=True))
+
+
+post_save.connect(
+    invalidate_usage_history_graphs, sender=BillingRecord,
+    dispatch_uid='billingrecord_invalidate_usage_history_graphs',
+)
+post_delete.connect(
+    invalidate_usage_history_graphs, sender=BillingRecord,
+    dispatch_uid='billingrecord_delete_invalidate_usage_history_graphs',
+)
+for _signal in (post_save, post_delete):
+    _signal.connect(
+        allocation_invalidate_usage_history_graph, sender=Allocation,
+        dispatch_uid=f'allocation_{_signal is post_save}_invalidate_usage_history_graph',
+    )
+    _signal.connect(
+        allocation_attribute_invalidate_usage_history_graph, sender=AllocationAttribute,
+        dispatch_uid=f'allocationattribute_{_signal is post_save}_invalidate_usage_history_graph',
+    )
+allocation_attributes_bulk_saved.connect(
+    allocation_attributes_invalidate_usage_history_graphs,
+    dispatch_uid='allocationattributes_bulk_invalidate_usage_history_graphs',
+)
+
+
+def generate_usage_history_graph(project, use_cache=True):
     """Create a Project billing record graph.
 
+    The charges of the last 13 months are summed per product, year and month
+    with one query and pivoted into a column per allocation. Allocations with
+    no BillingRecords for the current month show their projected cost, computed
+    for all of them at once with costs_for. When USAGE_HISTORY_CACHE is shared
+    between processes, graphs are cached per project and day until new
+    BillingRecords land or the project's allocations or their attributes change.
+
     Returns
     -------
     data : dict
         contains
         columns : list
     """
-    current_year = date.today().year
+    today = date.today()
+    cache = shared_cache(USAGE_HISTORY_CACHE) if use_cache else None
+    if cache is not None:
+        key = ':'.join([
+            'usage_history_graph',
+            _generation(cache, _USAGE_HISTORY_GENERATION_KEY),
+            _generation(cache, _project_generation_key(project.pk)),
+            str(project.pk),
+            today.isoformat(),
+        ])
+        data = cache.get(key)
+        if data is None:
+            data = generate_usage_history_graph(project, use_cache=False)
+            cache.set(key, data, USAGE_HISTORY_CACHE_TIMEOUT)
+        return data
+
+    current_year = today.year
     previous_year = current_year - 1
-    current_month = date.today().month
+    current_month = today.month
 
     # sort billing_records by year/month
     year_months = [(previous_year, month) for month in range(current_month, 13)] + [(current_year, month) for month in range(1, current_month+1)]
-    allocations = project.allocation_set.all()
+    allocations = list(
+        project.allocation_set.all().with_parent_resource().with_attribute_snapshot()
+    )
+    resource_names = [allocation.get_parent_resource.name for allocation in allocations]
+
+    charges = defaultdict(dict)
+    if allocations:
+        organization = ProjectOrganization.objects.get(project=project).organization
+        monthly_charges = BillingRecord.objects.filter(
+            (Q(year=current_year) | Q(year=previous_year, month__gte=current_month)),
+            product_usage__product__product_name__in=set(resource_names),
+            account__organization=organization,
+        ).values(
+            'product_usage__product__product_name', 'year', 'month'
+        ).annotate(charge=Sum('decimal_charge')).order_by()
+        for row in monthly_charges:
+            product_name = row['product_usage__product__product_name']
+            charges[product_name][(row['year'], row['month'])] = float(row['charge'] or 0)
+
     columns = []
     projection = False
-    for allocation in allocations:
-        allocation_res = allocation.get_parent_resource.name
-        allocation_billing_records = BillingRecord.objects.filter(
-                (Q(year=current_year) | Q(year=previous_year, month__gte=current_month)),
-                product_usage__product__product_name=allocation_res,
-                account__organization=ProjectOrganization.objects.get(project=project).organization,
-            )
+    projected_costs = None
+    for allocation, allocation_res in zip(allocations, resource_names):
+        resource_charges = charges.get(allocation_res, {})
         allocation_column = [allocation_res]
         projection = False
         for year_month in year_months:
-            year = year_month[0]
-            month = year_month[1]
-            ym_records = allocation_billing_records.filter(year=year, month=month)
-            if year == current_year and month == current_month and ym_records.count() == 0:
+            if year_month in resource_charges:
+                ym_cost = resource_charges[year_month]
+            elif year_month == (current_year, current_month):
                 projection = True
-                ym_cost = allocation.cost
-            elif ym_records.count() == 0:
-                ym_cost = 0
+                if projected_costs is None:
+                    projected_costs = costs_for(allocations)
+                ym_cost = projected_costs.get(allocation.pk)
             else:
-                ym_cost = float(sum(r.decimal_charge for r in ym_records))
-
+                ym_cost = 0
             allocation_column.append(ym_cost)
         columns.append(allocation_column)
 
@@ -63,8 +179,7 @@ def generate_usage_history_graph(project):
         "columns": columns,
         "type": "bar",
         "order": "null",
-        "groups": [[ allocation.get_parent_resource.name for allocation in allocations
-                ]],
+        "groups": [resource_names],
     }
 
     return data
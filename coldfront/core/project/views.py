@@ -25,6 +25,7 @@ from coldfront.core.allocation.models import (
     AllocationUser,
     AllocationStatusChoice,
     AllocationUserStatusChoice,
+    costs_for,
 )
 from coldfront.core.allocation.signals import (
     allocation_remove_user,
@@ -65,6 +66,7 @@ from coldfront.core.project.models import (
     ProjectReviewStatusChoice,
 )
 from coldfront.core.project.manager_role_notifications import notify_manager_role_transition
+from coldfront.core.project.reports import storage_report_contexts
 from coldfront.core.project.utils import generate_usage_history_graph
 from coldfront.core.publication.models import Publication
 from coldfront.core.research_output.models import ResearchOutput
@@ -120,30 +122,7 @@ class ProjectStorageReportView(LoginRequiredMixin, UserPassesTestMixin, PDFView)
         context = super().get_context_data(**kwargs)
 
         project_obj = get_object_or_404(Project, pk=self.kwargs.get('pk'))
-        project_users = project_obj.projectuser_set.filter(
-                    status__name='Active').order_by('user__username')
-
-        storage_allocations = project_obj.allocation_set.filter(
-            status__name__in=['Active', 'Paid', 'Ready for Review','Payment Requested'],
-            resources__resource_type__name='Storage'
-        ).distinct().prefetch_related('resources').order_by('-pk')
-        allocation_total = {'allocation_user_count': 0, 'size': 0, 'cost': 0, 'usage':0}
-        for allocation in storage_allocations:
-            if allocation.cost and allocation.requires_payment:
-                allocation_total['cost'] += allocation.cost
-            if allocation.size:
-                allocation_total['size'] += allocation.size
-            if allocation.usage:
-                allocation_total['usage'] += allocation.usage
-            allocation_total['allocation_user_count'] += int(
-                allocation.allocationuser_set.count()
-            )
-
-        context['project'] = project_obj
-        context['storage_allocations'] = storage_allocations
-        context['allocation_total'] = allocation_total
-        context['project_users'] = project_users
-        context['CENTER_BASE_URL'] = import_from_settings('CENTER_BASE_URL', '')
+        context.update(storage_report_contexts([project_obj])[project_obj.pk])
         return context
 
 
@@ -247,9 +226,13 @@ class ProjectDetailView(LoginRequiredMixin, UserPassesTestMixin, DetailView):
             status__name__in=['Active', 'Paid', 'Ready for Review','Payment Requested']
         ).distinct().order_by('-end_date')
         storage_allocations = allocations.filter(
-            resources__resource_type__name='Storage').order_by('resources__name')
-        compute_allocations = allocations.filter(resources__resource_type__name='Cluster')
+            resources__resource_type__name='Storage'
+        ).order_by('resources__name').with_attribute_snapshot().with_parent_resource()
+        compute_allocations = allocations.filter(
+            resources__resource_type__name='Cluster'
+        ).with_attribute_snapshot().with_parent_resource()
         allocation_total = {'allocation_user_count': 0, 'size': 0, 'cost': 0, 'usage':0}
+        costs_for(storage_allocations)
         for allocation in storage_allocations:
             if allocation.cost and allocation.requires_payment:
                 allocation_total['cost'] += allocation.cost
@@ -51,6 +51,8 @@ class Command(BaseCommand):
             # ('ServiceStart', 'Date'),
             ('slurm_cluster', 'Text'),
             ('slurm_specs', 'Attribute Expanded Text'),
+            ('slurmrest_node_update_time', 'Int'),
+            ('slurmrest_partition_update_time', 'Int'),
             # ('slurm_specs_attriblist', 'Text'),
             # ('Status', 'Public/Private'),
             # ('Vendor', 'Text'),
@@ -1,6 +1,9 @@
 from datetime import datetime
 
 from django.db import models
+from django.db.models import Prefetch
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.conf import settings
 from django.contrib.auth.models import Group
 from django.utils.translation import gettext_lazy as _
@@ -10,6 +13,9 @@ from simple_history.models import HistoricalRecords
 
 from coldfront.core import attribute_expansion
 
+# relations loaded alongside each ResourceAttribute in an attribute snapshot
+ATTRIBUTE_SNAPSHOT_RELATED = ('resource_attribute_type__attribute_type',)
+
 class AttributeType(TimeStampedModel):
     """ An attribute type indicates the data type of the attribute. Examples
     include Date, Float, Int, Text, and Yes/No.
@@ -96,6 +102,22 @@ class ResourceAttributeType(TimeStampedModel):
     class Meta:
         ordering = ['name', ]
 
+class ResourceQuerySet(models.QuerySet):
+    """QuerySet for Resource with helpers to bulk-load related data."""
+
+    def with_attribute_snapshot(self):
+        """Prefetch the ResourceAttributes of every resource in the queryset,
+        with their types, so that get_attribute and get_attribute_list are
+        served from memory.
+        """
+        return self.prefetch_related(Prefetch(
+            'resourceattribute_set',
+            queryset=ResourceAttribute.objects.select_related(
+                *ATTRIBUTE_SNAPSHOT_RELATED
+            ).order_by('pk'),
+        ))
+
+
 class Resource(TimeStampedModel):
     """ A resource is something a center maintains and provides access to for the community. Examples include Budgetstorage, Server, and Software License.
 
@@ -130,7 +152,43 @@ class Resource(TimeStampedModel):
     allowed_users = models.ManyToManyField(settings.AUTH_USER_MODEL, blank=True)
     linked_resources = models.ManyToManyField('self', blank=True)
     history = HistoricalRecords()
-    objects = ResourceManager()
+    objects = ResourceManager.from_queryset(ResourceQuerySet)()
+
+    def refresh_from_db(self, *args, **kwargs):
+        self.clear_attribute_snapshot()
+        super().refresh_from_db(*args, **kwargs)
+
+    def _get_attribute_snapshot(self):
+        """
+        Returns:
+            dict[str, list[ResourceAttribute]]: the resource's attributes, with their types, keyed by attribute type name and ordered by pk
+
+        All attributes are loaded in a single query on first access (or taken
+        from ResourceQuerySet.with_attribute_snapshot) and kept until a
+        ResourceAttribute of this resource is saved or deleted.
+        """
+        snapshot = getattr(self, '_attribute_snapshot', None)
+        if snapshot is not None:
+            return snapshot
+        prefetched = getattr(self, '_prefetched_objects_cache', {})
+        if 'resourceattribute_set' in prefetched:
+            attributes = prefetched['resourceattribute_set']
+        else:
+            attributes = self.resourceattribute_set.select_related(
+                *ATTRIBUTE_SNAPSHOT_RELATED
+            ).order_by('pk')
+        snapshot = {}
+        for attribute in attributes:
+            snapshot.setdefault(
+                attribute.resource_attribute_type.name, []
+            ).append(attribute)
+        self._attribute_snapshot = snapshot
+        return snapshot
+
+    def clear_attribute_snapshot(self):
+        """Discard the in-memory attribute snapshot so the next read reloads it."""
+        self._attribute_snapshot = None
+        getattr(self, '_prefetched_objects_cache', {}).pop('resourceattribute_set', None)
 
     def get_missing_resource_attributes(self, required=False):
         """
@@ -238,8 +296,8 @@ class Resource(TimeStampedModel):
             str: the value of the first attribute found for this resource with the specified name
         """
 
-        attr = self.resourceattribute_set.filter(
-            resource_attribute_type__name=name).first()
+        attrs = self._get_attribute_snapshot().get(name)
+        attr = attrs[0] if attrs else None
         if attr:
             if expand:
                 return attr.expanded_value(
@@ -267,8 +325,7 @@ class Resource(TimeStampedModel):
             list: the list of values of the attributes found with specified name
         """
 
-        attr = self.resourceattribute_set.filter(
-            resource_attribute_type__name=name).all()
+        attr = self._get_attribute_snapshot().get(name, [])
         if expand:
             return [a.expanded_value(extra_allocations=extra_allocations,
                 typed=typed) for a in attr]
@@ -397,3 +454,14 @@ class ResourceAttribute(TimeStampedModel):
 
     class Meta:
         unique_together = ('resource_attribute_type', 'resource')
+
+
+@receiver(post_save, sender=ResourceAttribute)
+@receiver(post_delete, sender=ResourceAttribute)
+def resource_attribute_clear_snapshot(sender, instance, **kwargs):
+    '''
+    Invalidate the attribute snapshot of the Resource the changed
+    ResourceAttribute is attached to, if that Resource is in memory
+    '''
+    if ResourceAttribute.resource.is_cached(instance):
+        instance.resource.clear_attribute_snapshot()
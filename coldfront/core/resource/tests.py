@@ -2,7 +2,7 @@ from django.test import TestCase
 
 from coldfront.core.test_helpers import utils
 from coldfront.core.test_helpers.factories import setup_models, ProjectFactory, ResourceFactory, ResourceAttributeTypeFactory, ResourceAttributeFactory
-from coldfront.core.resource.models import AttributeType
+from coldfront.core.resource.models import AttributeType, Resource
 
 
 UTIL_FIXTURES = [
@@ -11,6 +11,34 @@ UTIL_FIXTURES = [
 
 BACKEND = "django.contrib.auth.backends.ModelBackend"
 
+
+class ResourceAttributeSnapshotTest(TestCase):
+    """Tests for the Resource attribute snapshot"""
+    fixtures = UTIL_FIXTURES
+
+    @classmethod
+    def setUpTestData(cls):
+        """Test Data setup for resource attribute snapshot tests."""
+        setup_models(cls)
+
+    def test_with_attribute_snapshot_primes_queryset(self):
+        """with_attribute_snapshot loads attributes for all resources up front"""
+        resources = list(Resource.objects.with_attribute_snapshot())
+        with self.assertNumQueries(0):
+            labels = [r.quantity_label for r in resources]
+        self.assertIn('TB', labels)
+
+    def test_snapshot_invalidated_on_attribute_save(self):
+        """saving a resource attribute clears the snapshot of its resource"""
+        resource = self.storage_resource
+        self.assertEqual(resource.quantity_label, 'TB')
+        attribute = resource.resourceattribute_set.get(
+            resource_attribute_type__name='quantity_label')
+        attribute.value = 'TiB'
+        attribute.save()
+        self.assertEqual(resource.quantity_label, 'TiB')
+
+
 class ResourceViewBaseTest(TestCase):
     """Base test for resource view tests"""
     fixtures = UTIL_FIXTURES
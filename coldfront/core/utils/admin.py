@@ -1,3 +1,11 @@
 from django.contrib import admin
 
-# Register your models here.
+from coldfront.core.utils.models import OutboundEmail
+
+
+@admin.register(OutboundEmail)
+class OutboundEmailAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'sender', 'status', 'attempts', 'created', 'sent')
+    list_filter = ('status',)
+    search_fields = ('subject', 'sender', 'to')
+    readonly_fields = ('created', 'modified', 'sent', 'attempts', 'error', 'transient', 'claim')
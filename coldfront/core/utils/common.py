@@ -1,5 +1,7 @@
 # import the logging library
 import logging
+import time
+from contextlib import contextmanager
 
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
@@ -27,6 +29,43 @@ def get_domain_url(request):
     return request.build_absolute_uri().replace(request.get_full_path(), '')
 
 
+class PhaseTimer:
+    """Record the wall time spent in each named phase of a job."""
+
+    def __init__(self):
+        self.timings = {}
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0) + time.perf_counter() - start
+
+    def summary(self):
+        return ', '.join(f'{name} {seconds:.2f}s' for name, seconds in self.timings.items())
+
+
+def shared_cache(alias='default'):
+    """Return the cache with this alias if every process sees its entries,
+    else None.
+
+    LocMemCache and DummyCache entries are private to one process, so an
+    invalidation made by a cron job or another web worker would never reach
+    them; callers that depend on cross-process invalidation should not cache
+    in them.
+    """
+    from django.core.cache import caches
+    from django.core.cache.backends.dummy import DummyCache
+    from django.core.cache.backends.locmem import LocMemCache
+
+    cache = caches[alias]
+    if isinstance(cache, (LocMemCache, DummyCache)):
+        return None
+    return cache
+
+
 class Echo:
     """An object that implements just the write method of the file-like
     interface.
@@ -8,11 +8,14 @@ from functools import reduce
 from datetime import datetime
 
 import pandas as pd
+from django.db import transaction
 from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
 from django.contrib.auth import get_user_model
-from ifxbilling.models import Product
+from ifxbilling.models import Product, Rate
 
-from coldfront.core.utils.common import import_from_settings
+from coldfront.core.utils.common import import_from_settings, shared_cache
+from coldfront.core.utils.permissions import current_permission_cache
 from coldfront.core.project.models import Project
 from coldfront.core.resource.models import Resource
 
@@ -22,6 +25,14 @@ MISSING_DATA_DIR = './local_data/missing/'
 
 username_ignore_list = import_from_settings('username_ignore_list', [])
 groupname_ignore_list = import_from_settings('groupname_ignore_list', [])
+# cache alias for the resource rate table; it is only cached across requests
+# when the cache is shared between processes, so that every process sees a
+# rate edit
+RESOURCE_RATES_CACHE = import_from_settings('RESOURCE_RATES_CACHE', 'default')
+# seconds the resource rate table is cached; saving a Rate, Product or
+# Resource reloads it sooner
+RESOURCE_RATES_TIMEOUT = import_from_settings('RESOURCE_RATES_TIMEOUT', 3600)
+RESOURCE_RATES_KEY = 'resource_rates'
 
 
 def get_quarter_start_end():
@@ -118,17 +129,11 @@ def convert_size_fmt(num, target_unit, source_unit='B', system='binary'):
             num*=divisor
     return round(num, 3)
 
-def get_resource_rate(resource):
-    """find Product with the name provided and return the associated rate"""
-    try:
-        resource_obj = Resource.objects.get(name=resource)
-    except Resource.DoesNotExist:
-        return None
-    if resource_obj.resource_type.name == 'Storage Tier':
-        return None
-    prod_obj = Product.objects.get(product_name=resource)
-    rate_obj = prod_obj.rate_set.get(is_active=True)
-    if resource_obj.resource_type.name == "Cluster":
+def normalize_rate(rate_obj, resource_type_name):
+    """Return the price of an active Rate in the units allocations are billed
+    in: dollars per CPU hour for clusters, dollars per TB for storage.
+    """
+    if resource_type_name == "Cluster":
         return rate_obj.decimal_price
     # return charge per TB, adjusted to dollar value
     if rate_obj.units in ['TiB', 'TB']:
@@ -136,6 +141,108 @@ def get_resource_rate(resource):
     price = convert_size_fmt(rate_obj.price, 'TiB', source_unit=rate_obj.units)
     return round(price/100, 2)
 
+def load_resource_rates():
+    """Return a dict of resource name to normalized rate for every Resource
+    whose Product has exactly one active Rate, in two queries. Storage Tier
+    resources have no rate.
+    """
+    resource_types = dict(
+        Resource.objects.exclude(resource_type__name='Storage Tier')
+        .values_list('name', 'resource_type__name')
+    )
+    rates_by_name = {}
+    for rate_obj in Rate.objects.filter(
+        is_active=True, product__product_name__in=resource_types
+    ).select_related('product'):
+        rates_by_name.setdefault(rate_obj.product.product_name, []).append(rate_obj)
+    rates = {}
+    for name, rate_objs in rates_by_name.items():
+        if len(rate_objs) > 1:
+            logger.error('product %s has %s active rates', name, len(rate_objs))
+            continue
+        rates[name] = normalize_rate(rate_objs[0], resource_types[name])
+    return rates
+
+def resource_rates():
+    """Return the table of resource name to normalized rate, cached in
+    RESOURCE_RATES_CACHE if it is shared between processes, else in the
+    request's PermissionCache.
+    """
+    cache = shared_cache(RESOURCE_RATES_CACHE)
+    if cache is None:
+        request_cache = current_permission_cache()
+        rates = request_cache.get(RESOURCE_RATES_KEY, None, None) if request_cache else None
+        if rates is None:
+            rates = load_resource_rates()
+            if request_cache is not None:
+                request_cache.set(RESOURCE_RATES_KEY, None, None, rates)
+        return rates
+    rates = cache.get(RESOURCE_RATES_KEY)
+    if rates is None:
+        rates = load_resource_rates()
+        cache.set(RESOURCE_RATES_KEY, rates, RESOURCE_RATES_TIMEOUT)
+    return rates
+
+def _drop_resource_rates():
+    cache = shared_cache(RESOURCE_RATES_CACHE)
+    if cache is not None:
+        cache.delete(RESOURCE_RATES_KEY)
+    request_cache = current_permission_cache()
+    if request_cache is not None:
+        request_cache.set(RESOURCE_RATES_KEY, None, None, None)
+
+def invalidate_resource_rates(**kwargs):
+    """Drop the cached rate table, to be reloaded on next use. Inside a
+    transaction the table is dropped again on commit, since other processes
+    may have cached the old rates before the change was visible to them.
+    """
+    _drop_resource_rates()
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(_drop_resource_rates)
+
+for _sender in (Rate, Product, Resource):
+    post_save.connect(
+        invalidate_resource_rates, sender=_sender,
+        dispatch_uid=f'resource_rates_save_{_sender._meta.label}',
+    )
+    post_delete.connect(
+        invalidate_resource_rates, sender=_sender,
+        dispatch_uid=f'resource_rates_delete_{_sender._meta.label}',
+    )
+
+def refresh_rate_summaries(sender, instance, **kwargs):
+    """Refresh the summaries, and so the costs, of the allocations of the
+    resource whose rate changed.
+    """
+    # imported here because the allocation models import this module
+    from coldfront.core.allocation.models import Allocation, schedule_summary_refresh
+
+    product_name = instance.product.product_name if sender is Rate else instance.product_name
+    allocation_ids = list(
+        Allocation.objects.filter(resources__name=product_name).values_list('pk', flat=True)
+    )
+
+    def refresh():
+        # after commit, with the rate table dropped, so the refresh prices with the new rate
+        invalidate_resource_rates()
+        schedule_summary_refresh(allocation_ids)
+
+    transaction.on_commit(refresh)
+
+for _sender in (Rate, Product):
+    post_save.connect(
+        refresh_rate_summaries, sender=_sender,
+        dispatch_uid=f'rate_summaries_save_{_sender._meta.label}',
+    )
+    post_delete.connect(
+        refresh_rate_summaries, sender=_sender,
+        dispatch_uid=f'rate_summaries_delete_{_sender._meta.label}',
+    )
+
+def get_resource_rate(resource):
+    """find Product with the name provided and return the associated rate"""
+    return resource_rates().get(resource)
+
 def id_present_missing_resources(resourceserver_list):
     """
     Collect all Resource entries with resources in param resourceserver_list;
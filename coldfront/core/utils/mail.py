@@ -1,10 +1,21 @@
 import logging
-from smtplib import SMTPException
+import time
+import uuid
+from collections import namedtuple
+from datetime import timedelta
+from smtplib import (
+    SMTPException,
+    SMTPRecipientsRefused,
+    SMTPResponseException,
+    SMTPServerDisconnected,
+)
 
 from django.conf import settings
-from django.core.mail import EmailMessage
+from django.core.mail import EmailMessage, get_connection
+from django.db.models import Q
 from django.template.loader import render_to_string
 from django.urls import reverse
+from django.utils import timezone
 
 from coldfront.core.utils.common import import_from_settings
 
@@ -22,22 +33,34 @@ EMAIL_OPT_OUT_INSTRUCTION_URL = import_from_settings('EMAIL_OPT_OUT_INSTRUCTION_
 EMAIL_SIGNATURE = import_from_settings('EMAIL_SIGNATURE')
 EMAIL_CENTER_NAME = import_from_settings('CENTER_NAME')
 CENTER_BASE_URL = import_from_settings('CENTER_BASE_URL')
+# messages MailQueue sends per connection, and how it retries transient failures
+EMAIL_BATCH_SIZE = import_from_settings('EMAIL_BATCH_SIZE', 100)
+EMAIL_MAX_RETRIES = import_from_settings('EMAIL_MAX_RETRIES', 3)
+EMAIL_RETRY_BACKOFF = import_from_settings('EMAIL_RETRY_BACKOFF', 2)
+# save MailQueue messages as OutboundEmails unless the queue says otherwise
+EMAIL_QUEUE_PERSIST = import_from_settings('EMAIL_QUEUE_PERSIST', False)
+# delivery attempts after which send_queued_emails stops retrying a Failed OutboundEmail
+EMAIL_QUEUE_MAX_ATTEMPTS = import_from_settings('EMAIL_QUEUE_MAX_ATTEMPTS', 12)
+# seconds send_queued_emails leaves a Queued OutboundEmail to the MailQueue that saved it
+EMAIL_QUEUE_GRACE_PERIOD = import_from_settings('EMAIL_QUEUE_GRACE_PERIOD', 600)
+# seconds after which send_queued_emails takes over an OutboundEmail left Sending
+EMAIL_QUEUE_CLAIM_TIMEOUT = import_from_settings('EMAIL_QUEUE_CLAIM_TIMEOUT', 3600)
 
 
-def send_email(subject, body, sender, receiver_list, cc=None, attachments=None):
-    """Helper function for sending emails
+def build_email(subject, body, sender, receiver_list, cc=None, attachments=None, connection=None):
+    """Return the EmailMessage send_email would send, or None when email is
+    disabled or the message has no receivers or sender.
     """
-
     if not EMAIL_ENABLED:
-        return
+        return None
 
     if len(receiver_list) == 0:
         logger.error('Failed to send email missing receiver_list. Subject: %s', subject)
-        return
+        return None
 
     if len(sender) == 0:
         logger.error('Failed to send email missing sender address. Subject: %s', subject)
-        return
+        return None
 
     if len(EMAIL_SUBJECT_PREFIX) > 0:
         subject = EMAIL_SUBJECT_PREFIX + ' ' + subject
@@ -47,26 +70,41 @@ def send_email(subject, body, sender, receiver_list, cc=None, attachments=None):
         if cc:
             cc = EMAIL_DEVELOPMENT_EMAIL_LIST
 
+    return EmailMessage(
+        subject, body, sender, receiver_list, cc=cc, attachments=attachments, connection=connection
+    )
+
+
+def log_send_failure(message, error):
+    logger.error(
+        'Email send failure.',
+        exc_info=error,
+        extra={
+            'receiver_list': ','.join(message.to),
+            'sender': message.from_email,
+            'subject': message.subject,
+            'error': str(error),
+        }
+    )
+
+
+def send_email(subject, body, sender, receiver_list, cc=None, attachments=None, connection=None):
+    """Helper function for sending emails
+
+    Use a MailQueue to send many emails over one connection.
+    """
+    email = build_email(
+        subject, body, sender, receiver_list, cc=cc, attachments=attachments, connection=connection
+    )
+    if email is None:
+        return
     try:
-        email = EmailMessage(subject, body, sender, receiver_list, cc=cc, attachments=attachments)
         email.send(fail_silently=False)
     except SMTPException as e:
-        logger.exception(
-            'Email send failure.',
-            extra={
-                'receiver_list': ','.join(receiver_list),
-                'sender': sender,
-                'subject': subject,
-                'error': str(e),
-            }
-        )
+        log_send_failure(email, e)
 
 
-def send_email_template(
-    subject, template_name, template_context, sender, receiver_list, cc=None, attachments=None
-):
-    """Helper function for sending emails from a template
-    """
+def render_email_template(template_name, template_context, subject, sender, receiver_list, cc=None):
     body = render_to_string(template_name, template_context)
     logger.info(
         "Sending email.",
@@ -77,7 +115,256 @@ def send_email_template(
             'sender': sender,
         }
     )
-    return send_email(subject, body, sender, receiver_list, cc=cc, attachments=attachments)
+    return body
+
+
+def send_email_template(
+    subject, template_name, template_context, sender, receiver_list, cc=None, attachments=None,
+    connection=None
+):
+    """Helper function for sending emails from a template
+    """
+    body = render_email_template(template_name, template_context, subject, sender, receiver_list, cc)
+    return send_email(
+        subject, body, sender, receiver_list, cc=cc, attachments=attachments, connection=connection
+    )
+
+
+def is_transient_mail_error(error):
+    """Return True if sending can be retried after error: dropped or refused
+    connections, timeouts and 4xx SMTP replies.
+    """
+    if isinstance(error, SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    if isinstance(error, SMTPServerDisconnected):
+        return True
+    # other SMTPExceptions are protocol or configuration errors; OSErrors
+    # left are socket errors and timeouts
+    return not isinstance(error, SMTPException) and isinstance(error, OSError)
+
+
+MailOutcome = namedtuple('MailOutcome', ['message', 'sent', 'attempts', 'error', 'record'])
+MailOutcome.__doc__ = """What happened to a message sent by a MailQueue. record is its
+OutboundEmail when the queue persists messages, else None."""
+
+
+class MailQueue:
+    """Queue outbound emails and send them in batches over one reused connection.
+
+    Messages are validated as send_email would and held until flush, which
+    opens one connection per batch of EMAIL_BATCH_SIZE messages. A full batch
+    is flushed as soon as it is queued. A message that fails with a transient
+    error (see is_transient_mail_error) is retried on a fresh connection up to
+    EMAIL_MAX_RETRIES times, waiting EMAIL_RETRY_BACKOFF seconds and twice as
+    long after each further failure. Other failures are logged and the queue
+    moves on. flush returns a MailOutcome per message it sent, and outcomes
+    keeps every MailOutcome.
+
+    With persist=True, or EMAIL_QUEUE_PERSIST set, every queued message is
+    saved as an OutboundEmail whose status, attempts and error are updated
+    when it is flushed. flush first claims the queue's Queued OutboundEmails
+    and drops those send_queued_emails claimed already. Messages left Queued,
+    e.g. by a crashed job, are sent by send_queued_emails.
+
+    Used as a context manager, the queue is flushed on exit.
+    """
+
+    def __init__(self, batch_size=None, max_retries=None, backoff=None, persist=None, connection=None):
+        self.batch_size = batch_size or EMAIL_BATCH_SIZE
+        self.max_retries = EMAIL_MAX_RETRIES if max_retries is None else max_retries
+        self.backoff = EMAIL_RETRY_BACKOFF if backoff is None else backoff
+        self.persist = EMAIL_QUEUE_PERSIST if persist is None else persist
+        self.connection = connection
+        self.pending = []
+        self.outcomes = []
+
+    def __len__(self):
+        return len(self.pending)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def add(self, subject, body, sender, receiver_list, cc=None, attachments=None):
+        """Queue an email with the arguments of send_email. Returns the
+        EmailMessage, or None if it won't be sent.
+        """
+        message = build_email(subject, body, sender, receiver_list, cc=cc, attachments=attachments)
+        if message is not None:
+            self.add_message(message)
+        return message
+
+    def add_template(
+        self, subject, template_name, template_context, sender, receiver_list, cc=None, attachments=None
+    ):
+        """Queue an email with the arguments of send_email_template."""
+        body = render_email_template(template_name, template_context, subject, sender, receiver_list, cc)
+        return self.add(subject, body, sender, receiver_list, cc=cc, attachments=attachments)
+
+    def add_message(self, message, record=None):
+        """Queue a ready EmailMessage, optionally with its OutboundEmail."""
+        if record is None and self.persist:
+            from coldfront.core.utils.models import OutboundEmail
+            record = OutboundEmail.from_message(message)
+            record.save()
+        self.pending.append((message, record))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Send every queued message and return their MailOutcomes."""
+        pending, self.pending = self._claim(self.pending), []
+        outcomes = []
+        for start in range(0, len(pending), self.batch_size):
+            outcomes.extend(self._send_batch(pending[start:start + self.batch_size]))
+        self._save_records(outcomes)
+        self.outcomes.extend(outcomes)
+        sent = sum(outcome.sent for outcome in outcomes)
+        if outcomes:
+            logger.info('Sent %s of %s queued emails.', sent, len(outcomes))
+        return outcomes
+
+    @staticmethod
+    def _claim(pending):
+        """Claim the Queued OutboundEmails in pending and return pending
+        without the messages whose OutboundEmail was claimed by another queue.
+        """
+        from coldfront.core.utils.models import OutboundEmail
+        queued = [
+            record for _, record in pending
+            if record is not None and record.status == OutboundEmail.QUEUED
+        ]
+        if not queued:
+            return pending
+        claimed = set(
+            claim_outbound_emails(
+                Q(pk__in=[record.pk for record in queued], status=OutboundEmail.QUEUED)
+            ).values_list('pk', flat=True)
+        )
+        for record in queued:
+            if record.pk in claimed:
+                record.status = OutboundEmail.SENDING
+        return [
+            (message, record) for message, record in pending
+            if record is None or record.status != OutboundEmail.QUEUED
+        ]
+
+    def _send_batch(self, batch):
+        connection = self.connection or get_connection(fail_silently=False)
+        outcomes = []
+        try:
+            for message, record in batch:
+                outcomes.append(self._send_message(connection, message, record))
+        finally:
+            if self.connection is None:
+                self._close(connection)
+        return outcomes
+
+    def _send_message(self, connection, message, record):
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                connection.open()
+                sent = connection.send_messages([message])
+            except (SMTPException, OSError) as error:
+                if attempts > self.max_retries or not is_transient_mail_error(error):
+                    log_send_failure(message, error)
+                    return MailOutcome(message, False, attempts, error, record)
+                # start the retry on a fresh connection
+                self._close(connection)
+                time.sleep(self.backoff * 2 ** (attempts - 1))
+                continue
+            return MailOutcome(message, bool(sent), attempts, None, record)
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.close()
+        except (SMTPException, OSError):
+            pass
+
+    @staticmethod
+    def _save_records(outcomes):
+        from coldfront.core.utils.models import OutboundEmail
+        now = timezone.now()
+        records = []
+        for outcome in outcomes:
+            record = outcome.record
+            if record is None:
+                continue
+            record.attempts += outcome.attempts
+            record.modified = now
+            record.claim = ''
+            if outcome.sent:
+                record.status = OutboundEmail.SENT
+                record.sent = now
+                record.error = ''
+                record.transient = False
+            else:
+                record.status = OutboundEmail.FAILED
+                record.error = str(outcome.error or 'not accepted by the mail backend')
+                record.transient = outcome.error is None or is_transient_mail_error(outcome.error)
+            records.append(record)
+        if records:
+            OutboundEmail.objects.bulk_update(
+                records,
+                ['status', 'claim', 'attempts', 'error', 'transient', 'sent', 'modified'],
+                batch_size=500,
+            )
+
+
+def claim_outbound_emails(condition):
+    """Mark the OutboundEmails matching condition Sending with a new claim
+    token in one UPDATE, and return a queryset of the ones claimed.
+
+    The UPDATE re-checks condition, so of two queues claiming the same rows
+    only the first gets them.
+    """
+    from coldfront.core.utils.models import OutboundEmail
+    token = uuid.uuid4().hex
+    OutboundEmail.objects.filter(condition).update(
+        status=OutboundEmail.SENDING, claim=token, modified=timezone.now()
+    )
+    return OutboundEmail.objects.filter(claim=token)
+
+
+def send_queued_emails(limit=None, retry_failed=True, **kwargs):
+    """Send the OutboundEmails still Queued, oldest first, and retry the
+    Failed ones whose error was transient and that have had fewer than
+    EMAIL_QUEUE_MAX_ATTEMPTS delivery attempts. Keyword arguments are passed
+    to MailQueue. Returns the MailOutcomes.
+
+    Queued messages saved in the last EMAIL_QUEUE_GRACE_PERIOD seconds are
+    left to the MailQueue that saved them, and messages left Sending for
+    EMAIL_QUEUE_CLAIM_TIMEOUT seconds are taken over. Every message is
+    claimed before it is sent, so concurrent runs never send one twice.
+
+    Run by the send_queued_emails management command and the scheduled task
+    of the same name.
+    """
+    from coldfront.core.utils.models import OutboundEmail
+    now = timezone.now()
+    pending = (
+        Q(status=OutboundEmail.QUEUED, created__lt=now - timedelta(seconds=EMAIL_QUEUE_GRACE_PERIOD))
+        | Q(status=OutboundEmail.SENDING, modified__lt=now - timedelta(seconds=EMAIL_QUEUE_CLAIM_TIMEOUT))
+    )
+    if retry_failed:
+        pending |= Q(
+            status=OutboundEmail.FAILED, transient=True, attempts__lt=EMAIL_QUEUE_MAX_ATTEMPTS
+        )
+    candidates = OutboundEmail.objects.filter(pending).order_by('created').values_list('pk', flat=True)
+    if limit:
+        candidates = candidates[:limit]
+    records = claim_outbound_emails(pending & Q(pk__in=list(candidates))).order_by('created')
+    with MailQueue(**kwargs) as mail_queue:
+        for record in records:
+            mail_queue.add_message(record.to_message(), record)
+    return mail_queue.outcomes
 
 
 def email_template_context(extra_context=None):
@@ -52,3 +52,12 @@ class Command(BaseCommand):
                 schedule_type=Schedule.WEEKLY,
                 **kwargs
             )
+
+        if 'coldfront.core.utils.tasks.send_queued_emails' not in scheduled:
+            schedule(
+                'coldfront.core.utils.tasks.send_queued_emails',
+                next_run=date,
+                schedule_type=Schedule.MINUTES,
+                minutes=5,
+                **kwargs
+            )
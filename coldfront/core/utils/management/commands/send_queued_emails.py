@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from coldfront.core.utils.mail import send_queued_emails
+
+
+class Command(BaseCommand):
+    help = 'Send the persisted OutboundEmails that are queued, and retry the failed ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=None,
+            help='send at most this many emails')
+        parser.add_argument('--no-retry', action='store_true', default=False,
+            help='only send Queued emails, leaving the Failed ones alone')
+
+    def handle(self, *args, **options):
+        outcomes = send_queued_emails(
+            limit=options['limit'], retry_failed=not options['no_retry']
+        )
+        sent = sum(outcome.sent for outcome in outcomes)
+        self.stdout.write(f'sent {sent} of {len(outcomes)} emails')
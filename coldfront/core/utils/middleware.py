@@ -0,0 +1,17 @@
+from coldfront.core.utils.permissions import permission_cache
+
+
+class PermissionCacheMiddleware:
+    """
+    Middleware that memoizes the project and allocation permissions resolved
+    while handling a request. The cache is available as
+    request.permission_cache.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with permission_cache() as cache:
+            request.permission_cache = cache
+            response = self.get_response(request)
+        return response
@@ -1,3 +1,73 @@
+import base64
+
+from django.core.mail import EmailMessage
 from django.db import models
+from model_utils.models import TimeStampedModel
+
+
+class OutboundEmail(TimeStampedModel):
+    """An email queued by coldfront.core.utils.mail.MailQueue with persist=True.
+
+    Attributes:
+        subject (str): subject line, with EMAIL_SUBJECT_PREFIX applied
+        body (str): message body
+        sender (str): from address
+        to (list): recipient addresses
+        cc (list): cc addresses
+        attachments (list): [filename, base64 content, mimetype] triples
+        status (str): Queued until a queue claims it, Sending while it is sent,
+            then Sent or Failed
+        claim (str): token of the queue that claimed the message for sending
+        attempts (int): number of delivery attempts made
+        error (str): the last delivery error
+        transient (bool): whether the last delivery error may clear on a retry
+        sent (datetime): when the message was handed to the mail server
+    """
+    QUEUED = 'Queued'
+    SENDING = 'Sending'
+    SENT = 'Sent'
+    FAILED = 'Failed'
+    STATUS_CHOICES = ((QUEUED, QUEUED), (SENDING, SENDING), (SENT, SENT), (FAILED, FAILED))
+
+    subject = models.CharField(max_length=998)
+    body = models.TextField()
+    sender = models.CharField(max_length=254)
+    to = models.JSONField(default=list)
+    cc = models.JSONField(default=list, blank=True)
+    attachments = models.JSONField(default=list, blank=True)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED, db_index=True)
+    claim = models.CharField(max_length=32, blank=True, default='', db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True, default='')
+    transient = models.BooleanField(default=False)
+    sent = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return f'{self.subject} ({self.status})'
+
+    @classmethod
+    def from_message(cls, message):
+        """Return an unsaved OutboundEmail holding an EmailMessage."""
+        attachments = []
+        for filename, content, mimetype in message.attachments:
+            if isinstance(content, str):
+                content = content.encode()
+            attachments.append([filename, base64.b64encode(content).decode('ascii'), mimetype])
+        return cls(
+            subject=message.subject,
+            body=message.body,
+            sender=message.from_email,
+            to=list(message.to),
+            cc=list(message.cc),
+            attachments=attachments,
+        )
 
-# Create your models here.
+    def to_message(self):
+        """Rebuild the EmailMessage this row holds."""
+        return EmailMessage(
+            self.subject, self.body, self.sender, self.to, cc=self.cc,
+            attachments=[
+                (filename, base64.b64decode(content), mimetype)
+                for filename, content, mimetype in self.attachments
+            ],
+        )
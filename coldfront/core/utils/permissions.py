@@ -0,0 +1,57 @@
+"""Request-scoped memoization of object permissions.
+
+Project.user_permissions and Allocation.user_permissions keep what they
+resolve in the PermissionCache active in the current thread, so repeated
+checks for the same (user, object) while handling one request cost nothing.
+PermissionCacheMiddleware opens a cache for every request and puts it on
+request.permission_cache; outside a request, permission_cache() opens one
+for the duration of a block. With no cache active nothing is memoized.
+"""
+import threading
+from contextlib import contextmanager
+
+_cache_state = threading.local()
+
+
+class PermissionCache:
+    """Permissions already resolved, keyed by (kind, object pk, user pk)."""
+
+    def __init__(self):
+        self._permissions = {}
+
+    def get(self, kind, object_pk, user_pk):
+        return self._permissions.get((kind, object_pk, user_pk))
+
+    def set(self, kind, object_pk, user_pk, permissions):
+        self._permissions[(kind, object_pk, user_pk)] = permissions
+
+    def clear(self):
+        self._permissions.clear()
+
+
+def current_permission_cache():
+    """Return the PermissionCache active in this thread, if any."""
+    return getattr(_cache_state, 'cache', None)
+
+
+@contextmanager
+def permission_cache():
+    """Memoize the permissions resolved inside the block. Nested blocks share
+    the outermost cache.
+    """
+    cache = current_permission_cache()
+    if cache is not None:
+        yield cache
+        return
+    cache = _cache_state.cache = PermissionCache()
+    try:
+        yield cache
+    finally:
+        _cache_state.cache = None
+
+
+def clear_permission_cache(**kwargs):
+    """Forget the permissions resolved so far, e.g. after a role changes."""
+    cache = current_permission_cache()
+    if cache is not None:
+        cache.clear()
@@ -0,0 +1,13 @@
+import logging
+
+from coldfront.core.utils.mail import send_queued_emails as send_queued_email_records
+
+logger = logging.getLogger(__name__)
+
+
+def send_queued_emails():
+    """Send the persisted OutboundEmails that are queued or due a retry."""
+    outcomes = send_queued_email_records()
+    sent = sum(outcome.sent for outcome in outcomes)
+    logger.info('send_queued_emails sent %s of %s emails', sent, len(outcomes))
+    return f'sent {sent} of {len(outcomes)} emails'
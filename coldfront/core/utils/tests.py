@@ -1,10 +1,21 @@
+from datetime import timedelta
+from io import StringIO
+
 from django.core import mail
+from django.core.management import call_command
+from django.core.mail import get_connection
+from django.core.mail.backends.locmem import EmailBackend
 from django.test import TestCase, override_settings
-from smtplib import SMTPException
+from django.utils import timezone
+from smtplib import SMTPException, SMTPRecipientsRefused, SMTPServerDisconnected
 from unittest import mock, skip
 from unittest.mock import patch, MagicMock
 
+from coldfront.core.utils import mail as mail_module
+from coldfront.core.utils.models import OutboundEmail
 from coldfront.core.utils.mail import (
+    MailQueue,
+    send_queued_emails,
     send_email,
     send_email_template,
     email_template_context,
@@ -130,3 +141,124 @@ class EmailFunctionsTestCase(TestCase):
         self.assertEqual(len(mail.outbox), 1)
         self.assertIn('user@example.com', mail.outbox[0].to)
         mock_render.assert_called_once_with(self.template_name, mock.ANY)
+
+
+class FlakyEmailBackend(EmailBackend):
+    """locmem backend that drops the connection on the first send and refuses
+    messages with the subject 'refused'"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.calls = 0
+
+    def send_messages(self, messages):
+        self.calls += 1
+        if self.calls == 1:
+            raise SMTPServerDisconnected('connection dropped')
+        if messages[0].subject == 'refused':
+            raise SMTPRecipientsRefused({'receiver@example.com': (550, b'no such user')})
+        return super().send_messages(messages)
+
+
+@patch('coldfront.core.utils.mail.EMAIL_ENABLED', True)
+@patch('coldfront.core.utils.mail.EMAIL_SUBJECT_PREFIX', '')
+class MailQueueTestCase(TestCase):
+
+    def setUp(self):
+        self.sender = 'sender@example.com'
+        self.receiver_list = ['receiver@example.com']
+
+    def test_batches_share_a_connection(self):
+        with patch('coldfront.core.utils.mail.get_connection', wraps=get_connection) as connect:
+            with MailQueue(batch_size=2) as mail_queue:
+                for i in range(5):
+                    mail_queue.add(f'Subject {i}', 'Body', self.sender, self.receiver_list)
+        self.assertEqual(connect.call_count, 3)
+        self.assertEqual([m.subject for m in mail.outbox], [f'Subject {i}' for i in range(5)])
+        self.assertTrue(all(outcome.sent for outcome in mail_queue.outcomes))
+
+    def test_transient_failures_are_retried(self):
+        mail_queue = MailQueue(backoff=0, connection=FlakyEmailBackend())
+        mail_queue.add('sent', 'Body', self.sender, self.receiver_list)
+        mail_queue.add('refused', 'Body', self.sender, self.receiver_list)
+        sent, refused = mail_queue.flush()
+        self.assertTrue(sent.sent)
+        self.assertEqual(sent.attempts, 2)
+        self.assertFalse(refused.sent)
+        self.assertEqual(refused.attempts, 1)
+        self.assertIsInstance(refused.error, SMTPRecipientsRefused)
+        self.assertEqual([m.subject for m in mail.outbox], ['sent'])
+
+    @patch('coldfront.core.utils.mail.EMAIL_QUEUE_GRACE_PERIOD', 0)
+    def test_persisted_messages(self):
+        attachment = ('report.pdf', b'%PDF-1.4', 'application/pdf')
+        mail_queue = MailQueue(persist=True)
+        mail_queue.add('Subject', 'Body', self.sender, self.receiver_list, attachments=[attachment])
+        record = OutboundEmail.objects.get()
+        self.assertEqual(record.status, OutboundEmail.QUEUED)
+        # a queue that never flushed leaves its messages to send_queued_emails
+        outcomes = send_queued_emails()
+        self.assertEqual(len(outcomes), 1)
+        record.refresh_from_db()
+        self.assertEqual(record.status, OutboundEmail.SENT)
+        self.assertEqual(record.attempts, 1)
+        self.assertEqual(record.claim, '')
+        self.assertEqual(mail.outbox[0].attachments, [attachment])
+        # the queue finds its message claimed and doesn't send it again
+        self.assertEqual(mail_queue.flush(), [])
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_recent_messages_left_to_their_queue(self):
+        mail_queue = MailQueue(persist=True)
+        mail_queue.add('Subject', 'Body', self.sender, self.receiver_list)
+        self.assertEqual(send_queued_emails(), [])
+        self.assertEqual(len(mail_queue.flush()), 1)
+        self.assertEqual(OutboundEmail.objects.get().status, OutboundEmail.SENT)
+        self.assertEqual(len(mail.outbox), 1)
+
+    @patch('coldfront.core.utils.mail.EMAIL_QUEUE_CLAIM_TIMEOUT', 60)
+    def test_stale_claims_taken_over(self):
+        MailQueue(persist=True).add('Subject', 'Body', self.sender, self.receiver_list)
+        record = OutboundEmail.objects.get()
+        OutboundEmail.objects.update(status=OutboundEmail.SENDING, claim='crashed')
+        self.assertEqual(send_queued_emails(), [])
+        OutboundEmail.objects.update(modified=timezone.now() - timedelta(minutes=5))
+        self.assertEqual(len(send_queued_emails()), 1)
+        record.refresh_from_db()
+        self.assertEqual(record.status, OutboundEmail.SENT)
+
+    @patch('coldfront.core.utils.mail.EMAIL_QUEUE_GRACE_PERIOD', 0)
+    def test_failed_messages_retried_up_to_limit(self):
+        mail_queue = MailQueue(persist=True)
+        mail_queue.add('Subject', 'Body', self.sender, self.receiver_list)
+        record = OutboundEmail.objects.get()
+        record.status = OutboundEmail.FAILED
+        record.transient = True
+        record.attempts = mail_module.EMAIL_QUEUE_MAX_ATTEMPTS
+        record.save()
+        self.assertEqual(send_queued_emails(), [])
+        record.attempts = mail_module.EMAIL_QUEUE_MAX_ATTEMPTS - 1
+        record.save()
+        self.assertEqual(send_queued_emails(retry_failed=False), [])
+        outcomes = send_queued_emails()
+        self.assertEqual(len(outcomes), 1)
+        record.refresh_from_db()
+        self.assertEqual(record.status, OutboundEmail.SENT)
+
+    def test_permanent_failures_not_retried(self):
+        mail_queue = MailQueue(persist=True, backoff=0, connection=FlakyEmailBackend())
+        mail_queue.add('refused', 'Body', self.sender, self.receiver_list)
+        mail_queue.flush()
+        record = OutboundEmail.objects.get()
+        self.assertEqual(record.status, OutboundEmail.FAILED)
+        self.assertFalse(record.transient)
+        with patch('coldfront.core.utils.mail.EMAIL_QUEUE_GRACE_PERIOD', 0):
+            self.assertEqual(send_queued_emails(), [])
+
+    @patch('coldfront.core.utils.mail.EMAIL_QUEUE_GRACE_PERIOD', 0)
+    def test_send_queued_emails_command(self):
+        MailQueue(persist=True).add('Subject', 'Body', self.sender, self.receiver_list)
+        out = StringIO()
+        call_command('send_queued_emails', stdout=out)
+        self.assertIn('sent 1 of 1 emails', out.getvalue())
+        self.assertEqual(OutboundEmail.objects.get().status, OutboundEmail.SENT)
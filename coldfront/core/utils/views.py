@@ -1,6 +1,7 @@
 from django import forms
 from django.contrib import messages
 from django.views.generic import ListView
+from django.db.models import F, Q
 from django.db.models.query import QuerySet
 from django.shortcuts import get_object_or_404
 from django.views.generic.edit import CreateView, UpdateView
@@ -16,6 +17,72 @@ def produce_filter_parameter(key, value):
     return f'{key}={value}&'
 
 
+class KeysetPage:
+    """A page of rows read after a cursor row instead of at an offset.
+
+    Attributes:
+        object_list (list): the rows of the page
+        cursor (int): pk of the row the page follows, or None on the first page
+        next_cursor (int): pk to pass as the cursor of the next page, or None
+            on the last page
+    """
+
+    def __init__(self, object_list, cursor, next_cursor):
+        self.object_list = object_list
+        self.cursor = cursor
+        self.next_cursor = next_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+def keyset_paginate(queryset, after=None, page_size=100):
+    """Return the KeysetPage of up to page_size rows of queryset that follow
+    the row whose pk is after.
+
+    Rows are ordered by the queryset's first ordering field, with nulls last,
+    then by pk. Instead of an OFFSET, which makes the database read and skip
+    every earlier row, the page is selected with a WHERE on the ordering
+    value and pk of the cursor row, so late pages cost as much as the first.
+    """
+    order_by = queryset.query.order_by[0] if queryset.query.order_by else 'pk'
+    if not isinstance(order_by, str) or order_by.lstrip('-') == '?':
+        order_by = 'pk'
+    descending = order_by.startswith('-')
+    field = order_by.lstrip('-')
+    expression = F(field).desc(nulls_last=True) if descending else F(field).asc(nulls_last=True)
+    queryset = queryset.order_by(expression, '-pk' if descending else 'pk')
+
+    try:
+        cursor = int(after) if after else None
+    except ValueError:
+        cursor = None
+    if cursor is not None:
+        values = list(queryset.filter(pk=cursor).values_list(field, flat=True)[:1])
+        if not values:
+            cursor = None
+    if cursor is not None:
+        value = values[0]
+        after_cursor = 'lt' if descending else 'gt'
+        if value is None:
+            queryset = queryset.filter(**{f'{field}__isnull': True, f'pk__{after_cursor}': cursor})
+        else:
+            queryset = queryset.filter(
+                Q(**{f'{field}__{after_cursor}': value})
+                | Q(**{field: value, f'pk__{after_cursor}': cursor})
+                | Q(**{f'{field}__isnull': True})
+            )
+    rows = list(queryset[:page_size + 1])
+    next_cursor = rows[page_size - 1].pk if len(rows) > page_size else None
+    return KeysetPage(rows[:page_size], cursor, next_cursor)
+
+
 class ColdfrontListView(LoginRequiredMixin, ListView):
     """A ListView with definitions standard to complex ListView implementations in ColdFront
     """
@@ -4,7 +4,7 @@ from datetime import timedelta
 
 from django.contrib.auth import get_user_model
 
-from django.db.models import OuterRef, Subquery, Q, F, ExpressionWrapper, Case, When, Value, fields
+from django.db.models import OuterRef, Prefetch, Subquery, Q, F, ExpressionWrapper, Case, When, Value, fields
 from django.db.models.functions import Cast
 from django.http import HttpResponse
 from django_filters import rest_framework as filters
@@ -82,8 +82,23 @@ class AllocationFilter(filters.FilterSet):
     '''Filters for AllocationViewSet.
     created_before is the date the request was created before.
     created_after is the date the request was created after.
+    size, usage and pct_full filter and o sorts on the allocation summaries.
     '''
     created = filters.DateFromToRangeFilter()
+    size = filters.RangeFilter(label='Size Range', field_name='summary__size')
+    usage = filters.RangeFilter(label='Usage Range', field_name='summary__usage')
+    pct_full = filters.RangeFilter(label='Percent Full Range', field_name='summary__percent_full')
+    o = filters.OrderingFilter(
+        fields=(
+            ('id', 'id'),
+            ('created', 'created'),
+            ('project__title', 'project'),
+            ('summary__size', 'size'),
+            ('summary__usage', 'usage'),
+            ('summary__percent_full', 'pct_full'),
+            ('summary__cost', 'cost'),
+        )
+    )
 
     class Meta:
         model = Allocation
@@ -100,7 +115,7 @@ class AllocationViewSet(viewsets.ReadOnlyModelViewSet):
     def get_queryset(self):
         allocations = Allocation.objects.prefetch_related(
             'project', 'project__pi', 'status'
-        )
+        ).with_attribute_snapshot().with_parent_resource()
 
         if not (self.request.user.is_superuser or self.request.user.has_perm(
             'allocation.can_view_all_allocations'
@@ -226,7 +241,7 @@ class AllocationRequestViewSet(viewsets.ReadOnlyModelViewSet):
         # Annotate allocations with the status_id of their earliest historical record
         allocations = Allocation.objects.annotate(
             earliest_status_name=Subquery(earliest_history)
-        ).filter(earliest_status_name='New')
+        ).filter(earliest_status_name='New').with_attribute_snapshot().with_parent_resource()
 
         allocations = allocations.annotate(
             fulfilled_date=Subquery(fulfilled_date)
@@ -365,7 +380,8 @@ class AllocationChangeRequestViewSet(viewsets.ReadOnlyModelViewSet):
 
     def get_queryset(self):
         requests = AllocationChangeRequest.objects.prefetch_related(
-            'allocation', 'allocation__project', 'allocation__project__pi'
+            Prefetch('allocation', queryset=Allocation.objects.with_parent_resource()),
+            'allocation__project', 'allocation__project__pi'
         )
 
         if not (self.request.user.is_superuser or self.request.user.is_staff):
@@ -476,7 +492,10 @@ class ProjectViewSet(viewsets.ReadOnlyModelViewSet):
             projects = projects.prefetch_related('projectuser_set')
 
         if self.request.query_params.get('allocations') in ['True', 'true']:
-            projects = projects.prefetch_related('allocation_set')
+            projects = projects.prefetch_related(Prefetch(
+                'allocation_set',
+                queryset=Allocation.objects.with_attribute_snapshot().with_parent_resource(),
+            ))
 
         return projects.order_by('pi')
 
@@ -595,7 +614,9 @@ class UnusedStorageAllocationViewSet(viewsets.ReadOnlyModelViewSet):
                 # add the allocation to the list
             unused_alloc_ids.append(alloc.pk)
         # return all allocation objects with a matching pk
-        return Allocation.objects.filter(pk__in=unused_alloc_ids)
+        return Allocation.objects.filter(
+            pk__in=unused_alloc_ids
+        ).with_attribute_snapshot().with_parent_resource()
 
     def list(self, request, *args, **kwargs):
         queryset = self.filter_queryset(self.get_queryset())
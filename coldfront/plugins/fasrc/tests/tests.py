@@ -1,6 +1,12 @@
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase
 
-from coldfront.plugins.fasrc.utils import AllTheThingsConn, push_quota_data
+from coldfront.core.utils.fasrc import read_json
+from coldfront.plugins.fasrc.utils import (
+    AllTheThingsConn,
+    att_row_to_record,
+    push_att_rows,
+    push_quota_data,
+)
 from coldfront.core.test_helpers.factories import (
     setup_models,
     UserFactory,
@@ -48,3 +54,44 @@ class UploadTests(TestCase):
         """Ensure that push runs successfully"""
         push_quota_data(self.testfiles)
         # assert AllocationAttribute.
+
+    def test_push_skips_invalid_rows(self):
+        """rows with missing fields or invalid sizes are logged and skipped"""
+        rows_by_lab = read_json(self.testfiles)
+        rows_by_lab['gordon_lab'].append(dict(rows_by_lab['gordon_lab'][0], byte_allocation='N/A'))
+        rows_by_lab['gordon_lab'].append({'lab': 'gordon_lab'})
+        with self.assertLogs('coldfront.import_quotas', level='ERROR') as logs:
+            report = push_att_rows(rows_by_lab)
+        self.assertEqual(report['invalid rows'], 2)
+        self.assertEqual(len([line for line in logs.output if 'invalid ATT quota row' in line]), 2)
+
+
+class ATTRowTests(SimpleTestCase):
+    """Tests for the conversion of ATT quota rows"""
+
+    def row(self, **values):
+        row = {
+            'lab': 'gordon_lab', 'fs_path': '/n/holylfs10', 'server': 'holylfs10',
+            'byte_allocation': 1099511627776, 'byte_usage': 8183568264,
+            'tb_allocation': 1, 'tb_usage': 0.008183568264,
+        }
+        row.update(values)
+        return row
+
+    def test_sizes_converted(self):
+        """numeric strings become numbers and empty sizes None"""
+        record = att_row_to_record(self.row(
+            byte_allocation='1099511627776', byte_usage='', tb_allocation='1', tb_usage='0.5'
+        ))
+        self.assertEqual(record.limit_bytes, 1099511627776)
+        self.assertIsNone(record.used_bytes)
+        self.assertEqual(str(record.limit_tb), '1')
+        self.assertEqual(record.used_tb, 0.5)
+
+    def test_invalid_sizes_rejected(self):
+        """sizes that aren't finite, non-negative numbers raise ValueError"""
+        for value in ('N/A', 'nan', -1, True, [1]):
+            with self.assertRaises(ValueError):
+                att_row_to_record(self.row(byte_allocation=value))
+        with self.assertRaises(KeyError):
+            att_row_to_record({'lab': 'gordon_lab'})
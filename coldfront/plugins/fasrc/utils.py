@@ -1,5 +1,7 @@
 import json
 import logging
+import math
+from collections import defaultdict
 
 import requests
 
@@ -11,7 +13,13 @@ from coldfront.core.utils.fasrc import (
     id_present_missing_projects
 )
 from coldfront.core.resource.models import Resource
-from coldfront.core.allocation.models import AllocationAttributeType
+from coldfront.core.allocation.models import Allocation
+from coldfront.core.allocation.quota_sources import (
+    QuotaRecord,
+    QuotaSource,
+    poll_quota_sources,
+    write_quota_records,
+)
 
 
 logger = logging.getLogger(__name__)
@@ -215,104 +223,140 @@ class AllTheThingsConn:
         return resp_json
 
 
-def matched_dict_processing(allocation, data_dicts, paired_allocs, log_message):
-    logger = logging.getLogger('coldfront.import_quotas')
-    if len(data_dicts) == 1:
-        logger.debug(log_message)
-        paired_allocs[allocation] = data_dicts[0]
+class ATTQuotaSource(QuotaSource):
+    """Quotas of the Tier 0, 1 and 2 and tape storage allocations, as
+    reported by AllTheThings.
+
+    ATT rows are matched to a project's storage allocations by path and
+    server, and report sizes in the allocation's own units. The raw rows of
+    the last list_quotas call are kept in rows.
+    """
+    name = 'AllTheThings'
+
+    def __init__(self, volumes=None, timeout=None):
+        super().__init__(timeout=timeout)
+        self.volumes = volumes
+        self.rows = []
+
+    def list_quotas(self):
+        self.rows = QuotaDataPuller(volumes=self.volumes).pull('ATTQuery')
+        return att_rows_to_records(self.rows)
+
+    def get_size_attribute_name(self, allocation):
+        return f'Storage Quota ({allocation.unit_label})'
+
+    def match(self, records):
+        """pair allocations with records of the same lab, path and server"""
+        logger = logging.getLogger('coldfront.import_quotas')
+        records_by_lab_path = defaultdict(list)
+        for record in records:
+            if record.path:
+                records_by_lab_path[(record.group, record.path.lower())].append(record)
+        allocations = Allocation.objects.filter(
+            project__title__in={record.group for record in records},
+            status__name__in=['Active','Pending Deactivation'],
+            resources__resource_type__name='Storage'
+        ).exclude(
+            resources__name__icontains='vast'
+        ).distinct().select_related('project').with_parent_resource().with_attribute_snapshot()
+        pairs = []
+        unmatched = []
+        for allocation in allocations:
+            path = allocation.path.replace('HDD/', '').replace('SSD-HGST/', '').replace('SSD/', '').lower()
+            resource_name = min(allocation.ordered_resources, key=lambda r: r.name).name
+            matches = [
+                record for record in records_by_lab_path[(allocation.project.title, path)]
+                if record.server in resource_name
+            ]
+            if len(matches) == 1:
+                logger.debug('Path-based match: %s, %s, %s', allocation, allocation.path, matches[0])
+                pairs.append((allocation, matches[0]))
+            else:
+                if matches:
+                    logger.warning('too many matches for allocation %s %s: %s',
+                        allocation.pk, allocation, matches)
+                unmatched.append(allocation)
+        return pairs, unmatched
+
+
+def att_size(value):
+    """Return an ATT size as an int or float, or None if it is empty. Raises
+    ValueError for values that aren't finite, non-negative numbers.
+    """
+    if value in (None, ''):
+        return None
+    if isinstance(value, str):
+        try:
+            number = int(value)
+        except ValueError:
+            number = float(value)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        number = value
     else:
-        logger.warning('too many matches for allocation %s %s: %s',
-            allocation.pk, allocation, data_dicts)
-    return paired_allocs
+        raise ValueError(f'not a number: {value!r}')
+    if not math.isfinite(number) or number < 0:
+        raise ValueError(f'not a valid size: {value!r}')
+    return number
 
 
-def pair_allocations_data(project, quota_dicts):
-    """pair allocations with usage dicts"""
+def att_row_to_record(row):
+    """Normalize a row of ATT quota data into a QuotaRecord. Raises KeyError
+    or ValueError for rows missing a field or with an invalid size.
+    """
+    return QuotaRecord(
+        path=row['fs_path'],
+        group=row['lab'],
+        limit_bytes=att_size(row['byte_allocation']),
+        used_bytes=att_size(row['byte_usage']),
+        limit_tb=att_size(row['tb_allocation']),
+        used_tb=att_size(row['tb_usage']),
+        server=row['server'],
+    )
+
+
+def att_rows_to_records(rows):
+    """Return the QuotaRecords of the valid ATT rows, logging and skipping the others."""
     logger = logging.getLogger('coldfront.import_quotas')
-    allocs = project.allocation_set.filter(
-        status__name__in=['Active','Pending Deactivation'],
-        resources__resource_type__name='Storage'
-    ).exclude(resources__name__icontains='vast')
-    paired_allocs = {}
-    # first, pair allocations with those that have same
-    for allocation in allocs:
-        dicts = [
-            d for d in quota_dicts
-            if d['fs_path'] and d['fs_path'].lower() == allocation.path.replace('HDD/', '').replace('SSD-HGST/', '').replace('SSD/', '').lower()
-            and d['server'] in allocation.resources.first().name
-        ]
-        if dicts:
-            log_message = f'Path-based match: {allocation}, {allocation.path}, {dicts[0]}'
-            paired_allocs = matched_dict_processing(allocation, dicts, paired_allocs, log_message)
-    unpaired_allocs = [(a.pk, a, a.path) for a in allocs if a not in paired_allocs]
-    unpaired_dicts = [d for d in quota_dicts if d not in paired_allocs.values()]
-    if unpaired_dicts or unpaired_allocs:
-        print(
-            f"unpaired allocation data. Allocation: {unpaired_allocs} | Dict: {unpaired_dicts}"
-        )
+    records = []
+    for row in rows:
+        try:
+            records.append(att_row_to_record(row))
+        except (KeyError, ValueError) as e:
+            logger.error('skipping invalid ATT quota row %s: %r', row, e)
+    return records
+
+
+def push_att_rows(rows_by_lab, source=None):
+    """update group quota & usage values in Coldfront from ATT rows grouped by lab."""
+    logger = logging.getLogger('coldfront.import_quotas')
+    lab_count = len(rows_by_lab)
+    # produce lists of present labs & labs w/o projects
+    rows_by_lab_cleaned, _ = match_entries_with_projects(rows_by_lab)
+    rows = [row for rows in rows_by_lab_cleaned.values() for row in rows]
+    records = att_rows_to_records(rows)
+    report = write_quota_records(
+        source or ATTQuotaSource(), records, change_reason='import_quotas'
+    )
+    report['proj_err'] = lab_count - len(rows_by_lab_cleaned)
+    report['invalid rows'] = len(rows) - len(records)
+    if report['no entry'] or report['unmatched records']:
         logger.warning(
-            "unpaired allocation data. Allocation: %s | Dict: %s", unpaired_allocs, unpaired_dicts
+            "unpaired allocation data. Allocation: %s | records: %s",
+            report['no entry'], report['unmatched records']
         )
-    return paired_allocs
+    logger.warning('error counts: %s', {
+        k: report[k] if isinstance(report[k], int) else len(report[k])
+        for k in ('proj_err', 'invalid rows', 'complete', 'empty quota', 'errors')
+    })
+    if report['errors']:
+        logger.warning('errored_allocations:\n%s', report['errors'])
+    return report
 
 
 def push_quota_data(result_file):
     """update group quota & usage values in Coldfront from a JSON of quota data.
     """
-    logger = logging.getLogger('coldfront.import_quotas')
-    errored_allocations = {}
-    missing_allocations = []
-    result_json = read_json(result_file)
-    counts = {'proj_err': 0, 'res_err':0, 'all_err':0, 'complete':0}
-    # produce lists of present labs & labs w/o projects
-    result_json_cleaned, proj_models = match_entries_with_projects(result_json)
-    counts['proj_err'] = len(result_json) - len(result_json_cleaned)
-
-    # collect commonly used database objects here
-    proj_models = proj_models.prefetch_related('allocation_set')
-    allocation_attribute_types = AllocationAttributeType.objects.all()
-
-    for lab, quota_dicts in result_json_cleaned.items():
-        logger.info('PROJECT: %s ====================================', lab)
-        # Find the correct allocation_allocationattributes to update by:
-        # 1. finding the project with a name that matches lab.lab
-        project = proj_models.get(title=lab)
-        # 2. pair project allocations with data
-        allocation_data_dict = pair_allocations_data(project, quota_dicts)
-        for allocation, data_dict in allocation_data_dict.items():
-            try:
-                # 3. get the storage quota TB allocation_attribute that has allocation=a.
-                allocation_values = {
-                    f'Storage Quota ({allocation.unit_label})': [
-                        data_dict['tb_allocation'],data_dict['tb_usage']
-                    ]
-                }
-                if data_dict['byte_allocation'] is not None:
-                    allocation_values['Quota_In_Bytes'] = [
-                        data_dict['byte_allocation'], data_dict['byte_usage']
-                    ]
-                else:
-                    logger.warning(
-                        'no byte_allocation value for allocation %s, lab %s on resource %s',
-                        allocation.pk, lab, data_dict['server']
-                    )
-                for k, v in allocation_values.items():
-                    allocation_attr_type_obj = allocation_attribute_types.get(name=k)
-                    alloc_attr_obj, _ = allocation.allocationattribute_set.update_or_create(
-                        allocation_attribute_type=allocation_attr_type_obj,
-                        defaults={'value': v[0]}
-                    )
-                    alloc_attr_obj.allocationattributeusage.value = v[1]
-                    alloc_attr_obj.allocationattributeusage.save()
-
-                counts['complete'] += 1
-            except Exception as exc:
-                allocation_name = f"{data_dict['lab']}/{data_dict['server']}"
-                errored_allocations[allocation_name] = exc
-    log_missing('allocation', missing_allocations)
-    logger.warning('error counts: %s', counts)
-    if errored_allocations:
-        logger.warning('errored_allocations:\n%s', errored_allocations)
+    return push_att_rows(read_json(result_file))
 
 
 def match_entries_with_projects(result_json):
@@ -333,14 +377,19 @@ def match_entries_with_projects(result_json):
 
 def pull_push_quota_data(volumes=None):
     logger = logging.getLogger('coldfront.import_quotas')
-    att_data = QuotaDataPuller(volumes=volumes).pull('ATTQuery')
-    resp_json_by_lab = {entry['lab']:[] for entry in att_data}
-    for entry in att_data:
+    source = ATTQuotaSource(volumes=volumes)
+    result, = poll_quota_sources([source])
+    if not result.ok:
+        logger.error('could not pull quota data: %s', result.error)
+        return None
+    resp_json_by_lab = defaultdict(list)
+    for entry in source.rows:
         resp_json_by_lab[entry['lab']].append(entry)
+    resp_json_by_lab = dict(resp_json_by_lab)
     logger.debug(resp_json_by_lab)
     result_file = 'local_data/att_quota_data.json'
     save_json(result_file, resp_json_by_lab)
-    push_quota_data(result_file)
+    return push_att_rows(resp_json_by_lab, source=source)
 
 
 def generate_headers(token):
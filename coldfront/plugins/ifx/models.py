@@ -16,6 +16,7 @@ from rest_framework.exceptions import ValidationError
 from fiine.client import API as FiineAPI
 from fiine.client import ApiException
 from coldfront.core.allocation.models import AllocationUser, Allocation, AllocationAttribute
+from coldfront.core.allocation.signals import allocation_attributes_bulk_saved
 from coldfront.core.resource.models import Resource
 from coldfront.core.project.models import Project
 from ifxbilling.models import ProductUsage, Product, Facility
@@ -285,18 +286,36 @@ def allocation_post_save(sender, instance, **kwargs):
         except Exception as e:
             logger.error(f'Error creating product for allocation {instance}: {e}')
 
+# AllocationAttributes that go into the Product name or decide whether there is one
+PRODUCT_ATTRIBUTE_NAMES = ['Storage Quota (TB)', 'Storage Quota (TiB)', 'RequiresPayment', 'Subdirectory']
+
 @receiver(post_save, sender=AllocationAttribute)
 def allocation_attribute_post_save(sender, instance, **kwargs):
     '''
     When certain AllocationAttributes are changed, update the Product
     '''
     if not kwargs.get('raw'):
-        if instance.allocation_attribute_type.name in ['Storage Quota (TB)', 'Storage Quota (TiB)', 'RequiresPayment', 'Subdirectory']:
+        if instance.allocation_attribute_type.name in PRODUCT_ATTRIBUTE_NAMES:
             try:
                 update_allocation_product(instance.allocation)
             except Exception as e:
                 logger.error(f'Error updating product for allocation {instance.allocation} after change to attribute {instance}: {e}')
 
+@receiver(allocation_attributes_bulk_saved)
+def allocation_attributes_bulk_saved_handler(sender, attributes, **kwargs):
+    '''
+    Update the Product once for each Allocation whose product attributes were written in bulk
+    '''
+    allocations = {}
+    for attribute in attributes:
+        if attribute.allocation_attribute_type.name in PRODUCT_ATTRIBUTE_NAMES:
+            allocations.setdefault(attribute.allocation_id, attribute.allocation)
+    for allocation in allocations.values():
+        try:
+            update_allocation_product(allocation)
+        except Exception as e:
+            logger.error(f'Error updating product for allocation {allocation} after bulk attribute update: {e}')
+
 
 @receiver(post_save, sender=Resource)
 def resource_post_save(sender, instance, **kwargs):
@@ -1,14 +1,19 @@
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 import isilon_sdk.v9_12_0 as isilon_api
 from isilon_sdk.v9_12_0.rest import ApiException
 
 from coldfront.core.utils.common import import_from_settings
 from coldfront.core.allocation.models import AllocationAttributeType, AllocationAttribute
+from coldfront.core.allocation.quota_sources import QuotaRecord, QuotaSource, normalize_path
 from coldfront.config.plugins.isilon import ISILON_AUTH_MODEL
 
 logger = logging.getLogger(__name__)
 
+# directories whose child quotas hold the lab allocations
+ISILON_QUOTA_ROOTS = ('/ifs/rc_labs/', '/ifs/rc_fasse_labs/')
+
 if ISILON_AUTH_MODEL == 'ldap':
     try:
         from coldfront.plugins.ldap.utils import LDAPConn
@@ -517,3 +522,39 @@ def update_coldfront_quota_and_usage(alloc, usage_attribute_type, value_list):
     usage.value = value_list[1]
     usage.save()
     return usage_attribute
+
+
+class IsilonQuotaSource(QuotaSource):
+    """Quotas of the lab directories on an isilon cluster.
+
+    connection may be given to use an existing (or fake) IsilonConnection;
+    otherwise one is opened to the resource's url when quotas are listed.
+    """
+
+    def __init__(self, resource, connection=None, timeout=None):
+        super().__init__(resource, timeout=timeout)
+        self.connection = connection
+
+    def list_quotas(self):
+        if self.connection is None:
+            self.connection = IsilonConnection(get_isilon_url(self.resource))
+        # the quota roots are listed concurrently
+        with ThreadPoolExecutor(max_workers=len(ISILON_QUOTA_ROOTS)) as executor:
+            responses = list(executor.map(
+                lambda root: self.connection.quota_client.list_quota_quotas(
+                    path=root, recurse_path_children=True,
+                ),
+                ISILON_QUOTA_ROOTS,
+            ))
+        return [
+            QuotaRecord(
+                path=entry.path,
+                group=None,
+                limit_bytes=entry.thresholds.hard,
+                used_bytes=entry.usage.fslogical,
+            )
+            for response in responses for entry in response.quotas
+        ]
+
+    def allocation_key(self, allocation):
+        return normalize_path(f'/ifs/{allocation.path}')
@@ -1,8 +1,8 @@
 import datetime
 import logging
 import os
-import re
 import sys
+from sys import intern
 
 from coldfront.core.allocation.models import (
         Allocation,
@@ -37,7 +37,25 @@ class SlurmParserError(SlurmError):
     pass
 
 
+def _parse_sacctmgr_record(line, prefix):
+    """Split a sacctmgr dump line such as "User - 'jane':DefaultAccount='physics'"
+    into its name and interned spec strings. Returns None if the line is not
+    a "<prefix>'name'" record.
+    """
+    if not line.startswith(prefix):
+        return None
+    parts = line.split(':')
+    quoted_name = parts[0][len(prefix):].rstrip('\n')
+    if len(quoted_name) < 3 or quoted_name[0] != "'" or "'" in quoted_name[1:-1]:
+        return None
+    name = quoted_name.strip("'")
+    return name, [intern(spec) for spec in parts[1:]]
+
+
 class SlurmBase:
+    # share_dict and usage_dict are only set once sshare/sreport data is merged in
+    __slots__ = ('name', 'specs', 'share_dict', 'usage_dict')
+
     def __init__(self, name, specs=None):
         if specs is None:
             specs = []
@@ -81,50 +99,90 @@ class SlurmBase:
 
 
 class SlurmCluster(SlurmBase):
+    __slots__ = ('accounts',)
+
     def __init__(self, name, specs=None):
         super().__init__(name, specs=specs)
         self.accounts = {}
 
     @staticmethod
-    def new_from_stream(stream):
-        """Create a new SlurmCluster by parsing the output from sacctmgr dump."""
+    def iter_stream(stream):
+        """Lazily parse the output from sacctmgr dump.
+
+        Yields the SlurmCluster first, with no accounts attached, then each
+        SlurmAccount (including 'root') as soon as its users have all been
+        read, so a caller can process a dump account by account without
+        holding the whole cluster in memory. Accounts with no users are
+        yielded at the end of the stream. An account whose Parent block
+        appears more than once is yielded again after each later block, with
+        only that block's users; new_from_stream merges them.
+        """
         cluster = None
+        pending = {}
+        # specs of the accounts already yielded, to reopen them if their
+        # Parent block repeats
+        yielded_specs = {}
         parent = None
-        name = ""
         for line in stream:
             line = line.strip()
-            if re.match("^#", line):
+            if not line or line[0] == '#':
                 continue
-            if re.match("^Cluster - '[^']+'", line):
-                parts = line.split(':')
-                name = re.sub(r"^Cluster - ", '', parts[0]).strip("\n'")
-                if len(name) == 0:
-                    raise SlurmParserError(f'Cluster name not found for line: {line}')
-                cluster = SlurmCluster(name)
-                cluster.specs += parts[1:]
-            elif re.match("^Account - '[^']+'", line):
-                account = SlurmAccount.new_from_sacctmgr(line)
-                cluster.accounts[account.name] = account
-            elif re.match("^Parent - '[^']+'", line):
-                parent = re.sub(r"^Parent - ", '', line).strip("\n'")
-                if parent == 'root':
-                    cluster.accounts['root'] = SlurmAccount('root')
-                if not parent:
-                    raise SlurmParserError(
-                        f'Parent name not found for line: {line}')
-            elif re.match("^User - '[^']+'", line):
-                user = SlurmUser.new_from_sacctmgr(line)
+            if line.startswith('User - '):
+                record = _parse_sacctmgr_record(line, 'User - ')
+                if not record:
+                    continue
                 if not parent:
                     raise SlurmParserError(
                         f'Found user record without Parent for line: {line}')
-                account = cluster.accounts[parent]
-                account.add_user(user)
-                cluster.accounts[parent] = account
+                account = pending.get(parent)
+                if account is None:
+                    raise SlurmParserError(
+                        f'Found user record for undeclared account {parent} for line: {line}')
+                account.add_user(SlurmUser(*record))
+            elif line.startswith('Parent - '):
+                record = _parse_sacctmgr_record(line, 'Parent - ')
+                if not record:
+                    continue
+                if parent in pending:
+                    account = pending.pop(parent)
+                    yielded_specs[parent] = account.specs
+                    yield account
+                parent = record[0]
+                if parent == 'root':
+                    pending['root'] = SlurmAccount('root')
+                elif parent not in pending and parent in yielded_specs:
+                    pending[parent] = SlurmAccount(parent, list(yielded_specs[parent]))
+            elif line.startswith('Account - '):
+                record = _parse_sacctmgr_record(line, 'Account - ')
+                if not record:
+                    continue
+                if cluster is None:
+                    raise SlurmParserError(f'Found account record before Cluster for line: {line}')
+                pending[record[0]] = SlurmAccount(*record)
+            elif line.startswith('Cluster - '):
+                record = _parse_sacctmgr_record(line, 'Cluster - ')
+                if not record:
+                    continue
+                cluster = SlurmCluster(*record)
+                yield cluster
 
         if not cluster or not cluster.name:
             raise SlurmParserError(
                 'Failed to parse Slurm cluster name. Is this in sacctmgr dump file format?')
-        logger.debug(f"\x1b[33;20m  Cluster '{name}' accounts and users loaded \x1b[0m")
+        yield from pending.values()
+        logger.debug(f"\x1b[33;20m  Cluster '{cluster.name}' accounts and users loaded \x1b[0m")
+
+    @staticmethod
+    def new_from_stream(stream):
+        """Create a new SlurmCluster by parsing the output from sacctmgr dump."""
+        records = SlurmCluster.iter_stream(stream)
+        cluster = next(records)
+        for account in records:
+            if account.name in cluster.accounts:
+                for user in account.users.values():
+                    cluster.accounts[account.name].add_user(user)
+            else:
+                cluster.accounts[account.name] = account
         return cluster
 
     @staticmethod
@@ -141,7 +199,7 @@ class SlurmCluster(SlurmBase):
         # Process allocations
         for allocation in resource.allocation_set.filter(
             status__name__in=['Active', 'Renewal Requested']
-        ):
+        ).with_attribute_snapshot().with_resource_attributes():
             cluster.add_allocation(allocation, user_specs=user_specs)
 
         # Process child resources
@@ -152,7 +210,7 @@ class SlurmCluster(SlurmBase):
             partition_user_specs = r.get_attribute_list(SLURM_USER_SPECS_ATTRIBUTE_NAME)
             for allocation in r.allocation_set.filter(
                 status__name__in=['Active', 'Renewal Requested']
-            ):
+            ).with_attribute_snapshot().with_resource_attributes():
                 cluster.add_allocation(
                     allocation, specs=partition_specs, user_specs=partition_user_specs
                 )
@@ -275,6 +333,44 @@ class SlurmCluster(SlurmBase):
             #     new_allocation.save()
             #     self.add_allocation(new_allocation)
 
+    def _merge_rows(self, rows, user_key, attr_name, transform=None):
+        """Attach per-association report rows to the cluster's accounts and users.
+
+        rows are indexed by (account, user) in a single pass, with account-level
+        rows stored under an empty user, then looked up once per association.
+        The first row for an association wins; users are only merged for
+        accounts that have an account-level row.
+        """
+        index = {}
+        for row in rows:
+            key = (row['Account'], row[user_key])
+            if key in index:
+                logger.debug(f" Duplicate {attr_name} row for {key} ignored: {row}")
+                continue
+            index[key] = transform(row) if transform else row
+
+        merged = 0
+        for name, account in self.accounts.items():
+            account_row = index.get((name, ''))
+            if account_row is None:
+                continue
+            for user_name, user in account.users.items():
+                user_row = index.get((name, user_name))
+                if user_row is None:
+                    continue
+                if not hasattr(user, attr_name):
+                    setattr(user, attr_name, user_row)
+                    merged += 1
+                else:
+                    logger.debug(f" OVERWRITE BLOCKED: {user} {getattr(user, attr_name)} {user_row}")
+            if not hasattr(account, attr_name):
+                setattr(account, attr_name, account_row)
+                merged += 1
+            else:
+                logger.debug(f" OVERWRITE BLOCKED: {account} {getattr(account, attr_name)} {account_row}")
+        if len(index) > merged:
+            logger.debug(f" {len(index) - merged} {attr_name} rows had no matching association")
+
     def pull_sshare_data(self, file=None):
         """append sshare data to accounts and users"""
         def map_shares(share_info):
@@ -284,62 +380,19 @@ class SlurmCluster(SlurmBase):
             }
 
         if not file:
-            share_info = slurm_collect_shares(cluster=self.name)
+            self._merge_rows(
+                slurm_collect_shares(cluster=self.name), 'User', 'share_dict', map_shares
+            )
         else:
             with open(file, 'r') as share_file:
-                share_data = list(share_file)
-                share_info = slurm_fixed_width_lines_to_dict(share_data)
-        # select all share lines with no user val, pin to SlurmAccounts.
-        accounts_share = [share for share in share_info if not share['User']]
-        # pair accounts_share with SlurmAccounts
-        for acct_share in accounts_share:
-            account = next(
-                (a for a in self.accounts.values() if a.name == acct_share['Account']), None
-            )
-            if not account:
-                logger.debug(f" No account for {acct_share}")
-                continue
-            user_shares = [
-                d for d in share_info if d['Account'] == acct_share['Account'] and d['User']
-            ]
-            for user_share in user_shares:
-                user = next((u for u in account.users.values() if u.name == user_share['User']), None)
-                if not user:
-                    logger.debug(f" No user for {user_share}")
-                    continue
-                if not hasattr(user, 'share_dict'):
-                    user.share_dict = map_shares(user_share)
-                else:
-                    print("OVERWRITE BLOCKED:", user, user.share_dict, user_share)
-            if not hasattr(account, 'share_dict'):
-                account.share_dict = map_shares(acct_share)
-            else:
-                print("OVERWRITE BLOCKED:", account, account.share_dict, acct_share)
+                self._merge_rows(
+                    slurm_fixed_width_lines_to_dict(share_file), 'User', 'share_dict', map_shares
+                )
         logger.debug(f"\x1b[33;20m  Cluster '{self.name}' accounts and users share Info loaded \x1b[0m")
 
     def pull_usage(self):
         """append sreport usage data to accounts and users"""
-        usages = slurm_collect_usage(cluster=self.name)
-        acct_usages = [d for d in usages if not d['Login']]
-        for acct_usage in acct_usages:
-            account = next((a for a in self.accounts.values() if a.name == acct_usage['Account']), None)
-            if not account:
-                print(f"no account for {acct_usage}")
-                continue
-            user_usages = [d for d in usages if d['Account'] == account.name and d['Login']]
-            for user_usage in user_usages:
-                user = next((u for u in account.users.values() if u.name == user_usage['Login']), None)
-                if not user:
-                    print(f"no user for {user_usage}")
-                    continue
-                if not hasattr(user, 'usage_dict'):
-                    user.usage_dict = user_usage
-                else:
-                    print("OVERWRITE BLOCKED:", user, user.usage_dict, user_usage)
-            if not hasattr(account, 'usage_dict'):
-                account.usage_dict = acct_usage
-            else:
-                print("OVERWRITE BLOCKED:", account, account.usage_dict, acct_usage)
+        self._merge_rows(slurm_collect_usage(cluster=self.name), 'Login', 'usage_dict')
 
     def write(self, out):
         self._write(
@@ -362,6 +415,8 @@ class SlurmCluster(SlurmBase):
 
 
 class SlurmAccount(SlurmBase):
+    __slots__ = ('users',)
+
     def __init__(self, name, specs=None):
         super().__init__(name, specs=specs)
         self.users = {}
@@ -370,16 +425,12 @@ class SlurmAccount(SlurmBase):
     def new_from_sacctmgr(line):
         """Create a new SlurmAccount by parsing a line from sacctmgr dump. For
         example: Account - 'physics':Description='physics group':Organization='cas':Fairshare=100"""
-        if not re.match("^Account - '[^']+'", line):
+        record = _parse_sacctmgr_record(line, 'Account - ')
+        if not record:
             raise SlurmParserError(
                 f'Invalid format. Must start with "Account" for line: {line}')
 
-        parts = line.split(':')
-        name = re.sub(r"^Account - ", '', parts[0]).strip("\n'")
-        if len(name) == 0:
-            raise SlurmParserError(f'Cluster name not found for line: {line}')
-
-        return SlurmAccount(name, specs=parts[1:])
+        return SlurmAccount(*record)
 
     def add_allocation(self, allocation, user_specs=None):
         """Add users from a ColdFront Allocation model to SlurmAccount"""
@@ -428,19 +479,17 @@ class SlurmUser(SlurmBase):
     """Create a new SlurmUser by parsing a line from sacctmgr dump. For
     example: User - 'jdoe':DefaultAccount='doe_lab':Fairshare=100:MaxSubmitJobs=101"""
 
+    __slots__ = ()
+
     @staticmethod
     def new_from_sacctmgr(line):
         """Create a new SlurmUser by parsing a line from sacctmgr dump. For
         example: User - 'jane':DefaultAccount='physics':Fairshare=Parent:QOS='general-compute'"""
-        if not re.match("^User - '[^']+'", line):
+        record = _parse_sacctmgr_record(line, 'User - ')
+        if not record:
             raise SlurmParserError(f'Invalid format. Must start with "User" for line: {line}')
 
-        parts = line.split(':')
-        name = re.sub(r"^User - ", '', parts[0]).strip("\n'")
-        if len(name) == 0:
-            raise SlurmParserError(f'User name not found for line: {line}')
-
-        return SlurmUser(name, specs=parts[1:])
+        return SlurmUser(*record)
 
     def write(self, out):
         self._write(out, f"   User - {self.name} - Specs: {self.format_specs()} - Share: {self.format_share()}\n")
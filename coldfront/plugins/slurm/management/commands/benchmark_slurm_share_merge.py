@@ -0,0 +1,117 @@
+"""Time merging sshare output into a synthetic SlurmCluster.
+
+Builds a sacctmgr dump and matching fixed-width sshare output in memory for
+the requested number of associations, parses the dump, then times
+pull_sshare_data (streaming parse plus indexed merge) against the previous
+linear-scan merge, which is quadratic in the number of associations.
+"""
+import os
+import tempfile
+import time
+from io import StringIO
+
+from django.core.management.base import BaseCommand
+
+from coldfront.plugins.slurm.associations import SlurmCluster
+from coldfront.plugins.slurm.utils import slurm_fixed_width_lines_to_dict
+
+SSHARE_COLUMNS = (
+    ('Cluster', 10), ('Account', 30), ('User', 25), ('RawShares', 10),
+    ('NormShares', 11), ('RawUsage', 11), ('EffectvUsage', 13), ('FairShare', 10),
+)
+
+
+def synthetic_dump(accounts, users_per_account):
+    yield "Cluster - 'bench':Fairshare=1:QOS='normal'\n"
+    yield "Parent - 'root'\n"
+    yield "User - 'root':DefaultAccount='root':AdminLevel='Administrator':Fairshare=1\n"
+    for a in range(accounts):
+        yield f"Account - 'lab_{a}':Description='lab_{a}':Organization='lab_{a}':Fairshare=100\n"
+    for a in range(accounts):
+        yield f"Parent - 'lab_{a}'\n"
+        for u in range(users_per_account):
+            yield f"User - 'user_{a}_{u}':DefaultAccount='lab_{a}':Fairshare=parent\n"
+
+
+def synthetic_sshare(accounts, users_per_account):
+    def row(*values):
+        return ' '.join(
+            f'{value:>{width}}' for value, (_, width) in zip(values, SSHARE_COLUMNS)
+        ) + '\n'
+
+    yield ' '.join(f'{name:>{width}}' for name, width in SSHARE_COLUMNS) + '\n'
+    yield ' '.join('-' * width for _, width in SSHARE_COLUMNS) + '\n'
+    yield row('bench', 'root', '', '', '0.000000', '1000', '1.000000', '')
+    for a in range(accounts):
+        yield row('bench', f'lab_{a}', '', '100', '0.001000', a, '0.000100', '')
+        for u in range(users_per_account):
+            yield row('bench', f'lab_{a}', f'user_{a}_{u}', '1', '0.000010', u, '0.000001', '0.5')
+
+
+def legacy_merge(cluster, share_info):
+    """The linear-scan merge pull_sshare_data used before it was indexed"""
+    share_info = list(share_info)
+    accounts_share = [share for share in share_info if not share['User']]
+    for acct_share in accounts_share:
+        account = next(
+            (a for a in cluster.accounts.values() if a.name == acct_share['Account']), None
+        )
+        if not account:
+            continue
+        user_shares = [
+            d for d in share_info if d['Account'] == acct_share['Account'] and d['User']
+        ]
+        for user_share in user_shares:
+            user = next((u for u in account.users.values() if u.name == user_share['User']), None)
+            if user and not hasattr(user, 'share_dict'):
+                user.share_dict = user_share
+        if not hasattr(account, 'share_dict'):
+            account.share_dict = acct_share
+
+
+class Command(BaseCommand):
+    help = 'Benchmark merging sshare data into a synthetic cluster of many associations'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--associations', type=int, default=100000,
+            help='total number of user associations in the synthetic cluster')
+        parser.add_argument('--accounts', type=int, default=5000,
+            help='number of accounts the associations are spread over')
+        parser.add_argument('--legacy', action='store_true', default=False,
+            help='also time the previous quadratic merge (slow at full size)')
+
+    def handle(self, *args, **options):
+        accounts = options['accounts']
+        users_per_account = max(options['associations'] // accounts, 1)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            share_file = os.path.join(tmpdir, 'sshare.txt')
+            with open(share_file, 'w') as fh:
+                fh.writelines(synthetic_sshare(accounts, users_per_account))
+
+            start = time.perf_counter()
+            cluster = SlurmCluster.new_from_stream(
+                StringIO(''.join(synthetic_dump(accounts, users_per_account)))
+            )
+            self.stdout.write(
+                f'parsed dump: {accounts} accounts x {users_per_account} users '
+                f'in {time.perf_counter() - start:.3f}s'
+            )
+
+            start = time.perf_counter()
+            cluster.pull_sshare_data(file=share_file)
+            indexed = time.perf_counter() - start
+            self.stdout.write(f'     indexed merge: {indexed:.3f}s')
+
+            if options['legacy']:
+                cluster = SlurmCluster.new_from_stream(
+                    StringIO(''.join(synthetic_dump(accounts, users_per_account)))
+                )
+                start = time.perf_counter()
+                with open(share_file) as fh:
+                    legacy_merge(cluster, slurm_fixed_width_lines_to_dict(fh))
+                legacy = time.perf_counter() - start
+                self.stdout.write(f'      legacy merge: {legacy:.3f}s')
+                self.stdout.write(self.style.SUCCESS(
+                    f'speedup: {legacy / max(indexed, 1e-9):.1f}x'
+                ))
@@ -1,7 +1,10 @@
+import json
 import logging
 import os
 import sys
 import tempfile
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
 
 from django.core.management.base import BaseCommand
 
@@ -13,16 +16,23 @@ from coldfront.plugins.slurm.utils import (#SLURM_ACCOUNT_ATTRIBUTE_NAME,
                                            # SLURM_USER_SPECS_ATTRIBUTE_NAME,
                                            SlurmError, slurm_remove_qos,
                                            slurm_dump_cluster, slurm_remove_account,
-                                           slurm_remove_assoc)
+                                           slurm_remove_assoc, sacctmgr_batch)
 
 SLURM_IGNORE_USERS = import_from_settings('SLURM_IGNORE_USERS', [])
 SLURM_IGNORE_ACCOUNTS = import_from_settings('SLURM_IGNORE_ACCOUNTS', [])
 SLURM_IGNORE_CLUSTERS = import_from_settings('SLURM_IGNORE_CLUSTERS', [])
 SLURM_NOOP = import_from_settings('SLURM_NOOP', False)
+# maximum number of names sacctmgr is given in a single "where name=" clause
+SLURM_CHECK_BATCH_SIZE = import_from_settings('SLURM_CHECK_BATCH_SIZE', 100)
 
 logger = logging.getLogger(__name__)
 
 
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
 class Command(BaseCommand):
     help = '''Check consistency between Slurm associations and ColdFront allocations.
     Specifically, produce a file of active Coldfront cluster allocations
@@ -30,6 +40,10 @@ class Command(BaseCommand):
     '''
     sync = False
     noop = SLURM_NOOP
+    filter_user = None
+    filter_account = None
+    ignore_users = frozenset(SLURM_IGNORE_USERS)
+    ignore_accounts = frozenset(SLURM_IGNORE_ACCOUNTS)
 
 
     def add_arguments(self, parser):
@@ -47,6 +61,10 @@ class Command(BaseCommand):
         parser.add_argument("-a", "--account", help="Check specific account")
         parser.add_argument("-x", "--header",
             help="Include header in output", action="store_true")
+        parser.add_argument("-j", "--json",
+            help="Write the changeset as JSON to this path ('-' for stdout)")
+        parser.add_argument("-r", "--replay",
+            help="Apply a changeset written earlier with --json instead of checking")
 
     def write(self, data):
         try:
@@ -57,11 +75,11 @@ class Command(BaseCommand):
             sys.exit(1)
 
     def _skip_user(self, user, account):
-        if user in SLURM_IGNORE_USERS:
+        if user in self.ignore_users:
             logger.debug("Ignoring user %s", user)
             return True
 
-        if account in SLURM_IGNORE_ACCOUNTS:
+        if account in self.ignore_accounts:
             logger.debug("Ignoring account %s", account)
             return True
 
@@ -74,7 +92,7 @@ class Command(BaseCommand):
         return False
 
     def _skip_account(self, account):
-        if account in SLURM_IGNORE_ACCOUNTS:
+        if account in self.ignore_accounts:
             logger.debug("Ignoring account %s", account)
             return True
 
@@ -86,61 +104,6 @@ class Command(BaseCommand):
 
         return False
 
-    def remove_user(self, user, account, cluster):
-        if self._skip_user(user, account):
-            return
-
-        if self.sync:
-            try:
-                slurm_remove_assoc(user, cluster, account, noop=self.noop)
-            except SlurmError as e:
-                logger.error("Failed removing Slurm association user %s account %s cluster %s: %s",
-                    user, account, cluster, e)
-            else:
-                logger.error("Removed Slurm association user %s account %s cluster %s successfully",
-                    user, account, cluster)
-
-        row = [ user, account, cluster, 'Remove', ]
-
-        self.write('\t'.join(row))
-
-    def remove_account(self, account, cluster):
-        if self._skip_account(account):
-            return
-
-        if self.sync:
-            try:
-                slurm_remove_account(cluster, account, noop=self.noop)
-            except SlurmError as e:
-                logger.error("Failed removing Slurm account %s cluster %s: %s",
-                    account, cluster, e)
-            else:
-                logger.error(
-                    "Removed Slurm account %s cluster %s successfully", account, cluster)
-
-        row = [ '', account, cluster, 'Remove', ]
-
-        self.write('\t'.join(row))
-
-    def remove_qos(self, user, account, cluster, qos):
-        if self._skip_user(user, account):
-            return
-
-        if self.sync:
-            try:
-                slurm_remove_qos(user, cluster, account, qos, noop=self.noop)
-                pass
-            except SlurmError as e:
-                logger.error("Failed removing Slurm qos %s for user %s account %s cluster %s: %s",
-                    qos, user, account, cluster, e)
-            else:
-                logger.error("Removed Slurm qos %s for user %s account %s cluster %s successfully",
-                    qos, user, account, cluster)
-
-        row = [ user, account, cluster, 'Remove', qos ]
-
-        self.write('\t'.join(row))
-
     def _parse_qos(self, qos):
         if qos.startswith('QOS+='):
             qos = qos.replace('QOS+=', '').replace("'", '')
@@ -155,73 +118,147 @@ class Command(BaseCommand):
 
         return []
 
-    def _diff_qos(self, account_name, cluster_name, user_a, user_b):
-        logger.debug("diff qos: cluster=%s account=%s uid=%s a=%s b=%s",
-            cluster_name, account_name, user_a.name, user_a.spec_list(), user_b.spec_list())
-
-        specs_a = []
-        for s in user_a.spec_list():
-            if s.startswith('QOS'):
-                specs_a += self._parse_qos(s)
-
-        specs_b = []
-        for s in user_b.spec_list():
-            if s.startswith('QOS'):
-                specs_b += self._parse_qos(s)
-
-        specs_set_a = set(specs_a)
-        specs_set_b = set(specs_b)
-
-        diff = specs_set_a.difference(specs_set_b)
-        logger.debug("diff qos: cluster=%s account=%s uid=%s a=%s b=%s diff=%s",
-            cluster_name, account_name, user_a.name, specs_set_a, specs_set_b, diff)
-
-        if len(diff) > 0:
-            self.remove_qos(
-                user_a.name, account_name, cluster_name, 'QOS-='+','.join(list(diff))
-            )
-
-    def _diff(self, cluster_a, cluster_b):
-        for name, account in cluster_a.accounts.items():
+    def _qos_set(self, user):
+        qos_set = set()
+        for spec in user.spec_list():
+            if spec.startswith('QOS'):
+                qos_set.update(self._parse_qos(spec))
+        return qos_set
+
+    def _diff(self, cluster_a, cluster_b, accounts=None):
+        """Return the changeset that removes what is in cluster_a but not
+        cluster_b. accounts, if given, is an iterable of cluster_a's accounts
+        to use in place of cluster_a.accounts, such as the rest of a
+        SlurmCluster.iter_stream. They are diffed one at a time, so only
+        cluster_b and the names of cluster_a's accounts are held in memory.
+
+        An account is removed once none of its users are left, counting its
+        root user, which is never removed from an account ColdFront knows.
+
+        Returns:
+            dict: {'cluster': name, 'changes': [...]} where each change is a
+            dict with an 'action' of 'remove_qos', 'remove_assoc' or
+            'remove_account', in the order they should be applied
+        """
+        if accounts is None:
+            accounts = cluster_a.accounts.values()
+        changes = []
+        # account name -> whether any of its users are kept; an account can
+        # appear more than once in a stream, so accounts are removed last
+        kept_accounts = {}
+        for account in accounts:
+            name = account.name
             if name == 'root':
                 continue
-
-            if name in cluster_b.accounts:
-                total = 0
-                for uid, user in account.users.items():
-                    if uid == 'root':
-                        continue
-                    if uid not in cluster_b.accounts[name].users:
-                        self.remove_user(uid, name, cluster_a.name)
-                        total += 1
-                    else:
-                        self._diff_qos(
-                            name, cluster_a.name, user, cluster_b.accounts[name].users[uid])
-
-                if total == len(account.users):
-                    self.remove_account(name, cluster_a.name)
-            else:
-                for uid, user in account.users.items():
-                    self.remove_user(uid, name, cluster_a.name)
-
-                self.remove_account(name, cluster_a.name)
-
-    def check_consistency(self, slurm_cluster, coldfront_cluster):
+            account_b = cluster_b.accounts.get(name)
+            kept = False
+            for uid, user in account.users.items():
+                if account_b is not None and uid == 'root':
+                    kept = True
+                    continue
+                user_b = account_b.users.get(uid) if account_b is not None else None
+                if user_b is None:
+                    if not self._skip_user(uid, name):
+                        changes.append({'action': 'remove_assoc', 'account': name, 'user': uid})
+                    continue
+                kept = True
+                removed_qos = self._qos_set(user) - self._qos_set(user_b)
+                if removed_qos and not self._skip_user(uid, name):
+                    changes.append({
+                        'action': 'remove_qos', 'account': name, 'user': uid,
+                        'qos': 'QOS-=' + ','.join(sorted(removed_qos)),
+                    })
+            kept_accounts[name] = kept_accounts.get(name, False) or kept
+        for name, kept in kept_accounts.items():
+            if not kept and not self._skip_account(name):
+                changes.append({'action': 'remove_account', 'account': name})
+        return {'cluster': cluster_a.name, 'changes': changes}
+
+    def check_consistency(self, slurm_cluster, coldfront_cluster, slurm_accounts=None):
         # Check for accounts in Slurm NOT in ColdFront
-        self._diff(slurm_cluster, coldfront_cluster)
+        return self._diff(slurm_cluster, coldfront_cluster, accounts=slurm_accounts)
+
+    def write_changeset(self, changeset):
+        cluster = changeset['cluster']
+        for change in changeset['changes']:
+            row = [change.get('user', ''), change['account'], cluster, 'Remove']
+            if change['action'] == 'remove_qos':
+                row.append(change['qos'])
+            self.write('\t'.join(row))
+
+    def replay_changeset(self, changeset):
+        """Apply a changeset with as few sacctmgr processes as possible.
+
+        QOS removals are grouped by account and QOS, association removals by
+        account, and account removals per cluster, each into where-clauses of
+        up to SLURM_CHECK_BATCH_SIZE names. The resulting commands are then run
+        together as sacctmgr scripts through a sacctmgr_batch.
+
+        Returns:
+            list[tuple[str, SacctmgrOperation]]: a description of each
+            sacctmgr command and the operation that ran it
+        """
+        cluster = changeset['cluster']
+        qos_removals = defaultdict(list)
+        assoc_removals = defaultdict(list)
+        account_removals = []
+        for change in changeset['changes']:
+            if change['action'] == 'remove_qos':
+                qos_removals[(change['account'], change['qos'])].append(change['user'])
+            elif change['action'] == 'remove_assoc':
+                assoc_removals[change['account']].append(change['user'])
+            elif change['action'] == 'remove_account':
+                account_removals.append(change['account'])
+            else:
+                logger.error("Unknown changeset action %s", change['action'])
+
+        ops = []
+        with sacctmgr_batch(noop=self.noop):
+            for (account, qos), users in qos_removals.items():
+                for batch in _chunks(users, SLURM_CHECK_BATCH_SIZE):
+                    ops.append((
+                        f"qos {qos} for users {batch} account {account}",
+                        slurm_remove_qos(','.join(batch), cluster, account, qos, noop=self.noop),
+                    ))
+            for account, users in assoc_removals.items():
+                for batch in _chunks(users, SLURM_CHECK_BATCH_SIZE):
+                    ops.append((
+                        f"associations users {batch} account {account}",
+                        slurm_remove_assoc(','.join(batch), account, noop=self.noop),
+                    ))
+            for batch in _chunks(account_removals, SLURM_CHECK_BATCH_SIZE):
+                ops.append((
+                    f"accounts {batch}",
+                    slurm_remove_account(cluster, ','.join(batch), noop=self.noop),
+                ))
+
+        for description, op in ops:
+            if op.error:
+                logger.error("Failed removing Slurm %s cluster %s: %s", description, cluster, op.error)
+            else:
+                logger.info("Removed Slurm %s cluster %s successfully", description, cluster)
+        return ops
 
-    def _cluster_from_dump(self, cluster):
-        slurm_cluster = None
+    @contextmanager
+    def _dump_stream(self, cluster):
+        """Yield an open sacctmgr dump of the cluster, or None if the dump failed."""
         with tempfile.TemporaryDirectory() as tmpdir:
             fname = os.path.join(tmpdir, 'cluster.cfg')
             try:
                 slurm_dump_cluster(cluster, fname)
-                with open(fname) as fh:
-                    slurm_cluster = SlurmCluster.new_from_stream(fh)
             except SlurmError as e:
                 logger.error("Failed to dump Slurm cluster %s: %s", cluster, e)
+                yield None
+                return
+            with open(fname) as fh:
+                yield fh
 
-        return slurm_cluster
+    def _input_stream(self, options):
+        if options['cluster']:
+            return self._dump_stream(options['cluster'])
+        if options['input']:
+            return open(options['input'])
+        return nullcontext(sys.stdin)
 
     def handle(self, *args, **options):
         if options['sync']:
@@ -232,14 +269,30 @@ class Command(BaseCommand):
             self.noop = True
             logger.warning("NOOP enabled")
 
-        if options['cluster']:
-            slurm_cluster = self._cluster_from_dump(options['cluster'])
-        elif options['input']:
-            with open(options['input']) as fh:
-                slurm_cluster = SlurmCluster.new_from_stream(fh)
-        else:
-            slurm_cluster = SlurmCluster.new_from_stream(sys.stdin)
+        if options['replay']:
+            with open(options['replay']) as fh:
+                self.replay_changeset(json.load(fh))
+            return
+
+        with self._input_stream(options) as stream:
+            # the Slurm side is read account by account so only the ColdFront
+            # cluster is ever held in memory in full
+            slurm_records = SlurmCluster.iter_stream(stream) if stream is not None else iter(())
+            slurm_cluster = next(slurm_records, None)
+            changeset = self._check_stream(slurm_cluster, slurm_records, options)
+
+        if options['json'] != '-':
+            self.write_changeset(changeset)
+        if options['json']:
+            if options['json'] == '-':
+                self.write(json.dumps(changeset, indent=2))
+            else:
+                with open(options['json'], 'w') as fh:
+                    json.dump(changeset, fh, indent=2)
+        if self.sync:
+            self.replay_changeset(changeset)
 
+    def _check_stream(self, slurm_cluster, slurm_accounts, options):
         if not slurm_cluster:
             logger.error("Failed to import existing Slurm associations")
             sys.exit(1)
@@ -274,4 +327,4 @@ class Command(BaseCommand):
 
         coldfront_cluster = SlurmCluster.new_from_resource(resource)
 
-        self.check_consistency(slurm_cluster, coldfront_cluster)
+        return self.check_consistency(slurm_cluster, coldfront_cluster, slurm_accounts=slurm_accounts)
@@ -2,17 +2,27 @@ import sys
 import logging
 import os
 import tempfile
+from collections import Counter, defaultdict
 
 from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Prefetch, Q
 from django.utils import timezone
 from django.contrib.auth import get_user_model
+from simple_history.utils import bulk_create_with_history, bulk_update_with_history
 
 from coldfront.core.project.models import Project
 from coldfront.core.allocation.models import (
-    AllocationStatusChoice,
+    Allocation,
+    AllocationAttribute,
     AllocationAttributeType,
+    AllocationAttributeUsage,
+    AllocationStatusChoice,
+    AllocationUser,
+    AllocationUserAttribute,
     AllocationUserAttributeType,
     AllocationUserStatusChoice,
+    schedule_summary_refresh,
 )
 from coldfront.core.resource.models import Resource
 from coldfront.plugins.slurm.utils import SlurmError, slurm_dump_cluster
@@ -21,6 +31,42 @@ from coldfront.plugins.slurm.associations import SlurmCluster
 
 logger = logging.getLogger(__name__)
 
+SHARE_ATTRIBUTE_NAMES = ['RawShares', 'NormShares', 'FairShare', 'EffectvUsage', 'RawUsage']
+CHANGE_REASON = 'slurm_sync command'
+
+
+class ClusterChanges:
+    """Pending writes for one cluster, collected before anything is saved.
+
+    Attributes:
+        new_allocations (list[Allocation]): unsaved allocations for accounts with none on the cluster
+        allocation_updates (list[Allocation]): allocations whose status changed
+        attribute_creates (list[AllocationAttribute]): unsaved allocation attributes
+        attribute_updates (list[AllocationAttribute]): allocation attributes whose value changed
+        allocationuser_creates (list[AllocationUser]): unsaved allocation users
+        allocationuser_updates (list[AllocationUser]): allocation users whose status changed
+        userattribute_creates (list[AllocationUserAttribute]): unsaved allocation user attributes
+        userattribute_updates (list[AllocationUserAttribute]): allocation user attributes whose value changed
+        summary (Counter): number of changes of each kind
+    """
+
+    def __init__(self):
+        self.new_allocations = []
+        self.allocation_updates = []
+        self.attribute_creates = []
+        self.attribute_updates = []
+        self.allocationuser_creates = []
+        self.allocationuser_updates = []
+        self.userattribute_creates = []
+        self.userattribute_updates = []
+        self.summary = Counter()
+
+    def __bool__(self):
+        return any(self.summary.values())
+
+    def format_summary(self):
+        return ', '.join(f'{key}: {count}' for key, count in sorted(self.summary.items()) if count)
+
 
 class Command(BaseCommand):
     help = 'Import all Slurm allocations into Coldfront.'
@@ -28,6 +74,8 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('-f', '--file',
             help='designate a file with sacctmgr dump data to use as a datasource')
+        parser.add_argument('--dry-run', action='store_true', default=False,
+            help='report the changes that would be made without saving them')
 
     def _cluster_from_dump(self, cluster, file=None):
         slurm_cluster = None
@@ -51,155 +99,311 @@ class Command(BaseCommand):
         slurm_cluster.pull_sshare_data()
         return slurm_cluster
 
-    def create_account_allocations_and_attributes(self, cluster, resource):
-        def create_cluster_allocation_attributes(
-            allocation, account, cloud_acct_name_attrtype, hours_attrtype, slurm_specs_attrtype, slurm_acct_name_attrtype
-        ):
-            # XDMOD related allocation attributes
-            allocation.allocationattribute_set.get_or_create(
-                # 'slurm_account_name'? XDMOD_ACCOUNT_ATTRIBUTE_NAME
-                allocation_attribute_type=slurm_acct_name_attrtype,
-                defaults={'value': name}
-            )
-            allocation.allocationattribute_set.get_or_create(
-                # 'Cloud Account Name'? XDMOD_CLOUD_PROJECT_ATTRIBUTE_NAME
-                allocation_attribute_type=cloud_acct_name_attrtype,
-                defaults={'value': name}
-            )
-            allocation.allocationattribute_set.get_or_create(
-                allocation_attribute_type=hours_attrtype,
-                defaults={'value': 0}
-            )
-            # Sshare related allocation attributes
-            for key, value in account.share_dict.items():
-                if key in ['RawShares', 'NormShares', 'FairShare', 'EffectvUsage', 'RawUsage']:
-                    allocation.allocationattribute_set.update_or_create(
-                        allocation_attribute_type=AllocationAttributeType.objects.get(name=key),
-                        defaults={'value': value}
-                    )
-            share_data = ','.join(f"{key}={value}" for key, value in account.share_dict.items())
-            allocation.allocationattribute_set.update_or_create(
-                allocation_attribute_type=slurm_specs_attrtype,
-                defaults={"value": share_data}
+    def _load_cluster_allocations(self, resource, project_ids):
+        """Return the resource's allocations that are active or belong to one
+        of the given projects, keyed by project id, with their attributes,
+        allocation users and allocation user attributes loaded in bulk.
+        """
+        allocations = (
+            Allocation.objects.filter(resources=resource)
+            .filter(Q(project_id__in=project_ids) | Q(status__name='Active'))
+            .select_related('project')
+            .prefetch_related(
+                Prefetch(
+                    'allocationattribute_set',
+                    queryset=AllocationAttribute.objects.order_by('pk'),
+                ),
+                Prefetch(
+                    'allocationuser_set',
+                    queryset=AllocationUser.objects.select_related('user').prefetch_related(
+                        Prefetch(
+                            'allocationuserattribute_set',
+                            queryset=AllocationUserAttribute.objects.order_by('pk'),
+                        )
+                    ),
+                ),
             )
+        )
+        allocations_by_project = defaultdict(list)
+        for allocation in allocations:
+            allocations_by_project[allocation.project_id].append(allocation)
+        return allocations_by_project
 
-        def update_allocation_users(account, project_allocation, user_status_active, slurm_specs_allocationuser_attrtype):
-            for allocationuser in project_allocation.allocationuser_set.filter(status__name='Active'):
-                if allocationuser.user.username not in account.users.keys():
-                    allocationuser.status = AllocationUserStatusChoice.objects.get(name='Removed')
-                    allocationuser.save()
-            for user_name, user_account in account.users.items():
-                try:
-                    user = get_user_model().objects.get(username=user_name)
-                except Exception:
-                    logger.debug(f'no user found: {user_name}')
-                    continue
-                alloc_user, _ = project_allocation.allocationuser_set.get_or_create(
-                    user=user,
-                    defaults={
-                        'status': user_status_active, 'unit': 'CPU Hours'
-                    }
-                )
-                for key, value in user_account.share_dict.items():
-                    if key in ['RawShares', 'NormShares', 'FairShare', 'EffectvUsage', 'RawUsage']:
-                        alloc_user.allocationuserattribute_set.update_or_create(
-                            allocationuser_attribute_type=AllocationUserAttributeType.objects.get(name=key),
-                            defaults={'value': value}
-                        )
-                share_data = ','.join(f"{key}={value}" for key, value in user_account.share_dict.items())
-                alloc_user.allocationuserattribute_set.update_or_create(
-                    allocationuser_attribute_type=slurm_specs_allocationuser_attrtype,
-                    defaults={'value': share_data}
-                )
+    def diff_cluster(self, cluster, resource):
+        """Compare a parsed SlurmCluster with the allocations stored for its
+        resource and collect the writes needed to bring them in line.
 
+        Returns:
+            tuple[ClusterChanges, list[str]]: the pending changes and the names
+            of accounts with no corresponding project
+        """
+        changes = ClusterChanges()
         undetected_projects = []
-        user_status_active = AllocationUserStatusChoice.objects.get(name='Active')
-        slurm_acct_name_attr_type = AllocationAttributeType.objects.get(
-            name='slurm_account_name')
-        cloud_acct_name_attr_type = AllocationAttributeType.objects.get(
-            name='Cloud Account Name')
-        hours_attr_type = AllocationAttributeType.objects.get(
-            name='Core Usage (Hours)')
-        slurm_specs_allocation_attribute_type = AllocationAttributeType.objects.get(name='slurm_specs')
-        slurm_specs_allocationuser_attribute_type = AllocationUserAttributeType.objects.get(name='slurm_specs')
         allocation_active_status = AllocationStatusChoice.objects.get(name='Active')
         allocation_inactive_status = AllocationStatusChoice.objects.get(name='Inactive')
-        # deactivate allocations for accounts not found
-        account_names = set(cluster.accounts.keys())
-        cluster_project_names = set(
-            Project.objects.filter(
-                allocation__resources=resource,
-                allocation__status=allocation_active_status
-            ).values_list('title', flat=True)
-        )
-        projects_with_no_account_titles = cluster_project_names - account_names
-        projects_with_no_account = Project.objects.filter(
-            title__in=projects_with_no_account_titles
-        ).prefetch_related('allocation_set')
-        for project in projects_with_no_account:
-            allocation_to_deactivate = project.allocation_set.get(
-                resources=resource, status=allocation_active_status
+        user_status_active = AllocationUserStatusChoice.objects.get(name='Active')
+        user_status_removed = AllocationUserStatusChoice.objects.get(name='Removed')
+        attribute_types = {
+            attr_type.name: attr_type for attr_type in AllocationAttributeType.objects.filter(
+                name__in=SHARE_ATTRIBUTE_NAMES + [
+                    'slurm_account_name', 'Cloud Account Name', 'Core Usage (Hours)', 'slurm_specs'
+                ]
+            )
+        }
+        user_attribute_types = {
+            attr_type.name: attr_type for attr_type in AllocationUserAttributeType.objects.filter(
+                name__in=SHARE_ATTRIBUTE_NAMES + ['slurm_specs']
             )
-            logger.info(f"Deactivating {resource.name} allocation for project {project.title}")
-            allocation_to_deactivate.status = allocation_inactive_status
-            allocation_to_deactivate.save()
+        }
+        attribute_type_names = {attr_type.pk: name for name, attr_type in attribute_types.items()}
+        user_attribute_type_names = {
+            attr_type.pk: name for name, attr_type in user_attribute_types.items()
+        }
+        projects = {
+            project.title: project
+            for project in Project.objects.filter(title__in=list(cluster.accounts.keys()))
+        }
+        usernames = {
+            user_name for account in cluster.accounts.values() for user_name in account.users
+        }
+        users = {
+            user.username: user
+            for user in get_user_model().objects.filter(username__in=list(usernames))
+        }
+        allocations_by_project = self._load_cluster_allocations(
+            resource, {project.pk for project in projects.values()}
+        )
+
+        def set_attribute(allocation, existing, attr_type_name, value, overwrite=True):
+            value = str(value)
+            attribute = existing.get(attr_type_name)
+            if attribute is None:
+                changes.attribute_creates.append(AllocationAttribute(
+                    allocation=allocation,
+                    allocation_attribute_type=attribute_types[attr_type_name],
+                    value=value,
+                ))
+                changes.summary['allocation attributes created'] += 1
+            elif overwrite and attribute.value != value:
+                attribute.value = value
+                changes.attribute_updates.append(attribute)
+                changes.summary['allocation attributes updated'] += 1
+
+        def set_user_attribute(allocationuser, existing, attr_type_name, value):
+            value = str(value)
+            attribute = existing.get(attr_type_name)
+            if attribute is None:
+                changes.userattribute_creates.append(AllocationUserAttribute(
+                    allocationuser=allocationuser,
+                    allocationuser_attribute_type=user_attribute_types[attr_type_name],
+                    value=value,
+                ))
+                changes.summary['allocation user attributes created'] += 1
+            elif attribute.value != value:
+                attribute.value = value
+                changes.userattribute_updates.append(attribute)
+                changes.summary['allocation user attributes updated'] += 1
+
+        # deactivate allocations for accounts not found
+        for project_allocations in allocations_by_project.values():
+            for allocation in project_allocations:
+                if (
+                    allocation.project.title not in cluster.accounts
+                    and allocation.status_id == allocation_active_status.pk
+                ):
+                    logger.info(f"Deactivating {resource.name} allocation for project {allocation.project.title}")
+                    allocation.status = allocation_inactive_status
+                    changes.allocation_updates.append(allocation)
+                    changes.summary['allocations deactivated'] += 1
 
         # add/update allocations for existing accounts
         for name, account in cluster.accounts.items():
-            try:
-                project = Project.objects.get(title=name)
-            except Project.DoesNotExist:
+            project = projects.get(name)
+            if project is None:
                 undetected_projects.append(name)
                 continue
-            project_cluster_allocations = project.allocation_set.filter(resources=resource)
+            project_cluster_allocations = allocations_by_project.get(project.pk, [])
+            if len(project_cluster_allocations) > 1:
+                msg = f'multiple cluster allocations returned for project {project.title} resource {resource.name}: {project_cluster_allocations}'
+                logger.error(msg)
+                print(msg)
+                continue
             if not project_cluster_allocations:
-                new_project_allocation = project.allocation_set.create(
+                allocation = Allocation(
+                    project=project,
                     status=allocation_active_status,
                     start_date=timezone.now(),
                     justification='slurm_sync',
-                    quantity=1
+                    quantity=1,
                 )
-                new_project_allocation.resources.add(resource)
-                new_project_allocation.save()
-                project_allocation = new_project_allocation
-            elif len(project_cluster_allocations) == 1:
-                project_allocation = project_cluster_allocations.first()
-                if project_allocation.status.name != 'Active':
-                    project_allocation.status = allocation_active_status
-                    project_allocation.save()
-            elif len(project_cluster_allocations) > 1:
-                msg = f'multiple cluster allocations returned for project {project.title} resource {resource.name}: {project_cluster_allocations}',
-                logger.error(msg)
-                print(msg)
-                continue
-            create_cluster_allocation_attributes(project_allocation, account, cloud_acct_name_attr_type, hours_attr_type, slurm_specs_allocation_attribute_type, slurm_acct_name_attr_type)
+                changes.new_allocations.append(allocation)
+                changes.summary['allocations created'] += 1
+                existing_attributes = {}
+                existing_allocationusers = {}
+            else:
+                allocation = project_cluster_allocations[0]
+                if allocation.status_id != allocation_active_status.pk:
+                    allocation.status = allocation_active_status
+                    changes.allocation_updates.append(allocation)
+                    changes.summary['allocations activated'] += 1
+                existing_attributes = {}
+                for attribute in allocation.allocationattribute_set.all():
+                    type_name = attribute_type_names.get(attribute.allocation_attribute_type_id)
+                    if type_name:
+                        existing_attributes.setdefault(type_name, attribute)
+                existing_allocationusers = {
+                    allocationuser.user.username: allocationuser
+                    for allocationuser in allocation.allocationuser_set.all()
+                }
+
+            # XDMOD related allocation attributes
+            set_attribute(allocation, existing_attributes, 'slurm_account_name', name, overwrite=False)
+            set_attribute(allocation, existing_attributes, 'Cloud Account Name', name, overwrite=False)
+            set_attribute(allocation, existing_attributes, 'Core Usage (Hours)', 0, overwrite=False)
+            # Sshare related allocation attributes
+            share_dict = getattr(account, 'share_dict', {})
+            for key, value in share_dict.items():
+                if key in SHARE_ATTRIBUTE_NAMES:
+                    set_attribute(allocation, existing_attributes, key, value)
+            share_data = ','.join(f"{key}={value}" for key, value in share_dict.items())
+            set_attribute(allocation, existing_attributes, 'slurm_specs', share_data)
+
             # add allocationusers from account
-            update_allocation_users(account, project_allocation, user_status_active, slurm_specs_allocationuser_attribute_type)
+            for user_name, allocationuser in existing_allocationusers.items():
+                if allocationuser.status_id == user_status_active.pk and user_name not in account.users:
+                    allocationuser.status = user_status_removed
+                    changes.allocationuser_updates.append(allocationuser)
+                    changes.summary['allocation users removed'] += 1
+            for user_name, user_account in account.users.items():
+                allocationuser = existing_allocationusers.get(user_name)
+                if allocationuser is None:
+                    user = users.get(user_name)
+                    if user is None:
+                        logger.debug(f'no user found: {user_name}')
+                        continue
+                    allocationuser = AllocationUser(
+                        allocation=allocation, user=user, status=user_status_active, unit='CPU Hours'
+                    )
+                    changes.allocationuser_creates.append(allocationuser)
+                    changes.summary['allocation users created'] += 1
+                    existing_user_attributes = {}
+                else:
+                    existing_user_attributes = {}
+                    for attribute in allocationuser.allocationuserattribute_set.all():
+                        type_name = user_attribute_type_names.get(
+                            attribute.allocationuser_attribute_type_id
+                        )
+                        if type_name:
+                            existing_user_attributes.setdefault(type_name, attribute)
+                user_share_dict = getattr(user_account, 'share_dict', {})
+                for key, value in user_share_dict.items():
+                    if key in SHARE_ATTRIBUTE_NAMES:
+                        set_user_attribute(allocationuser, existing_user_attributes, key, value)
+                share_data = ','.join(f"{key}={value}" for key, value in user_share_dict.items())
+                set_user_attribute(allocationuser, existing_user_attributes, 'slurm_specs', share_data)
+
+        return changes, undetected_projects
+
+    def apply_changes(self, changes, resource):
+        """Save a ClusterChanges with bulk queries in a single transaction."""
+        with transaction.atomic():
+            # new allocations need their pks before anything can point at them
+            for allocation in changes.new_allocations:
+                allocation.save()
+                allocation.resources.add(resource)
+            if changes.allocation_updates:
+                bulk_update_with_history(
+                    changes.allocation_updates, Allocation, ['status'],
+                    batch_size=500, default_change_reason=CHANGE_REASON,
+                )
+            if changes.attribute_updates:
+                bulk_update_with_history(
+                    changes.attribute_updates, AllocationAttribute, ['value'],
+                    batch_size=500, default_change_reason=CHANGE_REASON,
+                )
+            if changes.attribute_creates:
+                created_attributes = bulk_create_with_history(
+                    changes.attribute_creates, AllocationAttribute,
+                    batch_size=500, default_change_reason=CHANGE_REASON,
+                )
+                # AllocationAttribute.save() is bypassed, so create the usages it would have
+                usages = [
+                    AllocationAttributeUsage(allocation_attribute=attribute)
+                    for attribute in created_attributes
+                    if attribute.allocation_attribute_type.has_usage
+                ]
+                if usages:
+                    bulk_create_with_history(
+                        usages, AllocationAttributeUsage,
+                        batch_size=500, default_change_reason=CHANGE_REASON,
+                    )
+            if changes.allocationuser_updates:
+                bulk_update_with_history(
+                    changes.allocationuser_updates, AllocationUser, ['status'],
+                    batch_size=500, default_change_reason=CHANGE_REASON,
+                )
+            if changes.allocationuser_creates:
+                created_allocationusers = bulk_create_with_history(
+                    changes.allocationuser_creates, AllocationUser,
+                    batch_size=500, default_change_reason=CHANGE_REASON,
+                )
+                # backends that can't return pks from bulk_create get them from the history helper
+                pks = {(au.allocation_id, au.user_id): au.pk for au in created_allocationusers}
+                for allocationuser in changes.allocationuser_creates:
+                    allocationuser.pk = pks[(allocationuser.allocation_id, allocationuser.user_id)]
+            if changes.userattribute_updates:
+                bulk_update_with_history(
+                    changes.userattribute_updates, AllocationUserAttribute, ['value'],
+                    batch_size=500, default_change_reason=CHANGE_REASON,
+                )
+            if changes.userattribute_creates:
+                bulk_create_with_history(
+                    changes.userattribute_creates, AllocationUserAttribute,
+                    batch_size=500, default_change_reason=CHANGE_REASON,
+                )
+            # the bulk writes send no signals
+            schedule_summary_refresh(
+                attribute.allocation_id
+                for attribute in changes.attribute_creates + changes.attribute_updates
+            )
+
+    def create_account_allocations_and_attributes(self, cluster, resource, dry_run=False):
+        """Reconcile the resource's allocations with the accounts and users of
+        a parsed SlurmCluster, writing only rows whose values changed.
 
-        return undetected_projects
+        Returns:
+            tuple[ClusterChanges, list[str]]: the changes made (or, for a dry
+            run, that would be made) and the names of accounts with no
+            corresponding project
+        """
+        changes, undetected_projects = self.diff_cluster(cluster, resource)
+        if changes and not dry_run:
+            self.apply_changes(changes, resource)
+        return changes, undetected_projects
 
     def handle(self, *args, **options):
         # make new SlurmCluster obj containing the dump from the cluster
         logger.debug("Loading cluster info starts", True)
         file = options['file']
+        dry_run = options['dry_run']
         cluster_resources = Resource.objects.filter(
             resource_type__name='Cluster', is_available=True, resourceattribute__value='CLI'
         )
         logger.debug(f"  File: {options['file']} - Cluster_resources {cluster_resources}")
-        slurm_clusters = {
-            cluster_resource: self._cluster_from_dump(cluster_resource, file=file)
-            for cluster_resource in cluster_resources
-        }
-        for cluster, cluster_dump in slurm_clusters.items():
-            cluster_dump.write(sys.stdout)
-        for resource, cluster in slurm_clusters.items():
+        # parse and reconcile one cluster at a time so only one dump is held in memory
+        for resource in cluster_resources:
+            cluster = self._cluster_from_dump(resource, file=file)
+            cluster.write(sys.stdout)
             # create an allocation for each account
-            undetected_projects = self.create_account_allocations_and_attributes(
-                cluster,
-                resource,
+            changes, undetected_projects = self.create_account_allocations_and_attributes(
+                cluster, resource, dry_run=dry_run,
             )
-            cluster.append_partitions()
+            summary = changes.format_summary() or 'no changes'
+            prefix = 'DRY RUN - would make' if dry_run else 'made'
+            logger.info(f'{resource}: {prefix} {summary}')
+            self.stdout.write(f'{resource}: {prefix} {summary}')
+            if not dry_run:
+                cluster.append_partitions()
             if undetected_projects:
                 logger.debug(f'{resource} Accounts without corresponding projects detected: {undetected_projects}', True)
         logger.debug("Associating Allocations and Cluster Partitions ends", True)
-
@@ -0,0 +1,15 @@
+from coldfront.plugins.slurm.utils import sacctmgr_batch
+
+
+class SacctmgrBatchMiddleware:
+    """
+    Middleware that queues the sacctmgr changes made while handling a
+    request and runs them as one sacctmgr script once the response is ready.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with sacctmgr_batch():
+            response = self.get_response(request)
+        return response
@@ -1,11 +1,16 @@
+import os
+import tempfile
 from io import StringIO
 
 from django.core.management import call_command
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase
 
 from coldfront.core.resource.models import Resource
-from coldfront.plugins.slurm.associations import SlurmCluster
-from coldfront.plugins.slurm.utils import SLURM_CLUSTER_ATTRIBUTE_NAME
+from coldfront.plugins.slurm.associations import SlurmCluster, SlurmParserError
+from coldfront.plugins.slurm.utils import (
+    SLURM_CLUSTER_ATTRIBUTE_NAME,
+    slurm_fixed_width_lines_to_dict,
+)
 
 
 class AssociationTest(TestCase):
@@ -75,3 +80,107 @@ User - 'larry':DefaultAccount='physics':Fairshare=parent
         self.assertEqual(len(cluster2.accounts['physics'].users), 3)
         for u in ['jane', 'john', 'larry']:
             self.assertIn(u, cluster2.accounts['physics'].users)
+
+
+SSHARE_OUTPUT = """\
+   Cluster                        Account                      User  RawShares  NormShares    RawUsage  EffectvUsage  FairShare
+---------- ------------------------------ ------------------------- ---------- ----------- ----------- ------------- ----------
+     alpha                           root                                      0.000000        1000      1.000000
+     alpha                        physics                                  100    0.500000         600      0.600000
+     alpha                        physics                      jane          1    0.250000         400      0.400000   0.500000
+     alpha                        physics                      john          1    0.250000         200      0.200000   0.750000
+     alpha                      chemistry                                  100    0.500000         400      0.400000
+     alpha                      chemistry                      jane          1    0.500000         400      0.400000   0.100000
+"""
+
+
+class ShareMergeTest(SimpleTestCase):
+    """Tests for streaming sshare parsing and the indexed share merge"""
+
+    def test_fixed_width_lines_to_dict_is_lazy(self):
+        rows = slurm_fixed_width_lines_to_dict(iter(StringIO(SSHARE_OUTPUT)))
+        self.assertFalse(isinstance(rows, list))
+        first = next(rows)
+        self.assertEqual(first['Account'], 'root')
+        self.assertEqual(first['User'], '')
+        self.assertEqual(len(list(rows)), 5)
+
+    def test_pull_sshare_data_from_file(self):
+        cluster = SlurmCluster.new_from_stream(StringIO("""
+Cluster - 'alpha':Fairshare=1
+Parent - 'root'
+User - 'root':DefaultAccount='root':AdminLevel='Administrator':Fairshare=1
+Account - 'physics':Fairshare=100
+Parent - 'physics'
+User - 'jane':DefaultAccount='physics':Fairshare=parent
+User - 'john':DefaultAccount='physics':Fairshare=parent
+User - 'larry':DefaultAccount='physics':Fairshare=parent
+        """))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            share_file = os.path.join(tmpdir, 'sshare.txt')
+            with open(share_file, 'w') as fh:
+                fh.write(SSHARE_OUTPUT)
+            cluster.pull_sshare_data(file=share_file)
+
+        physics = cluster.accounts['physics']
+        self.assertEqual(physics.share_dict['RawShares'], '100')
+        self.assertEqual(physics.users['jane'].share_dict['RawUsage'], '400')
+        self.assertEqual(physics.users['john'].share_dict['FairShare'], '0.750000')
+        # no sshare row for larry
+        self.assertFalse(hasattr(physics.users['larry'], 'share_dict'))
+
+
+class StreamParserTest(SimpleTestCase):
+    """Tests for the incremental sacctmgr dump parser"""
+
+    DUMP = """
+# comment lines are skipped
+Cluster - 'alpha':Fairshare=1
+Parent - 'root'
+User - 'root':DefaultAccount='root':AdminLevel='Administrator':Fairshare=1
+Account - 'physics':Fairshare=100
+Account - 'empty':Fairshare=100
+Parent - 'physics'
+User - 'jane':DefaultAccount='physics':Fairshare=parent
+User - 'john':DefaultAccount='physics':Fairshare=parent
+"""
+
+    def test_iter_stream_yields_cluster_then_accounts(self):
+        records = SlurmCluster.iter_stream(StringIO(self.DUMP))
+        cluster = next(records)
+        self.assertEqual(cluster.name, 'alpha')
+        self.assertEqual(cluster.specs, ['Fairshare=1'])
+        self.assertEqual(cluster.accounts, {})
+        # root is complete once the physics block starts, physics at the end
+        # of the stream, and the user-less account last of all
+        self.assertEqual([a.name for a in records], ['root', 'physics', 'empty'])
+
+    def test_specs_are_interned(self):
+        cluster = SlurmCluster.new_from_stream(StringIO(self.DUMP))
+        jane = cluster.accounts['physics'].users['jane']
+        john = cluster.accounts['physics'].users['john']
+        self.assertIs(jane.specs[1], john.specs[1])
+        self.assertFalse(hasattr(jane, '__dict__'))
+
+    def test_user_without_parent(self):
+        with self.assertRaises(SlurmParserError):
+            SlurmCluster.new_from_stream(StringIO(
+                "Cluster - 'alpha'\nUser - 'jane':DefaultAccount='physics'\n"
+            ))
+
+    def test_repeated_parent_block(self):
+        """users of a Parent block that repeats are added to the same account"""
+        dump = self.DUMP + (
+            "Parent - 'root'\n"
+            "Parent - 'physics'\n"
+            "User - 'larry':DefaultAccount='physics':Fairshare=parent\n"
+        )
+        records = SlurmCluster.iter_stream(StringIO(dump))
+        next(records)
+        physics = [a for a in records if a.name == 'physics']
+        self.assertEqual([list(a.users) for a in physics], [['jane', 'john'], ['larry']])
+        self.assertEqual(physics[1].specs, ['Fairshare=100'])
+
+        cluster = SlurmCluster.new_from_stream(StringIO(dump))
+        self.assertEqual(list(cluster.accounts['physics'].users), ['jane', 'john', 'larry'])
+        self.assertIn('root', cluster.accounts['root'].users)
@@ -0,0 +1,84 @@
+from io import StringIO
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from coldfront.plugins.slurm.associations import SlurmAccount, SlurmCluster, SlurmUser
+from coldfront.plugins.slurm.management.commands import slurm_check
+from coldfront.plugins.slurm.management.commands.slurm_check import Command
+
+SLURM_DUMP = """
+Cluster - 'alpha':Fairshare=1
+Parent - 'root'
+User - 'root':DefaultAccount='root':AdminLevel='Administrator':Fairshare=1
+Account - 'physics':Fairshare=100
+Account - 'defunct':Fairshare=100
+Parent - 'physics'
+User - 'jane':DefaultAccount='physics':QOS='+normal,+high'
+User - 'john':DefaultAccount='physics':QOS='+normal,+high'
+User - 'larry':DefaultAccount='physics'
+Parent - 'defunct'
+User - 'jane':DefaultAccount='defunct'
+"""
+
+
+class SlurmCheckDiffTest(SimpleTestCase):
+    """Tests for the slurm_check changeset"""
+
+    def setUp(self):
+        self.coldfront_cluster = SlurmCluster('alpha')
+        physics = SlurmAccount('physics')
+        physics.add_user(SlurmUser('jane', ["QOS='+normal'"]))
+        physics.add_user(SlurmUser('john', ["QOS='+normal'"]))
+        self.coldfront_cluster.accounts['physics'] = physics
+        self.command = Command(stdout=StringIO())
+
+    def changeset(self):
+        records = SlurmCluster.iter_stream(StringIO(SLURM_DUMP))
+        slurm_cluster = next(records)
+        return self.command.check_consistency(
+            slurm_cluster, self.coldfront_cluster, slurm_accounts=records
+        )
+
+    def test_changeset(self):
+        self.assertEqual(self.changeset(), {
+            'cluster': 'alpha',
+            'changes': [
+                {'action': 'remove_qos', 'account': 'physics', 'user': 'jane', 'qos': 'QOS-=high'},
+                {'action': 'remove_qos', 'account': 'physics', 'user': 'john', 'qos': 'QOS-=high'},
+                {'action': 'remove_assoc', 'account': 'physics', 'user': 'larry'},
+                {'action': 'remove_assoc', 'account': 'defunct', 'user': 'jane'},
+                {'action': 'remove_account', 'account': 'defunct'},
+            ],
+        })
+
+    def test_root_only_account_is_kept(self):
+        """an account ColdFront knows whose only Slurm user is root is not removed"""
+        self.coldfront_cluster.accounts['admin'] = SlurmAccount('admin')
+        admin = SlurmAccount('admin')
+        admin.add_user(SlurmUser('root'))
+        changeset = self.command.check_consistency(
+            SlurmCluster('alpha'), self.coldfront_cluster, slurm_accounts=[admin]
+        )
+        self.assertEqual(changeset['changes'], [])
+
+    def test_ignored_users_are_skipped(self):
+        self.command.ignore_users = frozenset(['larry'])
+        self.command.filter_account = 'physics'
+        actions = [(c['action'], c.get('user')) for c in self.changeset()['changes']]
+        self.assertEqual(actions, [
+            ('remove_qos', 'jane'), ('remove_qos', 'john'),
+        ])
+
+    def test_replay_batches_changes(self):
+        """changes sharing an account and QOS go to sacctmgr together"""
+        op = mock.Mock(error=None)
+        with mock.patch.object(slurm_check, 'slurm_remove_qos', return_value=op) as remove_qos, \
+                mock.patch.object(slurm_check, 'slurm_remove_assoc', return_value=op) as remove_assoc, \
+                mock.patch.object(slurm_check, 'slurm_remove_account', return_value=op) as remove_account:
+            self.command.replay_changeset(self.changeset())
+        remove_qos.assert_called_once_with(
+            'jane,john', 'alpha', 'physics', 'QOS-=high', noop=self.command.noop
+        )
+        self.assertEqual(remove_assoc.call_count, 2)
+        remove_account.assert_called_once_with('alpha', 'defunct', noop=self.command.noop)
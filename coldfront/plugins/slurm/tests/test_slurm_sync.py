@@ -0,0 +1,122 @@
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from coldfront.core.allocation.models import (
+    Allocation,
+    AllocationAttributeUsage,
+    AllocationUser,
+    AllocationUserAttribute,
+    check_allocation_summaries,
+)
+from coldfront.core.test_helpers.factories import setup_models
+from coldfront.plugins.slurm.associations import SlurmCluster
+from coldfront.plugins.slurm.management.commands.slurm_sync import Command
+
+UTIL_FIXTURES = ['coldfront/core/test_helpers/test_data/test_fixtures/ifx.json']
+
+DUMP = """
+Cluster - 'test-cluster':Fairshare=1:QOS='normal'
+Parent - 'root'
+User - 'root':DefaultAccount='root':AdminLevel='Administrator':Fairshare=1
+Account - 'poisson_lab':Description='poisson_lab':Organization='poisson_lab':Fairshare=100
+Parent - 'poisson_lab'
+User - 'ljbortkiewicz':DefaultAccount='poisson_lab':Fairshare=parent
+User - 'jdoe':DefaultAccount='poisson_lab':Fairshare=parent
+Parent - 'root'
+Account - 'unknown_lab':Description='unknown_lab':Organization='unknown_lab':Fairshare=100
+"""
+
+SHARES = {'RawShares': '100', 'NormShares': '0.5', 'RawUsage': '42', 'FairShare': '0.9'}
+
+
+class SlurmSyncTest(TestCase):
+    """Tests for the bulk slurm_sync reconciliation"""
+    fixtures = UTIL_FIXTURES
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('add_allocation_defaults')
+        setup_models(cls)
+
+    def setUp(self):
+        self.cluster = SlurmCluster.new_from_stream(StringIO(DUMP))
+        account = self.cluster.accounts['poisson_lab']
+        account.share_dict = dict(SHARES)
+        for user in account.users.values():
+            user.share_dict = dict(SHARES)
+
+    def test_sync_creates_then_noop(self):
+        """a second sync of unchanged data writes nothing"""
+        command = Command()
+        changes, undetected = command.create_account_allocations_and_attributes(
+            self.cluster, self.cluster_resource
+        )
+        self.assertEqual(undetected, ['unknown_lab'])
+        self.assertEqual(changes.summary['allocation users created'], 1)
+        self.assertEqual(changes.summary['allocation users removed'], 1)
+        self.assertEqual(
+            AllocationUser.objects.get(
+                allocation=self.cluster_allocation, user=self.nonproj_allocationuser
+            ).status.name,
+            'Removed',
+        )
+        jdoe = AllocationUser.objects.get(
+            allocation=self.cluster_allocation, user=self.cluster_allocationuser
+        )
+        self.assertEqual(
+            AllocationUserAttribute.objects.get(
+                allocationuser=jdoe, allocationuser_attribute_type__name='RawUsage'
+            ).value,
+            '42',
+        )
+        allocation = Allocation.objects.get(pk=self.cluster_allocation.pk)
+        self.assertEqual(allocation.get_attribute('slurm_account_name'), 'poisson_lab')
+        self.assertTrue(AllocationAttributeUsage.objects.filter(
+            allocation_attribute__allocation=allocation,
+            allocation_attribute__allocation_attribute_type__name='Core Usage (Hours)',
+        ).exists())
+
+        changes, _ = command.create_account_allocations_and_attributes(
+            self.cluster, self.cluster_resource
+        )
+        self.assertFalse(changes)
+
+    def test_sync_updates_changed_values_only(self):
+        """only attributes whose values changed are updated"""
+        command = Command()
+        command.create_account_allocations_and_attributes(self.cluster, self.cluster_resource)
+        self.cluster.accounts['poisson_lab'].share_dict['RawUsage'] = '43'
+        changes, _ = command.create_account_allocations_and_attributes(
+            self.cluster, self.cluster_resource
+        )
+        # RawUsage and slurm_specs
+        self.assertEqual(changes.summary['allocation attributes updated'], 2)
+        self.assertEqual(changes.summary['allocation attributes created'], 0)
+        allocation = Allocation.objects.get(pk=self.cluster_allocation.pk)
+        self.assertEqual(allocation.get_full_attribute('RawUsage').value, '43')
+
+    def test_sync_refreshes_summaries(self):
+        """the summaries of synced allocations are refreshed on commit"""
+        with self.captureOnCommitCallbacks(execute=True):
+            Command().create_account_allocations_and_attributes(
+                self.cluster, self.cluster_resource
+            )
+        self.assertEqual(check_allocation_summaries([self.cluster_allocation.pk]), {})
+
+    def test_dry_run(self):
+        """a dry run reports changes without saving them"""
+        changes, _ = Command().create_account_allocations_and_attributes(
+            self.cluster, self.cluster_resource, dry_run=True
+        )
+        self.assertTrue(changes)
+        self.assertFalse(AllocationUser.objects.filter(
+            allocation=self.cluster_allocation, user=self.cluster_allocationuser
+        ).exists())
+        self.assertEqual(
+            AllocationUser.objects.get(
+                allocation=self.cluster_allocation, user=self.nonproj_allocationuser
+            ).status.name,
+            'Active',
+        )
@@ -0,0 +1,121 @@
+import os
+import stat
+import tempfile
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from coldfront.plugins.slurm import utils
+
+# logs each invocation's arguments and stdin. A command naming "baduser" fails.
+# Like sacctmgr, a script runs every line, reporting failures and unknown
+# keywords on stderr, and stops for good at a line naming "crashuser".
+FAKE_SACCTMGR = """#!/bin/sh
+script=""
+if [ -z "$4" ]; then
+    script=$(cat)
+fi
+printf 'ARGS %s\\n%s\\n' "$*" "$script" >> "{log}"
+if [ -n "$4" ]; then
+    case "$*" in
+        *baduser*) echo "error: baduser" >&2; exit 1 ;;
+    esac
+    echo "ok"
+    exit 0
+fi
+printf '%s\\n' "$script" | while read -r keyword rest; do
+    case "$keyword $rest" in
+        *crashuser*) echo "fatal: crashuser" >&2; exit 1 ;;
+        *baduser*) echo "error: baduser" >&2 ;;
+        create*|delete*|modify*) ;;
+        ?*) echo "invalid keyword: $keyword" >&2 ;;
+    esac
+done
+exit 1
+"""
+
+
+class SacctmgrBatchTest(SimpleTestCase):
+    """Tests for batched sacctmgr changes against a fake sacctmgr"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.log = os.path.join(self.tmpdir.name, 'calls.log')
+        sacctmgr = os.path.join(self.tmpdir.name, 'sacctmgr')
+        with open(sacctmgr, 'w') as fh:
+            fh.write(FAKE_SACCTMGR.format(log=self.log))
+        os.chmod(sacctmgr, os.stat(sacctmgr).st_mode | stat.S_IEXEC)
+        patches = [
+            mock.patch.object(utils, 'SLURM_SACCTMGR_PATH', sacctmgr),
+            mock.patch.object(utils, 'SLURM_CMD_SACCTMGR_CHANGE', sacctmgr + ' -Q -i '),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def calls(self):
+        if not os.path.exists(self.log):
+            return []
+        with open(self.log) as fh:
+            return [line for line in fh.read().splitlines() if line.startswith('ARGS')]
+
+    def test_changes_run_as_one_script(self):
+        with utils.sacctmgr_batch():
+            ops = [
+                utils.slurm_add_assoc(f'user{i}', 'alpha', 'lab', specs=['Fairshare=parent'])
+                for i in range(5)
+            ]
+            self.assertEqual(self.calls(), [])
+        self.assertEqual(self.calls(), ['ARGS -Q -i'])
+        self.assertTrue(all(op.ok for op in ops))
+        with open(self.log) as fh:
+            self.assertIn('create user name=user4 cluster=alpha account=lab Fairshare=parent', fh.read())
+
+    def test_failed_script_maps_errors_to_operations(self):
+        with utils.sacctmgr_batch():
+            good = utils.slurm_remove_assoc('gooduser', 'lab')
+            bad = utils.slurm_remove_assoc('baduser', 'lab')
+            other = utils.slurm_remove_assoc('otheruser', 'lab')
+        # the script, then only the failed operation on its own
+        self.assertEqual(self.calls(), [
+            'ARGS -Q -i', 'ARGS -Q -i delete user where name=baduser account=lab',
+        ])
+        self.assertTrue(good.ok)
+        self.assertEqual(good.result, b'')
+        self.assertTrue(other.ok)
+        self.assertIsInstance(bad.error, utils.SlurmError)
+
+    def test_operations_not_reached_are_rerun(self):
+        with utils.sacctmgr_batch():
+            ops = [utils.slurm_remove_assoc(name, 'lab') for name in ('user0', 'crashuser', 'user2')]
+        self.assertEqual(self.calls(), [
+            'ARGS -Q -i',
+            'ARGS -Q -i delete user where name=crashuser account=lab',
+            'ARGS -Q -i delete user where name=user2 account=lab',
+        ])
+        self.assertTrue(all(op.ok for op in ops))
+
+    def test_split_batch_messages(self):
+        mark = utils.SACCTMGR_BATCH_MARK.encode()
+        stderr = b'invalid keyword: ' + mark + b'0\nerror: baduser\ninvalid keyword: ' + mark + b'1\n'
+        self.assertEqual(
+            utils._split_batch_messages(stderr, 3), [b'', b'error: baduser\n', None]
+        )
+
+    def test_noop(self):
+        with utils.sacctmgr_batch(noop=True):
+            op = utils.slurm_remove_account('alpha', 'lab')
+        self.assertTrue(op.done)
+        self.assertEqual(self.calls(), [])
+
+    def test_max_ops_per_script(self):
+        with mock.patch.object(utils, 'SLURM_BATCH_MAX_OPS', 2):
+            with utils.sacctmgr_batch():
+                for i in range(5):
+                    utils.slurm_remove_assoc(f'user{i}', 'lab')
+        self.assertEqual(len(self.calls()), 3)
+
+    def test_without_batch_runs_immediately(self):
+        utils.slurm_remove_assoc('gooduser', 'lab')
+        self.assertEqual(self.calls(), ['ARGS -Q -i delete user where name=gooduser account=lab'])
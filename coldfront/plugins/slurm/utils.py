@@ -4,6 +4,9 @@ import shlex
 import struct
 import subprocess
 import csv
+import itertools
+import threading
+from contextlib import contextmanager
 from io import StringIO
 
 from coldfront.core.utils.common import import_from_settings
@@ -22,18 +25,34 @@ SLURM_SACCTMGR_PATH = import_from_settings(
 SLURM_SSHARE_PATH = import_from_settings('SLURM_SSHARE_PATH', '/usr/bin/sshare')
 SLURM_SREPORT_PATH = import_from_settings('SLURM_SREPORT_PATH', '/usr/bin/sreport')
 SLURM_SCONTROL_PATH = import_from_settings('SLURM_SCONTROL_PATH', '/usr/bin/scontrol')
+# most sacctmgr changes sent to one sacctmgr process by a SacctmgrBatch
+SLURM_BATCH_MAX_OPS = import_from_settings('SLURM_BATCH_MAX_OPS', 200)
+# keyword written after each change of a sacctmgr script; sacctmgr rejects it
+# as "invalid keyword: <mark><n>" on stderr, which splits the error output of
+# the script per change
+SACCTMGR_BATCH_MARK = 'coldfront-end-of-op-'
 
 SLURM_CMD_PULL_FAIRSHARE = SLURM_SSHARE_PATH + ' -a -o "Cluster,Account%30,User%25,RawShares,NormShares,RawUsage,EffectvUsage,FairShare"'
-SLURM_CMD_PULL_SREPORT = SLURM_SREPORT_PATH + '-T gres/gpu,cpu cluster accountutilization format="Cluster,Account%25,Login%25,TRESname,Used" start={}T00:00:00 end=now -t hours'
-SLURM_CMD_REMOVE_USER = SLURM_SACCTMGR_PATH + ' -Q -i delete user where name={} account={}'
-SLURM_CMD_REMOVE_QOS = SLURM_SACCTMGR_PATH + ' -Q -i modify user where name={} cluster={} account={} set {}'
-SLURM_CMD_EDIT_RAWSHARE= SLURM_SACCTMGR_PATH + ' -Q -i modify user set fairshare={} where name={} account={}'
-SLURM_CMD_EDIT_ACCOUNT_RAWSHARE= SLURM_SACCTMGR_PATH + ' -Q -i modify account set fairshare={} where name={}'
-SLURM_CMD_REMOVE_ACCOUNT = SLURM_SACCTMGR_PATH + ' -Q -i delete account where name={} cluster={}'
-SLURM_CMD_ADD_ACCOUNT = SLURM_SACCTMGR_PATH + ' -Q -i create account name={} cluster={}'
-SLURM_CMD_ADD_USER = SLURM_SACCTMGR_PATH + ' -Q -i create user name={} cluster={} account={}'
+SLURM_CMD_PULL_SREPORT = SLURM_SREPORT_PATH + ' -T gres/gpu,cpu cluster accountutilization format="Cluster,Account%25,Login%25,TRESname,Used" start={}T00:00:00 end=now -t hours'
+# sacctmgr changes, as run by themselves (SLURM_CMD_*) or as lines of a batch script (SLURM_OP_*)
+SLURM_OP_REMOVE_USER = 'delete user where name={} account={}'
+SLURM_OP_REMOVE_QOS = 'modify user where name={} cluster={} account={} set {}'
+SLURM_OP_EDIT_RAWSHARE = 'modify user set fairshare={} where name={} account={}'
+SLURM_OP_EDIT_ACCOUNT_RAWSHARE = 'modify account set fairshare={} where name={}'
+SLURM_OP_REMOVE_ACCOUNT = 'delete account where name={} cluster={}'
+SLURM_OP_ADD_ACCOUNT = 'create account name={} cluster={}'
+SLURM_OP_ADD_USER = 'create user name={} cluster={} account={}'
+SLURM_OP_BLOCK_ACCOUNT = 'modify account {} where Cluster={} set GrpSubmitJobs=0'
+SLURM_CMD_SACCTMGR_CHANGE = SLURM_SACCTMGR_PATH + ' -Q -i '
+SLURM_CMD_REMOVE_USER = SLURM_CMD_SACCTMGR_CHANGE + SLURM_OP_REMOVE_USER
+SLURM_CMD_REMOVE_QOS = SLURM_CMD_SACCTMGR_CHANGE + SLURM_OP_REMOVE_QOS
+SLURM_CMD_EDIT_RAWSHARE= SLURM_CMD_SACCTMGR_CHANGE + SLURM_OP_EDIT_RAWSHARE
+SLURM_CMD_EDIT_ACCOUNT_RAWSHARE= SLURM_CMD_SACCTMGR_CHANGE + SLURM_OP_EDIT_ACCOUNT_RAWSHARE
+SLURM_CMD_REMOVE_ACCOUNT = SLURM_CMD_SACCTMGR_CHANGE + SLURM_OP_REMOVE_ACCOUNT
+SLURM_CMD_ADD_ACCOUNT = SLURM_CMD_SACCTMGR_CHANGE + SLURM_OP_ADD_ACCOUNT
+SLURM_CMD_ADD_USER = SLURM_CMD_SACCTMGR_CHANGE + SLURM_OP_ADD_USER
 SLURM_CMD_CHECK_ASSOCIATION = SLURM_SACCTMGR_PATH + ' list associations User={} Cluster={} Account={} Format=Cluster,Account,User,QOS -P'
-SLURM_CMD_BLOCK_ACCOUNT = SLURM_SACCTMGR_PATH + ' -Q -i modify account {} where Cluster={} set GrpSubmitJobs=0'
+SLURM_CMD_BLOCK_ACCOUNT = SLURM_CMD_SACCTMGR_CHANGE + SLURM_OP_BLOCK_ACCOUNT
 SLURM_CMD_DUMP_CLUSTER = SLURM_SACCTMGR_PATH + ' dump {} file={}'
 SLURM_CMD_LIST_PARTITIONS = SLURM_SCONTROL_PATH + ' show partitions'
 SLURM_CMD_GET_USER_INFO = SLURM_SSHARE_PATH + ' -u {} -A {} -o Account,User,RawShares,NormShares,RawUsage,FairShare --parsable'
@@ -96,56 +115,238 @@ def _run_slurm_cmd(cmd, noop=True, show_output=False):
 
     return result.stdout
 
+class SacctmgrOperation:
+    """One queued sacctmgr change.
+
+    Attributes:
+        command (str): the sacctmgr arguments, e.g. "delete user where name=jdoe account=lab"
+        noop (bool): log the change instead of running it
+        done (bool): set once the operation has been run (or skipped for noop)
+        result (bytes): sacctmgr's output for the operation: its stdout when
+            run alone, or the messages it printed for it in a batch script
+        error (SlurmError): set if the operation failed
+    """
+    __slots__ = ('command', 'noop', 'done', 'result', 'error')
+
+    def __init__(self, command, noop=False):
+        self.command = command
+        self.noop = noop
+        self.done = False
+        self.result = None
+        self.error = None
+
+    @property
+    def ok(self):
+        return self.done and self.error is None
+
+    def run(self):
+        """Run this operation in its own sacctmgr process."""
+        try:
+            self.result = _run_slurm_cmd(SLURM_SACCTMGR_PATH + ' -Q -i ' + self.command, noop=self.noop)
+        except SlurmError as e:
+            self.error = e
+        self.done = True
+
+    def __repr__(self):
+        return f'<SacctmgrOperation {self.command!r}>'
+
+
+class SacctmgrBatch:
+    """Collects sacctmgr changes and runs them as sacctmgr scripts.
+
+    Pending operations are written, one per line, to the stdin of a single
+    "sacctmgr -Q -i" process per SLURM_BATCH_MAX_OPS operations. Each line is
+    followed by a SACCTMGR_BATCH_MARK keyword, which sacctmgr reports on
+    stderr, so the messages sacctmgr prints are matched to the operation that
+    caused them. sacctmgr runs every line of a script even if one fails, and
+    is quiet about changes that succeed, so only the operations that
+    reported errors, or that sacctmgr never reached, are rerun on their own
+    to get their result or SlurmError.
+    """
+
+    def __init__(self, noop=False):
+        self.noop = noop
+        self.pending = []
+
+    def add(self, command, noop=False):
+        op = SacctmgrOperation(command, noop=noop or self.noop)
+        self.pending.append(op)
+        return op
+
+    def flush(self):
+        """Run every pending operation and return them."""
+        ops, self.pending = self.pending, []
+        for i in range(0, len(ops), SLURM_BATCH_MAX_OPS):
+            self._run_script(ops[i:i + SLURM_BATCH_MAX_OPS])
+        return ops
+
+    def _run_script(self, ops):
+        to_run = []
+        for op in ops:
+            if op.noop:
+                logger.warning('NOOP - Slurm cmd: sacctmgr %s', op.command)
+                op.done = True
+            else:
+                to_run.append(op)
+        if not to_run:
+            return
+        script = ''.join(
+            f'{op.command}\n{SACCTMGR_BATCH_MARK}{i}\n' for i, op in enumerate(to_run)
+        )
+        try:
+            # the marks make sacctmgr exit non-zero, so its status is not checked
+            result = subprocess.run(
+                [SLURM_SACCTMGR_PATH, '-Q', '-i'], input=script.encode(),
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            )
+        except OSError as e:
+            logger.warning(
+                'sacctmgr script of %s operations failed, running them one at a time: %s',
+                len(to_run), e,
+            )
+            for op in to_run:
+                op.run()
+            return
+        logger.debug(f' \x1b[33;20m Slurm batch of {len(to_run)} sacctmgr commands ran \x1b[0m')
+        failed = []
+        for op, messages in zip(to_run, _split_batch_messages(result.stderr, len(to_run))):
+            if messages is None or messages.strip():
+                failed.append(op)
+            else:
+                op.result = messages
+                op.done = True
+        if failed:
+            logger.warning(
+                '%s of %s operations in a sacctmgr script failed or did not run, '
+                'running them one at a time', len(failed), len(to_run),
+            )
+            for op in failed:
+                op.run()
+
+
+def _split_batch_messages(stderr, count):
+    """Split the stderr of a sacctmgr script on its SACCTMGR_BATCH_MARK lines.
+
+    Returns:
+        list: for each of the count operations, the messages sacctmgr printed
+        for it, or None if sacctmgr stopped before reaching its mark
+    """
+    mark = re.compile(re.escape(SACCTMGR_BATCH_MARK.encode()) + rb'(\d+)')
+    messages = [[] for _ in range(count)]
+    reached = [False] * count
+    current = 0
+    for line in stderr.splitlines(keepends=True):
+        match = mark.search(line)
+        if match:
+            index = int(match.group(1))
+            if index < count:
+                reached[index] = True
+            current = index + 1
+        elif current < count:
+            messages[current].append(line)
+    return [b''.join(lines) if done else None for lines, done in zip(messages, reached)]
+
+
+_batch_state = threading.local()
+
+
+def current_sacctmgr_batch():
+    """Return the SacctmgrBatch active in this thread, if any."""
+    return getattr(_batch_state, 'batch', None)
+
+
+@contextmanager
+def sacctmgr_batch(noop=False):
+    """Queue the sacctmgr changes made by the slurm_* helpers inside the block
+    and run them together when it exits. The helpers return SacctmgrOperation
+    objects instead of output while a batch is active; their results are
+    filled in by the flush. Nested blocks share the outermost batch.
+    """
+    batch = current_sacctmgr_batch()
+    if batch is not None:
+        yield batch
+        return
+    batch = SacctmgrBatch(noop=noop)
+    _batch_state.batch = batch
+    try:
+        yield batch
+    except BaseException:
+        if batch.pending:
+            logger.error('Discarding %s queued sacctmgr changes: %s', len(batch.pending), batch.pending)
+        raise
+    else:
+        for op in batch.flush():
+            if op.error:
+                logger.error('Slurm cmd sacctmgr %s failed: %s', op.command, op.error)
+    finally:
+        _batch_state.batch = None
+
+
+def flush_sacctmgr_batch():
+    """Run any queued sacctmgr changes now, before reading state back from Slurm."""
+    batch = current_sacctmgr_batch()
+    if batch is not None:
+        return batch.flush()
+    return []
+
+
+def _run_sacctmgr_change(op_command, noop=False):
+    """Run a sacctmgr change, or queue it if a sacctmgr_batch is active."""
+    batch = current_sacctmgr_batch()
+    if batch is not None:
+        return batch.add(op_command, noop=noop)
+    return _run_slurm_cmd(SLURM_CMD_SACCTMGR_CHANGE + op_command, noop=noop)
+
 def slurm_remove_assoc(user, account, noop=False):
-    cmd = SLURM_CMD_REMOVE_USER.format(
+    cmd = SLURM_OP_REMOVE_USER.format(
         shlex.quote(user), shlex.quote(account)
     )
-    _run_slurm_cmd(cmd, noop=noop)
+    return _run_sacctmgr_change(cmd, noop=noop)
 
 def slurm_remove_qos(user, cluster, account, qos, noop=False):
-    cmd = SLURM_CMD_REMOVE_QOS.format(
+    cmd = SLURM_OP_REMOVE_QOS.format(
         shlex.quote(user), shlex.quote(cluster), shlex.quote(account), shlex.quote(qos)
     )
-    _run_slurm_cmd(cmd, noop=noop)
+    return _run_sacctmgr_change(cmd, noop=noop)
 
 def slurm_update_raw_share(user,  account, raw_share, noop=False):
-    cmd = SLURM_CMD_EDIT_RAWSHARE.format(
+    cmd = SLURM_OP_EDIT_RAWSHARE.format(
         shlex.quote(raw_share),
         user,
         account
     )
-    return _run_slurm_cmd(cmd, noop=noop)
+    return _run_sacctmgr_change(cmd, noop=noop)
 
 def slurm_update_account_raw_share(account, raw_share, noop=False):
-    cmd = SLURM_CMD_EDIT_ACCOUNT_RAWSHARE.format(
+    cmd = SLURM_OP_EDIT_ACCOUNT_RAWSHARE.format(
         shlex.quote(raw_share),
         account
     )
-    return _run_slurm_cmd(cmd, noop=noop)
+    return _run_sacctmgr_change(cmd, noop=noop)
 
 def slurm_remove_account(cluster, account, noop=False):
-    cmd = SLURM_CMD_REMOVE_ACCOUNT.format(shlex.quote(account), shlex.quote(cluster))
-    _run_slurm_cmd(cmd, noop=noop)
+    cmd = SLURM_OP_REMOVE_ACCOUNT.format(shlex.quote(account), shlex.quote(cluster))
+    return _run_sacctmgr_change(cmd, noop=noop)
 
 def slurm_add_assoc(user, cluster, account, specs=None, noop=False):
     if specs is None:
         specs = []
-    cmd = SLURM_CMD_ADD_USER.format(shlex.quote(user), shlex.quote(cluster), shlex.quote(account))
+    cmd = SLURM_OP_ADD_USER.format(shlex.quote(user), shlex.quote(cluster), shlex.quote(account))
     if len(specs) > 0:
         cmd += ' ' + ' '.join(specs)
-    _run_slurm_cmd(cmd, noop=noop)
+    return _run_sacctmgr_change(cmd, noop=noop)
 
 def slurm_add_account(cluster, account, specs=None, noop=False):
     if specs is None:
         specs = []
-    cmd = SLURM_CMD_ADD_ACCOUNT.format(shlex.quote(account), shlex.quote(cluster))
+    cmd = SLURM_OP_ADD_ACCOUNT.format(shlex.quote(account), shlex.quote(cluster))
     if len(specs) > 0:
         cmd += ' ' + ' '.join(specs)
-    _run_slurm_cmd(cmd, noop=noop)
+    return _run_sacctmgr_change(cmd, noop=noop)
 
 def slurm_block_account(cluster, account, noop=False):
-    cmd = SLURM_CMD_BLOCK_ACCOUNT.format(shlex.quote(account), shlex.quote(cluster))
-    _run_slurm_cmd(cmd, noop=noop)
+    cmd = SLURM_OP_BLOCK_ACCOUNT.format(shlex.quote(account), shlex.quote(cluster))
+    return _run_sacctmgr_change(cmd, noop=noop)
 
 def slurm_get_nodes_info():
     def table_to_dict_list(table_info):
@@ -163,6 +364,7 @@ def slurm_check_assoc(user, cluster, account):
     cmd = SLURM_CMD_CHECK_ASSOCIATION.format(
         shlex.quote(user), shlex.quote(cluster), shlex.quote(account)
     )
+    flush_sacctmgr_batch()
     output = _run_slurm_cmd(cmd, noop=False)
 
     with StringIO(output.decode("UTF-8")) as fh:
@@ -175,6 +377,7 @@ def slurm_check_assoc(user, cluster, account):
 
 def slurm_dump_cluster(cluster, fname, noop=False):
     cmd = SLURM_CMD_DUMP_CLUSTER.format(shlex.quote(cluster), shlex.quote(fname))
+    flush_sacctmgr_batch()
     _run_slurm_cmd(cmd, noop=noop)
 
 def convert_to_dict(input_list):
@@ -186,47 +389,66 @@ def convert_to_dict(input_list):
     return result
 
 def slurm_fixed_width_lines_to_dict(line_iterable):
-    """Take a list of fixed-width lines and convert them to dictionaries.
-    line_iterable's first item should be the header; second item, dashed width indicators.
+    """Take an iterable of fixed-width lines and lazily convert them to dictionaries.
+    line_iterable's first non-empty item should be the header; second item, dashed width indicators.
+    Lines are consumed one at a time, so a file handle or generator can be passed directly.
     """
-    widths = [n.count('-') + 1 for n in line_iterable[1].split()]
-    fmtstring = ' '.join(f'{abs(fw)}s' for fw in widths)
-    unpack = struct.Struct(fmtstring).unpack_from
-    parse = lambda line: tuple(s.decode().strip() for s in unpack(line.encode()))
-    # split each line by width
-    line_iterable = [parse(line) for line in line_iterable if line]
+    lines = (line.rstrip('\r\n') for line in line_iterable)
+    lines = (line for line in lines if line)
+    header = next(lines, None)
+    dashes = next(lines, None)
+    if header is None or dashes is None:
+        return
+    widths = [n.count('-') + 1 for n in dashes.split()]
+    fmt = struct.Struct(' '.join(f'{abs(fw)}s' for fw in widths))
+    unpack = fmt.unpack_from
+    size = fmt.size
+    parse = lambda line: tuple(s.decode().strip() for s in unpack(line.encode().ljust(size)))
     # pair values with headers
-    return convert_to_dict(line_iterable)
+    keys = parse(header)
+    for line in lines:
+        yield dict(zip(keys, parse(line)))
+
+def _iter_cmd_output_lines(output):
+    """iterate over the decoded lines of a command's output without splitting it into a list"""
+    return iter(StringIO(output.decode('utf-8')))
 
 def slurm_collect_usage(cluster=None, output_file=None):
-    """collect usage for all accounts. Can specify a cluster if needed."""
+    """collect usage for all accounts. Can specify a cluster if needed.
+    Returns a generator of dicts, one per sreport row.
+    """
     cluster_str = f' cluster {cluster}' if cluster else ''
     output_str = f' > {output_file}' if output_file else ''
     quarter_start, _ = get_quarter_start_end()
     cmd = SLURM_CMD_PULL_SREPORT.format(shlex.quote(quarter_start)) + cluster_str + output_str
-    usage_data = _run_slurm_cmd(cmd)
-    usage_data = usage_data.decode('utf-8').split('\n')
-    header_idx = usage_data.index(next(l for l in usage_data if "TRES Name" in l))
-    usage_data = usage_data[header_idx:]
-    usage_data = slurm_fixed_width_lines_to_dict(usage_data)
-    return usage_data
+    flush_sacctmgr_batch()
+    usage_data = _run_slurm_cmd(cmd, noop=False)
+    usage_lines = itertools.dropwhile(
+        lambda line: "TRES Name" not in line, _iter_cmd_output_lines(usage_data)
+    )
+    return slurm_fixed_width_lines_to_dict(usage_lines)
 
 def slurm_collect_shares(cluster=None, output_file=None):
-    """collect fairshares for all accounts. Can specify a cluster if needed."""
+    """collect fairshares for all accounts. Can specify a cluster if needed.
+    Returns a generator of dicts, one per sshare row.
+    """
     cluster_str = f' -M {cluster}' if cluster else ''
     output_str = f' > {output_file}' if output_file else ''
     cmd = SLURM_CMD_PULL_FAIRSHARE + cluster_str + output_str
 
     logger.debug(f'  Pulling Share data for cluster {cluster}')
+    flush_sacctmgr_batch()
     share_data = _run_slurm_cmd(cmd, noop=False)
-    share_data = share_data.decode('utf-8').split('\n')
-    if "-----" not in share_data[1]:
-        share_data = share_data[1:]
-    share_data = slurm_fixed_width_lines_to_dict(share_data)
-    return share_data
+    share_lines = _iter_cmd_output_lines(share_data)
+    # multi-cluster output starts with a "CLUSTER: name" line before the header
+    first_lines = list(itertools.islice(share_lines, 2))
+    if len(first_lines) == 2 and "-----" not in first_lines[1]:
+        first_lines = first_lines[1:]
+    return slurm_fixed_width_lines_to_dict(itertools.chain(first_lines, share_lines))
 
 def slurm_get_user_info(username, account, noop=False):
     cmd = SLURM_CMD_GET_USER_INFO.format(shlex.quote(username), shlex.quote(account))
+    flush_sacctmgr_batch()
     output = _run_slurm_cmd(cmd, noop=noop)
     output = output.decode('utf-8').split('\n')
     return output
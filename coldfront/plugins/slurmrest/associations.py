@@ -1,18 +1,22 @@
 """Classes and utilities for managing associations between Coldfront and Slurm entities."""
 import logging
+from collections import defaultdict
 
+from django.db import transaction
 from django.utils import timezone
+from simple_history.utils import bulk_create_with_history, bulk_update_with_history
 
 from coldfront.core.utils.common import import_from_settings
 from coldfront.core.allocation.models import (
     Allocation,
     AllocationAttributeType,
+    schedule_summary_refresh,
 )
 from coldfront.core.allocation.utils import get_or_create_allocation
 
 from coldfront.core.project.models import Project
 from coldfront.core.resource.models import (
-    Resource, ResourceAttributeType, ResourceType, ResourceAttribute
+    AttributeType, Resource, ResourceAttributeType, ResourceType, ResourceAttribute
 )
 from coldfront.plugins.slurmrest.utils import (
     SlurmApiConnection,
@@ -29,14 +33,29 @@ SLURMREST_USER_SPECS_ATTRIBUTE_NAME = import_from_settings(
 SLURM_IGNORE_USERS = import_from_settings('SLURMREST_IGNORE_USERS', [])
 SLURM_IGNORE_ACCOUNTS = import_from_settings('SLURMREST_IGNORE_ACCOUNTS', [])
 SLURM_NOOP = import_from_settings('SLURMREST_NOOP', False)
+# cluster resource attributes holding the slurmctld time of the last node and
+# partition imports, sent as update_time to fetch only newer data
+NODE_UPDATE_TIME_ATTRIBUTE_NAME = 'slurmrest_node_update_time'
+PARTITION_UPDATE_TIME_ATTRIBUTE_NAME = 'slurmrest_partition_update_time'
+CHANGE_REASON = 'slurmrest import'
 logger = logging.getLogger(__name__)
 
+
+def slurm_number(value):
+    """Return the value of a slurmrestd number object ({'set', 'infinite',
+    'number'}), or the value itself if it is a plain number.
+    """
+    if isinstance(value, dict):
+        return value.get('number') if value.get('set', True) else None
+    return value
+
+
 class ClusterResourceManager:
     """Class to manage Coldfront Resource objects corresponding to Slurm cluster entities."""
-    def __init__(self, cluster_name):
+    def __init__(self, cluster_name, slurm_api=None):
         # connection
         self.cluster_name = cluster_name
-        self.slurm_api = SlurmApiConnection(cluster_name)
+        self.slurm_api = slurm_api or SlurmApiConnection(cluster_name)
         # slurm data caches
         self._accounts = None
         self._partitions = None
@@ -60,6 +79,15 @@ class ClusterResourceManager:
             name='Cloud Account Name')
         self.hours_allocattrtype = AllocationAttributeType.objects.get(
             name='Core Usage (Hours)')
+        int_attribute_type = AttributeType.objects.get(name='Int')
+        self.node_update_time_attribute_type = ResourceAttributeType.objects.get_or_create(
+            name=NODE_UPDATE_TIME_ATTRIBUTE_NAME,
+            defaults={'attribute_type': int_attribute_type},
+        )[0]
+        self.partition_update_time_attribute_type = ResourceAttributeType.objects.get_or_create(
+            name=PARTITION_UPDATE_TIME_ATTRIBUTE_NAME,
+            defaults={'attribute_type': int_attribute_type},
+        )[0]
 
 
     ### Properties to lazily load Slurm data and Coldfront resources ###
@@ -99,52 +127,153 @@ class ClusterResourceManager:
         return self._cluster_resource
 
 
+    ### Incremental import bookkeeping ###
+    def last_update(self, attribute_type):
+        """Return the cluster resource attribute holding the slurmctld time of
+        the last import, or None before the first import.
+        """
+        return self.cluster_resource.resourceattribute_set.filter(
+            resource_attribute_type=attribute_type
+        ).first()
+
+    def save_last_update(self, attribute_type, response):
+        """Record the last_update time of a slurmrestd response."""
+        last_update = slurm_number(response.get('last_update'))
+        if last_update is not None:
+            self.cluster_resource.resourceattribute_set.update_or_create(
+                resource_attribute_type=attribute_type,
+                defaults={'value': str(last_update)},
+            )
+
+
     ### Partition import methods ###
-    def import_partition_data(self):
-        """Import Slurm partitions as Coldfront Resources."""
-        for partition in self.partitions:
-            partition_resource = self.create_update_partition_resource(partition)
-            self.update_partition_resource_allocations(partition, partition_resource)
-
-    def create_update_partition_resource(self, partition_data):
-        """Create or update a Coldfront Resource for a Slurm partition.
+    def import_partition_data(self, full=False):
+        """Import Slurm partitions as Coldfront Resources.
+
+        Unless full is True, slurmrestd is asked for the partitions only if
+        they changed since the last import, and nothing is written if they
+        didn't. Partition access also depends on the cluster allocations, so a
+        cluster allocation created since the last import forces a full fetch.
+        """
+        last_update = None if full else self.last_update(self.partition_update_time_attribute_type)
+        update_time = last_update.value if last_update else None
+        if update_time and Allocation.objects.filter(
+            resources=self.cluster_resource, created__gte=last_update.modified
+        ).exists():
+            update_time = None
+        response = self.slurm_api.get_partitions(update_time=update_time)
+        partitions = response.get('partitions') or []
+        if update_time and not partitions:
+            logger.info("No partition changes on cluster %s since %s", self.cluster_name, update_time)
+            return
+        self._partitions = partitions
+        with transaction.atomic():
+            partition_resources = self.create_update_partition_resources(partitions)
+            self.update_partition_resource_allocations(partitions, partition_resources)
+            self.save_last_update(self.partition_update_time_attribute_type, response)
+
+    def create_update_partition_resources(self, partitions):
+        """Create or update the Coldfront Resources of Slurm partitions, in bulk.
         Slurm partition Resource names are formatted as "<cluster_name>:<partition_name>"
         to ensure uniqueness in the ColdFront database.
+
+        Returns a dict of partition name to Resource.
         """
-        partition_resource, created = Resource.objects.get_or_create(
-            name=f'{self.cluster_name}:{partition_data["name"]}',
-            parent_resource=self.cluster_resource,
-            resource_type=self.partition_resource_type,
-            defaults={
-                'description': f"{partition_data['name']} partition on {self.cluster_name}"
-            }
+        names = {f'{self.cluster_name}:{p["name"]}': p for p in partitions}
+        resources = {
+            r.name: r for r in Resource.objects.filter(
+                parent_resource=self.cluster_resource, resource_type=self.partition_resource_type,
+            ) if r.name in names
+        }
+        new_resources = [
+            Resource(
+                name=name,
+                parent_resource=self.cluster_resource,
+                resource_type=self.partition_resource_type,
+                description=f"{partition['name']} partition on {self.cluster_name}",
+            )
+            for name, partition in names.items() if name not in resources
+        ]
+        if new_resources:
+            bulk_create_with_history(
+                new_resources, Resource, batch_size=500, default_change_reason=CHANGE_REASON
+            )
+            # reloaded, since not every backend returns the pks of bulk_create
+            resources.update({r.name: r for r in Resource.objects.filter(
+                name__in=[r.name for r in new_resources],
+                parent_resource=self.cluster_resource,
+                resource_type=self.partition_resource_type,
+            )})
+            for resource in new_resources:
+                logger.info("Created new partition resource: %s", resource.name)
+
+        specs = {
+            a.resource_id: a for a in ResourceAttribute.objects.filter(
+                resource__in=list(resources.values()),
+                resource_attribute_type=self.slurm_specs_resourceattribute_type,
+            ).order_by('-pk')
+        }
+        creates, updates = [], []
+        for name, partition in names.items():
+            resource = resources[name]
+            value = partition['tres']['billing_weights']
+            attribute = specs.get(resource.pk)
+            if attribute is None:
+                creates.append(ResourceAttribute(
+                    resource=resource, value=value,
+                    resource_attribute_type=self.slurm_specs_resourceattribute_type,
+                ))
+            elif attribute.value != value:
+                attribute.value = value
+                updates.append(attribute)
+        bulk_create_with_history(
+            creates, ResourceAttribute, batch_size=500, default_change_reason=CHANGE_REASON
         )
-        partition_resource.resourceattribute_set.update_or_create(
-            resource_attribute_type=self.slurm_specs_resourceattribute_type,
-            defaults={'value': partition_data['tres']['billing_weights']}
+        bulk_update_with_history(
+            updates, ResourceAttribute, ['value'], batch_size=500,
+            default_change_reason=CHANGE_REASON,
+        )
+        return {partition['name']: resources[name] for name, partition in names.items()}
+
+    def update_partition_resource_allocations(self, partitions, partition_resources):
+        """Update allocations to include partition resources based on access
+        lists, comparing all partitions' current allocations at once and
+        writing only the differences.
+        """
+        through = Allocation.resources.through
+        # partition resource pk -> {allocation pk: (through row pk, project title)}
+        holders = defaultdict(dict)
+        for pk, allocation_id, resource_id, title in through.objects.filter(
+            resource__in=list(partition_resources.values())
+        ).values_list('pk', 'allocation_id', 'resource_id', 'allocation__project__title'):
+            holders[resource_id][allocation_id] = (pk, title)
+        cluster_allocations = list(Allocation.objects.filter(
+            resources=self.cluster_resource
+        ).values_list('pk', 'project__title'))
+
+        removals, additions = [], []
+        for partition in partitions:
+            resource = partition_resources[partition['name']]
+            # projects whose titles match the partition accounts
+            account_names = set(self.id_partition_projects(partition))
+            current = holders[resource.pk]
+            # remove allocations for projects no longer on the partition access list
+            removals.extend(
+                (pk, allocation_id) for allocation_id, (pk, title) in current.items()
+                if title not in account_names
+            )
+            # add allocations for projects newly added to the partition access list
+            additions.extend(
+                through(allocation_id=allocation_id, resource_id=resource.pk)
+                for allocation_id, title in cluster_allocations
+                if title in account_names and allocation_id not in current
+            )
+        through.objects.filter(pk__in=[pk for pk, _ in removals]).delete()
+        through.objects.bulk_create(additions, batch_size=1000)
+        schedule_summary_refresh(
+            [allocation_id for _, allocation_id in removals]
+            + [row.allocation_id for row in additions]
         )
-        if created:
-            logger.info("Created new partition resource: %s", partition_resource.name)
-        return partition_resource
-
-    def update_partition_resource_allocations(self, partition_data, partition_resource):
-        """Update allocations to include partition resources based on access lists."""
-        # identify the partition accounts
-        partition_account_names = self.id_partition_projects(partition_data)
-        # Retrieve all projects that have the same name as the resource accounts
-        matching_projects = Project.objects.filter(title__in=partition_account_names)
-        # collect allocations that have this resource
-        matching_allocations = Allocation.objects.filter(resources=partition_resource)
-        # remove allocations for projects no longer on the partition access list
-        for allocation in matching_allocations:
-            if allocation.project not in matching_projects:
-                allocation.resources.remove(partition_resource)
-        # add allocations for projects newly added to the partition access list
-        allocations_missing_partition = Allocation.objects.filter(
-                project__in=matching_projects, resources=self.cluster_resource
-        ).exclude(resources=partition_resource)
-        for allocation in allocations_missing_partition:
-            allocation.resources.add(partition_resource)
 
     def id_partition_projects(self, partition_data):
         """identify the partition projects
@@ -171,67 +300,170 @@ class ClusterResourceManager:
 
 
     ### Node import methods ###
-    def import_node_data(self):
+    def import_node_data(self, full=False):
         """Import Slurm nodes as Coldfront Resources.
         Include import of features, owner, core count, gpu count, etc.
+
+        Unless full is True, slurmrestd is asked for the nodes only if they
+        changed since the last import, and nothing is written if they didn't.
+        slurmctld returns every node whenever any changed, so nodes missing
+        from the response are gone from the cluster.
         """
-        for node in self.nodes:
-            self.create_update_node_resource(node)
-        for resource_to_delete in Resource.objects.filter(
-            parent_resource=self.cluster_resource,
-            resource_type=self.node_resource_type,
-            is_available=True,
-        ).exclude(name__in=[n['name'] for n in self.nodes]):
-            logger.info("Node resource %s no longer exists in Slurm cluster %s; marking unavailable.",
-                resource_to_delete.name, self.cluster_name
+        last_update = None if full else self.last_update(self.node_update_time_attribute_type)
+        update_time = last_update.value if last_update else None
+        response = self.slurm_api.get_nodes(update_time=update_time)
+        nodes = response.get('nodes') or []
+        if update_time and not nodes:
+            logger.info("No node changes on cluster %s since %s", self.cluster_name, update_time)
+            return
+        self._nodes = nodes
+        with transaction.atomic():
+            self.create_update_node_resources(nodes)
+            self.retire_node_resources({n['name'] for n in nodes})
+            self.save_last_update(self.node_update_time_attribute_type, response)
+
+    def create_update_node_resources(self, nodes):
+        """Create or update the Coldfront Resources of Slurm nodes and their
+        attributes, comparing them with the stored ones loaded up front and
+        writing only the differences with bulk queries.
+
+        Returns a dict of node name to Resource.
+        """
+        names = {n['name'] for n in nodes}
+        resources = {
+            r.name: r for r in Resource.objects.filter(resource_type=self.node_resource_type)
+            if r.name in names
+        }
+        new_resources = [
+            Resource(
+                name=node['name'],
+                resource_type=self.node_resource_type,
+                parent_resource=self.cluster_resource,
+                description=f"Node {node['name']} on {self.cluster_resource.name}",
             )
-            resource_to_delete.is_available = False
-            resource_to_delete.save()
-            ResourceAttribute.objects.update_or_create(
-                resource=resource_to_delete,
-                resource_attribute_type=self.service_end_attribute_type,
-                defaults={'value':timezone.now()}
+            for node in nodes if node['name'] not in resources
+        ]
+        if new_resources:
+            bulk_create_with_history(
+                new_resources, Resource, batch_size=500, default_change_reason=CHANGE_REASON
             )
+            # reloaded, since not every backend returns the pks of bulk_create
+            resources.update({r.name: r for r in Resource.objects.filter(
+                name__in=[r.name for r in new_resources], resource_type=self.node_resource_type,
+            )})
+            for resource in new_resources:
+                logger.info("Created new node resource: %s", resource.name)
 
-    def create_update_node_resource(self, node_data):
-        """Create or update a Coldfront Resource for a Slurm node."""
-        # create or get the node resource
-        node_resource, created = Resource.objects.get_or_create(
-            name=node_data['name'],
-            resource_type=self.node_resource_type,
-            defaults={
-                'parent_resource': self.cluster_resource,
-                'description': f"Node {node_data['name']} on {self.cluster_resource.name}",
-            }
+        moved = []
+        for name in names:
+            node_resource = resources[name]
+            if node_resource.parent_resource_id != self.cluster_resource.pk:
+                logger.info("changing parent_resource of %s from %s to %s",
+                    node_resource.name, node_resource.parent_resource_id, self.cluster_resource)
+            elif not node_resource.is_available:
+                logger.info("Node resource %s is back in Slurm cluster %s; marking available.",
+                    node_resource.name, self.cluster_name)
+            else:
+                continue
+            node_resource.parent_resource = self.cluster_resource
+            node_resource.is_available = True
+            moved.append(node_resource)
+        bulk_update_with_history(
+            moved, Resource, ['parent_resource', 'is_available'], batch_size=500,
+            default_change_reason=CHANGE_REASON,
         )
-        # create or update resource attributes
-        node_resource.resourceattribute_set.update_or_create(
-            resource_attribute_type=self.features_attribute_type,
-            defaults={'value': ','.join(node_data['features'])}
+
+        attribute_types = [
+            self.features_attribute_type, self.gpu_count_attribute_type,
+            self.core_count_attribute_type, self.owner_attribute_type,
+        ]
+        resource_ids = {r.pk for r in resources.values()}
+        attributes = {}
+        # every node resource has the cluster as parent by now
+        for attribute in ResourceAttribute.objects.filter(
+            resource__parent_resource=self.cluster_resource,
+            resource__resource_type=self.node_resource_type,
+            resource_attribute_type__in=attribute_types,
+        ).order_by('-pk'):
+            if attribute.resource_id in resource_ids:
+                attributes[(attribute.resource_id, attribute.resource_attribute_type_id)] = attribute
+
+        creates, updates = [], []
+        for node in nodes:
+            node_resource = resources[node['name']]
+            values = [
+                (self.features_attribute_type, ','.join(node['features'])),
+                (self.gpu_count_attribute_type, str(node.get('gpus', 0))),
+                (self.core_count_attribute_type, str(node.get('cores', 0))),
+            ]
+            # owner sometimes needs to be set manually, so we don't update it if it exists
+            if (node_resource.pk, self.owner_attribute_type.pk) not in attributes:
+                values.append((self.owner_attribute_type, node.get('owner', 'unknown')))
+            for attribute_type, value in values:
+                attribute = attributes.get((node_resource.pk, attribute_type.pk))
+                if attribute is None:
+                    creates.append(ResourceAttribute(
+                        resource=node_resource, resource_attribute_type=attribute_type, value=value
+                    ))
+                elif attribute.value != value:
+                    attribute.value = value
+                    updates.append(attribute)
+        bulk_create_with_history(
+            creates, ResourceAttribute, batch_size=500, default_change_reason=CHANGE_REASON
         )
-        node_resource.resourceattribute_set.update_or_create(
-            resource_attribute_type=self.gpu_count_attribute_type,
-            defaults={'value': str(node_data.get('gpus', 0))}
+        bulk_update_with_history(
+            updates, ResourceAttribute, ['value'], batch_size=500,
+            default_change_reason=CHANGE_REASON,
         )
-        node_resource.resourceattribute_set.update_or_create(
-            resource_attribute_type=self.core_count_attribute_type,
-            defaults={'value': str(node_data.get('cores', 0))}
+        return resources
+
+    def retire_node_resources(self, node_names):
+        """Mark unavailable the cluster's node Resources not in node_names and
+        set their ServiceEnd.
+
+        Returns the list of Resources retired.
+        """
+        retired = [
+            r for r in Resource.objects.filter(
+                parent_resource=self.cluster_resource,
+                resource_type=self.node_resource_type,
+                is_available=True,
+            ) if r.name not in node_names
+        ]
+        if not retired:
+            return retired
+        now = timezone.now()
+        service_ends = {
+            a.resource_id: a for a in ResourceAttribute.objects.filter(
+                resource__in=retired, resource_attribute_type=self.service_end_attribute_type,
+            ).order_by('-pk')
+        }
+        creates, updates = [], []
+        for resource in retired:
+            logger.info("Node resource %s no longer exists in Slurm cluster %s; marking unavailable.",
+                resource.name, self.cluster_name
+            )
+            resource.is_available = False
+            service_end = service_ends.get(resource.pk)
+            if service_end is None:
+                creates.append(ResourceAttribute(
+                    resource=resource, value=now,
+                    resource_attribute_type=self.service_end_attribute_type,
+                ))
+            else:
+                service_end.value = now
+                updates.append(service_end)
+        bulk_update_with_history(
+            retired, Resource, ['is_available'], batch_size=500, default_change_reason=CHANGE_REASON
         )
-        # owner sometimes needs to be set manually, so we don't update it if it exists
-        node_resource.resourceattribute_set.get_or_create(
-            resource_attribute_type=self.owner_attribute_type,
-            defaults={'value': node_data.get('owner', 'unknown')}
+        bulk_create_with_history(
+            creates, ResourceAttribute, batch_size=500, default_change_reason=CHANGE_REASON
         )
-        if created:
-            logger.info("Created new node resource: %s", node_resource.name)
-        else:
-            if node_resource.parent_resource != self.cluster_resource:
-                logger.info("changing parent_resource of %s from %s to %s",
-                    node_resource.name, node_resource.parent_resource, self.cluster_resource)
-                node_resource.parent_resource = self.cluster_resource
-                node_resource.is_available = True
-                node_resource.save()
-        return node_resource
+        bulk_update_with_history(
+            updates, ResourceAttribute, ['value'], batch_size=500,
+            default_change_reason=CHANGE_REASON,
+        )
+        return retired
 
 
     ### Allocation import methods ###
@@ -0,0 +1,274 @@
+"""Time slurmrest_sync's reconciliation against a fake slurmrestd.
+
+Seeds the requested number of projects and users inside a transaction that is
+rolled back at the end, builds matching get_accounts and get_shares payloads
+with the requested number of user associations, then times:
+- the first sync, which creates every allocation, allocation user and attribute;
+- a sync with nothing to change;
+- a sync after the usage of a tenth of the shares changed;
+- with --legacy, the per-association loop slurmrest_sync ran before, on the
+  same unchanged data. It issues several queries per association and takes
+  minutes at the default sizes.
+"""
+import random
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from coldfront.core.allocation.models import (
+    AllocationAttributeType,
+    AllocationStatusChoice,
+    AllocationUserAttributeType,
+    AllocationUserStatusChoice,
+    AttributeType as AllocationAttributeDataType,
+)
+from coldfront.core.field_of_science.models import FieldOfScience
+from coldfront.core.project.models import Project, ProjectStatusChoice
+from coldfront.core.resource.models import (
+    AttributeType,
+    Resource,
+    ResourceAttributeType,
+    ResourceType,
+)
+from coldfront.plugins.slurmrest.associations import (
+    SLURMREST_SPECS_ATTRIBUTE_NAME,
+    ClusterResourceManager,
+)
+from coldfront.plugins.slurmrest.management.commands.slurmrest_sync import (
+    ACCOUNT_ATTRIBUTE_NAMES,
+    SHARE_ATTRIBUTE_NAMES,
+    Command as SyncCommand,
+)
+from coldfront.plugins.slurmrest.utils import calculate_fairshare_factor
+
+
+class Rollback(Exception):
+    """Raised to discard the synthetic data."""
+
+
+def number(value):
+    return {'set': True, 'infinite': False, 'number': value}
+
+
+def share_entry(name, parent, usage):
+    return {
+        'name': name,
+        'parent': parent,
+        'shares': number(100),
+        'shares_normalized': number(0.001),
+        'usage': usage,
+        'effective_usage': number(usage / 1e9),
+        'fairshare': {'factor': number(0.5), 'level': number(1)},
+    }
+
+
+class FakeSlurmApi:
+    """Stands in for SlurmApiConnection, serving synthetic accounts and shares."""
+
+    def __init__(self, accounts, usernames, associations):
+        self.accounts = []
+        self.shares = [share_entry('root', '', 0)]
+        users_per_account = max(associations // accounts, 1)
+        for a in range(accounts):
+            account_name = f'bench-lab-{a}'
+            account_users = [
+                usernames[(a * users_per_account + u) % len(usernames)]
+                for u in range(users_per_account)
+            ]
+            self.accounts.append({
+                'name': account_name,
+                'associations': [{'account': account_name, 'user': ''}] + [
+                    {'account': account_name, 'user': user_name} for user_name in account_users
+                ],
+            })
+            self.shares.append(share_entry(account_name, 'root', a * 1000))
+            self.shares.extend(
+                share_entry(user_name, account_name, u * 100)
+                for u, user_name in enumerate(account_users)
+            )
+
+    def get_accounts(self):
+        return {'accounts': self.accounts}
+
+    def get_shares(self):
+        return {'shares': {'shares': self.shares}}
+
+
+def legacy_sync(cluster_manager, noop=False):
+    """The per-association loop slurmrest_sync ran before it was rebuilt"""
+    from coldfront.plugins.slurmrest.management.commands.slurmrest_sync import (
+        SLURM_IGNORE_ACCOUNTS, SLURM_IGNORE_USERS,
+    )
+    from coldfront.plugins.slurmrest.utils import SlurmError
+
+    allocationuser_active_status = AllocationUserStatusChoice.objects.get(name="Active")
+    allocationuser_inactive_status = AllocationUserStatusChoice.objects.get(name="Removed")
+    aattr_types = {name: AllocationAttributeType.objects.get(name=name) for name in SHARE_ATTRIBUTE_NAMES}
+    auattr_types = {name: AllocationUserAttributeType.objects.get(name=name) for name in SHARE_ATTRIBUTE_NAMES}
+    shares = cluster_manager.slurm_api.get_shares()
+    share_list = [
+        share for share in shares['shares']['shares']
+        if share['name'] not in SLURM_IGNORE_ACCOUNTS + SLURM_IGNORE_USERS
+    ]
+    for account in cluster_manager.accounts:
+        try:
+            allocation = cluster_manager.create_update_account_allocation(account)
+        except SlurmError:
+            continue
+        group_share = next(share for share in share_list if share['name'] == account['name'])
+        normshares = group_share['shares_normalized']['number']
+        effective_usage = group_share['effective_usage']['number']
+        spec_values = {
+            'RawShares': group_share['shares']['number'],
+            'NormShares': round(normshares, 6),
+            'RawUsage': group_share['usage'],
+            'FairShare': round(group_share['fairshare']['factor']['number'], 6),
+            'EffectvUsage': round(effective_usage, 6),
+        }
+        for name, value in spec_values.items():
+            allocation.allocationattribute_set.update_or_create(
+                allocation_attribute_type=aattr_types[name], defaults={'value': value}
+            )
+        account_users = [
+            assoc['user'] for assoc in account['associations']
+            if assoc['user'] not in SLURM_IGNORE_USERS
+        ]
+        allocation_users = allocation.allocationuser_set.all().values_list('user__username', flat=True)
+        user_shares = [share for share in share_list if share['parent'] == account['name']]
+        for user_name in allocation_users:
+            if user_name not in account_users and not noop:
+                alloc_user = allocation.allocationuser_set.get(user__username=user_name)
+                alloc_user.status = allocationuser_inactive_status
+                alloc_user.save()
+        for user_name in account_users:
+            try:
+                user = get_user_model().objects.get(username=user_name)
+            except get_user_model().DoesNotExist:
+                continue
+            if not noop:
+                allocation.allocationuser_set.update_or_create(
+                    user=user, defaults={'status': allocationuser_active_status, 'unit': 'CPU Hours'}
+                )
+            alloc_user = allocation.allocationuser_set.get(user__username=user_name)
+            user_share = next((share for share in user_shares if share['name'] == user_name), None)
+            if not user_share:
+                continue
+            normshares = user_share['shares_normalized']['number']
+            effective_usage = user_share['effective_usage']['number']
+            spec_values = {
+                'RawShares': user_share['shares']['number'],
+                'NormShares': round(normshares, 6),
+                'RawUsage': user_share['usage'],
+                'FairShare': round(calculate_fairshare_factor(normshares, effective_usage), 6),
+                'EffectvUsage': round(effective_usage, 6),
+            }
+            for name, value in spec_values.items():
+                alloc_user.allocationuserattribute_set.update_or_create(
+                    allocationuser_attribute_type=auattr_types[name], defaults={'value': value}
+                )
+
+
+class Command(BaseCommand):
+    help = 'Benchmark slurmrest_sync on a fake slurmrestd with many accounts and associations'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--accounts', type=int, default=5000,
+            help='number of synthetic accounts')
+        parser.add_argument('--associations', type=int, default=60000,
+            help='number of user associations, spread evenly over the accounts')
+        parser.add_argument('--users', type=int, default=20000,
+            help='number of distinct users in the associations')
+        parser.add_argument('--legacy', action='store_true', default=False,
+            help='also time the previous per-association sync')
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                manager = self.seed(options)
+                self.run(manager, options)
+                raise Rollback
+        except Rollback:
+            self.stdout.write('synthetic data rolled back')
+
+    def timed(self, label, func):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        summary = f' ({result.format_summary() or "no changes"})' if result is not None else ''
+        self.stdout.write(f'{label:>20}: {elapsed:8.2f}s{summary}')
+        return elapsed
+
+    def seed(self, options):
+        start = time.perf_counter()
+        text_type = AttributeType.objects.get_or_create(name='Text')[0]
+        for name in ('Owner', 'Features', 'GPU Count', 'Core Count', 'ServiceEnd',
+                     SLURMREST_SPECS_ATTRIBUTE_NAME, 'slurm_cluster'):
+            ResourceAttributeType.objects.get_or_create(name=name, defaults={'attribute_type': text_type})
+        for name in ('Cluster', 'Cluster Partition', 'Compute Node'):
+            ResourceType.objects.get_or_create(name=name)
+        allocation_text_type = AllocationAttributeDataType.objects.get_or_create(name='Text')[0]
+        for name in SHARE_ATTRIBUTE_NAMES + ACCOUNT_ATTRIBUTE_NAMES:
+            AllocationAttributeType.objects.get_or_create(name=name, defaults={
+                'attribute_type': allocation_text_type,
+                'has_usage': name == 'Core Usage (Hours)',
+            })
+        for name in SHARE_ATTRIBUTE_NAMES:
+            AllocationUserAttributeType.objects.get_or_create(
+                name=name, defaults={'attribute_type': allocation_text_type}
+            )
+        AllocationStatusChoice.objects.get_or_create(name='Active')
+        for name in ('Active', 'Removed'):
+            AllocationUserStatusChoice.objects.get_or_create(name=name)
+        FieldOfScience.objects.get_or_create(
+            pk=FieldOfScience.DEFAULT_PK, defaults={'description': 'Other'}
+        )
+
+        cluster = Resource.objects.create(
+            name='bench-cluster', resource_type=ResourceType.objects.get(name='Cluster'),
+            description='benchmark cluster',
+        )
+        cluster.resourceattribute_set.create(
+            resource_attribute_type=ResourceAttributeType.objects.get(name='slurm_cluster'),
+            value='bench',
+        )
+
+        n_accounts, n_users = options['accounts'], options['users']
+        get_user_model().objects.bulk_create([
+            get_user_model()(username=f'bench-user-{i}') for i in range(n_users)
+        ], batch_size=5000)
+        users = list(
+            get_user_model().objects.filter(username__startswith='bench-user-').order_by('pk')
+        )
+        project_status = ProjectStatusChoice.objects.get_or_create(name='Active')[0]
+        Project.objects.bulk_create([
+            Project(
+                title=f'bench-lab-{i}', pi=users[i % n_users], status=project_status,
+                description='benchmark project',
+            )
+            for i in range(n_accounts)
+        ], batch_size=5000)
+
+        api = FakeSlurmApi(n_accounts, [u.username for u in users], options['associations'])
+        manager = ClusterResourceManager('bench', slurm_api=api)
+        self.stdout.write(
+            f'seeded {n_accounts} accounts, {n_users} users and '
+            f'{sum(len(a["associations"]) - 1 for a in api.accounts)} associations '
+            f'in {time.perf_counter() - start:.1f}s'
+        )
+        return manager
+
+    def run(self, manager, options):
+        sync = SyncCommand()
+        self.timed('first sync', lambda: sync.sync_cluster(manager))
+        unchanged = self.timed('unchanged sync', lambda: sync.sync_cluster(manager))
+        shares = manager.slurm_api.shares
+        for share in random.Random(0).sample(shares, len(shares) // 10):
+            share['usage'] += 1000
+        self.timed('10% usage changed', lambda: sync.sync_cluster(manager))
+        if options['legacy']:
+            legacy = self.timed('legacy, unchanged', lambda: legacy_sync(manager))
+            self.stdout.write(self.style.SUCCESS(
+                f'unchanged sync speedup: {legacy / max(unchanged, 1e-9):.1f}x'
+            ))
@@ -1,20 +1,34 @@
 """Command to sync ColdFront cluster allocation data with Slurm cluster data via Slurm REST API."""
 
 import logging
+from collections import Counter, defaultdict
 
 from django.contrib.auth import get_user_model
 from django.core.management.base import BaseCommand
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Prefetch, Q
+from simple_history.utils import bulk_create_with_history, bulk_update_with_history
 
 from coldfront.core.allocation.models import (
-    AllocationUserAttributeType,
+    Allocation,
+    AllocationAttribute,
     AllocationAttributeType,
+    AllocationAttributeUsage,
     AllocationStatusChoice,
-    AllocationUserStatusChoice
+    AllocationUser,
+    AllocationUserAttribute,
+    AllocationUserAttributeType,
+    AllocationUserStatusChoice,
+    schedule_summary_refresh,
 )
+from coldfront.core.project.models import Project
 from coldfront.core.resource.models import Resource
 from coldfront.core.utils.common import import_from_settings
-from coldfront.plugins.slurmrest.utils import SlurmError, calculate_fairshare_factor
+from coldfront.plugins.slurmrest.utils import (
+    SlurmError,
+    calculate_fairshare_factor,
+    index_shares,
+)
 from coldfront.plugins.slurmrest.associations import ClusterResourceManager
 
 SLURMREST_CLUSTER_ATTRIBUTE_NAME = import_from_settings('SLURMREST_CLUSTER_ATTRIBUTE_NAME', 'slurm_cluster')
@@ -24,18 +38,392 @@ SLURM_IGNORE_CLUSTERS = import_from_settings('SLURMREST_IGNORE_CLUSTERS', [])
 NOOP = import_from_settings('SLURMREST_NOOP', False)
 SLURM_SPECS_ATTRIBUTE_NAME = import_from_settings('SLURMREST_SPECS_ATTRIBUTE_NAME', 'slurm_specs')
 
+SHARE_ATTRIBUTE_NAMES = ['RawShares', 'NormShares', 'RawUsage', 'FairShare', 'EffectvUsage']
+ACCOUNT_ATTRIBUTE_NAMES = ['slurm_account_name', 'Cloud Account Name', 'Core Usage (Hours)']
+CHANGE_REASON = 'slurmrest_sync command'
+
 logger = logging.getLogger(__name__)
 
+
+def account_share_values(share, calculate_fairshare=False):
+    """Return the allocation attribute values of an account's share entry."""
+    normshares = share['shares_normalized']['number']
+    effective_usage = share['effective_usage']['number']
+    if calculate_fairshare:
+        fairshare_factor = calculate_fairshare_factor(normshares, effective_usage)
+    else:
+        fairshare_factor = share['fairshare']['factor']['number']
+    return {
+        'RawShares': share['shares']['number'],
+        'NormShares': round(normshares, 6),
+        'RawUsage': share['usage'],
+        'FairShare': round(fairshare_factor, 6),
+        'EffectvUsage': round(effective_usage, 6),
+    }
+
+
+def user_share_values(share):
+    """Return the allocation user attribute values of a user's share entry."""
+    normshares = share['shares_normalized']['number']
+    effective_usage = share['effective_usage']['number']
+    rawshares = share['shares']['number']
+    if rawshares > 200000:
+        rawshares = 'parent'
+    return {
+        'RawShares': rawshares,
+        'NormShares': round(normshares, 6),
+        'RawUsage': share['usage'],
+        'FairShare': round(calculate_fairshare_factor(normshares, effective_usage), 6),
+        'EffectvUsage': round(effective_usage, 6),
+    }
+
+
+class ClusterChanges:
+    """Pending writes for one cluster, collected before anything is saved.
+
+    Attributes:
+        new_allocations (list[Allocation]): unsaved allocations for accounts with none on the cluster
+        attribute_creates (list[AllocationAttribute]): unsaved allocation attributes
+        attribute_updates (list[AllocationAttribute]): allocation attributes whose value changed
+        allocationuser_creates (list[AllocationUser]): unsaved allocation users
+        allocationuser_updates (list[AllocationUser]): allocation users whose status or unit changed
+        userattribute_creates (list[AllocationUserAttribute]): unsaved allocation user attributes
+        userattribute_updates (list[AllocationUserAttribute]): allocation user attributes whose value changed
+        summary (Counter): number of changes of each kind
+    """
+
+    def __init__(self):
+        self.new_allocations = []
+        self.attribute_creates = []
+        self.attribute_updates = []
+        self.allocationuser_creates = []
+        self.allocationuser_updates = []
+        self.userattribute_creates = []
+        self.userattribute_updates = []
+        self.summary = Counter()
+
+    def __bool__(self):
+        return any(self.summary.values())
+
+    def format_summary(self):
+        return ', '.join(f'{key}: {count}' for key, count in sorted(self.summary.items()) if count)
+
+
 class Command(BaseCommand):
     help = '''Sync ColdFront cluster allocation data with Slurm cluster data via Slurm REST API.
     '''
     noop = NOOP
 
     def add_arguments(self, parser):
-        parser.add_argument('-n', '--noop',
-            help='No operation mode: do not make any changes')
+        parser.add_argument('-n', '--noop', action='store_true',
+            help='No operation mode: do not add or remove allocation users')
         parser.add_argument('-c', '--cluster',
                             help='select a specific cluster to check')
+        parser.add_argument('--full-resync', action='store_true',
+                            help='import every node and partition, not only those changed since the last sync')
+
+    def diff_cluster(self, cluster_manager, share_list):
+        """Compare the accounts, associations and shares of a Slurm cluster
+        with the allocations stored for its resource, loaded in bulk, and
+        collect the writes needed to bring them in line.
+        """
+        changes = ClusterChanges()
+        cluster = cluster_manager.cluster_resource
+        allocation_active_status = AllocationStatusChoice.objects.get(name='Active')
+        allocationuser_active_status = AllocationUserStatusChoice.objects.get(name="Active")
+        allocationuser_inactive_status = AllocationUserStatusChoice.objects.get(name="Removed")
+        attribute_types = {
+            attr_type.name: attr_type for attr_type in AllocationAttributeType.objects.filter(
+                name__in=SHARE_ATTRIBUTE_NAMES + ACCOUNT_ATTRIBUTE_NAMES
+            )
+        }
+        user_attribute_types = {
+            attr_type.name: attr_type for attr_type in AllocationUserAttributeType.objects.filter(
+                name__in=SHARE_ATTRIBUTE_NAMES
+            )
+        }
+        attribute_type_names = {attr_type.pk: name for name, attr_type in attribute_types.items()}
+        user_attribute_type_names = {
+            attr_type.pk: name for name, attr_type in user_attribute_types.items()
+        }
+
+        account_shares, user_shares = index_shares(share_list)
+        calculate_fairshare = False
+        if not [s for s in share_list if s['fairshare']['factor']['number'] != 0]:
+            logger.warning("No valid fairshare values found for cluster %s, skipping update", cluster.name)
+            calculate_fairshare = True
+
+        accounts = cluster_manager.accounts
+        account_users = {
+            account['name']: [
+                assoc['user'] for assoc in account['associations']
+                if assoc['user'] and assoc['user'] not in SLURM_IGNORE_USERS
+            ]
+            for account in accounts
+        }
+        projects = {
+            project.title: project
+            for project in Project.objects.filter(title__in=list(account_users))
+        }
+        users = {
+            user.username: user for user in get_user_model().objects.filter(
+                username__in=list({u for names in account_users.values() for u in names})
+            )
+        }
+        allocations_by_project = defaultdict(list)
+        for allocation in Allocation.objects.filter(
+            resources=cluster, project_id__in=[project.pk for project in projects.values()]
+        ).prefetch_related(
+            # to_attr, so the filtered lists don't stand in for the attribute snapshots
+            Prefetch(
+                'allocationattribute_set',
+                queryset=AllocationAttribute.objects.filter(
+                    allocation_attribute_type__in=list(attribute_types.values())
+                ).order_by('pk'),
+                to_attr='sync_attributes',
+            ),
+            Prefetch(
+                'allocationuser_set',
+                queryset=AllocationUser.objects.select_related('user').prefetch_related(
+                    Prefetch(
+                        'allocationuserattribute_set',
+                        queryset=AllocationUserAttribute.objects.filter(
+                            allocationuser_attribute_type__in=list(user_attribute_types.values())
+                        ).order_by('pk'),
+                        to_attr='sync_attributes',
+                    )
+                ),
+                to_attr='sync_allocationusers',
+            ),
+        ):
+            allocations_by_project[allocation.project_id].append(allocation)
+
+        def set_attribute(allocation, existing, attr_type_name, value, overwrite=True):
+            value = str(value)
+            attribute = existing.get(attr_type_name)
+            if attribute is None:
+                changes.attribute_creates.append(AllocationAttribute(
+                    allocation=allocation,
+                    allocation_attribute_type=attribute_types[attr_type_name],
+                    value=value,
+                ))
+                changes.summary['allocation attributes created'] += 1
+            elif overwrite and attribute.value != value:
+                attribute.value = value
+                changes.attribute_updates.append(attribute)
+                changes.summary['allocation attributes updated'] += 1
+
+        def set_user_attribute(allocationuser, existing, attr_type_name, value):
+            value = str(value)
+            attribute = existing.get(attr_type_name)
+            if attribute is None:
+                changes.userattribute_creates.append(AllocationUserAttribute(
+                    allocationuser=allocationuser,
+                    allocationuser_attribute_type=user_attribute_types[attr_type_name],
+                    value=value,
+                ))
+                changes.summary['allocation user attributes created'] += 1
+            elif attribute.value != value:
+                attribute.value = value
+                changes.userattribute_updates.append(attribute)
+                changes.summary['allocation user attributes updated'] += 1
+
+        for account in accounts:
+            account_name = account['name']
+            project = projects.get(account_name)
+            if project is None:
+                logger.error(
+                    "Failed to create/update ColdFront allocation for account %s on cluster %s: %s",
+                    account_name, cluster.name,
+                    f"Unable to find Project for cluster {cluster_manager.cluster_name} account {account_name}",
+                )
+                continue
+            project_allocations = allocations_by_project.get(project.pk, [])
+            if len(project_allocations) > 1:
+                logger.error(
+                    "multiple cluster allocations returned for project %s resource %s: %s",
+                    project.title, cluster.name, project_allocations
+                )
+                continue
+            if not project_allocations:
+                allocation = Allocation(project=project, status=allocation_active_status)
+                changes.new_allocations.append(allocation)
+                changes.summary['allocations created'] += 1
+                existing_attributes = {}
+                existing_allocationusers = {}
+            else:
+                allocation = project_allocations[0]
+                existing_attributes = {}
+                for attribute in allocation.sync_attributes:
+                    existing_attributes.setdefault(
+                        attribute_type_names[attribute.allocation_attribute_type_id], attribute
+                    )
+                existing_allocationusers = {
+                    allocationuser.user.username: allocationuser
+                    for allocationuser in allocation.sync_allocationusers
+                }
+
+            # Add account-related attributes to the allocation
+            set_attribute(allocation, existing_attributes, 'slurm_account_name', account_name, overwrite=False)
+            set_attribute(allocation, existing_attributes, 'Cloud Account Name', account_name, overwrite=False)
+            set_attribute(allocation, existing_attributes, 'Core Usage (Hours)', 0, overwrite=False)
+
+            # add/update slurm specs
+            group_share = account_shares.get(account_name)
+            if group_share is None:
+                logger.warning(
+                    "No share data found for account %s on cluster %s", account_name, cluster.name
+                )
+            else:
+                for attr_type_name, value in account_share_values(
+                    group_share, calculate_fairshare
+                ).items():
+                    set_attribute(allocation, existing_attributes, attr_type_name, value)
+
+            # update allocation users according to the account's associations
+            slurm_users = set(account_users[account_name])
+            for user_name, allocationuser in existing_allocationusers.items():
+                if (
+                    user_name not in slurm_users
+                    and allocationuser.status_id != allocationuser_inactive_status.pk
+                ):
+                    if not self.noop:
+                        allocationuser.status = allocationuser_inactive_status
+                        changes.allocationuser_updates.append(allocationuser)
+                        changes.summary['allocation users removed'] += 1
+                    logger.info(
+                        "Set status to Removed for user %s in %s allocation for project %s",
+                        user_name, cluster.name, account_name
+                    )
+            for user_name in account_users[account_name]:
+                user = users.get(user_name)
+                if user is None:
+                    logger.error(
+                        "User %s not found in ColdFront, cannot add to %s allocation for project %s",
+                        user_name, cluster.name, account_name
+                    )
+                    continue
+                allocationuser = existing_allocationusers.get(user_name)
+                existing_user_attributes = {}
+                if allocationuser is None:
+                    if self.noop:
+                        continue
+                    allocationuser = AllocationUser(
+                        allocation=allocation, user=user,
+                        status=allocationuser_active_status, unit='CPU Hours',
+                    )
+                    existing_allocationusers[user_name] = allocationuser
+                    changes.allocationuser_creates.append(allocationuser)
+                    changes.summary['allocation users created'] += 1
+                    logger.info(
+                        "Added user %s to %s allocation for project %s",
+                        user_name, cluster.name, account_name
+                    )
+                else:
+                    if not self.noop and (
+                        allocationuser.status_id != allocationuser_active_status.pk
+                        or allocationuser.unit != 'CPU Hours'
+                    ):
+                        allocationuser.status = allocationuser_active_status
+                        allocationuser.unit = 'CPU Hours'
+                        changes.allocationuser_updates.append(allocationuser)
+                        changes.summary['allocation users updated'] += 1
+                    for attribute in allocationuser.sync_attributes:
+                        existing_user_attributes.setdefault(
+                            user_attribute_type_names[attribute.allocationuser_attribute_type_id],
+                            attribute,
+                        )
+
+                user_share = user_shares.get((account_name, user_name))
+                if not user_share:
+                    logger.warning(
+                        "No share data found for user %s in account %s on cluster %s",
+                        user_name, account_name, cluster.name
+                    )
+                    continue
+                for attr_type_name, value in user_share_values(user_share).items():
+                    set_user_attribute(
+                        allocationuser, existing_user_attributes, attr_type_name, value
+                    )
+        return changes
+
+    def apply_changes(self, changes, resource):
+        """Save a ClusterChanges with bulk queries in a single transaction."""
+        with transaction.atomic():
+            # new allocations need their pks before anything can point at them
+            for allocation in changes.new_allocations:
+                allocation.save()
+                allocation.resources.add(resource)
+                logger.info("Created new allocation entry for project %s with resource %s: %s",
+                    allocation.project.title, resource.name, allocation.pk
+                )
+            if changes.attribute_updates:
+                bulk_update_with_history(
+                    changes.attribute_updates, AllocationAttribute, ['value'],
+                    batch_size=500, default_change_reason=CHANGE_REASON,
+                )
+            if changes.attribute_creates:
+                created_attributes = bulk_create_with_history(
+                    changes.attribute_creates, AllocationAttribute,
+                    batch_size=500, default_change_reason=CHANGE_REASON,
+                )
+                # AllocationAttribute.save() is bypassed, so create the usages it would have
+                usage_type_ids = set(AllocationAttributeType.objects.filter(
+                    has_usage=True
+                ).values_list('pk', flat=True))
+                usages = [
+                    AllocationAttributeUsage(allocation_attribute=attribute)
+                    for attribute in created_attributes
+                    if attribute.allocation_attribute_type_id in usage_type_ids
+                ]
+                if usages:
+                    bulk_create_with_history(
+                        usages, AllocationAttributeUsage,
+                        batch_size=500, default_change_reason=CHANGE_REASON,
+                    )
+            if changes.allocationuser_updates:
+                bulk_update_with_history(
+                    changes.allocationuser_updates, AllocationUser, ['status', 'unit'],
+                    batch_size=500, default_change_reason=CHANGE_REASON,
+                )
+            if changes.allocationuser_creates:
+                created_allocationusers = bulk_create_with_history(
+                    changes.allocationuser_creates, AllocationUser,
+                    batch_size=500, default_change_reason=CHANGE_REASON,
+                )
+                # backends that can't return pks from bulk_create get them from the history helper
+                pks = {(au.allocation_id, au.user_id): au.pk for au in created_allocationusers}
+                for allocationuser in changes.allocationuser_creates:
+                    allocationuser.pk = pks[(allocationuser.allocation_id, allocationuser.user_id)]
+            if changes.userattribute_updates:
+                bulk_update_with_history(
+                    changes.userattribute_updates, AllocationUserAttribute, ['value'],
+                    batch_size=500, default_change_reason=CHANGE_REASON,
+                )
+            if changes.userattribute_creates:
+                bulk_create_with_history(
+                    changes.userattribute_creates, AllocationUserAttribute,
+                    batch_size=500, default_change_reason=CHANGE_REASON,
+                )
+            # the bulk writes send no signals
+            schedule_summary_refresh(
+                attribute.allocation_id
+                for attribute in changes.attribute_creates + changes.attribute_updates
+            )
+
+    def sync_cluster(self, cluster_manager):
+        """Reconcile the allocations of a cluster with its Slurm accounts,
+        associations and shares. Returns the ClusterChanges made.
+        """
+        shares = cluster_manager.slurm_api.get_shares()
+        share_list = [
+            share for share in shares['shares']['shares']
+            if share['name'] not in SLURM_IGNORE_ACCOUNTS + SLURM_IGNORE_USERS
+        ]
+        changes = self.diff_cluster(cluster_manager, share_list)
+        if changes:
+            self.apply_changes(changes, cluster_manager.cluster_resource)
+        return changes
 
     def handle(self, *args, **options):
         if options.get('noop'):
@@ -53,161 +441,21 @@ class Command(BaseCommand):
         if not clusters:
             logger.info("No clusters found to sync")
             return
-        # Process each cluster
-        allocationuser_active_status = AllocationUserStatusChoice.objects.get(name="Active")
-        allocationuser_inactive_status = AllocationUserStatusChoice.objects.get(name="Removed")
-        allocation_inactive_status = AllocationStatusChoice.objects.get(name='Inactive')
-
-        fairshare_aattr_type = AllocationAttributeType.objects.get(name='FairShare')
-        rawshares_aattr_type = AllocationAttributeType.objects.get(name='RawShares')
-        normshares_aattr_type = AllocationAttributeType.objects.get(name='NormShares')
-        rawusage_aattr_type = AllocationAttributeType.objects.get(name='RawUsage')
-        effectvusage_aattr_type = AllocationAttributeType.objects.get(name='EffectvUsage')
-
-        fairshare_auattr_type = AllocationUserAttributeType.objects.get(name='FairShare')
-        rawshares_auattr_type = AllocationUserAttributeType.objects.get(name='RawShares')
-        normshares_auattr_type = AllocationUserAttributeType.objects.get(name='NormShares')
-        rawusage_auattr_type = AllocationUserAttributeType.objects.get(name='RawUsage')
-        effectvusage_auattr_type = AllocationUserAttributeType.objects.get(name='EffectvUsage')
 
         for cluster in clusters:
             cluster_name = cluster.get_attribute(SLURMREST_CLUSTER_ATTRIBUTE_NAME)
             logger.info("Processing cluster %s (%s)", cluster.name, cluster_name)
             try:
                 cluster_manager = ClusterResourceManager(cluster_name)
-                slurm_cluster = cluster_manager.slurm_api
             except SlurmError as e:
                 logger.error("Failed to get Slurm data for cluster %s: %s", cluster.name, e)
                 continue
-            # get cluster data:
-            # shares
-            shares = slurm_cluster.get_shares()
-            share_list = [
-                share for share in shares['shares']['shares']
-                if share['name'] not in SLURM_IGNORE_ACCOUNTS + SLURM_IGNORE_USERS
-            ]
-            calculate_fairshare = False
-            if not [s for s in share_list if s['fairshare']['factor']['number'] != 0]:
-                logger.warning("No valid fairshare values found for cluster %s, skipping update", cluster.name)
-                calculate_fairshare = True
-            # accounts/associations
-            account_dicts = cluster_manager.accounts
-            # for each account:
-            for account in account_dicts:
-                try:
-                    allocation = cluster_manager.create_update_account_allocation(account)
-                except SlurmError as e:
-                    print(e)
-                    logger.error(
-                        "Failed to create/update ColdFront allocation for account %s on cluster %s: %s",
-                        account['name'], cluster.name, e
-                    )
-                    continue
-
-                # add/update slurm specs
-                group_share = next(
-                    share for share in share_list if share['name'] == account['name']
-                )
-                normshares = group_share['shares_normalized']['number']
-                effective_usage = group_share['effective_usage']['number']
-                if calculate_fairshare:
-                    fairshare_factor = calculate_fairshare_factor(
-                        normshares, effective_usage
-                    )
-                else:
-                    fairshare_factor = group_share['fairshare']['factor']['number']
-                spec_mapping = [
-                    {'attrtype': rawshares_aattr_type, 'value': group_share['shares']['number']},
-                    {'attrtype': normshares_aattr_type, 'value': round(normshares, 6)},
-                    {'attrtype': rawusage_aattr_type, 'value': group_share['usage']},
-                    {'attrtype': fairshare_aattr_type, 'value': round(fairshare_factor, 6)},
-                    {'attrtype': effectvusage_aattr_type, 'value': round(effective_usage, 6)},
-                        ]
-
-                for spec_pair in spec_mapping:
-                    alloc_attr, created = allocation.allocationattribute_set.update_or_create(
-                        allocation_attribute_type=spec_pair['attrtype'],
-                        defaults={'value': spec_pair['value']}
-                    )
-
-                # make list of users and update according allocation
-                account_users = [
-                    assoc['user'] for assoc in account['associations']
-                    if assoc['user'] not in SLURM_IGNORE_USERS
-                ]
-                allocation_users = allocation.allocationuser_set.all().values_list(
-                    'user__username', flat=True
-                )
-                # add missing users
-                user_shares = [
-                    share for share in share_list if share['parent'] == account['name']
-                ]
-                for user_name in allocation_users:
-                    if user_name not in account_users:
-                        if not self.noop:
-                            alloc_user = allocation.allocationuser_set.get(
-                                user__username=user_name
-                            )
-                            alloc_user.status = allocationuser_inactive_status
-                            alloc_user.save()
-                        logger.info(
-                            "Set status to Removed for user %s in %s allocation for project %s",
-                            user_name, cluster.name, account['name']
-                        )
-                for user_name in account_users:
-                    try:
-                        user = get_user_model().objects.get(username=user_name)
-                    except get_user_model().DoesNotExist:
-                        logger.error(
-                            "User %s not found in ColdFront, cannot add to %s allocation for project %s",
-                            user_name, cluster.name, account['name']
-                        )
-                        continue
-                    if not self.noop:
-                        alloc_user, created = allocation.allocationuser_set.update_or_create(
-                            user=user, defaults={
-                                'status': allocationuser_active_status,
-                                'unit': 'CPU Hours'
-                            }
-                        )
-                        if created:
-                            logger.info(
-                                "Added user %s to %s allocation for project %s",
-                                user_name, cluster.name, account['name']
-                            )
-
-                    alloc_user = allocation.allocationuser_set.get(user__username=user_name)
-                    user_share = next(
-                        (share for share in user_shares if share['name'] == user_name), None
-                    )
-                    if not user_share:
-                        logger.warning(
-                            "No share data found for user %s in account %s on cluster %s",
-                            user_name, account['name'], cluster.name
-                        )
-                        continue
-                    normshares = user_share['shares_normalized']['number']
-                    effective_usage = user_share['effective_usage']['number']
-                    rawshares = user_share['shares']['number']
-                    if rawshares > 200000:
-                        rawshares = 'parent'
-                    user_fairshare_factor = calculate_fairshare_factor(
-                        normshares, effective_usage
-                    )
-                    spec_mapping = [
-                        {'attrtype': rawshares_auattr_type, 'value': rawshares},
-                        {'attrtype': normshares_auattr_type, 'value': round(normshares, 6)},
-                        {'attrtype': rawusage_auattr_type, 'value': user_share['usage']},
-                        {'attrtype': fairshare_auattr_type, 'value': round(user_fairshare_factor, 6)},
-                        {'attrtype': effectvusage_auattr_type, 'value': round(effective_usage, 6)},
-                    ]
-                    for spec_pair in spec_mapping:
-                        alloc_user.allocationuserattribute_set.update_or_create(
-                            allocationuser_attribute_type=spec_pair['attrtype'],
-                            defaults={'value': spec_pair['value']}
-                        )
+            changes = self.sync_cluster(cluster_manager)
+            summary = changes.format_summary() or 'no changes'
+            logger.info("%s: made %s", cluster.name, summary)
+            self.stdout.write(f'{cluster.name}: made {summary}')
 
             # partitions
-            cluster_manager.import_partition_data()
+            cluster_manager.import_partition_data(full=options['full_resync'])
             # nodes
-            cluster_manager.import_node_data()
+            cluster_manager.import_node_data(full=options['full_resync'])
@@ -20,7 +20,7 @@ from coldfront.core.allocation.signals import (
 )
 from coldfront.core.resource.models import Resource
 from coldfront.plugins.slurmrest.utils import (
-    SlurmApiConnection, SlurmError, calculate_fairshare_factor
+    SlurmError, calculate_fairshare_factor, share_snapshots, slurm_api_pool
 )
 
 logger = logging.getLogger(__name__)
@@ -34,8 +34,8 @@ def slurmrest_allocation_user_attribute_edit_handler(sender, **kwargs):
     )
     if not slurm_cluster or slurm_cluster.get_attribute('slurm_integration') != 'API':
         return
-    api = SlurmApiConnection(slurm_cluster.get_attribute('slurm_cluster'))
-    api.post_assoc(kwargs['account'], kwargs['user'], {'shares_raw': int(kwargs['raw_share'])})
+    with slurm_api_pool.connection(slurm_cluster.get_attribute('slurm_cluster')) as api:
+        api.post_assoc(kwargs['account'], kwargs['user'], {'shares_raw': int(kwargs['raw_share'])})
     logger.info("Successfully updated Slurm user %s rawshare to %s for account %s on cluster %s",
         kwargs['user'], kwargs['raw_share'], kwargs['account'], kwargs.get('cluster')
     )
@@ -49,8 +49,8 @@ def slurmrest_allocation_add_user_handler(sender, **kwargs):
     )
     if not slurm_cluster or slurm_cluster.get_attribute('slurm_integration') != 'API':
         return
-    api = SlurmApiConnection(slurm_cluster.get_attribute('slurm_cluster'))
-    api.add_assoc(kwargs['account'], kwargs['username'])
+    with slurm_api_pool.connection(slurm_cluster.get_attribute('slurm_cluster')) as api:
+        api.add_assoc(kwargs['account'], kwargs['username'])
     logger.info("Successfully added Slurm user %s to account %s on cluster %s",
         kwargs['username'], kwargs['account'], kwargs.get('cluster')
     )
@@ -65,8 +65,8 @@ def slurmrest_allocation_user_deactivate_handler(sender, **kwargs):
     )
     if not slurm_cluster or slurm_cluster.get_attribute('slurm_integration') != 'API':
         return
-    api = SlurmApiConnection(slurm_cluster.get_attribute('slurm_cluster'))
-    api.remove_assoc(user_name=kwargs['username'], account_name=kwargs['account'])
+    with slurm_api_pool.connection(slurm_cluster.get_attribute('slurm_cluster')) as api:
+        api.remove_assoc(user_name=kwargs['username'], account_name=kwargs['account'])
     logger.info("Successfully removed Slurm user %s from account %s on cluster %s",
         kwargs['username'], kwargs['account'], kwargs.get('cluster')
     )
@@ -81,8 +81,8 @@ def slurmrest_allocation_raw_share_edit_handler(sender, **kwargs):
     )
     if not slurm_cluster or slurm_cluster.get_attribute('slurm_integration') != 'API':
         return
-    api = SlurmApiConnection(slurm_cluster.get_attribute('slurm_cluster'))
-    api.post_assoc(kwargs['account'], "", {'shares_raw': int(kwargs['raw_share'])})
+    with slurm_api_pool.connection(slurm_cluster.get_attribute('slurm_cluster')) as api:
+        api.post_assoc(kwargs['account'], "", {'shares_raw': int(kwargs['raw_share'])})
     logger.info("Successfully updated Slurm account %s rawshare to %s on cluster %s",
         kwargs['account'], kwargs['raw_share'], kwargs.get('cluster')
     )
@@ -95,14 +95,11 @@ def slurmrest_allocation_activate_user_handler(sender, **kwargs):
     slurm_cluster = allocationuser.allocation.get_parent_resource
     if slurm_cluster.get_attribute('slurm_integration') != 'API':
         return
-    api = SlurmApiConnection(slurm_cluster.get_attribute('slurm_cluster'))
     username = allocationuser.user.username
     project_title = allocationuser.allocation.project.title
 
-    share_data = api.get_shares()
-    user_data = next(
-        (e for e in share_data['shares']['shares']
-        if e['name'] == username and e['parent'] == project_title), None
+    user_data = share_snapshots.get_share(
+        slurm_cluster.get_attribute('slurm_cluster'), project_title, username
     )
     if not user_data:
         raise SlurmError(f"Unable to find Slurm user {username} for account {project_title} on cluster {slurm_cluster.name}")
@@ -116,9 +113,13 @@ def slurmrest_allocation_activate_user_handler(sender, **kwargs):
         'EffectvUsage': effective_usage,
         'FairShare': fairshare,
     }
+    attribute_types = {
+        attr_type.name: attr_type
+        for attr_type in AllocationUserAttributeType.objects.filter(name__in=spec_values)
+    }
     for spec, value in spec_values.items():
         allocationuser.allocationuserattribute_set.update_or_create(
-            allocationuser_attribute_type=AllocationUserAttributeType.objects.get(name=spec),
+            allocationuser_attribute_type=attribute_types[spec],
             defaults={'value': value}
         )
 
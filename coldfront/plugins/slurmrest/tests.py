@@ -0,0 +1,413 @@
+'''tests for the slurmrest plugin'''
+from contextlib import contextmanager
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase
+
+from coldfront.core.allocation.models import (
+    Allocation,
+    AllocationAttribute,
+    AllocationAttributeType,
+    AllocationAttributeUsage,
+    AllocationUser,
+    AllocationUserAttribute,
+)
+from coldfront.core.resource.models import Resource, ResourceAttributeType
+from coldfront.core.test_helpers.factories import (
+    AllocationFactory,
+    RAttributeTypeFactory,
+    ResourceAttributeTypeFactory,
+    setup_models,
+)
+from coldfront.plugins.slurmrest.associations import (
+    SLURMREST_SPECS_ATTRIBUTE_NAME,
+    ClusterResourceManager,
+)
+from coldfront.plugins.slurmrest.management.commands.slurmrest_sync import Command
+from coldfront.plugins.slurmrest.utils import ShareSnapshotCache, index_shares
+
+UTIL_FIXTURES = ['coldfront/core/test_helpers/test_data/test_fixtures/ifx.json']
+
+
+def share(name, parent, usage=0):
+    return {'name': name, 'parent': parent, 'usage': usage}
+
+
+class FakeSharesApi:
+    """Serves a share tree and records the get_shares calls."""
+
+    def __init__(self, shares):
+        self.shares = shares
+        self.calls = []
+
+    def get_shares(self, accounts=None, users=None):
+        self.calls.append(accounts)
+        shares = self.shares
+        if accounts:
+            shares = [s for s in shares if accounts in (s['name'], s['parent'])]
+        return {'shares': {'shares': shares}}
+
+
+def number(value):
+    return {'set': True, 'infinite': False, 'number': value}
+
+
+def node(name, cores=48):
+    return {'name': name, 'features': ['intel', 'holyib'], 'cores': cores, 'gpus': 0, 'owner': 'fasrc'}
+
+
+def partition(name, groups='', accounts=None):
+    accounts_data = {'deny': ''}
+    if accounts:
+        accounts_data['allowed'] = accounts
+    return {
+        'name': name,
+        'tres': {'billing_weights': 'CPU=1.0'},
+        'groups': {'allowed': groups},
+        'accounts': accounts_data,
+    }
+
+
+def account(name, *user_names):
+    return {
+        'name': name,
+        'associations': [{'account': name, 'user': ''}] + [
+            {'account': name, 'user': user_name} for user_name in user_names
+        ],
+    }
+
+
+def share_entry(name, parent, usage=0):
+    return {
+        'name': name,
+        'parent': parent,
+        'shares': number(100),
+        'shares_normalized': number(0.5),
+        'usage': usage,
+        'effective_usage': number(0.25),
+        'fairshare': {'factor': number(0.5), 'level': number(1)},
+    }
+
+
+class FakeClusterApi:
+    """Serves nodes, partitions, accounts and shares like slurmrestd: nodes
+    and partitions come back empty when update_time isn't older than
+    last_update. Records the update_times sent.
+    """
+
+    def __init__(self, nodes=(), partitions=(), accounts=(), shares=()):
+        self.nodes = list(nodes)
+        self.partitions = list(partitions)
+        self.accounts = list(accounts)
+        self.shares = list(shares)
+        self.last_update = 1000
+        self.update_times = []
+
+    def _since(self, items, update_time):
+        self.update_times.append(update_time)
+        if update_time is not None and int(update_time) >= self.last_update:
+            return []
+        return items
+
+    def get_nodes(self, update_time=None, flags=None):
+        return {'nodes': self._since(self.nodes, update_time), 'last_update': number(self.last_update)}
+
+    def get_partitions(self, update_time=None, flags=None):
+        return {
+            'partitions': self._since(self.partitions, update_time),
+            'last_update': number(self.last_update),
+        }
+
+    def get_accounts(self):
+        return {'accounts': self.accounts}
+
+    def get_shares(self, accounts=None, users=None):
+        return {'shares': {'shares': self.shares}}
+
+
+class FakePool:
+
+    def __init__(self, api):
+        self.api = api
+
+    @contextmanager
+    def connection(self, cluster_name):
+        yield self.api
+
+
+class IndexSharesTest(SimpleTestCase):
+
+    def test_first_entry_wins(self):
+        by_name, by_parent = index_shares([
+            share('lab', 'root', 1), share('jdoe', 'lab', 2), share('jdoe', 'other_lab', 3),
+        ])
+        self.assertEqual(by_name['jdoe']['usage'], 2)
+        self.assertEqual(by_parent[('other_lab', 'jdoe')]['usage'], 3)
+
+
+class ShareSnapshotCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        self.api = FakeSharesApi([
+            share('root', ''), share('lab', 'root', 10),
+            share('jdoe', 'lab', 1), share('asmith', 'lab', 2),
+            share('other_lab', 'root', 20), share('jdoe', 'other_lab', 3),
+        ])
+        self.cache = ShareSnapshotCache(ttl=60, pool=FakePool(self.api))
+
+    def test_one_fetch_per_burst(self):
+        self.assertEqual(self.cache.get_share('cluster', 'lab', 'jdoe')['usage'], 1)
+        self.assertEqual(self.cache.get_share('cluster', 'lab', 'asmith')['usage'], 2)
+        self.assertEqual(self.cache.get_share('cluster', 'other_lab', 'jdoe')['usage'], 3)
+        self.assertEqual(self.api.calls, [None])
+
+    def test_miss_refetches_account(self):
+        self.cache.get_share('cluster', 'lab', 'jdoe')
+        # added in Slurm after the snapshot, without a write through the cache
+        self.api.shares.append(share('newuser', 'lab', 4))
+        self.assertEqual(self.cache.get_share('cluster', 'lab', 'newuser')['usage'], 4)
+        self.assertIsNone(self.cache.get_share('cluster', 'lab', 'nobody'))
+        self.assertEqual(self.api.calls, [None, 'lab', 'lab'])
+
+    def test_ttl(self):
+        self.cache.get_share('cluster', 'lab', 'jdoe')
+        with mock.patch('coldfront.plugins.slurmrest.utils.time.monotonic', return_value=1e12):
+            self.cache.get_share('cluster', 'lab', 'jdoe')
+        self.assertEqual(self.api.calls, [None, None])
+
+    def test_invalidate_account(self):
+        self.cache.get_share('cluster', 'lab', 'jdoe')
+        self.api.shares.append(share('newuser', 'lab', 4))
+        self.api.shares = [s for s in self.api.shares if s['name'] != 'asmith']
+        self.cache.invalidate('cluster', 'lab')
+        self.assertEqual(self.cache.get_share('cluster', 'lab', 'newuser')['usage'], 4)
+        self.assertIsNone(self.cache.get_share('cluster', 'lab', 'asmith'))
+        # other accounts are served from the snapshot
+        self.assertEqual(self.cache.get_share('cluster', 'other_lab', 'jdoe')['usage'], 3)
+        # the asmith miss refetched lab once more
+        self.assertEqual(self.api.calls, [None, 'lab', 'lab'])
+
+    def test_invalidate_cluster(self):
+        self.cache.get_share('cluster', 'lab', 'jdoe')
+        self.cache.invalidate('cluster')
+        self.cache.get_share('cluster', 'lab', 'jdoe')
+        self.assertEqual(self.api.calls, [None, None])
+
+
+class SlurmrestTestCase(TestCase):
+    """Sets up a cluster resource and a ClusterResourceManager on a FakeClusterApi"""
+    fixtures = UTIL_FIXTURES
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('add_allocation_defaults')
+        setup_models(cls)
+        for name, attribute_type in (
+            ('Features', 'Text'),
+            ('GPU Count', 'Int'),
+            ('Core Count', 'Int'),
+            (SLURMREST_SPECS_ATTRIBUTE_NAME, 'Attribute Expanded Text'),
+        ):
+            ResourceAttributeTypeFactory(
+                name=name, attribute_type=RAttributeTypeFactory(name=attribute_type)
+            )
+        cls.cluster_resource.resourceattribute_set.create(
+            resource_attribute_type=ResourceAttributeType.objects.get(name='slurm_cluster'),
+            value='test-cluster',
+        )
+
+    def setUp(self):
+        self.api = FakeClusterApi(
+            nodes=[node('holy1'), node('holy2')],
+            partitions=[partition('shared', groups='cluster_users'), partition('lab', accounts='poisson_lab')],
+            accounts=[account('poisson_lab', 'jdoe', 'ljbortkiewicz')],
+            shares=[
+                share_entry('root', ''), share_entry('poisson_lab', 'root', 1000),
+                share_entry('jdoe', 'poisson_lab', 400), share_entry('ljbortkiewicz', 'poisson_lab', 600),
+            ],
+        )
+        self.manager = ClusterResourceManager('test-cluster', slurm_api=self.api)
+
+
+class ClusterResourceManagerTest(SlurmrestTestCase):
+    """Tests for the node and partition imports of ClusterResourceManager"""
+
+    def test_node_import_skipped_when_unchanged(self):
+        """nodes are only written when slurmctld reports a change"""
+        self.manager.import_node_data()
+        holy1 = Resource.objects.get(name='holy1')
+        self.assertEqual(holy1.parent_resource, self.cluster_resource)
+        self.assertEqual(
+            holy1.resourceattribute_set.get(resource_attribute_type__name='Core Count').value, '48'
+        )
+        with mock.patch.object(self.manager, 'create_update_node_resources') as create_update:
+            self.manager.import_node_data()
+        create_update.assert_not_called()
+        self.assertEqual(self.api.update_times, [None, '1000'])
+        self.manager.import_node_data(full=True)
+        self.assertIsNone(self.api.update_times[-1])
+
+    def test_node_changes_written(self):
+        """changed node attributes are updated"""
+        self.manager.import_node_data()
+        self.api.nodes = [node('holy1', cores=64), node('holy2')]
+        self.api.last_update = 2000
+        self.manager.import_node_data()
+        self.assertEqual(
+            Resource.objects.get(name='holy1').resourceattribute_set.get(
+                resource_attribute_type__name='Core Count'
+            ).value,
+            '64',
+        )
+
+    def test_missing_nodes_retired(self):
+        """nodes gone from the cluster are made unavailable until they return"""
+        self.manager.import_node_data()
+        self.api.nodes = [node('holy1')]
+        self.api.last_update = 2000
+        self.manager.import_node_data()
+        holy2 = Resource.objects.get(name='holy2')
+        self.assertFalse(holy2.is_available)
+        self.assertTrue(
+            holy2.resourceattribute_set.filter(resource_attribute_type__name='ServiceEnd').exists()
+        )
+        self.assertEqual(self.manager.retire_node_resources({'holy1'}), [])
+        self.api.nodes = [node('holy1'), node('holy2')]
+        self.api.last_update = 3000
+        self.manager.import_node_data()
+        self.assertTrue(Resource.objects.get(name='holy2').is_available)
+        retired = self.manager.retire_node_resources({'holy2'})
+        self.assertEqual([resource.name for resource in retired], ['holy1'])
+        self.assertFalse(Resource.objects.get(name='holy1').is_available)
+
+    def test_partition_import_skipped_when_unchanged(self):
+        """partitions are refetched when they change or a cluster allocation is added"""
+        self.manager.import_partition_data()
+        self.manager.import_partition_data()
+        self.assertEqual(self.api.update_times, [None, '1000'])
+        allocation = AllocationFactory(project=self.project, justification='new compute')
+        allocation.resources.add(self.cluster_resource)
+        self.manager.import_partition_data()
+        self.assertIsNone(self.api.update_times[-1])
+
+    def test_partition_access_diff(self):
+        """allocations gain and lose partitions as the access lists change"""
+        self.manager.import_partition_data()
+        shared = Resource.objects.get(name='test-cluster:shared')
+        lab = Resource.objects.get(name='test-cluster:lab')
+        self.assertEqual(
+            set(self.cluster_allocation.resources.all()), {self.cluster_resource, shared, lab}
+        )
+        self.assertEqual(
+            shared.resourceattribute_set.get(
+                resource_attribute_type__name=SLURMREST_SPECS_ATTRIBUTE_NAME
+            ).value,
+            'CPU=1.0',
+        )
+        through = Allocation.resources.through
+        kept = through.objects.get(allocation=self.cluster_allocation, resource=shared).pk
+
+        self.api.partitions = [
+            partition('shared', groups='cluster_users'), partition('lab', accounts='other_lab'),
+        ]
+        self.api.last_update = 2000
+        self.manager.import_partition_data()
+        self.assertEqual(set(self.cluster_allocation.resources.all()), {self.cluster_resource, shared})
+        # the row of the unchanged partition is left in place
+        self.assertEqual(
+            through.objects.get(allocation=self.cluster_allocation, resource=shared).pk, kept
+        )
+
+
+class SlurmrestSyncTest(SlurmrestTestCase):
+    """Tests for the bulk slurmrest_sync reconciliation"""
+
+    def allocationuser(self, user):
+        return AllocationUser.objects.get(allocation=self.cluster_allocation, user=user)
+
+    def test_sync_creates_then_noop(self):
+        """the first sync adds and removes allocation users; a second writes nothing"""
+        changes = Command().sync_cluster(self.manager)
+        self.assertEqual(changes.summary['allocation users created'], 1)
+        self.assertEqual(changes.summary['allocation users removed'], 1)
+        self.assertEqual(self.allocationuser(self.nonproj_allocationuser).status.name, 'Removed')
+        jdoe = self.allocationuser(self.cluster_allocationuser)
+        self.assertEqual(jdoe.status.name, 'Active')
+        self.assertEqual(
+            AllocationUserAttribute.objects.get(
+                allocationuser=jdoe, allocationuser_attribute_type__name='RawUsage'
+            ).value,
+            '400',
+        )
+        allocation = Allocation.objects.get(pk=self.cluster_allocation.pk)
+        self.assertEqual(allocation.get_full_attribute('slurm_account_name').value, 'poisson_lab')
+        self.assertEqual(allocation.get_full_attribute('RawUsage').value, '1000')
+        self.assertFalse(Command().sync_cluster(self.manager))
+
+    def test_new_attributes_get_usages(self):
+        """attributes created for has_usage types get their usage, as save() would make"""
+        Command().sync_cluster(self.manager)
+        for attribute in AllocationAttribute.objects.filter(allocation=self.cluster_allocation):
+            self.assertEqual(
+                AllocationAttributeUsage.objects.filter(allocation_attribute=attribute).exists(),
+                attribute.allocation_attribute_type.has_usage,
+            )
+        self.assertTrue(AllocationAttributeType.objects.get(name='Core Usage (Hours)').has_usage)
+        self.assertTrue(AllocationAttributeUsage.objects.filter(
+            allocation_attribute__allocation=self.cluster_allocation,
+            allocation_attribute__allocation_attribute_type__name='Core Usage (Hours)',
+        ).exists())
+
+    def test_noop_leaves_allocation_users(self):
+        """with noop, allocation users are neither added nor removed"""
+        command = Command()
+        command.noop = True
+        changes = command.sync_cluster(self.manager)
+        self.assertEqual(changes.summary['allocation users created'], 0)
+        self.assertEqual(changes.summary['allocation users removed'], 0)
+        self.assertEqual(self.allocationuser(self.nonproj_allocationuser).status.name, 'Active')
+        self.assertFalse(AllocationUser.objects.filter(
+            allocation=self.cluster_allocation, user=self.cluster_allocationuser
+        ).exists())
+        # the allocation attributes are still synced
+        allocation = Allocation.objects.get(pk=self.cluster_allocation.pk)
+        self.assertEqual(allocation.get_full_attribute('RawUsage').value, '1000')
+
+    def test_removed_user_reactivated(self):
+        """a removed allocation user back in the account's associations is made Active"""
+        Command().sync_cluster(self.manager)
+        self.assertEqual(self.allocationuser(self.nonproj_allocationuser).status.name, 'Removed')
+        self.api.accounts = [account('poisson_lab', 'jdoe', 'ljbortkiewicz', 'jsaul')]
+        changes = Command().sync_cluster(self.manager)
+        self.assertEqual(changes.summary['allocation users updated'], 1)
+        jsaul = self.allocationuser(self.nonproj_allocationuser)
+        self.assertEqual(jsaul.status.name, 'Active')
+        self.assertEqual(jsaul.unit, 'CPU Hours')
+
+    def test_account_attributes_not_overwritten(self):
+        """the account name and core usage attributes are only set when missing"""
+        for name, value in (('slurm_account_name', 'poisson'), ('Core Usage (Hours)', '12')):
+            AllocationAttribute.objects.create(
+                allocation=self.cluster_allocation, value=value,
+                allocation_attribute_type=AllocationAttributeType.objects.get(name=name),
+            )
+        Command().sync_cluster(self.manager)
+        allocation = Allocation.objects.get(pk=self.cluster_allocation.pk)
+        self.assertEqual(allocation.get_full_attribute('slurm_account_name').value, 'poisson')
+        self.assertEqual(allocation.get_full_attribute('Core Usage (Hours)').value, '12')
+        self.assertEqual(allocation.get_full_attribute('Cloud Account Name').value, 'poisson_lab')
+
+    def test_missing_shares_logged(self):
+        """accounts and users without share data are synced without share attributes"""
+        self.api.shares = [share_entry('root', '')]
+        sync_logger = 'coldfront.plugins.slurmrest.management.commands.slurmrest_sync'
+        with self.assertLogs(sync_logger, level='WARNING') as logs:
+            Command().sync_cluster(self.manager)
+        self.assertIn('No share data found for account poisson_lab', '\n'.join(logs.output))
+        self.assertIn('No share data found for user jdoe', '\n'.join(logs.output))
+        jdoe = self.allocationuser(self.cluster_allocationuser)
+        self.assertFalse(jdoe.allocationuserattribute_set.exists())
+        allocation = Allocation.objects.get(pk=self.cluster_allocation.pk)
+        self.assertIsNone(allocation.get_full_attribute('RawUsage'))
+        self.assertEqual(allocation.get_full_attribute('slurm_account_name').value, 'poisson_lab')
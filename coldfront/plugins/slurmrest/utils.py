@@ -1,10 +1,19 @@
 import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
 from slurmrest_python import SlurmApi, SlurmdbApi, ApiClient, Configuration
 from coldfront.core.utils.common import import_from_settings
 
 
 SLURMREST_CLUSTERS = import_from_settings('SLURMREST_CLUSTERS', {})
 SLURMREST_NOOP = import_from_settings('SLURMREST_NOOP', False)
+# idle connections kept per cluster for the signal handlers
+SLURMREST_CONNECTION_POOL_SIZE = import_from_settings('SLURMREST_CONNECTION_POOL_SIZE', 4)
+# seconds a get_shares snapshot answers share lookups before it is fetched again
+SLURMREST_SHARE_CACHE_TTL = import_from_settings('SLURMREST_SHARE_CACHE_TTL', 60)
 
 logger = logging.getLogger(__name__)
 
@@ -16,6 +25,7 @@ class SlurmError(Exception):
 class SlurmApiConnection():
 
     def __init__(self, cluster_name):
+        self.cluster_name = cluster_name
         self.active_cluster = SLURMREST_CLUSTERS.get(cluster_name, None)
         assert self.active_cluster is not None, f"Unable to load cluster specs for {cluster_name} -- {SLURMREST_CLUSTERS.keys()}"
         self.configuration = self._return_configuration()
@@ -93,6 +103,8 @@ class SlurmApiConnection():
             noop=noop,
             **account_dict
         )
+        if not noop:
+            share_snapshots.invalidate(self.cluster_name, account_name)
         logger.info('added accounts: %s', response)
         return response
 
@@ -106,6 +118,8 @@ class SlurmApiConnection():
             noop=noop,
             **{'account_name': account_name}
         )
+        if not noop:
+            share_snapshots.invalidate(self.cluster_name, account_name)
         logger.info('removed account: %s', response)
         return response
 
@@ -143,6 +157,8 @@ class SlurmApiConnection():
             noop=noop,
             **{'v0041_openapi_assocs_resp':{'associations': associations}}
         )
+        if not noop:
+            share_snapshots.invalidate(self.cluster_name, account_name)
         logger.info('updated association: %s', response)
         return response
 
@@ -161,6 +177,8 @@ class SlurmApiConnection():
             noop=noop,
             **association_dict
         )
+        if not noop:
+            share_snapshots.invalidate(self.cluster_name, account_name)
         logger.info('added associations: %s', response)
         return response
 
@@ -191,6 +209,9 @@ class SlurmApiConnection():
             noop=noop,
             **args
         )
+        if not noop:
+            # without an account name, the whole snapshot is dropped
+            share_snapshots.invalidate(self.cluster_name, account_name)
         logger.info("deleted association: %s", args)
         return response
 
@@ -337,3 +358,135 @@ def calculate_fairshare_factor(normalized_share, effective_usage):
         return 0
     factor = 2 ** (-effective_usage / normalized_share)
     return factor
+
+
+def index_shares(shares):
+    """Index the entries of a get_shares share list for constant-time lookups.
+
+    Returns:
+        tuple[dict, dict]: the entries keyed by name, where the first entry of
+        a name wins as it would in a scan of the list, and the entries keyed
+        by (parent, name), which is how a user's share in an account is found
+    """
+    by_name = {}
+    by_parent = {}
+    for share in shares:
+        by_name.setdefault(share['name'], share)
+        by_parent.setdefault((share['parent'], share['name']), share)
+    return by_name, by_parent
+
+
+class SlurmApiConnectionPool:
+    """Idle SlurmApiConnections kept per cluster, so the signal handlers reuse
+    the API clients instead of building new ones for every signal.
+
+    Use as `with slurm_api_pool.connection(cluster_name) as api:`. At most
+    `size` idle connections are kept per cluster; connections checked out
+    beyond that are discarded when they are given back.
+    """
+
+    def __init__(self, size=SLURMREST_CONNECTION_POOL_SIZE):
+        self.size = size
+        self._idle = defaultdict(list)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self, cluster_name):
+        with self._lock:
+            idle = self._idle[cluster_name]
+            api = idle.pop() if idle else None
+        if api is None:
+            api = SlurmApiConnection(cluster_name)
+        try:
+            yield api
+        finally:
+            with self._lock:
+                if len(self._idle[cluster_name]) < self.size:
+                    self._idle[cluster_name].append(api)
+
+    def clear(self):
+        with self._lock:
+            self._idle.clear()
+
+
+class ShareSnapshotCache:
+    """Per-cluster snapshots of the get_shares share tree, indexed by
+    (account, user), for the signal handlers that look up one share at a time.
+
+    A snapshot answers lookups for `ttl` seconds, so a burst of signals costs
+    one get_shares call per cluster instead of one per signal. Writes made
+    through SlurmApiConnection invalidate the account they touched; the next
+    lookup in that account refetches only its shares, as does a lookup that
+    misses. Invalidating without an account drops the cluster's snapshot.
+    """
+
+    def __init__(self, ttl=SLURMREST_SHARE_CACHE_TTL, pool=None):
+        self.ttl = ttl
+        self.pool = pool
+        self._snapshots = {}
+        self._stale_accounts = defaultdict(set)
+        self._locks = defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+
+    def _cluster_lock(self, cluster_name):
+        with self._lock:
+            return self._locks[cluster_name]
+
+    def _fetch(self, cluster_name, accounts=None):
+        with (self.pool or slurm_api_pool).connection(cluster_name) as api:
+            shares = api.get_shares(accounts=accounts)['shares']['shares']
+        tree = defaultdict(dict)
+        for (parent, name), share in index_shares(shares)[1].items():
+            tree[parent][name] = share
+        return tree
+
+    def _refresh_account(self, cluster_name, account_name):
+        tree = self._snapshots[cluster_name][1]
+        # the account's users replace the old ones; its own entry is under its parent
+        account_tree = self._fetch(cluster_name, account_name)
+        tree[account_name] = account_tree.pop(account_name, {})
+        for parent, entries in account_tree.items():
+            tree[parent].update(entries)
+        self._stale_accounts[cluster_name].discard(account_name)
+
+    def get_share(self, cluster_name, account_name, user_name):
+        """Return the share entry of a user in an account, or None if Slurm
+        has no such association.
+
+        A user missing from a snapshot fetched before this lookup may have
+        been added since, so the account is refetched once before giving up.
+        """
+        # concurrent lookups of a cluster wait for a single fetch
+        with self._cluster_lock(cluster_name):
+            fetched = True
+            snapshot = self._snapshots.get(cluster_name)
+            if snapshot is None or time.monotonic() - snapshot[0] > self.ttl:
+                snapshot = (time.monotonic(), self._fetch(cluster_name))
+                self._snapshots[cluster_name] = snapshot
+                self._stale_accounts.pop(cluster_name, None)
+            elif account_name in self._stale_accounts[cluster_name]:
+                self._refresh_account(cluster_name, account_name)
+            else:
+                fetched = False
+            user_share = snapshot[1].get(account_name, {}).get(user_name)
+            if user_share is None and not fetched:
+                self._refresh_account(cluster_name, account_name)
+                user_share = snapshot[1].get(account_name, {}).get(user_name)
+            return user_share
+
+    def invalidate(self, cluster_name, account_name=None):
+        with self._cluster_lock(cluster_name):
+            if account_name is None:
+                self._snapshots.pop(cluster_name, None)
+                self._stale_accounts.pop(cluster_name, None)
+            elif cluster_name in self._snapshots:
+                self._stale_accounts[cluster_name].add(account_name)
+
+    def clear(self):
+        with self._lock:
+            self._snapshots.clear()
+            self._stale_accounts.clear()
+
+
+slurm_api_pool = SlurmApiConnectionPool()
+share_snapshots = ShareSnapshotCache()
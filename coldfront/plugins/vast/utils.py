@@ -1,8 +1,90 @@
+import logging
+
 from vastpy import VASTClient
-from coldfront.config.plugins.vast import VASTUSER, VASTPASS, VASTADDRESS
+
+from coldfront.config.plugins.vast import VASTUSER, VASTPASS, VASTADDRESS, VASTAUTHORIZER
+from coldfront.core.allocation.models import Allocation
+from coldfront.core.allocation.quota_sources import QuotaRecord, QuotaSource
+
+if VASTAUTHORIZER == 'AD':
+    from coldfront.plugins.ldap.utils import LDAPConn
+
+logger = logging.getLogger(__name__)
 
 client = VASTClient(
     address=VASTADDRESS,
     user=VASTUSER,
     password=VASTPASS,
 )
+
+
+class VastQuotaSource(QuotaSource):
+    """Group quotas of a VAST view, matched to allocations by project title.
+
+    The resource is named vast-<prefix>, where /<prefix> is the path the
+    quotas live under. vast_client and group_resolver default to the
+    configured VAST client and, for the AD authorizer, an LDAP gid lookup;
+    either can be replaced with a fake.
+    """
+
+    def __init__(self, resource, vast_client=None, group_resolver=None, timeout=None):
+        super().__init__(resource, timeout=timeout)
+        self.prefix = resource.name.removeprefix('vast-')
+        self.vast_client = vast_client or client
+        self.group_resolver = group_resolver
+
+    def resolve_gid(self, gid):
+        """Return the AD group name for a gid, or None."""
+        if self.group_resolver is None:
+            if VASTAUTHORIZER != 'AD':
+                return None
+            ad = LDAPConn()
+            self.group_resolver = lambda gid: next(iter(
+                result['sAMAccountName'][0] for result in
+                ad.search_groups({'gidNumber': gid}, attributes=['sAMAccountName'])
+            ), None)
+        return self.group_resolver(gid)
+
+    def list_quotas(self):
+        quotas = self.vast_client.userquotas.get(
+            entity__is_group=True,
+            path__startswith=f'/{self.prefix}'
+        )
+        group_names = {}
+        records = []
+        for quota_dict in quotas:
+            entity = quota_dict['entity']
+            if entity['identifier_type'] == 'gid':
+                gid = entity['identifier']
+                if gid not in group_names:
+                    group_names[gid] = self.resolve_gid(gid)
+                group_name = group_names[gid]
+                if group_name is None:
+                    logger.error("could not find matching AD group for quota_dict %s", quota_dict)
+                    continue
+            elif entity['identifier_type'] == 'groupname':
+                group_name = entity['identifier']
+            else:
+                logger.error("Unhandled identifier type: %s", entity['identifier_type'])
+                continue
+            used_bytes = quota_dict['used_capacity']
+            records.append(QuotaRecord(
+                path=quota_dict.get('path'),
+                group=group_name,
+                limit_bytes=quota_dict['hard_limit'],
+                used_bytes=used_bytes,
+                # a directory holding 1000 bytes or less counts as unused
+                used_tb=0 if used_bytes <= 1000 else None,
+            ))
+        return records
+
+    def allocations(self):
+        return Allocation.objects.filter(
+            resources=self.resource
+        ).select_related('project').with_attribute_snapshot()
+
+    def allocation_key(self, allocation):
+        return allocation.project.title
+
+    def record_key(self, record):
+        return record.group
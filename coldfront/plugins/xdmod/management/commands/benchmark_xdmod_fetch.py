@@ -0,0 +1,91 @@
+"""Time reading a large XDMoD usage table.
+
+Serves a synthetic per-user table of the requested number of rows from the
+fake XDMoD endpoint of the plugin's tests, then times and measures the peak
+memory of:
+- the previous fetch, which read the whole response text, tried to decode it
+  as json and built a full ElementTree;
+- the streaming fetch, which parses rows as they arrive;
+- the same fetch answered by a warm on-disk response cache.
+"""
+import json
+import shutil
+import tempfile
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+import requests
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.management.base import BaseCommand
+
+from coldfront.plugins.xdmod.tests import FakeXDModEndpoint
+from coldfront.plugins.xdmod.utils import XDModFetcher
+
+
+def legacy_fetch_table(url, payload):
+    """The way XDModFetcher.fetch_table read a table before it streamed"""
+    r = requests.get(url, params=payload)
+    try:
+        r.json()
+    except json.decoder.JSONDecodeError:
+        pass
+    rows = ET.fromstring(r.text).find('rows')
+    stats = {}
+    for row in rows:
+        cells = row.findall('cell')
+        stats[cells[0].find('value').text] = cells[1].find('value').text
+    return stats
+
+
+class Command(BaseCommand):
+    help = 'Benchmark fetching a large per-user XDMoD table from a local fake endpoint'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=50000,
+            help='number of rows in the synthetic table')
+        parser.add_argument('--rounds', type=int, default=3,
+            help='number of times each fetch is run; the best time is reported')
+
+    def measure(self, label, func, rounds):
+        best, result = None, None
+        for _ in range(rounds):
+            start = time.perf_counter()
+            result = func()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.stdout.write(f'{label:>16}: {best * 1000:9.1f}ms, peak {peak / 2**20:7.1f}MiB')
+        return best, result
+
+    def handle(self, *args, **options):
+        rows = [(f'user_{i}', f'{i * 1.5:.2f}') for i in range(options['rows'])]
+        rounds = options['rounds']
+        cache_dir = tempfile.mkdtemp()
+        try:
+            with FakeXDModEndpoint(lambda params: rows) as endpoint:
+                def fetch(cache):
+                    fetcher = XDModFetcher(resources=['bench'], cache=cache)
+                    fetcher.url = endpoint.url
+                    return fetcher.xdmod_fetch_cpu_hours('bench_lab', group_by='per-user')
+
+                payload = dict(XDModFetcher(resources=['bench'], cache=False).payload)
+                legacy = self.measure(
+                    'legacy', lambda: legacy_fetch_table(endpoint.url, payload), rounds
+                )
+                streaming = self.measure('streaming', lambda: fetch(False), rounds)
+                cache = FileBasedCache(cache_dir, {'TIMEOUT': 60})
+                fetch(cache)
+                cached = self.measure('cached', lambda: fetch(cache), rounds)
+        finally:
+            shutil.rmtree(cache_dir)
+
+        if not legacy[1] == streaming[1] == cached[1] == dict(rows):
+            self.stdout.write(self.style.ERROR('the fetched tables differ'))
+        self.stdout.write(self.style.SUCCESS(
+            f'streaming speedup: {legacy[0] / max(streaming[0], 1e-9):.2f}x, '
+            f'cached speedup: {legacy[0] / max(cached[0], 1e-9):.2f}x'
+        ))
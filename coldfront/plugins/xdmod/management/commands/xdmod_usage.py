@@ -1,14 +1,24 @@
 import logging
 import os
 import sys
-import urllib3
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
+import urllib3
 from django.core.management.base import BaseCommand
 from django.db.models import Q
 from django.contrib.auth import get_user_model
-
-from coldfront.core.allocation.models import Allocation, AllocationUserStatusChoice
+from simple_history.utils import bulk_create_with_history, bulk_update_with_history
+
+from coldfront.core.allocation.models import (
+    Allocation,
+    AllocationAttributeType,
+    AllocationUser,
+    AllocationUserStatusChoice,
+)
+from coldfront.core.allocation.utils import bulk_set_attribute_values_and_usages
 from coldfront.core.resource.models import Resource
+from coldfront.core.utils.common import PhaseTimer
 from coldfront.plugins.xdmod.utils import (XDMOD_ACCOUNT_ATTRIBUTE_NAME,
                                            XDMOD_CLOUD_CORE_TIME_ATTRIBUTE_NAME,
                                            XDMOD_CLOUD_PROJECT_ATTRIBUTE_NAME,
@@ -17,14 +27,43 @@ from coldfront.plugins.xdmod.utils import (XDMOD_ACCOUNT_ATTRIBUTE_NAME,
                                            XDMOD_RESOURCE_ATTRIBUTE_NAME,
                                            XDMOD_STORAGE_ATTRIBUTE_NAME,
                                            XDMOD_STORAGE_GROUP_ATTRIBUTE_NAME,
+                                           XDMOD_MAX_WORKERS,
                                            XdmodNotFoundError,
                                            XdmodJsonReturnError,
                                            XdmodNoRowsError,
-                                           XDModFetcher)
+                                           XDModFetcher,
+                                           XDModSession)
 
 logger = logging.getLogger(__name__)
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# how --bulk harvests each statistic: the XDMoD statistic, realm and grouping
+# of the usage table, the allocation attributes holding the XDMoD account and
+# the usage, the divisor of the XDMoD values, whether the usage is also
+# written as the attribute value, and whether per-user usage is harvested
+HarvestSpec = namedtuple('HarvestSpec', [
+    'statistic', 'realm', 'group_by', 'account_attribute', 'usage_attribute',
+    'divisor', 'set_value', 'per_user',
+])
+HARVEST_SPECS = {
+    'total_cpu_hours': HarvestSpec(
+        'total_cpu_hours', 'Jobs', 'pi', XDMOD_ACCOUNT_ATTRIBUTE_NAME,
+        XDMOD_CPU_HOURS_ATTRIBUTE_NAME, 1, True, True,
+    ),
+    'total_acc_hours': HarvestSpec(
+        'total_gpu_hours', 'Jobs', 'pi', XDMOD_ACCOUNT_ATTRIBUTE_NAME,
+        XDMOD_ACC_HOURS_ATTRIBUTE_NAME, 1, False, False,
+    ),
+    'total_storage': HarvestSpec(
+        'avg_physical_usage', 'Storage', 'pi', XDMOD_STORAGE_GROUP_ATTRIBUTE_NAME,
+        XDMOD_STORAGE_ATTRIBUTE_NAME, 1E9, False, False,
+    ),
+    'cloud_core_time': HarvestSpec(
+        'cloud_core_time', 'Cloud', 'project', XDMOD_CLOUD_PROJECT_ATTRIBUTE_NAME,
+        XDMOD_CLOUD_CORE_TIME_ATTRIBUTE_NAME, 1, False, False,
+    ),
+}
+
 
 class Command(BaseCommand):
     help = 'Sync usage data from XDMoD to ColdFront'
@@ -35,6 +74,9 @@ class Command(BaseCommand):
     sync = False
     print_header = False
     fetch_expired = False
+    session = None
+    cache = True
+    workers = XDMOD_MAX_WORKERS
 
     def add_arguments(self, parser):
         parser.add_argument("-r", "--resource",
@@ -54,6 +96,14 @@ class Command(BaseCommand):
             default='total_cpu_hours')
         parser.add_argument("--expired",
             help="XDMoD statistic for archived projects", action="store_true")
+        parser.add_argument("--bulk",
+            help="Fetch each usage table once per resource set and update in bulk",
+            action="store_true")
+        parser.add_argument("--workers", type=int, default=XDMOD_MAX_WORKERS,
+            help="Number of concurrent XDMoD requests")
+        parser.add_argument("--no-cache",
+            help="Fetch from XDMoD even if the response cache has the data",
+            action="store_true")
 
     def write(self, data):
         try:
@@ -70,10 +120,17 @@ class Command(BaseCommand):
                 XDMOD_RESOURCE_ATTRIBUTE_NAME)
         return rname
 
+    def resource_xdmod_name(self, resource):
+        """Return the XDMoD name of a resource, looked up once per resource."""
+        names = self.__dict__.setdefault('_xdmod_names', {})
+        if resource.pk not in names:
+            names[resource.pk] = self.run_resource_checks(resource)
+        return names[resource.pk]
+
     def id_allocation_resources(self, s):
         resources = []
         for r in s.resources.all():
-            rname = self.run_resource_checks(r)
+            rname = self.resource_xdmod_name(r)
             if self.filter_resource and self.filter_resource != rname:
                 continue
             resources.append(rname)
@@ -102,10 +159,9 @@ class Command(BaseCommand):
             )
 
         allocations = (
-            allocations.select_related('project')
-                .prefetch_related(
-                    'resources', 'allocationattribute_set', 'allocationuser_set'
-                )
+            allocations.select_related('project', 'project__pi')
+                .prefetch_related('resources', 'allocationuser_set')
+                .with_attribute_snapshot()
                 .filter(resources__in=cleared_resources)
             )
         if self.fetch_expired:
@@ -161,7 +217,7 @@ class Command(BaseCommand):
 
             resources = self.id_allocation_resources(s)
 
-            fetcher = XDModFetcher(resources=resources)
+            fetcher = XDModFetcher(resources=resources, session=self.session, cache=self.cache)
             try:
                 usage = fetcher.xdmod_fetch_storage(
                     account_name, statistic='avg_physical_usage'
@@ -217,7 +273,7 @@ class Command(BaseCommand):
 
             resources = self.id_allocation_resources(s)
 
-            fetcher = XDModFetcher(resources=resources)
+            fetcher = XDModFetcher(resources=resources, session=self.session, cache=self.cache)
             try:
                 usage = fetcher.xdmod_fetch_cpu_hours(
                         account_name, statistics='total_gpu_hours'
@@ -279,7 +335,7 @@ class Command(BaseCommand):
 
             resources = self.id_allocation_resources(s)
 
-            fetcher = XDModFetcher(resources=resources)
+            fetcher = XDModFetcher(resources=resources, session=self.session, cache=self.cache)
             try:
                 usage = fetcher.xdmod_fetch_cpu_hours(account_name)
             except XdmodJsonReturnError as e:
@@ -373,7 +429,7 @@ class Command(BaseCommand):
                 continue
             resources = self.id_allocation_resources(s)
 
-            fetcher = XDModFetcher(resources=resources)
+            fetcher = XDModFetcher(resources=resources, session=self.session, cache=self.cache)
             try:
                 usage = fetcher.xdmod_fetch_cloud_core_time(project_name)
             except XdmodNotFoundError:
@@ -397,6 +453,162 @@ class Command(BaseCommand):
                 str(usage),
             ]))
 
+    def process_bulk(self, statistic):
+        """Harvest a statistic with one XDMoD request per distinct set of
+        resources, plus the per-account user tables for CPU hours, and apply
+        the usages with bulk writes.
+        """
+        spec = HARVEST_SPECS[statistic]
+        account_header = 'project' if spec.group_by == 'project' else 'account'
+        header = [
+            'allocation_id',
+            'pi',
+            account_header,
+            'resources',
+            f'max_{spec.usage_attribute}',
+            statistic,
+        ]
+        if self.print_header:
+            self.write('\t'.join(header))
+
+        timer = PhaseTimer()
+        with timer.phase('load'):
+            allocations = Allocation.objects.filter(
+                allocationattribute__allocation_attribute_type__name__in=[
+                    spec.account_attribute, spec.usage_attribute,
+                ]
+            )
+            allocations = self.filter_allocations(
+                allocations, account_attr_name=spec.account_attribute
+            ).distinct()
+            items = []
+            for s in allocations:
+                account_name = self.attribute_check(s, spec.account_attribute)
+                limit = self.attribute_check(s, spec.usage_attribute, num=True)
+                if None in [account_name, limit]:
+                    continue
+                resources = tuple(sorted(self.id_allocation_resources(s)))
+                items.append((s, account_name, resources, limit))
+
+        with timer.phase('fetch'):
+            tables = {}
+            for resources in {item[2] for item in items}:
+                fetcher = XDModFetcher(resources=list(resources), session=self.session, cache=self.cache)
+                try:
+                    tables[resources] = fetcher.xdmod_fetch_all_usages(
+                        spec.statistic, realm=spec.realm, group_by=spec.group_by
+                    )
+                except XdmodNotFoundError as e:
+                    logger.warning(
+                        "No XDMoD %s data found for resources %s: %s",
+                        spec.statistic, resources, e
+                    )
+                    tables[resources] = {}
+
+            usages, no_xdmodrows = [], []
+            for s, account_name, resources, limit in items:
+                usage = tables[resources].get(account_name)
+                if usage is None:
+                    no_xdmodrows.append([s, account_name, resources])
+                    continue
+                usages.append((s, account_name, resources, limit, float(usage) / spec.divisor))
+            if no_xdmodrows:
+                logger.warning("XDmod rows not found for the following items: %s", no_xdmodrows)
+
+            user_usages = {}
+            if spec.per_user:
+                def fetch_user_usages(key):
+                    resources, account_name = key
+                    fetcher = XDModFetcher(resources=list(resources), session=self.session, cache=self.cache)
+                    try:
+                        return key, fetcher.xdmod_fetch_cpu_hours(account_name, group_by='per-user')
+                    except XdmodNotFoundError as e:
+                        logger.warning(
+                            "No XDMoD per-user data found for account %s resources %s: %s",
+                            account_name, resources, e
+                        )
+                        return key, None
+                keys = {(resources, account_name) for _, account_name, resources, _, _ in usages}
+                # the requests only wait on XDMoD and use no database connection
+                with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                    user_usages = dict(executor.map(fetch_user_usages, keys))
+
+        with timer.phase('update'):
+            if user_usages:
+                self.update_allocation_users([
+                    (s, user_usages[(resources, account_name)])
+                    for s, account_name, resources, _, _ in usages
+                    if user_usages[(resources, account_name)] is not None
+                ])
+            if self.sync:
+                attribute_type = AllocationAttributeType.objects.get(name=spec.usage_attribute)
+                bulk_set_attribute_values_and_usages([
+                    (
+                        s, attribute_type,
+                        usage if spec.set_value else s.get_attribute(spec.usage_attribute, typed=False),
+                        usage if attribute_type.has_usage else None,
+                    )
+                    for s, _, _, _, usage in usages
+                ], change_reason='xdmod usage sync')
+
+        for s, account_name, resources, limit, usage in usages:
+            self.write('\t'.join([
+                str(s.id),
+                s.project.pi.username,
+                account_name,
+                ','.join(resources),
+                str(limit),
+                str(usage),
+            ]))
+        return timer
+
+    def update_allocation_users(self, allocation_usages):
+        """Set the usage of the AllocationUsers of each (allocation, per-user
+        usage dict) pair, zeroing users absent from the usage and adding the
+        missing ones.
+        """
+        allocation_users = {}
+        for allocation_user in AllocationUser.objects.filter(
+            allocation__in=[s for s, _ in allocation_usages]
+        ).select_related('user'):
+            allocation_users.setdefault(allocation_user.allocation_id, {})[
+                allocation_user.user.username
+            ] = allocation_user
+        usernames = {username for _, usage_data in allocation_usages for username in usage_data}
+        users = {
+            user.username: user
+            for user in get_user_model().objects.filter(username__in=usernames)
+        }
+        auser_status_active = AllocationUserStatusChoice.objects.get(name='Active')
+
+        to_update, to_create = [], []
+        for s, usage_data in allocation_usages:
+            existing = allocation_users.get(s.pk, {})
+            for username, allocation_user in existing.items():
+                user_usage = float(usage_data.get(username, 0))
+                if allocation_user.usage != user_usage:
+                    allocation_user.usage = user_usage
+                    to_update.append(allocation_user)
+            for username, user_usage in usage_data.items():
+                if username in existing:
+                    continue
+                if username not in users:
+                    # if user not present, add to ifx
+                    logger.warning("user missing from ifx: %s", username)
+                    continue
+                to_create.append(AllocationUser(
+                    allocation=s, user=users[username], usage=user_usage,
+                    unit='CPU Hours', status=auser_status_active,
+                ))
+        bulk_update_with_history(
+            to_update, AllocationUser, ['usage'], batch_size=500,
+            default_change_reason='xdmod usage sync',
+        )
+        bulk_create_with_history(
+            to_create, AllocationUser, batch_size=500,
+            default_change_reason='xdmod usage sync',
+        )
+
     def handle(self, *args, **options):
         # print("Calling handle")
         if options['sync']:
@@ -404,40 +616,43 @@ class Command(BaseCommand):
             logger.warning("Syncing ColdFront with XDMoD")
 
         filters = {
-            'username': self.filter_user,
-            'account': self.filter_account,
-            'project': self.filter_project,
-            'resource': self.filter_resource,
+            'username': 'filter_user',
+            'account': 'filter_account',
+            'project': 'filter_project',
+            'resource': 'filter_resource',
         }
-        # print(filters.items())
-        if options['resource']:
-            self.filter_resource = options['resource']
-
         for filter_name, filter_attr in filters.items():
             if options[filter_name]:
                 logger.info("Filtering output by %s: %s", filter_name, options[filter_name])
-                filter_attr = options[filter_name]
+                setattr(self, filter_attr, options[filter_name])
 
         bool_opts = {
-            'header':self.print_header,
-            'expired':self.fetch_expired,
+            'header': 'print_header',
+            'expired': 'fetch_expired',
         }
         for opt, attribute in bool_opts.items():
             if options[opt]:
-                attribute = True
+                setattr(self, attribute, True)
+        self.cache = not options['no_cache']
 
         statistic = 'total_cpu_hours'
         if options['statistic']:
             statistic = options['statistic']
 
-        if statistic == 'total_cpu_hours':
-            self.process_total_cpu_hours()
-        elif statistic == 'cloud_core_time':
-            self.process_cloud_core_time()
-        elif statistic == 'total_acc_hours':
-            self.process_total_gpu_hours()
-        elif statistic == 'total_storage':
-            self.process_total_storage()
-        else:
-            logger.error("Unsupported XDMoD statistic")
-            sys.exit(1)
+        self.workers = options['workers']
+        with XDModSession(self.workers) as self.session:
+            if options['bulk'] and statistic in HARVEST_SPECS:
+                timer = self.process_bulk(statistic)
+                logger.info("bulk harvest phases: %s", timer.summary())
+            elif statistic == 'total_cpu_hours':
+                self.process_total_cpu_hours()
+            elif statistic == 'cloud_core_time':
+                self.process_cloud_core_time()
+            elif statistic == 'total_acc_hours':
+                self.process_total_gpu_hours()
+            elif statistic == 'total_storage':
+                self.process_total_storage()
+            else:
+                logger.error("Unsupported XDMoD statistic")
+                sys.exit(1)
+            logger.info("%s XDMoD requests issued", self.session.requests)
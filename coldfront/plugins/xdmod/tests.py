@@ -0,0 +1,148 @@
+'''tests for the XDMoD plugin'''
+import json
+import shutil
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+from django.core.cache.backends.filebased import FileBasedCache
+from django.test import SimpleTestCase
+
+from coldfront.plugins.xdmod.utils import (
+    XdmodJsonReturnError,
+    XdmodNoRowsError,
+    XDModFetcher,
+    XDModSession,
+)
+
+
+def xdmod_table_xml(rows):
+    """Yield the chunks of an XDMoD XML dataset with the (name, value) rows."""
+    yield (
+        '<?xml version="1.0" encoding="UTF-8"?>\n<xdmod-xml-dataset><header>'
+        '<headers><header>name</header><header>statistic</header></headers>'
+        '</header><rows>'
+    ).encode()
+    for name, value in rows:
+        yield (
+            f'<row><cell><value>{name}</value></cell>'
+            f'<cell><value>{value}</value></cell></row>'
+        ).encode()
+    yield b'</rows></xdmod-xml-dataset>'
+
+
+class FakeXDModEndpoint:
+    """A local HTTP server standing in for the XDMoD usage endpoint.
+
+    respond(params) returns the (name, value) rows for the query parameters,
+    or a dict to return as a json error. Every query is recorded in `queries`.
+
+    Use as a context manager; point an XDModFetcher at it with
+    `fetcher.url = endpoint.url`.
+    """
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.queries = []
+        endpoint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            wbufsize = 64 * 1024
+
+            def do_GET(self):
+                params = dict(parse_qsl(urlparse(self.path).query))
+                endpoint.queries.append(params)
+                result = endpoint.respond(params)
+                self.send_response(200)
+                if isinstance(result, dict):
+                    body = [json.dumps(result).encode()]
+                    self.send_header('Content-Type', 'application/json')
+                else:
+                    body = xdmod_table_xml(result)
+                    self.send_header('Content-Type', 'text/xml')
+                self.end_headers()
+                for chunk in body:
+                    self.wfile.write(chunk)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/controllers/user_interface.php'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def person_rows(params):
+    if params.get('group_by') == 'person':
+        return [('alice', '10.5'), ('bob', '2')]
+    if params.get('pi_filter') == '"empty_lab"':
+        return []
+    if params.get('pi_filter') == '"broken_lab"':
+        return {'success': False, 'message': 'Invalid filter value'}
+    return [('jdoe_lab', '12.5')]
+
+
+class XDModFetcherTest(SimpleTestCase):
+
+    def setUp(self):
+        self.endpoint = FakeXDModEndpoint(person_rows).__enter__()
+        self.addCleanup(self.endpoint.__exit__)
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        self.cache = FileBasedCache(self.cache_dir, {'TIMEOUT': 60})
+
+    def fetcher(self, **kwargs):
+        kwargs.setdefault('cache', self.cache)
+        fetcher = XDModFetcher(resources=['cluster'], **kwargs)
+        fetcher.url = self.endpoint.url
+        return fetcher
+
+    def test_fetch_value_and_table(self):
+        fetcher = self.fetcher()
+        self.assertEqual(fetcher.xdmod_fetch_cpu_hours('jdoe_lab'), '12.5')
+        self.assertEqual(
+            fetcher.xdmod_fetch_cpu_hours('jdoe_lab', group_by='per-user'),
+            {'alice': '10.5', 'bob': '2'},
+        )
+        self.assertEqual(self.endpoint.queries[0]['resource_filter'], '"cluster"')
+
+    def test_errors(self):
+        fetcher = self.fetcher()
+        with self.assertRaises(XdmodNoRowsError):
+            fetcher.xdmod_fetch_cpu_hours('empty_lab')
+        with self.assertRaises(XdmodJsonReturnError):
+            fetcher.xdmod_fetch_cpu_hours('broken_lab')
+
+    def test_responses_are_cached(self):
+        with XDModSession() as session:
+            self.fetcher(session=session).xdmod_fetch_cpu_hours('jdoe_lab')
+            self.fetcher(session=session).xdmod_fetch_cpu_hours('jdoe_lab')
+            # empty results are cached too, errors are not
+            for _ in range(2):
+                with self.assertRaises(XdmodNoRowsError):
+                    self.fetcher(session=session).xdmod_fetch_cpu_hours('empty_lab')
+                with self.assertRaises(XdmodJsonReturnError):
+                    self.fetcher(session=session).xdmod_fetch_cpu_hours('broken_lab')
+            self.assertEqual(session.requests, 4)
+        self.assertEqual(len(self.endpoint.queries), 4)
+
+        self.fetcher(cache=False).xdmod_fetch_cpu_hours('jdoe_lab')
+        self.assertEqual(len(self.endpoint.queries), 5)
+
+    def test_cache_key_ignores_payload_order(self):
+        fetcher = self.fetcher()
+        self.assertEqual(
+            fetcher.cache_key({'a': '1', 'b': '2'}), fetcher.cache_key({'b': '2', 'a': ' 1'})
+        )
+        self.assertNotEqual(
+            fetcher.cache_key({'a': '1'}), fetcher.cache_key({'a': '2'})
+        )
@@ -1,8 +1,13 @@
+import hashlib
 import logging
 import json
+import threading
 import xml.etree.ElementTree as ET
+from itertools import chain
 
 import requests
+from django.core.cache.backends.filebased import FileBasedCache
+from requests.adapters import HTTPAdapter
 
 from coldfront.core.utils.common import import_from_settings
 from coldfront.core.utils.fasrc import get_quarter_start_end
@@ -28,9 +33,18 @@ XDMOD_STORAGE_ATTRIBUTE_NAME = import_from_settings(
 XDMOD_STORAGE_GROUP_ATTRIBUTE_NAME = import_from_settings(
     'XDMOD_STORAGE_GROUP_ATTRIBUTE_NAME', 'Storage_Group_Name')
 
-XDMOD_API_URL = import_from_settings('XDMOD_API_URL')
+# set by coldfront.config.plugins.xdmod; the defaults let the module import
+# without the plugin enabled
+XDMOD_API_URL = import_from_settings('XDMOD_API_URL', '')
 
-XDMOD_VERIFY = import_from_settings('XDMOD_VERIFY')
+XDMOD_VERIFY = import_from_settings('XDMOD_VERIFY', True)
+
+# concurrent requests made by a bulk xdmod_usage harvest
+XDMOD_MAX_WORKERS = import_from_settings('XDMOD_MAX_WORKERS', 8)
+
+# directory of the on-disk XDMoD response cache; empty disables the cache
+XDMOD_CACHE_DIR = import_from_settings('XDMOD_CACHE_DIR', '')
+XDMOD_CACHE_TTL = import_from_settings('XDMOD_CACHE_TTL', 60 * 60 * 6)
 
 _ENDPOINT_CORE_HOURS = '/controllers/user_interface.php'
 
@@ -60,11 +74,59 @@ class XdmodJsonReturnError(XdmodNotFoundError):
 class XdmodNoRowsError(XdmodNotFoundError):
     pass
 
+class XDModSession:
+    """A requests.Session with a connection pool sized for concurrent use,
+    shared by the XDModFetchers of one harvest, that counts the requests
+    it issues.
+    """
+
+    def __init__(self, pool_size=XDMOD_MAX_WORKERS):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def get(self, url, **kwargs):
+        with self._lock:
+            self.requests += 1
+        return self.session.get(url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def xdmod_response_cache():
+    """Return the on-disk XDMoD response cache, or None if XDMOD_CACHE_DIR
+    is not set.
+    """
+    if not XDMOD_CACHE_DIR:
+        return None
+    return FileBasedCache(XDMOD_CACHE_DIR, {'TIMEOUT': XDMOD_CACHE_TTL})
+
+
 class XDModFetcher:
-    def __init__(self, start=QUARTER_START, end=QUARTER_END, resources=None):
+    def __init__(
+        self, start=QUARTER_START, end=QUARTER_END, resources=None, session=None, cache=True
+    ):
+        """
+        Params:
+            session (XDModSession): session to issue the requests through
+            cache: True for the XDMOD_CACHE_DIR response cache, False for none,
+                or a Django cache to keep the parsed responses in
+        """
         self.url = f'{XDMOD_API_URL}{_ENDPOINT_CORE_HOURS}'
         self.resources = resources
-        payload = _DEFAULT_PARAMS
+        self.session = session
+        self.cache = xdmod_response_cache() if cache is True else cache or None
+        payload = dict(_DEFAULT_PARAMS)
         payload['start_date'] = start
         payload['end_date'] = end
         if resources:
@@ -72,50 +134,84 @@ class XDModFetcher:
         self.payload = payload
         self.group_by = {'total':'pi', 'per-user':'person'}
 
-    def fetch_data(self, payload, search_item=None):
-        r = requests.get(self.url, params=payload, verify=XDMOD_VERIFY)
-        logger.info(r.url)
-        logger.info(r.text)
+    def cache_key(self, payload):
+        """return the response cache key of a request, which is the same for
+        any ordering of the payload
+        """
+        normalized = json.dumps(
+            [self.url, sorted((k, str(v).strip()) for k, v in payload.items())]
+        )
+        return f'xdmod:{hashlib.sha256(normalized.encode()).hexdigest()}'
 
-        try:
-            error = r.json()
+    def iter_rows(self, response):
+        """parse the XML of a response as it streams in, yielding the (name,
+        value) pair of each row and discarding the row once it is read.
+        """
+        chunks = response.iter_content(chunk_size=64 * 1024)
+        first = b''
+        for chunk in chunks:
+            first += chunk
+            if first.strip():
+                break
+        if first.lstrip()[:1] in (b'{', b'['):
+            # XDMoD reports errors as json
+            body = first + b''.join(chunks)
+            try:
+                error = json.loads(body)
+            except ValueError as e:
+                raise XdmodError(f'Invalid XML data returned from XDMoD API: {e}') from e
             raise XdmodJsonReturnError(f'Got json response but expected XML: {error}')
-        except json.decoder.JSONDecodeError:
-            pass
 
+        parser = ET.XMLPullParser(events=('end',))
+        values = []
         try:
-            root = ET.fromstring(r.text)
-        except ET.ParserError as e:
+            for chunk in chain([first], chunks):
+                parser.feed(chunk)
+                for _, element in parser.read_events():
+                    tag = element.tag
+                    if tag == 'value':
+                        values.append(element.text)
+                    elif tag == 'row':
+                        if len(values) < 2:
+                            raise XdmodError('Invalid XML data returned from XDMoD API: Cells not found')
+                        yield values[0], values[1]
+                        values = []
+                        element.clear()
+                    elif tag != 'cell':
+                        values = []
+            parser.close()
+        except ET.ParseError as e:
             raise XdmodError(f'Invalid XML data returned from XDMoD API: {e}') from e
 
-        rows = root.find('rows')
-        if len(rows) < 1:
+    def fetch_data(self, payload, search_item=None):
+        """return the (name, value) pairs of the rows XDMoD returns for the
+        payload, read from the response cache while it holds a fresh copy.
+        """
+        key = self.cache_key(payload)
+        rows = self.cache.get(key) if self.cache else None
+        if rows is None:
+            get = self.session.get if self.session else requests.get
+            with get(self.url, params=payload, verify=XDMOD_VERIFY, stream=True) as r:
+                logger.info(r.url)
+                rows = list(self.iter_rows(r))
+            if self.cache:
+                self.cache.set(key, rows)
+
+        if not rows:
             raise XdmodNoRowsError(
-                f'Rows not found for {search_item} - {self.payload["resource_filter"]}'
+                f'Rows not found for {search_item} - {self.payload.get("resource_filter")}'
             )
         return rows
 
     def fetch_value(self, payload, search_item=None):
         rows = self.fetch_data(payload, search_item=search_item)
-        cells = rows.find('row').findall('cell')
-        if len(cells) != 2:
-            raise XdmodError('Invalid XML data returned from XDMoD API: Cells not found')
-        stats = cells[1].find('value').text
-        return stats
+        return rows[0][1]
 
     def fetch_table(self, payload, search_item=None):
         """make a dictionary of usernames and their associated core hours from
         XML data.
         """
-        # return rows extracted from XML data
-        rows = self.fetch_data(payload, search_item=search_item)
-        # Produce a dict of usernames and their associated core hours from those rows
-        stats = {}
-        for row in rows:
-            cells = row.findall('cell')
-            username = cells[0].find('value').text
-            stats[username] = cells[1].find('value').text
-        return stats
+        return dict(self.fetch_data(payload, search_item=search_item))
 
     def xdmod_fetch(self, account, statistic, realm, group_by='total'):
         """fetch either total or per-user usage stats for specified project"""
@@ -132,14 +228,19 @@ class XDModFetcher:
             raise Exception('unrecognized group_by value')
         return core_hours
 
-    def xdmod_fetch_all_project_usages(self, statistic):
-        """return usage statistics for all projects"""
+    def xdmod_fetch_all_usages(self, statistic, realm='Jobs', group_by='pi'):
+        """return a dict of every group_by item (pi, project or person) and
+        its usage statistic, fetched in one request
+        """
         payload = dict(self.payload)
-        payload['group_by'] = 'pi'
-        payload['realm'] = 'Jobs'
+        payload['group_by'] = group_by
+        payload['realm'] = realm
         payload['statistic'] = statistic
-        stats = self.fetch_table(payload)
-        return stats
+        return self.fetch_table(payload)
+
+    def xdmod_fetch_all_project_usages(self, statistic):
+        """return usage statistics for all projects"""
+        return self.xdmod_fetch_all_usages(statistic)
 
     def xdmod_fetch_cpu_hours(self, account, group_by='total', statistics='total_cpu_hours'):
         """fetch either total or per-user cpu hours"""